@@ -10,6 +10,7 @@ if raw_path not in os.sys.path:
 
 import bioxtasraw.RAWAPI as raw
 import bioxtasraw.SASCalc as SASCalc
+import bioxtasraw.DENSS as DENSS
 
 @pytest.mark.atsas
 def test_ambimeter(gi_gnom_ift):
@@ -226,6 +227,54 @@ def test_denss(gi_gnom_ift, temp_directory):
     assert np.allclose(support_vol, 381174.8969421387)
     assert np.allclose(I_fit.sum(), 0.1419790665740152)
 
+@pytest.mark.very_slow
+def test_denss_ensemble(gi_gnom_ift, temp_directory):
+    (rhos, sides, chi_sq, rg, support_vol, average_rho, mean_cor, std_cor,
+        threshold, res, scores, fsc) = raw.denss_ensemble(gi_gnom_ift,
+        'denss_ens', temp_directory, nruns=4, n_proc=2, mode='Fast', seed=1)
+
+    assert len(rhos) == 4
+    assert np.allclose(chi_sq[0], 0.8973733889747175)
+    assert np.allclose(rg[0], 34.28961149550543)
+    assert len(scores) == 4
+    assert os.path.exists(os.path.join(temp_directory, 'denss_ens_04.mrc'))
+    assert os.path.exists(os.path.join(temp_directory, 'denss_ens_average.mrc'))
+    assert os.path.exists(os.path.join(temp_directory, 'denss_ens_fsc.dat'))
+
+    assert not os.path.exists(os.path.join(temp_directory,
+        'denss_ens_01_checkpoint.npz'))
+
+def test_denss_ensemble_checkpoints(gi_gnom_ift, temp_directory):
+    (q, I, sigq, D, q_raw, i_raw, err_raw,
+        denss_settings) = raw._get_denss_input(gi_gnom_ift, mode='Fast')
+
+    ensemble = DENSS.DenssEnsemble(q, I, sigq, D, q_raw, i_raw, err_raw,
+        'denss_ens', temp_directory, denss_settings, 4, resume=True)
+
+    result = (q, I, sigq, q, I, np.ones(5), np.arange(5.), np.arange(5.),
+        np.ones((4, 4, 4)), 100., I, 0.9)
+
+    ensemble._save_checkpoint(0, result)
+
+    loaded = ensemble._load_checkpoint(0)
+
+    assert loaded[9] == 100.
+    assert np.all(loaded[8] == result[8])
+
+    new_settings = dict(denss_settings, electrons=20000)
+
+    new_ensemble = DENSS.DenssEnsemble(q, I, sigq, D, q_raw, i_raw, err_raw,
+        'denss_ens', temp_directory, new_settings, 4, resume=True)
+
+    assert new_ensemble._load_checkpoint(0) is None
+
+    new_ensemble = DENSS.DenssEnsemble(q, 2*I, sigq, D, q_raw, i_raw,
+        err_raw, 'denss_ens', temp_directory, denss_settings, 4, resume=True)
+
+    assert new_ensemble._load_checkpoint(0) is None
+
+    os.remove(ensemble.checkpoint_file(0))
+
 @pytest.mark.very_slow
 def test_denss_average(temp_directory):
     fnames = ['./data/denss_data/glucose_isomerase_{:02d}.mrc'.format(i)
@@ -266,6 +315,22 @@ def test_denss_average_single_proc(temp_directory):
     assert os.path.exists(os.path.join(temp_directory, 'denss_fsc.dat'))
     assert os.path.exists(os.path.join(temp_directory, 'denss_average.mrc'))
 
+@pytest.mark.very_slow
+def test_denss_average_fft(temp_directory):
+    fnames = ['./data/denss_data/glucose_isomerase_{:02d}.mrc'.format(i)
+        for i in range(1, 5)]
+
+    rhos, sides = raw.load_mrc(fnames)
+
+    (average_rho, mean_cor, std_cor, threshold, res, scores,
+        fsc) = raw.denss_average(np.array(rhos), sides[0], 'denss',
+        temp_directory, n_proc=1, align_method='fft')
+
+    assert np.isclose(average_rho.sum(), 11.779369592666626)
+    assert mean_cor > 0.93
+    assert res <= 36.3
+    assert os.path.exists(os.path.join(temp_directory, 'denss_average.mrc'))
+
 @pytest.mark.very_slow
 def test_denss_align(temp_directory):
     rhos, sides = raw.load_mrc(['./data/denss_data/glucose_isomerase_01.mrc'])
@@ -285,3 +350,14 @@ def test_denss_align_single_proc(temp_directory):
 
     assert np.isclose(score, 0.8464630033326552)
     assert np.isclose(aligned_density.sum(), 11.779369354248047)
+
+@pytest.mark.very_slow
+def test_denss_align_fft(temp_directory):
+    rhos, sides = raw.load_mrc(['./data/denss_data/glucose_isomerase_01.mrc'])
+
+    aligned_density, score = raw.denss_align(rhos[0], sides[0], '1XIB_4mer.pdb',
+        './data/dammif_data/', save_datadir=temp_directory, n_proc=1,
+        align_method='fft')
+
+    assert score > 0.8
+    assert np.isclose(aligned_density.sum(), 11.779369354248047)
@@ -1,6 +1,11 @@
 import os
+import sys
 import copy
 import shutil
+import platform
+import gc
+import weakref
+import multiprocessing
 
 import pytest
 import numpy as np
@@ -10,6 +15,10 @@ if raw_path not in os.sys.path:
     os.sys.path.append(raw_path)
 
 import bioxtasraw.RAWAPI as raw
+import bioxtasraw.BIFT as BIFT
+import bioxtasraw.DENSS as DENSS
+import bioxtasraw.SASProc as SASProc
+import bioxtasraw.SASCalc as SASCalc
 
 def test_auto_guinier(clean_gi_sub_profile):
     profile = copy.deepcopy(clean_gi_sub_profile)
@@ -29,6 +38,54 @@ def test_auto_guinier(clean_gi_sub_profile):
     assert idx_max == 50
     assert r_sqr == 00.9942014318763518
 
+def test_auto_guinier_batch(clean_gi_sub_profile):
+    profile = copy.deepcopy(clean_gi_sub_profile)
+
+    q = profile.getQ()
+    i = np.vstack([profile.getI(), 2*profile.getI(), np.zeros_like(q)])
+    err = np.vstack([profile.getErr(), 2*profile.getErr(), profile.getErr()])
+
+    (rg, i0, rg_err, i0_err, qmin, qmax, qRg_min, qRg_max, idx_min,
+        idx_max, r_sqr) = raw.auto_guinier_batch(q, i, err)
+
+    assert np.allclose(rg[:2], 33.893575007646085)
+    assert np.allclose(i0[:2], [0.06158163170868536, 2*0.06158163170868536])
+    assert np.allclose(rg_err[0], 0.2411253445992467)
+    assert np.all(idx_min[:2] == 8)
+    assert np.all(idx_max[:2] == 50)
+    assert np.allclose(qmin[:2], 0.0147123743)
+    assert np.allclose(r_sqr[:2], 0.9942014318763518)
+    assert rg[2] == -1
+    assert idx_min[2] == -1
+
+@pytest.mark.parametrize('error_weight', [True, False])
+def test_calc_rg_window(clean_gi_sub_profile, error_weight):
+    q = clean_gi_sub_profile.getQ()
+    i = copy.deepcopy(clean_gi_sub_profile.getI())
+    err = copy.deepcopy(clean_gi_sub_profile.getErr())
+
+    i[12] = -1
+    err[30] = 0
+
+    x = np.square(q)
+    y = np.log(i)
+    yerr = np.absolute(err/i)
+
+    for start, stop in [(0, 20), (5, 50), (25, 45)]:
+        finite = np.isfinite(y[start:stop])
+
+        assert (SASCalc.calcRgWindow(x, y, yerr, start, stop, error_weight)
+            == SASCalc.calcRg(x[start:stop][finite], y[start:stop][finite],
+            yerr[start:stop][finite], False, error_weight))
+
+    # Adding to the sums of a shorter window gives the same fit
+    sums = np.zeros(11)
+    SASCalc.addRgWindowSums(x, y, yerr, 5, 20, sums)
+    SASCalc.addRgWindowSums(x, y, yerr, 20, 50, sums)
+
+    assert (SASCalc.calcRgWindowSums(x, y, 5, 50, sums, error_weight)
+        == SASCalc.calcRgWindow(x, y, yerr, 5, 50, error_weight))
+
 def test_guinier_fit(clean_gi_sub_profile):
     profile = copy.deepcopy(clean_gi_sub_profile)
 
@@ -373,6 +430,40 @@ def test_bift_single_proc(clean_gi_sub_profile, old_settings, gi_bift_ift):
     assert np.allclose(ift.r, gi_bift_ift.r)
     assert np.allclose(ift.p, gi_bift_ift.p)
 
+@pytest.mark.slow
+def test_bift_batch(clean_gi_sub_profile, old_settings, gi_bift_ift):
+    profile = copy.deepcopy(clean_gi_sub_profile)
+
+    profiles = [(profile.getQ(), profile.getI(), profile.getErr(),
+        profile.getParameter('filename')) for j in range(3)]
+
+    iftms = BIFT.doBiftBatch(profiles, old_settings.get('PrPoints'),
+        old_settings.get('minAlpha'), old_settings.get('maxAlpha'),
+        old_settings.get('AlphaPoints'), old_settings.get('maxDmax'),
+        old_settings.get('minDmax'), old_settings.get('DmaxPoints'),
+        old_settings.get('mcRuns'))
+
+    assert len(iftms) == 3
+
+    for ift in iftms:
+        assert np.allclose(ift.getParameter('dmax'),
+            gi_bift_ift.getParameter('dmax'))
+        assert np.allclose(ift.r, gi_bift_ift.r)
+        assert np.allclose(ift.p, gi_bift_ift.p)
+
+@pytest.mark.skipif(multiprocessing.cpu_count() < 2,
+    reason='Needs more than one processor')
+def test_bift_executor_per_nprocs():
+    executor = BIFT.getBiftExecutor(1)
+    results = executor.imapEvidence([[(1., 50.)]], np.linspace(0.01, 0.3, 50),
+        np.ones(50), np.ones(50), 20)
+
+    executor2 = BIFT.getBiftExecutor(2)
+
+    assert executor2 is not executor
+    assert BIFT.getBiftExecutor(1) is executor
+    assert len(list(results)) == 1
+
 @pytest.mark.atsas
 def test_datgnom(clean_gi_sub_profile):
     profile = copy.deepcopy(clean_gi_sub_profile)
@@ -511,6 +602,133 @@ def test_datgnom_file_idx_min_max(clean_gi_sub_profile):
     assert round(ift.q_orig[0], 6) == round(clean_gi_sub_profile.getQ()[30], 6)
     assert round(ift.q_orig[-1], 6) == round(clean_gi_sub_profile.getQ()[300], 6)
 
+@pytest.fixture(scope='package')
+def atsas_stub_dir(tmp_path_factory):
+    """
+    A directory of stand in ATSAS programs, which write a log of each call
+    and give results that depend on their inputs.
+    """
+    stub_dir = tmp_path_factory.mktemp('atsas_stub')
+
+    out_file = os.path.abspath(os.path.join('.', 'data', 'glucose_isomerase.out'))
+
+    header = ('#!{}\n'
+        'import os, sys, shutil\n'
+        'args = sys.argv[1:]\n'
+        'with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '
+        '"calls.log"), "a") as f:\n'
+        '    f.write(os.path.basename(__file__) + "\\n")\n'
+        'with open(args[-1]) as f:\n'
+        '    npts = len([line for line in f if line.strip() and not '
+        'line.startswith("#")])\n'
+        'opts = dict(arg[2:].split("=") for arg in args[:-1] if '
+        'arg.startswith("--"))\n').format(sys.executable)
+
+    programs = {
+        'datmw': ('if float(opts["rg"]) < 0:\n'
+            '    sys.stderr.write("Could not find Rg\\n")\n'
+            '    sys.exit(1)\n'
+            'if float(opts["rg"]) == 0:\n'
+            '    print("unexpected output")\n'
+            '    sys.exit(0)\n'
+            'print(float(opts["rg"])*1000, 0.5, npts*1000, '
+            'float(opts["first"])*1000, 0.9, "bayes")\n'),
+        'datclass': ('if float(opts["rg"]) == 0:\n'
+            '    print("unexpected output")\n'
+            '    sys.exit(0)\n'
+            'print("compact", float(opts["i0"])*1000, npts, '
+            '"compact")\n'),
+        'datgnom': ('if float(args[3]) < 0:\n'
+            '    sys.stderr.write("Could not find Rg\\n")\n'
+            '    sys.exit(1)\n'
+            'shutil.copy("{}", args[1])\n'.format(out_file)),
+        }
+
+    for name, body in programs.items():
+        path = stub_dir / name
+        path.write_text(header + body)
+        path.chmod(0o755)
+
+    return str(stub_dir)
+
+def _atsas_stub_calls(atsas_stub_dir):
+    with open(os.path.join(atsas_stub_dir, 'calls.log')) as f:
+        ncalls = len(f.readlines())
+
+    return ncalls
+
+@pytest.mark.skipif(platform.system() == 'Windows',
+    reason='ATSAS stubs are scripts')
+def test_mw_bayes_batch_stub(clean_gi_sub_profile, atsas_stub_dir):
+    profile = copy.deepcopy(clean_gi_sub_profile)
+    npts = len(profile.getQ())
+
+    with raw.SASCalc.ATSASRunner(atsas_stub_dir, n_proc=2) as runner:
+        results = raw.mw_bayes_batch([profile]*3, rg=[30, 31, -1], i0=0.06,
+            first=[0, 4, 0], runner=runner)
+
+        assert results[0] == (30., 50., npts, 1., 90.)
+        assert results[1] == (31., 50., npts, 5., 90.)
+        assert results[2] == (-1, -1, -1, -1, -1)
+
+        ncalls = _atsas_stub_calls(atsas_stub_dir)
+
+        cached = raw.mw_bayes_batch([profile]*2, rg=[30, 32], i0=0.06,
+            first=[0, 0], runner=runner)
+
+        assert cached[0] == results[0]
+        assert cached[1][0] == 32.
+        assert _atsas_stub_calls(atsas_stub_dir) == ncalls + 1
+
+        staging_dir = runner._staging_dir
+
+        assert os.listdir(staging_dir) == []
+
+    assert not os.path.exists(staging_dir)
+
+@pytest.mark.skipif(platform.system() == 'Windows',
+    reason='ATSAS stubs are scripts')
+def test_mw_datclass_batch_stub(clean_gi_sub_profile, atsas_stub_dir):
+    profile = copy.deepcopy(clean_gi_sub_profile)
+
+    results = raw.mw_datclass_batch([profile, profile], rg=32, i0=[0.06, 0.07],
+        first=0, atsas_dir=atsas_stub_dir)
+
+    assert results[0] == (0.06, 'compact', len(profile.getQ()))
+    assert results[1][0] == 0.07
+
+@pytest.mark.skipif(platform.system() == 'Windows',
+    reason='ATSAS stubs are scripts')
+def test_atsas_batch_unexpected_output_stub(clean_gi_sub_profile,
+    atsas_stub_dir):
+    profile = copy.deepcopy(clean_gi_sub_profile)
+
+    results = raw.mw_bayes_batch([profile, profile], rg=[0, 30], i0=0.06,
+        first=0, atsas_dir=atsas_stub_dir)
+
+    assert results[0] == (-1, -1, -1, -1, -1)
+    assert results[1][0] == 30.
+
+    results = raw.mw_datclass_batch([profile, profile], rg=[0, 32], i0=0.06,
+        first=0, atsas_dir=atsas_stub_dir)
+
+    assert results[0] == (-1, None, -1)
+    assert results[1][0] == 0.06
+
+@pytest.mark.skipif(platform.system() == 'Windows',
+    reason='ATSAS stubs are scripts')
+def test_datgnom_batch_stub(clean_gi_sub_profile, gi_gnom_ift, atsas_stub_dir):
+    profile = copy.deepcopy(clean_gi_sub_profile)
+
+    ifts = raw.datgnom_batch([profile, profile], rg=[30, -1],
+        atsas_dir=atsas_stub_dir)
+
+    assert ifts[1] is None
+    assert ifts[0].getParameter('dmax') == gi_gnom_ift.getParameter('dmax')
+    assert np.allclose(ifts[0].p, gi_gnom_ift.p)
+    assert (ifts[0].getParameter('filename')
+        == os.path.splitext(profile.getParameter('filename'))[0] + '.out')
+
 @pytest.mark.atsas
 def test_gnom(clean_gi_sub_profile, gi_gnom_ift):
     profile = copy.deepcopy(clean_gi_sub_profile)
@@ -757,6 +975,33 @@ def test_cormap_ref(bsa_series_profiles):
     assert corrected_pvals[5] == 0.54454
     assert len(failed_comparisons) == 0
 
+def test_cormap_all_incremental(bsa_series_profiles):
+    profiles = bsa_series_profiles[:6]
+    pvals, corrected_pvals, failed_comparisons = raw.cormap(profiles)
+
+    pvals2, corrected_pvals2, failed_comparisons2 = raw.cormap(bsa_series_profiles)
+
+    assert np.all(pvals2[:6, :6] == pvals)
+    assert pvals2[0][1] == 0.202088
+    assert pvals2[5][0] == 0.054454
+    assert len(failed_comparisons2) == 0
+
+def test_cormap_matrix_weak_references(bsa_series_profiles):
+    profiles = [copy.deepcopy(profile) for profile in bsa_series_profiles[:3]]
+    ref = weakref.ref(profiles[0])
+
+    matrix = SASProc.CorMapMatrix()
+    runs, n_pts = matrix.update(profiles)
+
+    runs2, n_pts2 = matrix.update(profiles)
+
+    assert np.all(runs2 == runs)
+
+    del profiles
+    gc.collect()
+
+    assert ref() is None
+
 @pytest.mark.atsas
 @pytest.mark.slow
 def test_crysol_model(temp_directory):
@@ -913,6 +1158,38 @@ def test_pdb2sas_fit(temp_directory, clean_gi_sub_profile, gi_pdb2sas_fit_ift):
     assert np.allclose(pdb2sas.getI().sum(), 20496743823.859074)
     assert np.allclose(denss_analysis['Chi_squared'], 1.088)
 
+def test_pdb2sas_debye(temp_directory):
+    shutil.copy2(os.path.join('./data/dammif_data', '1XIB_4mer.pdb'),
+            os.path.join(temp_directory, '1XIB_4mer.pdb'))
+
+    results = raw.pdb2sas([os.path.join(temp_directory, '1XIB_4mer.pdb')],
+        debye_method='histogram')
+
+    theory = results['1XIB_4mer'][0]
+    debye = results['1XIB_4mer'][2]
+
+    assert np.allclose(debye.getQ(), theory.getQ())
+
+    pdb = DENSS.PDB(os.path.join(temp_directory, '1XIB_4mer.pdb'))
+    pdb2sas = DENSS.PDB2SAS(pdb, q=theory.getQ()[:2])
+
+    # At q=0 every pair contributes f_i*f_j
+    assert np.isclose(debye.getI()[0], np.sum(pdb2sas.ff[:,0])**2)
+
+@pytest.mark.parametrize('numba', [True, False])
+def test_pdb2sas_debye_histogram(numba):
+    pdb = DENSS.PDB(os.path.join('./data/dammif_data', '1XIB_4mer.pdb'))
+    pdb.remove_atoms_from_object(np.arange(pdb.natoms) >= 1500)
+
+    q = np.linspace(0, 0.5, 51)
+
+    exact = DENSS.PDB2SAS(pdb, q=q, numba=numba, method='exact').I
+    hist = DENSS.PDB2SAS(pdb, q=q, numba=numba, method='histogram').I
+    tiled = DENSS.PDB2SAS(pdb, q=q, numba=False, method='exact').I
+
+    assert np.allclose(exact, tiled, rtol=1e-10)
+    assert np.allclose(hist, exact, rtol=1e-3)
+
 
 
 
@@ -9,6 +9,7 @@ if raw_path not in os.sys.path:
     os.sys.path.append(raw_path)
 
 import bioxtasraw.RAWAPI as raw
+import bioxtasraw.SASCalc as SASCalc
 
 
 @pytest.fixture(scope="function")
@@ -38,6 +39,34 @@ def test_svd_list(bsa_series):
     svd_s, svd_U, svd_V = raw.svd(sasms)
     assert np.allclose(svd_s[0], 7474.750264659797)
 
+@pytest.mark.parametrize('svd_method', ['randomized', 'truncated'])
+def test_svd_truncated(bsa_series, svd_method):
+    svd_s, svd_U, svd_V = raw.svd(bsa_series)
+    t_svd_s, t_svd_U, t_svd_V = raw.svd(bsa_series, svd_method=svd_method,
+        n_sv=10)
+
+    assert len(t_svd_s) == 10
+    assert t_svd_U.shape[1] == 10
+    assert t_svd_V.shape[1] == 10
+    assert np.allclose(t_svd_s, svd_s[:10], rtol=1e-2)
+    assert np.allclose(np.abs(t_svd_U[:, :2]), np.abs(svd_U[:, :2]), atol=1e-6)
+    assert np.allclose(np.abs(t_svd_V[:, :2]), np.abs(svd_V[:, :2]), atol=1e-6)
+
+def test_efa_incremental(bsa_series):
+    svd_a = SASCalc.SVDonSASMs(bsa_series.subtracted_sasm_list,
+        do_binning=False, do_autocorr=False)[-2]
+
+    for forward in [True, False]:
+        slist = SASCalc.runEFA(svd_a, forward)
+        inc_slist = SASCalc.runEFA(svd_a, forward, 'incremental', 10)
+
+        assert np.all(inc_slist[10:] == 0)
+        assert np.allclose(inc_slist[:10], slist[:10], rtol=0.1)
+
+        signal = slist[:2] > 0.1*slist.max()
+        assert np.any(signal)
+        assert np.allclose(inc_slist[:2][signal], slist[:2][signal], rtol=1e-3)
+
 def test_efa(bsa_series):
     efa_profiles, converged, conv_data, rotation_data = raw.efa(bsa_series,
         [[130, 187], [149, 230]], framei=130, framef=230)
@@ -60,6 +89,16 @@ def test_efa_list(bsa_series):
     assert len(efa_profiles) == 2
     assert np.allclose(efa_profiles[0].getI().sum(), 75885.43573919893)
 
+def test_efa_randomized_svd(bsa_series):
+    efa_profiles, converged, conv_data, rotation_data = raw.efa(bsa_series,
+        [[130, 187], [149, 230]], framei=130, framef=230,
+        svd_method='randomized')
+
+    assert converged
+    assert len(efa_profiles) == 2
+    assert np.allclose(efa_profiles[0].getI().sum(), 75885.43573919893,
+        rtol=1e-4)
+
 def test_regals(bsa_series):
     prof1_settings = {
         'type'          : 'simple',
@@ -230,6 +269,72 @@ def test_regals_realspace(bsa_series):
     assert params['total_iter'] == 33
     assert np.allclose(regals_ifts[0].p.sum(), 0.021077276247305057)
 
+def test_regals_multistart(bsa_series, temp_directory):
+    comp_settings_list = []
+
+    for conc_lambda in [6.0e3, 1.0e4]:
+        prof1_settings = {
+            'type'          : 'simple',
+            'lambda'        : 0.0,
+            'auto_lambda'   : False,
+            'kwargs'        : {},
+            }
+
+        conc1_settings = {
+            'type'          : 'smooth',
+            'lambda'        : conc_lambda,
+            'auto_lambda'   : False,
+            'kwargs'                : {
+                'xmin'              : 130,
+                'xmax'              : 187,
+                'Nw'                : 50,
+                'is_zero_at_xmin'   : False,
+                'is_zero_at_xmax'   : True,
+                }
+            }
+
+        prof2_settings = {
+            'type'          : 'simple',
+            'lambda'        : 0.0,
+            'auto_lambda'   : False,
+            'kwargs'        : {},
+            }
+
+        conc2_settings = {
+            'type'          : 'smooth',
+            'lambda'        : 8.0e3,
+            'auto_lambda'   : False,
+            'kwargs'                : {
+                'xmin'              : 149,
+                'xmax'              : 230,
+                'Nw'                : 50,
+                'is_zero_at_xmin'   : True,
+                'is_zero_at_xmax'   : False,
+                }
+            }
+
+        comp_settings_list.append([(prof1_settings, conc1_settings),
+            (prof2_settings, conc2_settings)])
+
+    trace_file = os.path.join(temp_directory, 'regals_trace.csv')
+
+    results = raw.regals_multistart(bsa_series, comp_settings_list,
+        framei=130, framef=230, nprocs=1, trace_file=trace_file)
+
+    mixture, params, residual = results[0]
+
+    assert len(results) == 2
+    assert np.allclose(params['x2'], 1.0332748476863391)
+    assert params['total_iter'] == 43
+
+    # The second run starts from the first solution
+    assert results[1][1]['total_iter'] < params['total_iter']
+
+    trace = np.loadtxt(trace_file, delimiter=',', skiprows=1)
+
+    assert len(trace) == params['total_iter'] + results[1][1]['total_iter']
+    assert np.allclose(trace[params['total_iter']-1, 3], params['x2'])
+
 def test_find_buffer_range(bsa_series):
     success, region_start, region_end = raw.find_buffer_range(bsa_series)
 
@@ -316,6 +421,18 @@ def test_series_calc(bsa_series):
     assert vcmw[200] == 65.39761365015703
     assert vpmw[200] == 69.44895475238502
 
+def test_series_calc_multiproc(bsa_series):
+    sasms = bsa_series.subtracted_sasm_list
+
+    rg, rger, i0, i0er, vcmw, vcmwer, vpmw = raw.series_calc(sasms,
+        single_proc=False, nprocs=2)
+
+    assert rg[200] == 28.359975022504145
+    assert rger[200] == 0.27691242689048307
+    assert i0[200] == 139.3524947924968
+    assert vcmw[200] == 65.39761365015703
+    assert vpmw[200] == 69.44895475238502
+
 def test_find_sample_range(bsa_series):
     success, region_start, region_end = raw.find_sample_range(bsa_series)
 
@@ -336,6 +453,22 @@ def test_find_sample_range_list(bsa_series):
     assert region_start == 188
     assert region_end == 206
 
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_find_ranges_nprocs(bsa_series, nprocs):
+    success, region_start, region_end = raw.find_buffer_range(bsa_series,
+        nprocs=nprocs)
+
+    assert success
+    assert region_start == 81
+    assert region_end == 116
+
+    success, region_start, region_end = raw.find_sample_range(bsa_series,
+        nprocs=nprocs)
+
+    assert success
+    assert region_start == 188
+    assert region_end == 206
+
 def test_validate_sample_range_good(bsa_series):
     (valid, similarity_results, param_results, svd_results,
         sn_results) = raw.validate_sample_range(bsa_series, [[188, 206]])
@@ -544,3 +677,66 @@ def test_set_baseline_correction_linear(clean_baseline_series):
     assert rger[200] == 0.12827521377190731
     assert all(rg == clean_baseline_series.getRg()[0])
     assert clean_baseline_series.getIntI(int_type='baseline').sum() == 0.10684702672323632
+
+@pytest.mark.parametrize('bl_type,start_range,end_range', [
+    ('Integral', [42, 71], [318, 347]), ('Linear', [0, 10], [390, 400])])
+def test_baseline_correction_online(clean_baseline_series, bl_type, start_range,
+    end_range):
+    unsub_profiles = clean_baseline_series.getAllSASMs()
+    sub_profiles = clean_baseline_series.subtracted_sasm_list
+
+    bl_correction = SASCalc.BaselineCorrection(start_range, end_range, bl_type,
+        100, 2000, True, 'total', None, None, 1.02)
+
+    for n_frames in range(250, len(sub_profiles), 25):
+        bl_correction.update(unsub_profiles[:n_frames], sub_profiles[:n_frames])
+
+    bl_correction.update(unsub_profiles, sub_profiles)
+
+    bl_cor_profiles = raw.set_baseline_correction(clean_baseline_series,
+        start_range, end_range, bl_type)[0]
+
+    assert len(bl_correction.bl_sasms) == len(bl_cor_profiles)
+    assert all(np.array_equal(online.getI(), batch.getI())
+        for online, batch in zip(bl_correction.bl_sasms, bl_cor_profiles))
+    assert (bl_correction.use_subtracted_sasms
+        == clean_baseline_series.use_baseline_subtracted_sasm)
+
+@pytest.mark.parametrize('bl_type,start_range,end_range', [
+    ('Integral', [42, 71], [318, 347]), ('Linear', [0, 10], [390, 400])])
+def test_update_baseline_correction(clean_baseline_series, bl_type,
+    start_range, end_range):
+    unsub_profiles = clean_baseline_series.getAllSASMs()
+    sub_profiles = clean_baseline_series.subtracted_sasm_list
+    use_sub_profiles = clean_baseline_series.use_subtracted_sasm
+    n_start = end_range[1] + 5
+
+    series = raw.profiles_to_series(unsub_profiles[:n_start])
+    series.setSubtractedSASMs(sub_profiles[:n_start], use_sub_profiles[:n_start])
+
+    raw.set_baseline_correction(series, start_range, end_range, bl_type)
+
+    for first_frame in range(n_start, len(sub_profiles), 10):
+        last_frame = min(first_frame+10, len(sub_profiles))
+
+        series.append([sasm.getParameter('filename') for sasm in
+            unsub_profiles[first_frame:last_frame]],
+            unsub_profiles[first_frame:last_frame],
+            range(first_frame, last_frame))
+        series.appendSubtractedSASMs(sub_profiles[first_frame:last_frame],
+            use_sub_profiles[first_frame:last_frame], 0)
+
+        bl_cor_profiles, bl_first_frame = raw.update_baseline_correction(series)
+
+        assert len(bl_cor_profiles) == last_frame - bl_first_frame
+
+    batch_profiles = raw.set_baseline_correction(clean_baseline_series,
+        start_range, end_range, bl_type)[0]
+
+    assert len(series.baseline_subtracted_sasm_list) == len(batch_profiles)
+    assert all(np.array_equal(online.getI(), batch.getI()) for online, batch
+        in zip(series.baseline_subtracted_sasm_list, batch_profiles))
+    assert (series.use_baseline_subtracted_sasm
+        == clean_baseline_series.use_baseline_subtracted_sasm)
+    assert np.allclose(series.getIntI(int_type='baseline'),
+        clean_baseline_series.getIntI(int_type='baseline'))
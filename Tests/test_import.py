@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+raw_path = os.path.abspath(os.path.join('.', __file__, '..', '..'))
+
+def run_import(code):
+    # The API is already imported by the test session, so the import is
+    # timed in a fresh interpreter
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([raw_path, env.get('PYTHONPATH', '')])
+
+    output = subprocess.check_output([sys.executable, '-c', code], env=env,
+        cwd=raw_path, universal_newlines=True)
+
+    return output.strip().splitlines()[-1]
+
+def test_rawapi_import_is_lazy():
+    code = ("import sys\n"
+        "import bioxtasraw.RAWAPI as raw\n"
+        "heavy = ['bioxtasraw.DENSS', 'bioxtasraw.RAWReport', 'matplotlib', "
+        "'scipy.signal', 'reportlab']\n"
+        "print(','.join(m for m in heavy if m in sys.modules), "
+        "raw._default_settings is None, sep='|')\n"
+        )
+
+    loaded, no_settings = run_import(code).split('|')
+
+    assert loaded == ''
+    assert no_settings == 'True'
+
+def test_rawapi_lazy_default_settings():
+    code = ("import bioxtasraw.RAWAPI as raw\n"
+        "print(raw.atsas_dir == raw.__default_settings.get('ATSASDir'))\n"
+        )
+
+    assert run_import(code) == 'True'
+
+@pytest.mark.slow
+def test_rawapi_import_time():
+    code = ("import time\n"
+        "start = time.time()\n"
+        "import bioxtasraw.RAWAPI\n"
+        "print(time.time()-start)\n"
+        )
+
+    # Best of several runs, so the first run can warm the disk cache
+    import_time = min(float(run_import(code)) for i in range(3))
+
+    assert import_time < 2
@@ -1,4 +1,5 @@
 import os
+import copy
 
 import pytest
 import numpy as np
@@ -11,6 +12,10 @@ import bioxtasraw.RAWAPI as raw
 import bioxtasraw.RAWSettings as RAWSettings
 import bioxtasraw.SASM as SASM
 import bioxtasraw.SECM as SECM
+import bioxtasraw.SASImage as SASImage
+import bioxtasraw.SASExceptions as SASExceptions
+import bioxtasraw.SASMask as SASMask
+import bioxtasraw.SASOnline as SASOnline
 
 
 @pytest.fixture(scope="package")
@@ -1354,6 +1359,66 @@ def test_load_series_sasbdb_keywords():
     assert secm.total_i[0] == 0.008572792727392729
     assert secm.total_i[-1] == 0.008598722084516956
 
+def test_load_series_lazy(series_images, temp_directory):
+    raw.save_series(series_images, 'test_series_lazy.hdf5', temp_directory)
+
+    filenames = [os.path.join(temp_directory, 'test_series_lazy.hdf5')]
+
+    secm = raw.load_series(filenames, lazy=True)[0]
+
+    assert isinstance(secm.getAllSASMs(), SECM.LazyProfileList)
+    assert len(secm.getAllSASMs()) == len(series_images.getAllSASMs())
+    assert np.allclose(secm.total_i, series_images.total_i)
+    assert np.allclose(secm.total_i_sub, series_images.total_i_sub)
+    assert np.allclose(secm.getSASM(5, 'sub').getI(),
+        series_images.getSASM(5, 'sub').getI())
+
+    secm.scale(2.)
+    secm.I(0.1)
+
+    assert np.allclose(secm.total_i, 2*series_images.total_i)
+    assert np.allclose(secm.getSASM(-1).getI(), 2*series_images.getSASM(-1).getI())
+    assert np.allclose(secm.I_of_q, 2*np.array([sasm.getIofQ(0.1)
+        for sasm in series_images.getAllSASMs()]))
+
+def test_load_series_lazy_append(series_images, temp_directory):
+    raw.save_series(series_images, 'test_series_lazy_append.hdf5', temp_directory)
+
+    filenames = [os.path.join(temp_directory, 'test_series_lazy_append.hdf5')]
+
+    secm = raw.load_series(filenames, lazy=True)[0]
+
+    sasm_list = secm.getAllSASMs()
+    sub_list = secm.subtracted_sasm_list
+    n_sub = len(sub_list)
+
+    loaded = []
+
+    def load_parameters(val, load=sasm_list.load_parameters):
+        loaded.append(val)
+        return load(val)
+
+    sasm_list.load_parameters = load_parameters
+    sub_list.load_parameters = load_parameters
+
+    secm.hdr_format = 'G1, CHESS'
+    secm.time = []
+    secm._calcTime(sasm_list)
+
+    assert np.allclose(secm.time, [float(sasm.getParameter('counters')['Time'])
+        for sasm in series_images.getAllSASMs()])
+
+    new_sasms = [series_images.getSASM(j, 'sub') for j in range(3)]
+    secm.appendSubtractedSASMs(new_sasms, [True]*3, 2)
+
+    assert secm.subtracted_sasm_list is sub_list
+    assert len(sub_list) == n_sub + 1
+    assert len(secm.use_subtracted_sasm) == n_sub + 1
+    assert len(secm.total_i_sub) == n_sub + 1
+    assert secm.getSASM(-1, 'sub') is new_sasms[-1]
+    assert np.allclose(secm.total_i_sub[:n_sub-2], series_images.total_i_sub[:n_sub-2])
+    assert len(loaded) == 0
+
 def test_load_images(old_settings):
     filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
 
@@ -1597,6 +1662,31 @@ def test_make_profile():
     assert all(new_profile.getI() == profile.getI())
     assert all(new_profile.getErr() == profile.getErr())
 
+def test_make_profile_no_copy():
+    filenames = [os.path.join('.', 'data', 'glucose_isomerase.dat')]
+    profile = raw.load_profiles(filenames)[0]
+
+    q = np.array(profile.getQ())
+    i = np.array(profile.getI())
+    err = np.array(profile.getErr())
+
+    new_profile = raw.make_profile(q, i, err, 'test', copy_data=False)
+    new_profile2 = raw.make_profile(q, 2*i, err, 'test2', copy_data=False)
+
+    assert new_profile.getRawQ() is q
+    assert new_profile.getRawQ() is new_profile2.getRawQ()
+    assert new_profile.getTotalI() == profile.getTotalI()
+
+    new_profile.scale(2)
+
+    assert np.allclose(new_profile.getI(), new_profile2.getI())
+    assert np.allclose(i, profile.getI())
+    assert new_profile.getTotalI() == new_profile2.getTotalI()
+
+    new_profile.removeZingers()
+
+    assert np.allclose(i, profile.getI())
+
 def test_load_crysol_int():
     filenames = [os.path.join('.', 'data', 'crysol.int')]
 
@@ -1931,3 +2021,386 @@ def test_integrate_image(old_settings):
     assert all(profile.getI() == profile_list[0].getI())
     assert all(profile.getErr() == profile_list[0].getErr())
 
+@pytest.mark.parametrize('setting,value', [('ZingerRemovalRadAvg', True),
+    ('ErrorModel', 'azimuthal')])
+def test_integrate_image_without_sparse_integrator(old_settings, setting,
+    value):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    settings = copy.deepcopy(old_settings)
+    settings.set(setting, value)
+
+    profile_list, img_list = raw.load_and_integrate_images(filenames*2,
+        settings)
+
+    assert len(profile_list) == 2
+    assert profile_list[0].getRawQ() is profile_list[1].getRawQ()
+    assert all(profile_list[0].getI() == profile_list[1].getI())
+
+
+def test_integration_plan_cache(old_settings):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    SASImage.clearIntegrationPlans()
+
+    profile_list, img_list = raw.load_and_integrate_images(filenames, old_settings)
+    profile_list2, img_list2 = raw.load_and_integrate_images(filenames, old_settings)
+
+    assert len(SASImage._integration_plans) == 1
+    assert all(profile_list[0].getI() == profile_list2[0].getI())
+
+    plan = list(SASImage._integration_plans.values())[0]
+
+    settings = copy.deepcopy(old_settings)
+    settings.set('Binsize', 2)
+
+    profile_list3, img_list3 = raw.load_and_integrate_images(filenames, settings)
+
+    assert len(SASImage._integration_plans) == 2
+    assert len(profile_list3[0].getQ()) != len(profile_list[0].getQ())
+
+    new_plan = SASImage.getIntegrationPlan(settings, img_list3[0].shape,
+        plan.calibration)
+
+    assert new_plan is not plan
+    assert new_plan.npts == plan.npts//2
+
+def test_integration_plan_cache_masks(old_settings):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    settings = copy.deepcopy(old_settings)
+
+    img_list, img_hdrs = raw.load_images(filenames, settings)
+    img = img_list[0]
+
+    calibration = SASImage.getCalibrationValues(settings, img_hdrs[0], {})
+    plan = SASImage.getIntegrationPlan(settings, img.shape, calibration)
+
+    assert settings.get('AzimuthalIntegrator') is None
+
+    # An equal mask, as when the settings are reloaded for each image
+    mask_dict = settings.get('Masks')
+    mask_dict['BeamStopMask'][2] = mask_dict['BeamStopMask'][2].copy()
+
+    same_plan = SASImage.getIntegrationPlan(settings, img.shape, calibration)
+
+    assert same_plan is plan
+
+    # A changed mask
+    new_mask = mask_dict['BeamStopMask'][2].copy()
+    new_mask[:10, :10] = True
+    mask_dict['BeamStopMask'][2] = new_mask
+
+    new_plan = SASImage.getIntegrationPlan(settings, img.shape, calibration)
+
+    assert new_plan is not plan
+    assert new_plan.bs_mask[:10, :10].all()
+
+    # A mask changed in place is only seen once the plans are cleared
+    new_mask[:10, :10] = False
+
+    assert SASImage.getIntegrationPlan(settings, img.shape,
+        calibration) is new_plan
+
+    SASImage.clearIntegrationPlans()
+    cleared_plan = SASImage.getIntegrationPlan(settings, img.shape, calibration)
+
+    assert cleared_plan is not new_plan
+    assert not cleared_plan.bs_mask[:10, :10].any()
+
+def test_integration_plan_matches_pyfai(old_settings):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    img_list, img_hdrs = raw.load_images(filenames, old_settings)
+    img = img_list[0]
+
+    calibration = SASImage.getCalibrationValues(old_settings, img_hdrs[0], {})
+    plan = SASImage.getIntegrationPlan(old_settings, img.shape, calibration)
+
+    q, i, err = plan.integrate(img, 2.0)
+
+    kwargs = dict(plan.integration_kwargs)
+    kwargs['normalization_factor'] = 2.0
+
+    ref_q, ref_i, ref_err = plan.ai.integrate1d(img, plan.npts, **kwargs)
+
+    assert np.allclose(q, ref_q)
+    assert np.allclose(i, ref_i)
+    assert np.allclose(err, np.nan_to_num(ref_err))
+
+def test_integrate_image_stack(old_settings):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    counters = raw.load_counter_values(filenames, old_settings)[0]
+
+    img_list, img_hdrs = raw.load_images(filenames, old_settings)
+    img = img_list[0]
+
+    profile = raw.integrate_image(img, old_settings, 'test_image', img_hdrs[0],
+        counters, filenames[0])
+
+    imgs = np.stack([img, img*2, img])
+
+    q, i, err = raw.integrate_image_stack(imgs, old_settings,
+        [img_hdrs[0]]*3, [counters]*3, chunk_size=2)
+
+    assert i.shape == (3, len(q))
+    assert err.shape == i.shape
+    assert np.allclose(q, profile.getRawQ())
+    assert np.allclose(i[0], profile.getRawI())
+    assert np.allclose(err[0], profile.getRawErr())
+    assert np.allclose(i[1], 2*i[0])
+    assert np.allclose(i[2], i[0])
+
+@pytest.mark.parametrize('error_model,use_variance', [('poisson', False),
+    ('azimuthal', False), ('poisson', True)])
+
+def test_integrate_image_stack_error_model(old_settings, error_model,
+    use_variance):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    settings = copy.deepcopy(old_settings)
+    settings.set('ErrorModel', error_model)
+    settings.set('UseImageForVariance', use_variance)
+
+    counters = raw.load_counter_values(filenames, settings)[0]
+
+    img_list, img_hdrs = raw.load_images(filenames, settings)
+    img = img_list[0]
+
+    imgs = np.stack([img, img*2])
+
+    q, i, err = raw.integrate_image_stack(imgs, settings,
+        [img_hdrs[0]]*2, [counters]*2)
+
+    for j in range(2):
+        profile = raw.integrate_image(imgs[j], settings, 'test_image',
+            img_hdrs[0], counters, filenames[0])
+
+        assert np.allclose(i[j], profile.getRawI())
+        assert np.allclose(err[j], profile.getRawErr())
+
+def test_integrate_image_stack_different_calibrations(old_settings):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]
+
+    settings = copy.deepcopy(old_settings)
+    settings.set('UseHeaderForCalib', True)
+
+    bind_list = copy.deepcopy(settings.get('HeaderBindList'))
+    bind_list['Wavelength'] = ['WaveLength', ['test_wavelength', 'imghdr'], '']
+    settings.set('HeaderBindList', bind_list)
+
+    counters = raw.load_counter_values(filenames, settings)[0]
+
+    img_list, img_hdrs = raw.load_images(filenames, settings)
+    img = img_list[0]
+
+    hdr1 = dict(img_hdrs[0], test_wavelength=1.0)
+    hdr2 = dict(img_hdrs[0], test_wavelength=1.1)
+
+    calib1 = SASImage.getCalibrationValues(settings, hdr1, counters)
+    calib2 = SASImage.getCalibrationValues(settings, hdr2, counters)
+
+    plan1 = SASImage.getIntegrationPlan(settings, img.shape, calib1)
+    plan2 = SASImage.getIntegrationPlan(settings, img.shape, calib2)
+
+    assert plan1.npts == plan2.npts
+
+    imgs = np.stack([img, img])
+
+    with pytest.raises(SASExceptions.DataNotCompatible):
+        SASImage.integrateImageStack(imgs, settings, [hdr1, hdr2],
+            [counters, counters])
+
+def test_calc_expression_stack():
+    img_hdrs = [{'I1': '2.0', 'Exposure_time': 0.5},
+        {'I1': 4.0, 'Exposure_time': 0.5},
+        {'I1': 8.0, 'Exposure_time': 'bad'}]
+    file_hdrs = [{'I0': 10.}, {'I0': 20.}, {'I0': 40., 'Exposure_time': 2}]
+
+    expr = 'I1/I0*sqrt(Exposure_time)*pi'
+
+    vals = SASImage.calcExpressionStack(expr, img_hdrs, file_hdrs)
+    ref_vals = [SASImage.calcExpression(expr, img_hdrs[j], file_hdrs[j])
+        for j in range(3)]
+
+    assert np.allclose(vals, ref_vals)
+    assert np.allclose(vals[0], 0.2*np.sqrt(0.5)*np.pi)
+    assert np.allclose(vals[2], 0.2*np.sqrt(2)*np.pi)
+    assert SASImage.calcExpressionStack('', img_hdrs, file_hdrs) is None
+    assert np.all(SASImage.calcExpressionStack('2', img_hdrs, file_hdrs) == 2)
+
+def test_mask_fill_matches_fill_points():
+    img_dim = (195, 487)
+
+    masks = [SASMask.CircleMask((100.5, 80.2), (130.5, 80.2), 0, img_dim),
+        SASMask.RectangleMask((-10, 50), (200, 70), 1, img_dim),
+        SASMask.PolygonMask([(300, -5), (480, 120), (350, 190), (410, 60)],
+            2, img_dim),
+        SASMask.CircleMask((450, 10), (470, 10), 3, img_dim, True),
+        ]
+
+    for mask in masks:
+        ref = np.zeros(img_dim, dtype=bool)
+
+        for x, y in mask.getFillPoints():
+            if 0 <= x < img_dim[0] and 0 <= y < img_dim[1]:
+                ref[int(x), int(y)] = True
+
+        assert np.all(mask.getFillMask(img_dim) == ref)
+
+def test_mask_matrix_cache():
+    img_dim = (195, 487)
+
+    masks = [SASMask.CircleMask((100, 80), (130, 80), 0, img_dim),
+        SASMask.RectangleMask((10, 50), (200, 70), 1, img_dim)]
+
+    mask_img = SASMask.createMaskMatrix(img_dim, masks)
+
+    assert mask_img.shape == img_dim
+    assert mask_img[img_dim[0]-81, 100] == 0
+    assert mask_img[0, 0] == 1
+
+    mask_img[0, 0] = 0
+
+    same_masks = [SASMask.CircleMask((100, 80), (130, 80), 0, img_dim),
+        SASMask.RectangleMask((10, 50), (200, 70), 1, img_dim)]
+
+    assert np.all(SASMask.createMaskMatrix(img_dim, same_masks)
+        == SASMask.createMaskMatrix(img_dim, masks))
+    assert SASMask.createMaskMatrix(img_dim, masks)[0, 0] == 1
+
+    masks[0].grow(5)
+
+    assert np.sum(SASMask.createMaskMatrix(img_dim, masks)) < np.sum(
+        SASMask.createMaskMatrix(img_dim, same_masks))
+
+def test_directory_watcher(tmp_path):
+    with open(os.path.join(tmp_path, 'old.dat'), 'w') as f:
+        f.write('old')
+
+    watcher = SASOnline.DirectoryWatcher(str(tmp_path), stable_time=0,
+        use_inotify=False)
+    watcher.rescan_interval = 0
+
+    watcher.scanOnce()
+
+    with open(os.path.join(tmp_path, 'new.dat'), 'w') as f:
+        f.write('new')
+
+    with open(os.path.join(tmp_path, 'saved.dat'), 'w') as f:
+        f.write('saved')
+
+    watcher.skip(['saved.dat'])
+
+    watcher.scanOnce()
+    watcher.scanOnce()
+
+    events = watcher.getEvents()
+
+    assert len(events) == 1
+    assert events[0].name == 'new.dat'
+    assert events[0].type == 'new'
+    assert events[0].size == 3
+
+    watcher.scanOnce()
+
+    assert len(watcher.getEvents()) == 0
+
+    with open(os.path.join(tmp_path, 'old.dat'), 'w') as f:
+        f.write('rewritten')
+
+    with open(os.path.join(tmp_path, 'new.dat'), 'w') as f:
+        f.write('rewritten')
+
+    watcher.scanOnce()
+    watcher.scanOnce()
+
+    events = watcher.getEvents()
+
+    assert sorted(event.name for event in events) == ['new.dat', 'old.dat']
+    assert all(event.type == 'modified' for event in events)
+    assert all(event.size == 9 for event in events)
+
+def test_directory_watcher_polling(tmp_path):
+    with open(os.path.join(tmp_path, 'old.dat'), 'w') as f:
+        f.write('old')
+
+    watcher = SASOnline.DirectoryWatcher(str(tmp_path), stable_time=0,
+        use_inotify=False)
+
+    watcher.scanOnce()
+
+    with open(os.path.join(tmp_path, 'old.dat'), 'w') as f:
+        f.write('rewritten')
+
+    with open(os.path.join(tmp_path, 'new.dat'), 'w') as f:
+        f.write('new')
+
+    watcher.scanOnce()
+    watcher.scanOnce()
+
+    # Files that weren't changing are only checked in a full scan
+    events = watcher.getEvents()
+
+    assert [event.name for event in events] == ['new.dat']
+
+    watcher._backend.rescan_interval = 0
+
+    watcher.scanOnce()
+    watcher.scanOnce()
+
+    events = watcher.getEvents()
+
+    assert [event.name for event in events] == ['old.dat']
+    assert events[0].type == 'modified'
+
+def test_directory_watcher_tracked_files(tmp_path):
+    watcher = SASOnline.DirectoryWatcher(str(tmp_path), stable_time=0,
+        use_inotify=False)
+    watcher.max_tracked = 2
+
+    watcher.scanOnce()
+
+    for j in range(4):
+        with open(os.path.join(tmp_path, 'new_{}.dat'.format(j)), 'w') as f:
+            f.write('new')
+
+    watcher.scanOnce()
+    watcher.scanOnce()
+
+    assert len(watcher.getEvents()) == 4
+    assert list(watcher._handed_off.keys()) == ['new_2.dat', 'new_3.dat']
+
+def test_online_filter():
+    filter_list = [['Ignore', 'buffer', 'At start'],
+        ['Open only with', '.tiff', 'At end']]
+
+    assert SASOnline.filterFilename('sample_001.tiff', filter_list)
+    assert not SASOnline.filterFilename('buffer_001.tiff', filter_list)
+    assert not SASOnline.filterFilename('sample_001.dat', filter_list)
+
+def test_online_reduction(old_settings, tmp_path):
+    filenames = [os.path.join('.', 'data', 'GI2_A9_19_001_0000.tiff')]*4
+
+    profiles, imgs = raw.load_and_integrate_images(filenames[:1], old_settings)
+
+    reducer = raw.online_reduction(old_settings, output_dir=str(tmp_path),
+        n_buffer_frames=2, n_workers=2, max_queue_size=2)
+
+    for fname in filenames:
+        reducer.submit(fname)
+
+    reducer.stop()
+
+    assert len(reducer.errors) == 0
+    assert len(reducer.series.getAllSASMs()) == 4
+    assert len(reducer.series.subtracted_sasm_list) == 4
+    assert np.allclose(reducer.series.getSASM(3).getI(), profiles[0].getI())
+    assert np.allclose(reducer.series.subtracted_sasm_list[0].getI(), 0)
+
+    stats = reducer.getStageStats()
+    assert stats['integrate']['count'] == 4
+    assert stats['series']['count'] == 4
+
+    assert os.path.exists(os.path.join(tmp_path, 'online_series.hdf5'))
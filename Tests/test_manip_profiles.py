@@ -2065,3 +2065,179 @@ def test_scaleq_profile(gi_sub_profile, scale_factor):
     test_profile.scaleQ(scale_factor)
 
     assert all(test_profile.getQ() == q*scale_factor)
+
+def test_scale_series(bsa_series, scale_factor):
+    test_series = copy.deepcopy(bsa_series)
+    test_series.I(0.02)
+
+    profiles = [copy.deepcopy(sasm) for sasm in test_series.getAllSASMs()]
+
+    test_series.scale(scale_factor)
+    test_series.offset(0.1)
+    test_series.setQrange(5, 200)
+
+    for sasm in profiles:
+        sasm.scale(scale_factor)
+        sasm.offset(0.1)
+        sasm.setQrange((5, 201))
+
+    series_profiles = test_series.getAllSASMs()
+
+    assert all(np.allclose(sasm.getI(), ref.getI())
+        for sasm, ref in zip(series_profiles, profiles))
+    assert all(np.allclose(sasm.getErr(), ref.getErr())
+        for sasm, ref in zip(series_profiles, profiles))
+    assert np.allclose(test_series.getMeanI(),
+        [sasm.getMeanI() for sasm in profiles])
+    assert np.allclose(test_series.getIntI(),
+        [sasm.getTotalI() for sasm in profiles])
+    assert np.allclose(test_series.getIofQ(),
+        [sasm.getIofQ(0.02) for sasm in profiles])
+
+def test_profile_metadata_copy_on_write(bsa_series_profiles):
+    profile = copy.deepcopy(bsa_series_profiles[0])
+    profile.setParameter('counters', {'I0': 1.0})
+
+    sub_profile = raw.subtract([profile], bsa_series_profiles[1])[0]
+    sub_profile.setParameter('counters', {'I0': 1.0})
+    rebin_profile = raw.rebin([sub_profile], rebin_factor=2)[0]
+
+    history = rebin_profile.getParameter('history')['linear_binning']
+    sub_history = history['initial_file'][1]['subtraction']
+
+    assert history['initial_file'][0] == sub_profile.getParameter('filename')
+    assert sub_history['initial_file'][0] == profile.getParameter('filename')
+    assert sub_history == sub_profile.getParameter('history')['subtraction']
+    assert rebin_profile.getParameter('counters') == {'I0': 1.0}
+
+    rebin_profile.getParameter('counters')['I0'] = 2.0
+
+    assert sub_profile.getParameter('counters')['I0'] == 1.0
+
+    copy_profile = copy.deepcopy(profile)
+    copy_profile.getParameter('counters')['I0'] = 2.0
+
+    assert profile.getParameter('counters')['I0'] == 1.0
+    assert copy_profile.getParameter('counters')['I0'] == 2.0
+    assert copy.deepcopy(profile.getAllParameters()) == profile.getAllParameters()
+
+def test_subtract_stack(bsa_series_profiles):
+    profiles = copy.deepcopy(bsa_series_profiles)
+
+    bkg_profile = profiles.pop(0)
+
+    stack = raw.profiles_to_stack(profiles)
+    sub_stack = raw.subtract_stack(stack, bkg_profile)
+
+    sub_profiles = raw.subtract(profiles, bkg_profile)
+
+    assert len(sub_stack) == len(sub_profiles)
+
+    for sasm, ref in zip(sub_stack.getAllSASMs(), sub_profiles):
+        assert all(sasm.getQ() == ref.getQ())
+        assert np.allclose(sasm.getI(), ref.getI())
+        assert np.allclose(sasm.getErr(), ref.getErr())
+        assert sasm.getParameter('filename') == ref.getParameter('filename')
+        assert sasm.getParameter('history') == ref.getParameter('history')
+
+@pytest.mark.parametrize('rebin_factor,npts,log_rebin', [(2, 100, False),
+    (1, 50, False), (1, 60, True), (10000, 100, False)])
+def test_rebin_stack(bsa_series_profiles, rebin_factor, npts, log_rebin):
+    stack = raw.profiles_to_stack(bsa_series_profiles)
+
+    rebin_stack = raw.rebin_stack(stack, npts=npts, rebin_factor=rebin_factor,
+        log_rebin=log_rebin)
+    rebin_profiles = raw.rebin(bsa_series_profiles, npts=npts,
+        rebin_factor=rebin_factor, log_rebin=log_rebin)
+
+    for sasm, ref in zip(rebin_stack, rebin_profiles):
+        assert np.allclose(sasm.getQ(), ref.getQ())
+        assert np.allclose(sasm.getI(), ref.getI())
+        assert np.allclose(sasm.getErr(), ref.getErr())
+        assert sasm.getParameter('filename') == ref.getParameter('filename')
+
+def test_average_stack(bsa_series_profiles):
+    stack = raw.profiles_to_stack(bsa_series_profiles)
+
+    groups = [[0, 1, 2], range(2, 8), [9]]
+
+    avg_stack = raw.average_stack(stack, groups)
+
+    assert len(avg_stack) == len(groups)
+
+    for sasm, group in zip(avg_stack, groups):
+        ref = raw.average([bsa_series_profiles[j] for j in group])
+
+        assert np.allclose(sasm.getI(), ref.getI())
+        assert np.allclose(sasm.getErr(), ref.getErr())
+        assert sasm.getParameter('filename') == ref.getParameter('filename')
+
+def test_weighted_average_stack(bsa_series_profiles):
+    profiles = copy.deepcopy(bsa_series_profiles)
+
+    for j, sasm in enumerate(profiles):
+        sasm.setParameter('counters', {'I0': 1.+j})
+
+    stack = raw.profiles_to_stack(profiles)
+
+    groups = [[0, 1, 2], range(2, 8)]
+
+    for weight_by_error in [True, False]:
+        avg_stack = raw.weighted_average_stack(stack, groups,
+            weight_by_error=weight_by_error, weight_counter='I0')
+
+        for sasm, group in zip(avg_stack, groups):
+            ref = raw.weighted_average([profiles[j] for j in group],
+                weight_by_error=weight_by_error, weight_counter='I0')
+
+            assert np.allclose(sasm.getI(), ref.getI())
+            assert np.allclose(sasm.getErr(), ref.getErr())
+
+    avg_stack = raw.weighted_average_stack(stack, groups, weight_by_error=False,
+        weights=np.arange(len(profiles))+1.)
+    count_stack = raw.weighted_average_stack(stack, groups, weight_by_error=False,
+        weight_counter='I0')
+
+    assert np.allclose(avg_stack.getI(), count_stack.getI())
+    assert np.allclose(avg_stack.getErr(), count_stack.getErr())
+
+def test_profile_stack(bsa_series_profiles):
+    q = bsa_series_profiles[0].getQ()
+    i = np.array([sasm.getI() for sasm in bsa_series_profiles])
+    err = np.array([sasm.getErr() for sasm in bsa_series_profiles])
+    names = [sasm.getParameter('filename') for sasm in bsa_series_profiles]
+
+    stack = raw.make_profile_stack(q, i, err, names)
+
+    sasm = stack[3]
+    sasm.setParameter('filename', 'test')
+
+    assert all(sasm.getI() == bsa_series_profiles[3].getI())
+    assert stack.getParameters(3)['filename'] == names[3]
+
+    sub_stack = stack[2:5]
+
+    assert len(sub_stack) == 3
+    assert all(sub_stack[0].getI() == bsa_series_profiles[2].getI())
+    assert [sasm.getParameter('filename') for sasm in sub_stack] == names[2:5]
+
+def test_profile_metadata_copy_not_aliased(bsa_series_profiles):
+    profile = copy.deepcopy(bsa_series_profiles[0])
+    profile.setParameter('analysis', {})
+    profile.setParameter('history', {'scale': {'value': 1.0}})
+
+    analysis = profile.getParameter('analysis')
+    copy_profile = copy.deepcopy(profile)
+    analysis['guinier'] = {'Rg': 27.5}
+
+    assert 'guinier' in profile.getParameter('analysis')
+    assert 'guinier' not in copy_profile.getParameter('analysis')
+
+    params = profile.getAllParameters()
+    history = dict.__getitem__(params, 'history')
+
+    raw.subtract([profile], bsa_series_profiles[1])
+
+    assert dict.__getitem__(params, 'history') is history
+    assert type(history) is dict
+    assert profile.getParameter('history') == {'scale': {'value': 1.0}}
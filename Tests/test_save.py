@@ -218,6 +218,48 @@ def test_save_series_images(series_images, temp_directory):
     assert len(test_series.use_baseline_subtracted_sasm) == len(series_images.use_baseline_subtracted_sasm)
     assert all(test_series.total_i_bcsub == series_images.total_i_bcsub)
 
+def test_save_series_columnar(series_images, temp_directory):
+    import h5py
+    import bioxtasraw.SASFileIO as SASFileIO
+
+    fname = os.path.join(temp_directory, 'test_series_columnar.hdf5')
+    raw.save_series(series_images, 'test_series_columnar.hdf5', temp_directory)
+
+    with h5py.File(fname, 'r') as f:
+        assert f['profiles'].attrs['layout'] == 'columnar'
+        assert (f['profiles']['intensity'].shape
+            == (len(series_images.getAllSASMs()), len(series_images.getSASM(0).getQ())))
+
+        counters = f['profiles']['counters'][()]
+        assert np.allclose(counters['Time'], [float(sasm.getParameter('counters')['Time'])
+            for sasm in series_images.getAllSASMs()])
+
+    test_series = raw.load_series([fname])[0]
+
+    for sasm, test_sasm in zip(series_images.getAllSASMs(), test_series.getAllSASMs()):
+        assert np.allclose(sasm.getQ(), test_sasm.getQ())
+        assert np.allclose(sasm.getI(), test_sasm.getI())
+        assert np.allclose(sasm.getErr(), test_sasm.getErr())
+        assert sasm.getParameter('filename') == test_sasm.getParameter('filename')
+
+    frames = [5, 2, 5]
+    sasm_list = SASFileIO.load_series_frames(fname, frames)
+    sasm_list = [SASFileIO.makeSeriesSASM(sasm_data) for sasm_data in sasm_list]
+
+    for frame, test_sasm in zip(frames, sasm_list):
+        sasm = series_images.getSASM(frame)
+        assert np.allclose(sasm.getI(), test_sasm.getI())
+        assert sasm.getParameter('filename') == test_sasm.getParameter('filename')
+
+def test_load_series_frames_old_layout(series_images):
+    import bioxtasraw.SASFileIO as SASFileIO
+
+    fname = os.path.join('.', 'data', 'series_new_images.hdf5')
+    sasm_data = SASFileIO.load_series_frames(fname, [3])[0]
+    test_sasm = SASFileIO.makeSeriesSASM(sasm_data)
+
+    assert np.allclose(series_images.getSASM(3).getI(), test_sasm.getI())
+
 def test_save_series_sasbdb_keywords(series_sasbdb_keywords, temp_directory):
     raw.save_series(series_sasbdb_keywords, 'test_series_sasbdb_keywords.hdf5', temp_directory)
 
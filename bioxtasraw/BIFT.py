@@ -22,8 +22,8 @@ from io import open
 import six
 
 import multiprocessing
-import functools
 import threading
+import atexit
 import os
 import platform
 
@@ -153,11 +153,12 @@ def bift_inner_loop(f, p, B, alpha, N, sum_dia):
     return f, p, sigma, dotsp, xprec
 
 @jit(nopython=True, cache=True)
-def getEvidence(params, q, i, err, N):
-
-    alpha, dmax = params
-    alpha = np.exp(alpha)
-
+def getEvidenceSetup(dmax, q, i, err, N):
+    """
+    Calculates the parts of the evidence calculation that depend only on
+    dmax: the prior, the transform matrix, and the B matrix. These can be
+    reused for every alpha at a given dmax, see getEvidenceFromSetup.
+    """
     err = err**2
 
     p, r = makePriorDistribution(i[0], N, dmax, 'sphere') #Note, here I use p for what Hansen calls m
@@ -183,6 +184,17 @@ def getEvidence(params, q, i, err, N):
     p[1:-1] = p[1:-1]*(c2/c1)
     f[1:-1] = p[1:-1]*1.001     #Note: f is called P in the original RAW BIFT code
 
+    return f, p, r, T, B, sum_dia, err
+
+@jit(nopython=True, cache=True)
+def getEvidenceFromSetup(alpha, dmax, f, p, r, T, B, sum_dia, i, err, N):
+    """
+    Calculates the evidence for a given alpha from the results of
+    getEvidenceSetup. Note that f and p are modified in place, so copies
+    should be passed if the setup is reused.
+    """
+    alpha = np.exp(alpha)
+
     # Do the optimization
     f, p, sigma, dotsp, xprec = bift_inner_loop(f, p, B, alpha, N, sum_dia)
 
@@ -210,11 +222,177 @@ def getEvidence(params, q, i, err, N):
 
     return evidence, c, f, r
 
+@jit(nopython=True, cache=True)
+def getEvidence(params, q, i, err, N):
+
+    alpha, dmax = params
+
+    f, p, r, T, B, sum_dia, err = getEvidenceSetup(dmax, q, i, err, N)
+
+    return getEvidenceFromSetup(alpha, dmax, f, p, r, T, B, sum_dia, i, err, N)
+
+def getEvidenceBatch(pts, q, i, err, N):
+    """
+    Calculates the evidence for a list of (alpha, dmax) points. The dmax
+    dependent setup (including the transform matrix) is only calculated
+    once for consecutive points with the same dmax, so batches should be
+    ordered by dmax, e.g. a row of the alpha/dmax search grid.
+    """
+    results = []
+    setup_dmax = None
+
+    for alpha, dmax in pts:
+        if setup_dmax is None or dmax != setup_dmax:
+            f, p, r, T, B, sum_dia, err_sq = getEvidenceSetup(dmax, q, i, err, N)
+            setup_dmax = dmax
+
+        results.append(getEvidenceFromSetup(alpha, dmax, f.copy(), p.copy(),
+            r, T, B, sum_dia, i, err_sq, N))
+
+    return results
+
+def _getEvidenceBatch(args):
+    return getEvidenceBatch(*args)
+
 def getEvidenceOptimize(params, q, i, err, N):
     evidence, c, f, r = getEvidence(params, q, i, err, N)
     #Negative so you can minimize on it
     return -evidence
 
+class BiftExecutor(object):
+    """
+    A long-lived pool of worker processes for BIFT. Creating a
+    multiprocessing pool costs more than the evidence calculations for a
+    typical profile, so pools are shared by all BIFT calls (see
+    getBiftExecutor). Evidence calculations are sent to the workers in
+    batches, rather than one (alpha, dmax) point per task.
+    """
+
+    def __init__(self, nprocs=0):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        nprocs: int, optional
+            The number of worker processes. If 0, uses the number of
+            processors in the computer -1 (minimum 1).
+        """
+        if nprocs == 0:
+            self.nprocs = max(multiprocessing.cpu_count()-1, 1)
+        else:
+            self.nprocs = min(nprocs, multiprocessing.cpu_count())
+
+        self._pool = multiprocessing.Pool(processes=self.nprocs)
+
+    def imapEvidence(self, batches, q, i, err, N):
+        """
+        Calculates the evidence for batches of (alpha, dmax) points, as
+        for getEvidenceBatch. Returns an iterator that yields the list of
+        results for each batch, in order.
+        """
+        tasks = [(batch, q, i, err, N) for batch in batches]
+
+        return self._pool.imap(_getEvidenceBatch, tasks)
+
+    def mapEvidence(self, pts, q, i, err, N):
+        """
+        Calculates the evidence for a list of (alpha, dmax) points, split
+        into one batch per worker process. Returns a list of results in
+        the same order as pts.
+        """
+        n_batches = min(self.nprocs, len(pts))
+        batches = [batch for batch in np.array_split(np.arange(len(pts)),
+            n_batches) if len(batch) > 0]
+
+        results = []
+
+        for batch_results in self.imapEvidence([[pts[k] for k in batch]
+            for batch in batches], q, i, err, N):
+            results.extend(batch_results)
+
+        return results
+
+    def imapBift(self, profiles, bift_settings):
+        """
+        Runs BIFT on many profiles at once, one profile per task. Returns
+        an iterator that yields the IFT (or None if BIFT failed) for each
+        profile, in order.
+
+        Parameters
+        ----------
+        profiles: list
+            A list of (q, i, err, filename) for each profile.
+        bift_settings: dict
+            Keyword arguments for doBift, such as npts, alpha_min, etc.
+        """
+        tasks = [(profile, bift_settings) for profile in profiles]
+
+        return self._pool.imap(_doBiftTask, tasks)
+
+    def close(self):
+        """Closes the worker pool."""
+        self._pool.close()
+        self._pool.join()
+
+def _imapEvidenceRows(executor, rows, q, i, err, N):
+    # Rows are submitted one pool-width at a time so that an abort doesn't
+    # leave the rest of the grid running in the shared pool
+    for start in range(0, len(rows), executor.nprocs):
+        wave = rows[start:start+executor.nprocs]
+
+        for results in executor.imapEvidence(wave, q, i, err, N):
+            yield results
+
+def _imapBiftWaves(executor, profiles, bift_settings):
+    for start in range(0, len(profiles), executor.nprocs):
+        wave = profiles[start:start+executor.nprocs]
+
+        for iftm in executor.imapBift(wave, bift_settings):
+            yield iftm
+
+def _doBiftTask(args):
+    (q, i, err, filename), bift_settings = args
+
+    bift_settings = dict(bift_settings)
+    bift_settings['single_proc'] = True
+
+    return doBift(q, i, err, filename, **bift_settings)
+
+_bift_executors = {}
+_bift_executor_lock = threading.Lock()
+
+def getBiftExecutor(nprocs=0):
+    """
+    Gets the shared BiftExecutor with the requested number of processes,
+    creating it if necessary. There is one executor for each number of
+    processes, so a call with a different number never closes a pool that
+    another thread is using.
+    """
+    if nprocs == 0:
+        n_proc = max(multiprocessing.cpu_count()-1, 1)
+    else:
+        n_proc = min(nprocs, multiprocessing.cpu_count())
+
+    with _bift_executor_lock:
+        executor = _bift_executors.get(n_proc, None)
+
+        if executor is None:
+            executor = BiftExecutor(n_proc)
+            _bift_executors[n_proc] = executor
+
+    return executor
+
+def closeBiftExecutor():
+    """Closes the shared BiftExecutors, if there are any."""
+    with _bift_executor_lock:
+        for executor in _bift_executors.values():
+            executor.close()
+
+        _bift_executors.clear()
+
+atexit.register(closeBiftExecutor)
+
 def calc_bift_errors(opt_params, q, i, err, N, mc_runs=300, abort_check=False,
     single_proc=False, nprocs=0):
     #First, randomly generate a set of parameters similar but not quite the same as the best parameters (monte carlo)
@@ -223,14 +401,7 @@ def calc_bift_errors(opt_params, q, i, err, N, mc_runs=300, abort_check=False,
     mult = 3.0
 
     if not single_proc:
-        if nprocs == 0:
-            n_proc = max(multiprocessing.cpu_count()-1, 1)
-        else:
-            n_proc = min(nprocs, multiprocessing.cpu_count())
-        mp_pool = multiprocessing.Pool(processes=n_proc)
-        mp_get_evidence = functools.partial(getEvidence, q=q, i=i, err=err, N=N)
-    else:
-        n_proc = nprocs
+        executor = getBiftExecutor(nprocs)
 
     ev_array = np.zeros(mc_runs)
     c_array = np.zeros(mc_runs)
@@ -253,14 +424,9 @@ def calc_bift_errors(opt_params, q, i, err, N, mc_runs=300, abort_check=False,
         pts = list(zip(alpha_array, dmax_array))
 
         if not single_proc:
-            try:
-                results = mp_pool.map(mp_get_evidence, pts)
-            except Exception:
-                mp_pool.close()
-                mp_pool.join()
-                raise
+            results = executor.mapEvidence(pts, q, i, err, N)
         else:
-            results = [getEvidence(params, q, i, err, N) for params in pts]
+            results = getEvidenceBatch(pts, q, i, err, N)
 
         for res_idx, res in enumerate(results):
             dmax = dmax_array[res_idx]
@@ -289,10 +455,6 @@ def calc_bift_errors(opt_params, q, i, err, N, mc_runs=300, abort_check=False,
         else:
             run_mc = False
 
-    if not single_proc:
-        mp_pool.close()
-        mp_pool.join()
-
     #Then, calculate the probability of each result as exp(evidence - evidence_max)**(1/minimum_chisq), normalized by the sum of all result probabilities
 
     ev_max = ev_array.max()
@@ -386,41 +548,27 @@ def doBift(q, i, err, filename, npts, alpha_min, alpha_max, alpha_n, dmax_min,
 
     N = npts - 1
 
-    if not single_proc:
-        if nprocs == 0:
-            n_proc = max(multiprocessing.cpu_count()-1, 1)
-        else:
-            n_proc = min(nprocs, multiprocessing.cpu_count())
-        mp_pool = multiprocessing.Pool(processes=n_proc)
-        mp_get_evidence = functools.partial(getEvidence, q=q, i=i, err=err, N=N)
-    else:
-        n_proc = nprocs
-
     # Loop through a range of dmax and alpha to get a starting point for the minimization
 
     if abort_check.is_set():
         if queue is not None:
             queue.put({'canceled' : True})
 
-        if not single_proc:
-            mp_pool.close()
-            mp_pool.join()
-
         return None
 
-    for d_idx, dmax in enumerate(dmax_points):
+    # Each dmax row is one batch, so the transform matrix for that dmax is
+    # only calculated once per row
+    grid_pts = [[(alpha, dmax) for alpha in alpha_points] for dmax in dmax_points]
 
-        pts = [(alpha, dmax) for alpha in alpha_points]
+    if not single_proc:
+        grid_results = _imapEvidenceRows(getBiftExecutor(nprocs), grid_pts,
+            q, i, err, N)
+    else:
+        grid_results = (getEvidenceBatch(pts, q, i, err, N) for pts in grid_pts)
 
-        if not single_proc:
-            try:
-                results = mp_pool.map(mp_get_evidence, pts)
-            except Exception:
-                mp_pool.close()
-                mp_pool.join()
-                raise
-        else:
-            results = [getEvidence(params, q, i, err, N) for params in pts]
+    for d_idx, results in enumerate(grid_results):
+
+        pts = grid_pts[d_idx]
 
         for res_idx, res in enumerate(results):
             all_posteriors[d_idx, res_idx] = res[0]
@@ -441,16 +589,8 @@ def doBift(q, i, err, filename, npts, alpha_min, alpha_max, alpha_n, dmax_min,
             if queue is not None:
                 queue.put({'canceled' : True})
 
-            if not single_proc:
-                mp_pool.close()
-                mp_pool.join()
-
             return None
 
-    if not single_proc:
-        mp_pool.close()
-        mp_pool.join()
-
     if queue is not None:
         bift_status = {
             'alpha'     : pts[-1][0],
@@ -514,7 +654,7 @@ def doBift(q, i, err, filename, npts, alpha_min, alpha_max, alpha_n, dmax_min,
 
             # Use a monte carlo method to estimate the errors in pr function, values found
             err_calc = calc_bift_errors((alpha, dmax), q, i, err, N, mc_runs,
-                abort_check=abort_check, single_proc=single_proc, nprocs=n_proc)
+                abort_check=abort_check, single_proc=single_proc, nprocs=nprocs)
 
             if abort_check.is_set():
                 if queue is not None:
@@ -568,3 +708,57 @@ def doBift(q, i, err, filename, npts, alpha_min, alpha_max, alpha_n, dmax_min,
         return None
 
     return iftm
+
+def doBiftBatch(profiles, npts, alpha_min, alpha_max, alpha_n, dmax_min,
+    dmax_max, dmax_n, mc_runs, abort_check=threading.Event(),
+    single_proc=False, nprocs=0):
+    """
+    Runs BIFT on many profiles. When running in parallel, each profile is
+    a single task in the shared BiftExecutor, which is more efficient than
+    parallelizing the evidence calculations within each profile.
+
+    Parameters
+    ----------
+    profiles: list
+        A list of (q, i, err, filename) for each profile.
+    single_proc: bool, optional
+        If True, the profiles are processed one at a time in this process.
+    nprocs: int, optional
+        The number of processes to use. If 0, uses the number of processors
+        in the computer -1 (minimum 1).
+
+    Other parameters are as for doBift.
+
+    Returns
+    -------
+    iftms: list
+        A list of the IFTM for each profile, in the same order as profiles.
+        The entry is None if BIFT failed for that profile. If the
+        calculation is aborted, returns None.
+    """
+    bift_settings = {
+        'npts'      : npts,
+        'alpha_min' : alpha_min,
+        'alpha_max' : alpha_max,
+        'alpha_n'   : alpha_n,
+        'dmax_min'  : dmax_min,
+        'dmax_max'  : dmax_max,
+        'dmax_n'    : dmax_n,
+        'mc_runs'   : mc_runs,
+        }
+
+    if not single_proc:
+        results = _imapBiftWaves(getBiftExecutor(nprocs), profiles,
+            bift_settings)
+    else:
+        results = (_doBiftTask((profile, bift_settings)) for profile in profiles)
+
+    iftms = []
+
+    for iftm in results:
+        iftms.append(iftm)
+
+        if abort_check.is_set():
+            return None
+
+    return iftms
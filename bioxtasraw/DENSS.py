@@ -42,15 +42,18 @@ import sys
 import re
 import os
 import json
+import hashlib
 import struct
 import logging
 from functools import partial
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import threading
 import datetime, time
 from time import sleep
 import warnings
 import copy
+import collections
 
 import pickle
 
@@ -2057,6 +2060,233 @@ def euler2matrix(alpha=0.0,beta=0.0,gamma=0.0):
         [0, sing, cosg]]))
     return reduce(np.dot,R[::-1])
 
+def matrix2euler(R):
+    """Convert a rotation matrix to the Euler angles alpha, beta, gamma
+        used by euler2matrix (and so by transform_rho)."""
+    beta = np.arcsin(np.clip(R[0,2], -1., 1.))
+    alpha = np.arctan2(-R[0,1], R[0,0])
+    gamma = np.arctan2(-R[1,2], R[2,2])
+    return np.array([alpha, beta, gamma])
+
+def rotvec2matrix(v):
+    """Convert a rotation vector (axis times angle in radians) to a rotation matrix."""
+    theta = np.linalg.norm(v)
+    if theta == 0:
+        return np.eye(3)
+    k = v/theta
+    K = np.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+    return np.eye(3) + np.sin(theta)*K + (1-np.cos(theta))*K.dot(K)
+
+def rotation_grid(step=20.):
+    """Approximately uniform grid of rotation matrices with a spacing of
+        about step degrees. The rotation axis directions are sampled on a
+        Fibonacci sphere and combined with evenly spaced rotations about them."""
+    step = np.radians(step)
+    ndir = max(int(round(4*np.pi/step**2)), 1)
+    npsi = max(int(round(2*np.pi/step)), 1)
+    indices = np.arange(0, ndir, dtype=float) + 0.5
+    theta = np.arccos(1 - 2*indices/ndir)
+    phi = np.pi * (1 + 5**0.5) * indices
+    psi = np.arange(npsi)*2*np.pi/npsi
+    rotations = []
+    for t, p in zip(theta, phi):
+        Rdir = euler2matrix(p, 0, 0).dot(euler2matrix(0, t, 0))
+        for s in psi:
+            rotations.append(Rdir.dot(euler2matrix(s, 0, 0)))
+    return np.array(rotations)
+
+class FFTAligner(object):
+    """
+    Aligns electron density maps to a fixed reference using FFT
+    cross-correlation. The reference is centered, low-pass filtered and
+    cropped once, like in minimize_rho. For each trial rotation of the moving
+    map the best translation is then found from a single cross-correlation,
+    so only rotations need to be searched. A grid of rotations is scored in
+    batches on a binned grid, and the best candidates are refined on
+    successively finer local rotation grids and at full sampling.
+
+    The result is the same as align: the aligned map and the overlap score
+    with the reference. The transform can also be returned, as the
+    [alpha, beta, gamma, x, y, z] vector used by transform_rho.
+    """
+
+    def __init__(self, refrho, coarse_step=20., fine_step=1., topn=5,
+        sigma=1.0, coarse_samples=8, batch_size=64):
+        """
+        refrho - fixed, reference rho
+        coarse_step - spacing in degrees of the initial rotation grid
+        fine_step - final angular precision in degrees of the refinement
+        topn - number of candidates from the initial grid to refine
+        sigma - width in voxels of the gaussian low-pass filter
+        coarse_samples - approximate number of samples per side for the
+            initial grid search
+        batch_size - number of rotations scored at once
+        """
+        self.refrho = refrho
+        self.coarse_step = coarse_step
+        self.fine_step = fine_step
+        self.topn = topn
+        self.sigma = sigma
+        self.batch_size = batch_size
+
+        self.gridcenter = (np.array(refrho.shape)-1.)/2.
+        refrhocom = np.array(ndimage.measurements.center_of_mass(np.abs(refrho)))
+        self.refshift = self.gridcenter-refrhocom
+        self._refrhocen = ndimage.interpolation.shift(refrho, self.refshift,
+            order=3, mode='wrap')
+
+        #to speed it up crop out the solvent
+        n = refrho.shape[0]
+        self._crop = (int(n/4),int(3*n/4))
+        self.coarse_bin = max(int(round((self._crop[1]-self._crop[0])
+            /float(coarse_samples))), 1)
+
+        self._levels = {}
+        self._get_level(1)
+        self._get_level(self.coarse_bin)
+
+        self.rotations = rotation_grid(coarse_step)
+
+    def _get_level(self, binning):
+        """ Filtered and cropped reference sampled every binning voxels."""
+        if binning not in self._levels:
+            b, e = self._crop
+            sigma = self.sigma*binning
+            refrho = ndimage.gaussian_filter(self._refrhocen, sigma=sigma,
+                mode='wrap')
+            refrho = refrho[b:e:binning,b:e:binning,b:e:binning]
+            x_ = np.arange(b, e, binning) - self.gridcenter[0]
+            grid = np.array(np.meshgrid(x_,x_,x_,indexing='ij')).reshape(3,-1)
+
+            self._levels[binning] = {
+                'sigma'     : sigma,
+                'shape'     : refrho.shape,
+                'grid'      : grid,
+                'ref_ft'    : fft.rfftn(refrho),
+                'ref_norm'  : np.sum(refrho**2)**0.5,
+                }
+
+        return self._levels[binning]
+
+    def _score_rotations(self, level, movrho, c_in, rotations):
+        """ Overlap score and best translation of the filtered movrho for
+            each rotation, and the last cross-correlation computed."""
+        shape = level['shape']
+        scores = np.zeros(len(rotations))
+        shifts = np.zeros((len(rotations), 3), dtype=int)
+
+        for start in range(0, len(rotations), self.batch_size):
+            R = rotations[start:start+self.batch_size]
+            nrot = len(R)
+
+            #rotate about the center of mass, as in transform_rho
+            coords = np.matmul(R.transpose(0,2,1), level['grid'])
+            coords = coords.transpose(1,0,2) + c_in[:,np.newaxis,np.newaxis]
+            rotrho = ndimage.map_coordinates(movrho, coords, order=1,
+                mode='wrap').reshape((nrot,)+shape)
+
+            norm = np.sum(rotrho**2, axis=(1,2,3))**0.5
+            cc = fft.irfftn(level['ref_ft']*np.conj(fft.rfftn(rotrho,
+                axes=(1,2,3))), s=shape, axes=(1,2,3))
+
+            best = np.argmax(cc.reshape(nrot, -1), axis=1)
+            scores[start:start+nrot] = (cc.reshape(nrot, -1)[np.arange(nrot),best]
+                /(norm*level['ref_norm']))
+            shifts[start:start+nrot] = np.array(np.unravel_index(best, shape)).T
+
+        return scores, shifts, cc
+
+    def align(self, movrho, coarse=True, return_transform=False,
+        abort_event=None):
+        """ Align movrho to the reference. If coarse is False, only the local
+            refinement around the current orientation is done."""
+        c_in = np.array(ndimage.measurements.center_of_mass(np.abs(movrho)))
+        filtered = {}
+
+        def score(binning, rotations):
+            level = self._get_level(binning)
+            if binning not in filtered:
+                filtered[binning] = ndimage.gaussian_filter(movrho,
+                    sigma=level['sigma'], mode='wrap')
+            return self._score_rotations(level, filtered[binning], c_in,
+                rotations)
+
+        if coarse:
+            scores = score(self.coarse_bin, self.rotations)[0]
+            candidates = self.rotations[np.argsort(-scores)[:self.topn]]
+            delta = np.radians(self.coarse_step)/2.
+        else:
+            candidates = np.eye(3)[np.newaxis]
+            delta = np.radians(self.fine_step)*2.
+
+        offsets = np.array(np.meshgrid(*[[-1,0,1]]*3, indexing='ij')).reshape(3,-1).T
+        niter = 0
+
+        while delta >= np.radians(self.fine_step)/2.:
+            if abort_event is not None:
+                if abort_event.is_set():
+                    return (None, None, None) if return_transform else (None, None)
+
+            #refine every candidate on a local grid, then keep the best
+            dR = np.array([rotvec2matrix(delta*v) for v in offsets])
+            rotations = np.matmul(dR[np.newaxis], candidates[:,np.newaxis])
+            scores = score(max(self.coarse_bin >> (niter+1), 1),
+                rotations.reshape(-1,3,3))[0].reshape(len(candidates), -1)
+            best = np.argmax(scores, axis=1)
+            best_cand = np.argmax(scores[np.arange(len(candidates)), best])
+            candidates = rotations[best_cand, best[best_cand]][np.newaxis]
+            delta /= 2.
+            niter += 1
+
+        R = candidates[0]
+        scores, shifts, cc = score(1, R[np.newaxis])
+        shift = self._subvoxel_peak(cc[0], shifts[0])
+        shape = np.array(cc.shape[1:])
+        shift = np.where(shift > shape//2, shift-shape, shift)
+
+        #the translation is applied before the rotation in transform_rho,
+        #and also moves the map back to where refrho was
+        T = np.concatenate((matrix2euler(R), R.T.dot(self.refshift-shift)))
+        newrho = transform_rho(movrho, T)
+        finalscore = -1.*rho_overlap_score(self.refrho, newrho)
+
+        if return_transform:
+            return newrho, finalscore, T
+        else:
+            return newrho, finalscore
+
+    def _subvoxel_peak(self, cc, peak):
+        """ Refine the cross-correlation peak position with a parabola along each axis."""
+        shift = peak.astype(float)
+        for axis in range(3):
+            lo = list(peak)
+            hi = list(peak)
+            lo[axis] -= 1
+            hi[axis] = (hi[axis]+1) % cc.shape[axis]
+            ym, y0, yp = cc[tuple(lo)], cc[tuple(peak)], cc[tuple(hi)]
+            denom = ym - 2*y0 + yp
+            if denom < 0:
+                shift[axis] += 0.5*(ym-yp)/denom
+        return shift
+
+def fft_align(refrho, movrho, coarse=True, abort_event=None, aligner=None):
+    """ Align second electron density map to the first using an FFTAligner.
+        A prepared aligner for refrho can be passed in to reuse it."""
+    if abort_event is not None:
+        if abort_event.is_set():
+            return None, None
+
+    if aligner is None:
+        aligner = FFTAligner(refrho)
+
+    ne_rho = np.sum((movrho))
+    movrho, score = aligner.align(movrho, coarse=coarse, abort_event=abort_event)
+
+    if movrho is not None:
+        movrho *= ne_rho/np.sum(movrho)
+
+    return movrho, score
+
 def inertia_tensor(rho,side):
     """Calculate the moment of inertia tensor for the given electron density map."""
     halfside = side/2.
@@ -2157,12 +2387,22 @@ def generate_enantiomers(rho):
     enans = np.array([rho,rho_zflip])
     return enans
 
-def align(refrho, movrho, coarse=True, abort_event=None):
-    """ Align second electron density map to the first."""
+def align(refrho, movrho, coarse=True, abort_event=None, method='minimize',
+    aligner=None):
+    """ Align second electron density map to the first.
+
+        method - 'minimize' for a grid search followed by minimization of the
+        overlap score, or 'fft' to use an FFTAligner. aligner is an optional
+        prepared FFTAligner for refrho.
+        """
     if abort_event is not None:
         if abort_event.is_set():
             return None, None
 
+    if method == 'fft':
+        return fft_align(refrho, movrho, coarse=coarse,
+            abort_event=abort_event, aligner=aligner)
+
     try:
         sleep(1)
         ne_rho = np.sum((movrho))
@@ -2178,14 +2418,15 @@ def align(refrho, movrho, coarse=True, abort_event=None):
         print("KeyboardInterrupt")
         pass
 
-def select_best_enantiomer(refrho, rho, abort_event=None):
+def select_best_enantiomer(refrho, rho, abort_event=None, method='minimize'):
     """ Generate, align and select the enantiomer that best fits the reference map."""
     #translate refrho to center in case not already centered
     #just use roll to approximate translation to avoid interpolation, since
     #fine adjustments and interpolation will happen during alignment step
 
     try:
-        sleep(1)
+        if method != 'fft':
+            sleep(1)
         c_refrho = center_rho_roll(refrho)
         #center rho in case it is not centered. use roll to get approximate location
         #and avoid interpolation
@@ -2197,8 +2438,14 @@ def select_best_enantiomer(refrho, rho, abort_event=None):
             if abort_event.is_set():
                 return None, None
 
+        if method == 'fft':
+            aligner = FFTAligner(c_refrho)
+        else:
+            aligner = None
+
         #align each enantiomer and store the aligned maps and scores in results list
-        results = [align(c_refrho, enan, abort_event=abort_event) for enan in enans]
+        results = [align(c_refrho, enan, abort_event=abort_event,
+            method=method, aligner=aligner) for enan in enans]
 
         #now select the best enantiomer
         #rather than return the aligned and therefore interpolated enantiomer,
@@ -2215,7 +2462,7 @@ def select_best_enantiomer(refrho, rho, abort_event=None):
         pass
 
 def select_best_enantiomers(rhos, refrho=None, cores=1, avg_queue=None,
-    abort_event=None, single_proc=False):
+    abort_event=None, single_proc=False, method='minimize'):
     """ Select the best enantiomer from each map in the set (or a single map).
         refrho should not be binary averaged from the original
         denss maps, since that would likely lose handedness.
@@ -2229,7 +2476,7 @@ def select_best_enantiomers(rhos, refrho=None, cores=1, avg_queue=None,
     if not single_proc:
         pool = multiprocessing.Pool(cores)
         try:
-            mapfunc = partial(select_best_enantiomer, refrho)
+            mapfunc = partial(select_best_enantiomer, refrho, method=method)
             results = pool.map(mapfunc, rhos)
             pool.close()
             pool.join()
@@ -2240,14 +2487,27 @@ def select_best_enantiomers(rhos, refrho=None, cores=1, avg_queue=None,
             raise
 
     else:
-        results = [select_best_enantiomer(refrho=refrho, rho=rho, abort_event=abort_event) for rho in rhos]
+        results = [select_best_enantiomer(refrho=refrho, rho=rho,
+            abort_event=abort_event, method=method) for rho in rhos]
 
     best_enans = np.array([results[k][0] for k in range(len(results))])
     best_scores = np.array([results[k][1] for k in range(len(results))])
 
     return best_enans, best_scores
 
-def align_multiple(refrho, rhos, cores=1, abort_event=None, single_proc=False):
+def shift_rho_to_ref(rho, shift):
+    """ Center a map, then shift it to where the reference was (shift is
+        minus the shift returned when centering the reference)."""
+    rho = center_rho_roll(rho)
+    ne_rho = np.sum(rho)
+    #now shift rho back to where refrho was originally
+    #rho = ndimage.interpolation.shift(rho,-refshift,order=3,mode='wrap')
+    rho = np.roll(np.roll(np.roll(rho, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
+    rho *= ne_rho/np.sum(rho)
+    return rho
+
+def align_multiple(refrho, rhos, cores=1, abort_event=None, single_proc=False,
+    method='minimize'):
     """ Align multiple (or a single) maps to the reference."""
     if rhos.ndim == 3:
         rhos = rhos[np.newaxis,...]
@@ -2255,21 +2515,22 @@ def align_multiple(refrho, rhos, cores=1, abort_event=None, single_proc=False):
     cen_refrho, refshift = center_rho_roll(refrho, return_shift=True)
     shift = -refshift
     for i in range(rhos.shape[0]):
-        rhos[i] = center_rho_roll(rhos[i])
-        ne_rho = np.sum(rhos[i])
-        #now shift each rho back to where refrho was originally
-        #rhos[i] = ndimage.interpolation.shift(rhos[i],-refshift,order=3,mode='wrap')
-        rhos[i] = np.roll(np.roll(np.roll(rhos[i], shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
-        rhos[i] *= ne_rho/np.sum(rhos[i])
+        rhos[i] = shift_rho_to_ref(rhos[i], shift)
 
     if abort_event is not None:
         if abort_event.is_set():
             return None, None
 
+    #the reference only needs to be prepared once for all of the maps
+    if method == 'fft':
+        aligner = FFTAligner(refrho)
+    else:
+        aligner = None
+
     if not single_proc:
         pool = multiprocessing.Pool(cores)
         try:
-            mapfunc = partial(align, refrho)
+            mapfunc = partial(align, refrho, method=method, aligner=aligner)
             results = pool.map(mapfunc, rhos)
             pool.close()
             pool.join()
@@ -2279,32 +2540,38 @@ def align_multiple(refrho, rhos, cores=1, abort_event=None, single_proc=False):
             sys.exit(1)
             raise
     else:
-        results = [align(refrho, rho, abort_event=abort_event) for rho in rhos]
+        results = [align(refrho, rho, abort_event=abort_event, method=method,
+            aligner=aligner) for rho in rhos]
 
     rhos = np.array([results[i][0] for i in range(len(results))])
     scores = np.array([results[i][1] for i in range(len(results))])
 
     return rhos, scores
 
-def average_two(rho1, rho2, abort_event=None):
+def average_two(rho1, rho2, abort_event=None, method='minimize'):
     """ Align two electron density maps and return the average."""
-    rho2, score = align(rho1, rho2, abort_event=abort_event)
+    rho2, score = align(rho1, rho2, abort_event=abort_event, method=method)
     average_rho = (rho1+rho2)/2
     return average_rho
 
 def multi_average_two(niter, **kwargs):
     """ Wrapper script for averaging two maps for multiprocessing."""
     try:
-        sleep(1)
-        return average_two(kwargs['rho1'][niter],kwargs['rho2'][niter],abort_event=kwargs['abort_event'])
+        method = kwargs.get('method', 'minimize')
+        if method != 'fft':
+            sleep(1)
+        return average_two(kwargs['rho1'][niter],kwargs['rho2'][niter],
+            abort_event=kwargs['abort_event'], method=method)
     except KeyboardInterrupt:
         print("KeyboardInterrupt")
         pass
 
-def average_pairs(rhos, cores=1, abort_event=None, single_proc=False):
+def average_pairs(rhos, cores=1, abort_event=None, single_proc=False,
+    method='minimize'):
     """ Average pairs of electron density maps, second half to first half."""
     #create even/odd pairs, odds are the references
-    rho_args = {'rho1':rhos[::2], 'rho2':rhos[1::2], 'abort_event': abort_event}
+    rho_args = {'rho1':rhos[::2], 'rho2':rhos[1::2], 'abort_event': abort_event,
+        'method': method}
 
     if not single_proc:
         pool = multiprocessing.Pool(cores)
@@ -2324,7 +2591,8 @@ def average_pairs(rhos, cores=1, abort_event=None, single_proc=False):
 
     return np.array(average_rhos)
 
-def binary_average(rhos, cores=1, abort_event=None, single_proc=False):
+def binary_average(rhos, cores=1, abort_event=None, single_proc=False,
+    method='minimize'):
     """ Generate a reference electron density map using binary averaging."""
     twos = 2**np.arange(20)
     nmaps = np.max(twos[twos<=rhos.shape[0]])
@@ -2334,7 +2602,7 @@ def binary_average(rhos, cores=1, abort_event=None, single_proc=False):
     rhos = rhos[:nmaps]
     for level in range(levels):
         rhos = average_pairs(rhos, cores, abort_event=abort_event,
-            single_proc=single_proc)
+            single_proc=single_proc, method=method)
     refrho = center_rho_roll(rhos[0])
     return refrho
 
@@ -2395,6 +2663,47 @@ def fsc2res(fsc, cutoff=0.5, return_plot=False):
     else:
         return resn
 
+def average_aligned(aligned, scores, refrho, side, prefix, path='.'):
+    """ Average a set of maps aligned to refrho, rejecting maps with scores
+        more than 2 standard deviations below the mean, and estimate the
+        resolution from the FSC of each map against refrho. Writes the
+        average map, FSC, and a log file to path."""
+    #filter rhos with scores below the mean - 2*standard deviation.
+    mean_cor = np.mean(scores)
+    std_cor = np.std(scores)
+    threshold = mean_cor - 2*std_cor
+
+    nmaps = aligned.shape[0]
+    aligned = aligned[scores>threshold]
+    average_rho = np.mean(aligned,axis=0)
+
+    write_mrc(average_rho, side, os.path.join(path, prefix+'_average.mrc'))
+
+    #rather than compare two halves, average all fsc's to the reference
+    fscs = []
+    for calc_map in range(len(aligned)):
+        fscs.append(calc_fsc(aligned[calc_map],refrho,side))
+    fscs = np.array(fscs)
+    fsc = np.mean(fscs,axis=0)
+    x = np.linspace(fsc[0,0],fsc[-1,0],100)
+    y = np.interp(x, fsc[:,0], fsc[:,1])
+    resi = np.argmin(y>=0.5)
+    resx = np.interp(0.5,[y[resi+1],y[resi]],[x[resi+1],x[resi]])
+    resn = round(float(1./resx),1)
+    np.savetxt(os.path.join(path, prefix+'_fsc.dat'),fsc,delimiter=" ",
+        fmt="%.5e",header="1/resolution, FSC; Resolution=%.1f A" % resn)
+
+    with open(os.path.join(path, '{}_average.log'.format(prefix)), 'w') as f:
+        f.write( "Mean of correlation scores: %.3f\n" % mean_cor)
+        f.write( "Standard deviation of scores: %.3f\n" % std_cor)
+        f.write('Total number of input maps for alignment: %i\n' % nmaps)
+        f.write('Number of aligned maps accepted: %i\n' % aligned.shape[0])
+        f.write(('Correlation score between average and reference: %.3f\n'
+            % (1./rho_overlap_score(average_rho, refrho))))
+        f.write("Resolution: %.1f " % resn + 'Angstrom\n')
+
+    return average_rho, mean_cor, std_cor, threshold, resn, fsc
+
 def sigmoid(x, x0, k, b, L):
     y = L / (1 + np.exp(-k*(x-x0))) + b
     return (y)
@@ -4261,13 +4570,16 @@ class PDB2SAS(object):
 
     pdb - a saxstats PDB file object.
     q - q values to use for calculations (optional).
+    numba - use the numba versions of the calculations, if numba is available.
+    method - 'exact' or 'histogram', see calc_I (default='exact').
+    dr - histogram bin width in angstrom for the histogram method (default=0.02).
     """
-    def __init__(self, pdb, q=None, numba=True):
+    def __init__(self, pdb, q=None, numba=True, method='exact', dr=0.02):
         self.pdb = pdb
         if q is None:
             q = np.linspace(0,0.5,101)
         self.q = q
-        self.calc_I()
+        self.calc_I(numba=numba, method=method, dr=dr)
 
     def calc_form_factors(self, B=0.0):
         """Calculate the scattering of an object from a set of 3D coordinates using the Debye formula.
@@ -4278,7 +4590,13 @@ class PDB2SAS(object):
         if B.shape[0] == 1:
             B = np.ones(self.pdb.natoms) * B
         self.ff = np.zeros((self.pdb.natoms,len(self.q)))
+        #atoms of the same type with the same B have the same form factor
+        ff_cache = {}
         for i in range(self.pdb.natoms):
+            key = (self.pdb.atomtype[i], self.pdb.atomname[i], B[i])
+            if key in ff_cache:
+                self.ff[i,:] = ff_cache[key]
+                continue
             try:
                 self.ff[i,:] = formfactor(self.pdb.atomtype[i],q=self.q,B=B[i])
             except Exception as e:
@@ -4292,6 +4610,7 @@ class PDB2SAS(object):
                     print("Defaulting to Carbon form factor.")
                     print(e)
                     self.ff[i,:] = formfactor("C",q=self.q,B=B[i])
+            ff_cache[key] = self.ff[i,:]
 
     def calc_debye(self, natoms_limit=1000):
         """Calculate the scattering of an object from a set of 3D coordinates using the Debye formula.
@@ -4305,17 +4624,124 @@ class PDB2SAS(object):
             s = np.sinc(self.q * self.pdb.rij[...,None]/np.pi)
             self.I = np.einsum('iq,jq,ijq->q',self.ff,self.ff,s)
 
-    def calc_I(self, numba=True):
+    def calc_I(self, numba=True, method='exact', dr=0.02, block_size=1024):
+        """Calculate the scattering intensity using the Debye formula.
+
+        method - 'exact' sums over every pair of atoms. The pairs are
+            processed in tiles, so memory use doesn't grow with the number of atoms.
+            'histogram' bins the pair distances into histograms of width dr, one for each
+            pair of atom types, and calculates the intensity from the histograms. It is much
+            faster for large models. The error grows with q*dr, for the default dr and q up
+            to 0.5 1/A the relative error is typically ~1e-5 and at most a few times 1e-4.
+        numba - use the numba versions of the calculations, if numba is available.
+        dr - histogram bin width in angstrom (default=0.02).
+        block_size - number of atoms in a tile when numba isn't used (default=1024).
+        """
         self.calc_form_factors()
-        if numba:
-            try:
-                #try numba function first
-                self.I = calc_debye_numba(self.pdb.coords, self.q, self.ff)
-            except:
-                print("numba failed. Calculating debye slowly.")
-                self.calc_debye()
+        if method == 'histogram':
+            self.I = calc_debye_histogram(self.pdb.coords, self.q, self.ff,
+                dr=dr, use_numba=numba, block_size=block_size)
+        elif method == 'exact':
+            if numba:
+                try:
+                    #try numba function first
+                    self.I = calc_debye_numba(self.pdb.coords, self.q, self.ff)
+                except:
+                    print("numba failed. Calculating debye slowly.")
+                    self.I = calc_debye_tiled(self.pdb.coords, self.q, self.ff,
+                        block_size)
+            else:
+                self.I = calc_debye_tiled(self.pdb.coords, self.q, self.ff,
+                    block_size)
         else:
-            self.calc_debye()
+            raise ValueError("method must be 'exact' or 'histogram'")
+
+def calc_debye_tiled(coords, q, ff, block_size=1024):
+    """Calculate the scattering of an object from a set of 3D coordinates using the Debye formula.
+    The atom pairs are processed in block_size x block_size tiles to bound the memory use.
+    coords - Nx3 array of coordinates of atoms (like pdb.coords)
+    q - q values to use for calculations.
+    ff - an array of form factors calculated for each atom in a pdb object. q's much match q array.
+    """
+    coords = coords[:,:3]
+    natoms = coords.shape[0]
+    #self terms
+    I = np.sum(ff**2, axis=0)
+    for si in range(0, natoms, block_size):
+        ei = min(si+block_size, natoms)
+        for sj in range(si, natoms, block_size):
+            ej = min(sj+block_size, natoms)
+            r = spatial.distance.cdist(coords[si:ei], coords[sj:ej])
+            if sj == si:
+                #only count each pair in the diagonal tile once
+                mask = np.triu(np.ones(r.shape, dtype=bool), 1)
+            else:
+                mask = None
+            for k in range(len(q)):
+                s = np.sinc(q[k]*r/np.pi)
+                if mask is not None:
+                    s *= mask
+                I[k] += 2*(ff[si:ei,k] @ s @ ff[sj:ej,k])
+    return I
+
+def calc_debye_histogram(coords, q, ff, dr=0.02, use_numba=True, block_size=1024):
+    """Calculate the scattering of an object from a set of 3D coordinates using the Debye formula,
+    evaluated from histograms of the pair distances.
+
+    Atoms with identical form factors are grouped into classes, the distances between every pair
+    of atoms are binned once into a histogram for each pair of classes, and the intensity is
+    I(q) = sum_a N_a f_a(q)**2 + 2 sum_ab f_a(q) f_b(q) sum_k H_ab(r_k) sinc(q r_k)
+    where r_k = k*dr are the bin centers.
+    coords - Nx3 array of coordinates of atoms (like pdb.coords)
+    q - q values to use for calculations.
+    ff - an array of form factors calculated for each atom in a pdb object. q's much match q array.
+    dr - histogram bin width in angstrom.
+    use_numba - use numba to calculate the histograms, if numba is available.
+    block_size - number of atoms in a tile for the histograms if numba isn't used.
+    """
+    coords = np.ascontiguousarray(coords[:,:3], dtype=np.float64)
+    class_ff, atom_class = np.unique(ff, axis=0, return_inverse=True)
+    atom_class = atom_class.ravel().astype(np.int64)
+    nclasses = class_ff.shape[0]
+
+    #upper bound on the maximum dimension
+    dmax = 2*np.max(np.linalg.norm(coords-coords.mean(axis=0), axis=1))
+    nbins = int(dmax/dr)+2
+
+    if use_numba and numba:
+        nchunks = nb.get_num_threads()
+        hist = debye_histograms_numba(coords, atom_class, nclasses, dr, nbins,
+            nchunks)
+    else:
+        hist = debye_histograms_tiled(coords, atom_class, nclasses, dr, nbins,
+            block_size)
+
+    r = np.arange(nbins)*dr
+    sinc = np.sinc(np.outer(r, q)/np.pi)
+    pair_sums = (hist.reshape(nclasses*nclasses, nbins) @ sinc).reshape(nclasses, nclasses, len(q))
+
+    counts = np.bincount(atom_class, minlength=nclasses)
+    I = np.sum(counts[:,None]*class_ff**2, axis=0)
+    I += 2*np.einsum('aq,bq,abq->q', class_ff, class_ff, pair_sums)
+    return I
+
+def debye_histograms_tiled(coords, atom_class, nclasses, dr, nbins, block_size=1024):
+    """Histogram the distances between every pair of atoms i<j for each pair of atom classes,
+    processing the pairs in tiles. Returns an array with shape (nclasses, nclasses, nbins).
+    """
+    natoms = coords.shape[0]
+    hist = np.zeros(nclasses*nclasses*nbins)
+    for si in range(0, natoms, block_size):
+        ei = min(si+block_size, natoms)
+        for sj in range(si, natoms, block_size):
+            ej = min(sj+block_size, natoms)
+            r = spatial.distance.cdist(coords[si:ei], coords[sj:ej])
+            idx = ((atom_class[si:ei,None]*nclasses + atom_class[None,sj:ej])*nbins
+                + (r/dr+0.5).astype(np.int64))
+            if sj == si:
+                idx = idx[np.triu_indices(ei-si, 1)]
+            hist += np.bincount(idx.ravel(), minlength=hist.size)
+    return hist.reshape(nclasses, nclasses, nbins)
 
 if numba:
     @nb.njit(fastmath=True,parallel=True,error_model="numpy",cache=True)
@@ -4335,32 +4761,66 @@ if numba:
                 C[i,j]=np.sqrt(acc)
         return C
 
-    @nb.njit(fastmath=True,parallel=True,error_model="numpy",cache=True)
     def calc_debye_numba(coords, q, ff):
         """Calculate the scattering of an object from a set of 3D coordinates using the Debye formula.
-        This function is intended to be used with the numba njit decorator for speed.
+        Each pair distance is calculated once, and the atoms are split into interleaved
+        chunks with separate accumulators, so the memory used is independent of the number of atoms.
         coords - Nx3 array of coordinates of atoms (like pdb.coords)
         q - q values to use for calculations.
         ff - an array of form factors calculated for each atom in a pdb object. q's much match q array.
         """
+        return debye_pairs_numba(np.ascontiguousarray(coords[:,:3], dtype=np.float64),
+            q, ff, nb.get_num_threads())
+
+    @nb.njit(fastmath=True,parallel=True,error_model="numpy",cache=True)
+    def debye_pairs_numba(coords, q, ff, nchunks):
+        """Sum the Debye formula over every pair of atoms. See calc_debye_numba."""
         nr = coords.shape[0]
         nq = q.shape[0]
-        I = np.empty(nq, np.float64)
-        ff_T = np.ascontiguousarray(ff.T)
-        for qi in nb.prange(nq):
-            acc=0
-            for ri in nb.prange(nr):
-                for rj in nb.prange(nr):
-                    #loop through all atoms, and add the debye formulism for the pair
-                    qri_j = q[qi] * np.linalg.norm(coords[ri]-coords[rj])
-                    if qri_j != 0:
-                        s = np.sin(qri_j)/(qri_j)
-                    else:
-                        s = 1.0
-                    acc += ff_T[qi,ri]*ff_T[qi,rj]*s
-            I[qi]=acc
+        acc = np.zeros((nchunks, nq))
+        for c in nb.prange(nchunks):
+            for ri in range(c, nr, nchunks):
+                for qi in range(nq):
+                    acc[c,qi] += ff[ri,qi]*ff[ri,qi]
+                for rj in range(ri+1, nr):
+                    d = np.sqrt((coords[ri,0]-coords[rj,0])**2
+                        + (coords[ri,1]-coords[rj,1])**2
+                        + (coords[ri,2]-coords[rj,2])**2)
+                    for qi in range(nq):
+                        #add the debye formulism for the pair, counted for ij and ji
+                        qri_j = q[qi] * d
+                        if qri_j != 0:
+                            s = np.sin(qri_j)/(qri_j)
+                        else:
+                            s = 1.0
+                        acc[c,qi] += 2*ff[ri,qi]*ff[rj,qi]*s
+        I = np.zeros(nq)
+        for c in range(nchunks):
+            for qi in range(nq):
+                I[qi] += acc[c,qi]
         return I
 
+    @nb.njit(parallel=True,cache=True)
+    def debye_histograms_numba(coords, atom_class, nclasses, dr, nbins, nchunks):
+        """Histogram the distances between every pair of atoms i<j for each pair of atom classes.
+        Atoms are split into interleaved chunks, each with its own histogram, so the
+        chunks can run in parallel. Returns an array with shape (nclasses, nclasses, nbins).
+        """
+        nr = coords.shape[0]
+        hists = np.zeros((nchunks, nclasses, nclasses, nbins), dtype=np.int32)
+        for c in nb.prange(nchunks):
+            for ri in range(c, nr, nchunks):
+                ci = atom_class[ri]
+                for rj in range(ri+1, nr):
+                    d = np.sqrt((coords[ri,0]-coords[rj,0])**2
+                        + (coords[ri,1]-coords[rj,1])**2
+                        + (coords[ri,2]-coords[rj,2])**2)
+                    hists[c,ci,atom_class[rj],int(d/dr+0.5)] += 1
+        hist = np.zeros((nclasses, nclasses, nbins))
+        for c in range(nchunks):
+            hist += hists[c]
+        return hist
+
 def pdb2map_simple_gauss_by_radius(pdb,x,y,z,cutoff=3.0,global_B=None,rho0=0.334,ignore_waters=True):
     """Simple isotropic single gaussian sum at coordinate locations.
 
@@ -5162,6 +5622,21 @@ def pdb2mrc_to_sasm(pdb2mrc):
 
     return theory, fit
 
+def pdb2sas_to_sasm(pdb, q, method='histogram', dr=0.02):
+    """Calculate the in vacuo scattering of the atoms in a PDB object at the
+    given q values with the Debye formula (PDB2SAS), and return it as a SASM."""
+    pdb2sas = PDB2SAS(pdb, q=q, method=method, dr=dr)
+    I = pdb2sas.I
+
+    debye_fn = os.path.splitext(os.path.basename(pdb.filename))[0] + '_debye.dat'
+    debye = SASM.SASM(
+        i=I,
+        q=q,
+        err=I*0.01 + I[0]*0.002, #simulated errors, as for pdb2mrc
+        parameters={"filename":debye_fn})
+
+    return debye
+
 def runDenss(q, I, sigq, D, qraw, iraw, sigqraw, prefix, path, denss_settings,
     avg_model=None, comm_list=None, my_lock=None, thread_num_q=None, wx_queue=None,
     abort_event=None, gui=True, log_id=None):
@@ -5366,7 +5841,7 @@ def runDenss(q, I, sigq, D, qraw, iraw, sigqraw, prefix, path, denss_settings,
     return data
 
 def run_enantiomers(rhos, cores, num=0, avg_q=None, my_lock=None, wx_queue=None,
-    abort_event=None, single_proc=False, gui=True):
+    abort_event=None, single_proc=False, gui=True, method='minimize'):
 
     if gui:
         #Check to see if things have been aborted
@@ -5379,7 +5854,7 @@ def run_enantiomers(rhos, cores, num=0, avg_q=None, my_lock=None, wx_queue=None,
             return None, None
 
     best_enans, scores = select_best_enantiomers(rhos, rhos[0], cores, avg_q,
-        abort_event, single_proc)
+        abort_event, single_proc, method)
 
     if gui:
         if abort_event.is_set():
@@ -5393,7 +5868,7 @@ def run_enantiomers(rhos, cores, num=0, avg_q=None, my_lock=None, wx_queue=None,
 
 def run_align(allrhos, sides, ref_file, avg_q=None, abort_event=None, center=True,
     resolution=15.0, enantiomer=True, cores=1, single_proc=False, gui=True,
-    ignore_waters=True):
+    ignore_waters=True, method='minimize'):
     #based on denss.align.py
 
     if gui:
@@ -5443,7 +5918,7 @@ def run_align(allrhos, sides, ref_file, avg_q=None, abort_event=None, center=Tru
         if gui:
             avg_q.put_nowait('Selecting best enantiomer...\n')
         allrhos, scores = select_best_enantiomers(allrhos, refrho, cores,
-            avg_q, abort_event, single_proc)
+            avg_q, abort_event, single_proc, method)
 
     if gui:
         if abort_event.is_set():
@@ -5453,10 +5928,296 @@ def run_align(allrhos, sides, ref_file, avg_q=None, abort_event=None, center=Tru
             avg_q.put_nowait('Aligning model(s) to reference\n')
 
     aligned, scores = align_multiple(refrho, allrhos, cores, abort_event,
-        single_proc)
+        single_proc, method)
 
     return aligned, scores
 
+class DenssEnsemble(object):
+    """
+    Runs a set of DENSS reconstructions, and optionally averages them, in a
+    single process pool. At most cores tasks are run at once, so a new
+    reconstruction starts whenever a worker frees up. The enantiomer
+    selection, reference building, and alignment steps of the average are
+    started as soon as the maps they need are finished, and take priority
+    over new reconstructions, rather than waiting for every reconstruction to
+    finish. The average is the same as running select_best_enantiomers,
+    binary_average, and align_multiple on the finished maps.
+
+    Each finished reconstruction is saved to a checkpoint file in the output
+    directory, along with a hash of the input data and settings. If resume
+    is True, reconstructions with a checkpoint made from the same data and
+    settings are loaded instead of being run again, so an interrupted
+    ensemble can be restarted with the same prefix and path. The checkpoints
+    are removed once the ensemble finishes.
+
+    align_method sets the alignment used for the average (see align). With
+    'fft' the FFTAligner for the reference is prepared once and shared by
+    all of the alignment tasks.
+    """
+
+    _checkpoint_keys = ['qdata', 'Idata', 'sigqdata', 'qbinsc', 'Imean', 'chi',
+        'rg', 'supportV', 'rho', 'side', 'fit', 'final_chi2']
+
+    def __init__(self, q, I, sigq, D, qraw, iraw, sigqraw, prefix, path,
+        denss_settings, nruns, cores=1, average=True, resume=False,
+        abort_event=None, align_method='minimize'):
+        if average and nruns < 4:
+            raise ValueError('At least four reconstructions are needed to '
+                'average.')
+
+        self.q = q
+        self.I = I
+        self.sigq = sigq
+        self.D = D
+        self.qraw = qraw
+        self.iraw = iraw
+        self.sigqraw = sigqraw
+        self.prefix = prefix
+        self.path = path
+        self.denss_settings = denss_settings
+        self.nruns = nruns
+        self.cores = max(int(cores), 1)
+        self.average = average
+        self.resume = resume
+        self.abort_event = abort_event
+        self.align_method = align_method
+
+        self.results = [None for i in range(nruns)]
+        self.enans = [None for i in range(nruns)]
+        self.aligned = [None for i in range(nruns)]
+        self.scores = [None for i in range(nruns)]
+        self.refrho = None
+        self.average_results = None
+        self._ref_shift = None
+        self._aligner = None
+
+        #binary_average builds the reference from the first 2**levels maps
+        twos = 2**np.arange(20)
+        nmaps = np.max([np.max(twos[twos<=nruns]), 8])
+        self._levels = int(np.log2(nmaps))-1
+        self._tree = [{} for i in range(self._levels+1)]
+
+        self._ready = collections.deque()
+        self._running = {}
+        self._next_run = 0
+
+        self._input_hash = self._make_input_hash()
+
+    def run_prefix(self, run):
+        """ The output prefix of a reconstruction, matching the GUI."""
+        return '{}_{}'.format(self.prefix, str(run+1).zfill(2))
+
+    def checkpoint_file(self, run):
+        return os.path.join(self.path, self.run_prefix(run)+'_checkpoint.npz')
+
+    def run(self):
+        """ Run the ensemble. Returns False if it was aborted."""
+        manager = multiprocessing.Manager()
+        self._worker_abort = manager.Event()
+
+        executor = ProcessPoolExecutor(self.cores)
+
+        try:
+            for run in range(self.nruns):
+                if self.resume and os.path.exists(self.checkpoint_file(run)):
+                    result = self._load_checkpoint(run)
+
+                    if result is not None:
+                        self._denss_finished(run, result)
+
+            self._fill(executor)
+
+            while self._running:
+                done, not_done = wait(list(self._running.keys()), timeout=0.5,
+                    return_when=FIRST_COMPLETED)
+
+                if self.abort_event is not None and self.abort_event.is_set():
+                    self._worker_abort.set()
+                    return False
+
+                for future in done:
+                    task, key = self._running.pop(future)
+                    result = future.result()
+
+                    if task == 'denss':
+                        if len(result) == 0:
+                            raise Exception('DENSS run {} failed to run '
+                                'properly'.format(key+1))
+
+                        self._save_checkpoint(key, result)
+                        self._denss_finished(key, result)
+
+                    elif task == 'enantiomer':
+                        self._enantiomer_finished(key, result[0])
+
+                    elif task == 'average':
+                        self._average_finished(key, result)
+
+                    elif task == 'align':
+                        self.aligned[key] = result[0]
+                        self.scores[key] = result[1]
+
+                self._fill(executor)
+
+        finally:
+            for future in self._running:
+                future.cancel()
+
+            executor.shutdown()
+            manager.shutdown()
+
+        if self.average:
+            side = self.results[0][9]
+            self.average_results = average_aligned(np.array(self.aligned),
+                np.array(self.scores), self.refrho, side, self.prefix,
+                self.path)
+
+        for run in range(self.nruns):
+            if os.path.exists(self.checkpoint_file(run)):
+                os.remove(self.checkpoint_file(run))
+
+        return True
+
+    def _fill(self, executor):
+        """ Start queued averaging tasks first, then new reconstructions,
+            until all of the workers are busy."""
+        while len(self._running) < self.cores:
+            if self._ready:
+                task, key, func, args = self._ready.popleft()
+
+            elif self._next_run < self.nruns:
+                run = self._next_run
+                self._next_run += 1
+
+                if self.results[run] is not None:
+                    continue
+
+                settings = copy.copy(self.denss_settings)
+
+                if settings.get('seed') is not None:
+                    settings['seed'] = settings['seed'] + run
+
+                task = 'denss'
+                key = run
+                func = partial(runDenss, gui=False,
+                    abort_event=self._worker_abort,
+                    log_id='{}_{}'.format(self.prefix, run))
+                args = (self.q, self.I, self.sigq, self.D, self.qraw,
+                    self.iraw, self.sigqraw, self.run_prefix(run), self.path,
+                    settings)
+
+            else:
+                break
+
+            future = executor.submit(func, *args)
+            self._running[future] = (task, key)
+
+    def _queue(self, task, key, func, *args):
+        self._ready.append((task, key, func, args))
+
+    def _denss_finished(self, run, result):
+        self.results[run] = result
+
+        if not self.average:
+            return
+
+        if run == 0:
+            #The first map is the reference for the enantiomer selection
+            for j in range(self.nruns):
+                if self.results[j] is not None:
+                    self._queue_enantiomer(j)
+
+        elif self.results[0] is not None:
+            self._queue_enantiomer(run)
+
+    def _queue_enantiomer(self, run):
+        self._queue('enantiomer', run, partial(select_best_enantiomer,
+            method=self.align_method), self.results[0][8],
+            self.results[run][8])
+
+    def _enantiomer_finished(self, run, enan):
+        self.enans[run] = enan
+
+        if run < 2**self._levels:
+            self._tree[0][run] = enan
+            self._queue_pair_average(0, run//2)
+
+        if self.refrho is not None:
+            self._queue_align(run)
+
+    def _queue_pair_average(self, level, pair):
+        maps = self._tree[level]
+
+        if 2*pair in maps and 2*pair+1 in maps:
+            self._queue('average', (level, pair), partial(average_two,
+                method=self.align_method), maps[2*pair], maps[2*pair+1])
+
+    def _average_finished(self, key, rho):
+        level, pair = key
+        level += 1
+
+        self._tree[level][pair] = rho
+
+        if level < self._levels:
+            self._queue_pair_average(level, pair//2)
+
+        else:
+            self.refrho = center_rho_roll(rho)
+            self._ref_shift = -center_rho_roll(self.refrho, return_shift=True)[1]
+
+            if self.align_method == 'fft':
+                self._aligner = FFTAligner(self.refrho)
+
+            for run in range(self.nruns):
+                if self.enans[run] is not None:
+                    self._queue_align(run)
+
+    def _queue_align(self, run):
+        rho = shift_rho_to_ref(self.enans[run], self._ref_shift)
+
+        self._queue('align', run, partial(align, method=self.align_method,
+            aligner=self._aligner), self.refrho, rho)
+
+    def _make_input_hash(self):
+        """ A hash of the reconstruction input data and settings, so that
+            checkpoints from a different input aren't resumed."""
+        input_hash = hashlib.sha256()
+
+        for data in (self.q, self.I, self.sigq, self.qraw, self.iraw,
+            self.sigqraw):
+            input_hash.update(np.ascontiguousarray(data,
+                dtype=np.float64).tobytes())
+
+        input_hash.update(repr(float(self.D)).encode())
+
+        for key in sorted(self.denss_settings):
+            input_hash.update(repr((key, self.denss_settings[key])).encode())
+
+        return input_hash.hexdigest()
+
+    def _save_checkpoint(self, run, result):
+        fname = self.checkpoint_file(run)
+        tmp_fname = fname + '.tmp.npz'
+
+        np.savez(tmp_fname, input_hash=self._input_hash,
+            **dict(zip(self._checkpoint_keys, result)))
+        os.replace(tmp_fname, fname)
+
+    def _load_checkpoint(self, run):
+        """ Loads a checkpoint. Returns None if it was made from different
+            input data or settings."""
+        with np.load(self.checkpoint_file(run)) as data:
+            if ('input_hash' not in data.files
+                or str(data['input_hash']) != self._input_hash):
+                return None
+
+            result = [data[key] for key in self._checkpoint_keys]
+
+        result[9] = float(result[9])
+        result[11] = float(result[11])
+
+        return tuple(result)
+
 def run_pdb2mrc(
     pdb_fname,
     exp_fname=None,
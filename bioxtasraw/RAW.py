@@ -92,6 +92,7 @@ import bioxtasraw.SASExceptions as SASExceptions
 import bioxtasraw.SASCalc as SASCalc
 import bioxtasraw.SASCalib as SASCalib
 import bioxtasraw.SASMask as SASMask
+import bioxtasraw.SASOnline as SASOnline
 import bioxtasraw.RAWPlot as RAWPlot
 import bioxtasraw.RAWImage as RAWImage
 import bioxtasraw.RAWOptions as RAWOptions
@@ -3552,7 +3553,8 @@ class OnlineController(object):
 
         self.online_timer.Bind(wx.EVT_TIMER, self.onOnlineTimer)
 
-        self.old_dir_list_dict = {}
+        self.watcher = None
+        self._last_sizes = {}
         self.is_online = False
         self.seek_dir = []
         self.bg_filename = None
@@ -3595,14 +3597,7 @@ class OnlineController(object):
             found_path = self.selectSearchDir()
 
             if found_path is not None:
-                dir_list = os.listdir(self.seek_dir)
-
-                dir_list_dict = {}
-                for each_file in dir_list:
-                    dir_list_dict[each_file] = (os.path.getmtime(os.path.join(self.seek_dir, each_file)),
-                        os.path.getsize(os.path.join(self.seek_dir, each_file)))
-
-                self.old_dir_list_dict = dir_list_dict
+                self._startWatcher()
 
                 return True
 
@@ -3616,14 +3611,7 @@ class OnlineController(object):
             found_path = True
 
         if found_path:
-            dir_list = os.listdir(self.seek_dir)
-
-            dir_list_dict = {}
-            for each_file in dir_list:
-                dir_list_dict[each_file] = (os.path.getmtime(os.path.join(self.seek_dir, each_file)),
-                    os.path.getsize(os.path.join(self.seek_dir, each_file)))
-
-            self.old_dir_list_dict = dir_list_dict
+            self._startWatcher()
 
             self.online_timer.Start(2000)
             return True
@@ -3633,8 +3621,19 @@ class OnlineController(object):
     def goOffline(self):
         self.main_frame.setStatus('', 0)
 
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
         return self.online_timer.Stop()
 
+    def _startWatcher(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+
+        self.watcher = SASOnline.DirectoryWatcher(self.seek_dir)
+        self.watcher.start()
+
     def startTimer(self):
         return self.online_timer.Start(2000)
 
@@ -3686,99 +3685,45 @@ class OnlineController(object):
                 item.Check(True)
                 return
 
-        dir_list = os.listdir(self.seek_dir)
-
-        dir_list_dict = {}
-
-        for each_file in dir_list:
-            try:
-                dir_list_dict[each_file] = (os.path.getmtime(os.path.join(self.seek_dir, each_file)), os.path.getsize(os.path.join(self.seek_dir, each_file)))
-            except OSError:
-                pass
+        if self.watcher is None:
+            return
 
-        diff_list = list(set(dir_list_dict.items()) - set(self.old_dir_list_dict.items()))
-        diff_list.sort(key = lambda name: name[0])
+        events = self.watcher.getEvents()
 
         files_to_plot=[]
 
-        if diff_list != []:
-            if not self._enable_filt:
-
-                for each in diff_list:
-                    each_newfile = each[0]
-
-                    process_str = 'Processing incomming file: ' + str(each_newfile)
-                    self.main_frame.setStatus(process_str, 0)
-
-                    filepath = os.path.join(self.seek_dir, str(each_newfile))
-
-                    if self._fileTypeIsCompatible(filepath):
-
-                        if each_newfile in self.old_dir_list_dict:
-                            #ONLY UPDATE IMAGE
-                            mainworker_cmd_queue.put(['online_mode_update_data', [filepath]])
-                            print('Changed: ' + str(each_newfile))
-                        else:
-                            print(process_str)
-                            files_to_plot.append(filepath)
-                            # mainworker_cmd_queue.put(['plot', [filepath]])
-                            #UPDATE PLOT
+        for event in events:
+            each_newfile = event.name
 
+            if self._enable_filt:
+                load = SASOnline.filterFilename(each_newfile, self._filt_list)
             else:
-                for each in diff_list:
-                    load=True
-                    each_newfile = each[0]
-
-                    for item in self._filt_list:
-                        if item[0]=='Ignore':
-                            if item[2]=='At start':
-                                if each_newfile.startswith(item[1]):
-                                    load=False
-                            elif item[2]=='Anywhere':
-                                if each_newfile.find(item[1])!=-1:
-                                    load=False
-                            else:
-                                if each_newfile.endswith(item[1]):
-                                    load=False
-                        else:
-                            if item[2]=='At start':
-                                if not each_newfile.startswith(item[1]):
-                                    load=False
-                            elif item[2]=='Anywhere':
-                                if not each_newfile.find(item[1])!=-1:
-                                    load=False
-                            else:
-                                if not each_newfile.endswith(item[1]):
-                                    load=False
+                load = True
 
-                    if load:
-                        process_str = 'Processing incomming file: ' + str(each_newfile)
-                        self.main_frame.setStatus(process_str, 0)
+            if load:
+                process_str = 'Processing incomming file: ' + str(each_newfile)
+                self.main_frame.setStatus(process_str, 0)
 
-                        filepath = os.path.join(self.seek_dir, str(each_newfile))
+                filepath = event.path
 
-                        if self._fileTypeIsCompatible(filepath):
+                if self._fileTypeIsCompatible(filepath):
 
-                            if each_newfile in self.old_dir_list_dict:
-                                if each[1][1] == self.old_dir_list_dict[each_newfile][1]:
-                                    #If the size is the same, ONLY UPDATE IMAGE
-                                    mainworker_cmd_queue.put(['online_mode_update_data', [filepath]])
-                                    print('Changed: ' + str(each_newfile))
-                                else:
-                                    print(process_str)
-                                    files_to_plot.append(filepath)
-                            else:
-                                print(process_str)
-                                files_to_plot.append(filepath)
-                                # mainworker_cmd_queue.put(['plot', [filepath]])
-                                #UPDATE PLOT
+                    if (event.type == 'modified' and (not self._enable_filt
+                        or event.size == self._last_sizes.get(each_newfile, None))):
+                        #If the size is the same, ONLY UPDATE IMAGE
+                        mainworker_cmd_queue.put(['online_mode_update_data', [filepath]])
+                        print('Changed: ' + str(each_newfile))
                     else:
-                        print('Ignored: '+str(each_newfile))
+                        print(process_str)
+                        files_to_plot.append(filepath)
+                        #UPDATE PLOT
+            else:
+                print('Ignored: '+str(each_newfile))
 
-            if len(files_to_plot) > 0:
-                mainworker_cmd_queue.put(['plot', files_to_plot])
+            self._last_sizes[each_newfile] = event.size
 
-            self.old_dir_list_dict.update(diff_list)
+        if len(files_to_plot) > 0:
+            mainworker_cmd_queue.put(['plot', files_to_plot])
 
 
     def _fileTypeIsCompatible(self, path):
@@ -3792,16 +3737,8 @@ class OnlineController(object):
             return False
 
     def updateSkipList(self, file_list):
-        dir_list_dict = {}
-
-        for each_file in file_list:
-            dir_list_dict[each_file] = (os.path.getmtime(os.path.join(self.seek_dir, each_file)),
-                os.path.getsize(os.path.join(self.seek_dir, each_file)))
-
-        diff_list = list(set(dir_list_dict.items()) - set(self.old_dir_list_dict.items()))
-        diff_list.sort(key = lambda name: name[0])
-
-        self.old_dir_list_dict.update(diff_list)
+        if self.watcher is not None:
+            self.watcher.skip(file_list)
 
 class OnlineSECController(object):
     def __init__(self, parent, raw_settings):
@@ -4989,136 +4926,19 @@ class MainWorkerThread(threading.Thread):
 
 
         if secm.baseline_subtracted_sasm_list:
-            r1_start = secm.baseline_start_range[0]
-            r1_end = secm.baseline_start_range[1]
-            r2_start = secm.baseline_end_range[0]
-            r2_end = secm.baseline_end_range[1]
-
-            bl_type = secm.baseline_type
-            bl_extrap = secm.baseline_extrap
-
-            new_sasms = secm.subtracted_sasm_list[first_frame:]
-
-            bl_sasms = []
-            baselines = secm.baseline_corr
-            fit_results = secm.baseline_fit_results
-
-            bl_q = copy.deepcopy(new_sasms[0].getQ())
-            bl_err = np.zeros_like(new_sasms[0].getQ())
-            new_baselines = []
-
-            for j, sasm in enumerate(new_sasms):
-                idx = j + first_frame
-                q = copy.deepcopy(sasm.getQ())
-
-                if bl_type == 'Integral':
-                    if idx < r1_start:
-                        baseline = baselines[0].getI()
-                        i = copy.deepcopy(sasm.getI())
-                        err = copy.deepcopy(sasm.getErr())
-                    elif idx >= r1_end and idx < r2_start:
-                        baseline = baselines[idx-r1_end].getI()
-                        i = sasm.getI() - baseline
-                        err = sasm.getErr() * i/sasm.getI()
-                    else:
-                        baseline = baselines[-1].getI()
-                        i = sasm.getI() - baseline
-                        err = sasm.getErr() * i/sasm.getI()
-
-                elif bl_type == 'Linear':
-
-                    if bl_extrap:
-                        baseline = np.array([SASCalc.linear_func(idx, fit[0], fit[1]) for fit in fit_results])
-                        i = sasm.getI() - baseline
-                        err = sasm.getErr() * i/sasm.getI()
-
-                        bl_newSASM = SASM.SASM(baseline, bl_q, bl_err, {})
-                        new_baselines.append(bl_newSASM)
-
-                    else:
-                        if idx >= r1_start and idx <= r2_end:
-                            baseline = np.array([SASCalc.linear_func(idx, fit[0], fit[1]) for fit in fit_results])
-                            i = sasm.getI() - baseline
-                            err = sasm.getErr() * i/sasm.getI()
-
-                            bl_newSASM = SASM.SASM(baseline, bl_q, bl_err, {})
-                            new_baselines.append(bl_newSASM)
-                        else:
-                            i = copy.deepcopy(sasm.getI())
-                            err = copy.deepcopy(sasm.getErr())
-                            baseline = np.zeros_like(i)
-
-                parameters = copy.deepcopy(sasm.getAllParameters())
-
-                old_history = parameters['history']
-
-                history1 = []
-                history1.append(copy.deepcopy(sasm.getParameter('filename')))
-
-                for key in old_history:
-                    history1.append({key:old_history[key]})
-
-                history = {}
-                history['baseline_correction'] = {'initial_file':history1,
-                    'type':bl_type}
-
-                parameters['history'] = history
-
-                newSASM = SASM.SASM(i, q, err, parameters, copy.deepcopy(sasm.getQErr()))
-
-                bl_sasms.append(newSASM)
-
-            if bl_type == 'Linear':
-                if bl_extrap:
-                    baselines = baselines[:-window_size]+new_baselines
-                else:
-                    if first_frame <= r2_end:
-                        bl_idx = min(r2_end-first_frame, window_size)
-                        baselines = baselines[:-bl_idx] + new_baselines
-
-            baseline_use_subtracted_sasms = []
-
-            buffer_sub_sasms = secm.subtracted_sasm_list
-            start_sasms = [buffer_sub_sasms[k] for k in range(r1_start, r1_end+1)]
-
-            start_avg_sasm = SASProc.average(start_sasms, forced=True,
-                copy_params=False)
-
-            if  plot_y == 'total':
-                ref_intensity = start_avg_sasm.getTotalI()
-            elif plot_y == 'mean':
-                ref_intensity = start_avg_sasm.getMeanI()
-            elif plot_y == 'q_val':
-                qref = float(self.plot_page.q_val.GetValue())
-                ref_intensity = start_avg_sasm.getIofQ(qref)
-            elif plot_y == 'q_range':
-                q1 = float(self.plot_page.q_range_start.GetValue())
-                q2 = float(self.plot_page.q_range_end.GetValue())
-                ref_intensity = start_avg_sasm.getIofQRange(q1, q2)
-
-            for sasm in bl_sasms:
-                if plot_y == 'total':
-                    sasm_intensity = sasm.getTotalI()
-                elif plot_y == 'mean':
-                    sasm_intensity = sasm.getMeanI()
-                elif plot_y == 'q_val':
-                    sasm_intensity = sasm.getIofQ(qref)
-                elif plot_y == 'q_range':
-                    sasm_intensity = sasm.getIofQRange(q1, q2)
-
-                if abs(sasm_intensity/ref_intensity) > threshold:
-                    baseline_use_subtracted_sasms.append(True)
-                else:
-                    baseline_use_subtracted_sasms.append(False)
-
-            secm.appendBCSubtractedSASMs(bl_sasms, baseline_use_subtracted_sasms,
-                window_size)
-            secm.baseline_corr = baselines
-
-            success, results = SASCalc.run_secm_calcs(bl_sasms,
-                baseline_use_subtracted_sasms, window_size, is_protein, error_weight,
-                vp_density, vp_cutoff, vp_qmax, vc_cutoff, vc_qmax, vc_a_prot,
-                vc_b_prot, vc_a_rna, vc_b_rna)
+            bl_first_frame = SASCalc.updateSeriesBaseline(secm,
+                self._raw_settings.get('IBaselineMinIter'),
+                self._raw_settings.get('IBaselineMaxIter'), plot_y, secm.qref,
+                secm.qrange, threshold, first_frame)
+
+            # If the baseline changed, earlier corrected profiles changed too
+            first_frame = min(first_frame, max(bl_first_frame-window_size, 0))
+
+            success, results = SASCalc.run_secm_calcs(
+                secm.baseline_subtracted_sasm_list[first_frame:],
+                secm.use_baseline_subtracted_sasm[first_frame:], window_size,
+                is_protein, error_weight, vp_density, vp_cutoff, vp_qmax,
+                vc_cutoff, vc_qmax, vc_a_prot, vc_b_prot, vc_a_rna, vc_b_rna)
 
         else:
             success, results = SASCalc.run_secm_calcs(subtracted_sasm_list,
@@ -53,22 +53,45 @@ if raw_path not in os.sys.path:
 import bioxtasraw.SASCalc as SASCalc
 import bioxtasraw.SASExceptions as SASExceptions
 import bioxtasraw.SASFileIO as SASFileIO
+import bioxtasraw.SASImage as SASImage
 import bioxtasraw.SASMask as SASMask
+import bioxtasraw.SASOnline as SASOnline
 import bioxtasraw.SASM as SASM
 import bioxtasraw.SASProc as SASProc
 import bioxtasraw.RAWSettings as RAWSettings
 import bioxtasraw.RAWGlobals as RAWGlobals
 import bioxtasraw.SECM as SECM
 import bioxtasraw.BIFT as BIFT
-import bioxtasraw.DENSS as DENSS
 import bioxtasraw.SASUtils as SASUtils
-import bioxtasraw.RAWReport as RAWReport
 
 __version__ = RAWGlobals.version
 
-__default_settings = RAWSettings.RawGuiSettings()
-atsas_dir = SASUtils.findATSASDirectory()
-__default_settings.set('ATSASDir', atsas_dir)
+# The default settings, and the ATSAS directory search, are only made when
+# they are first needed, since most uses of the API don't need them.
+_default_settings = None
+_default_settings_lock = threading.Lock()
+
+def _get_default_settings():
+    global _default_settings
+
+    with _default_settings_lock:
+        if _default_settings is None:
+            settings = RAWSettings.RawGuiSettings()
+            settings.set('ATSASDir', SASUtils.findATSASDirectory())
+            _default_settings = settings
+
+    return _default_settings
+
+def __getattr__(name):
+    # Provides the module level default settings and atsas_dir without
+    # making them at import
+    if name == '__default_settings':
+        return _get_default_settings()
+    elif name == 'atsas_dir':
+        return _get_default_settings().get('ATSASDir')
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+        name))
 
 RAWGlobals.RAWResourcesDir = os.path.join(raw_path, 'bioxtasraw', 'resources')
 RAWGlobals.RAWDefinitionsDir = os.path.join(raw_path, 'bioxtasraw', 'definitions')
@@ -98,7 +121,7 @@ def load_settings(file, settings=None):
     """
 
     if settings is None:
-        settings = copy.deepcopy(__default_settings)
+        settings = copy.deepcopy(_get_default_settings())
 
     file = os.path.abspath(os.path.expanduser(file))
 
@@ -261,7 +284,7 @@ def load_profiles(filename_list, settings=None):
         images.
     """
     if settings is None:
-        settings = __default_settings
+        settings = _get_default_settings()
 
     profile_list, iftm_list, secm_list, img_list = load_files(filename_list, settings)
 
@@ -283,13 +306,13 @@ def load_ifts(filename_list):
     ift_list: list
         A list of individual IFT (:class:`bioxtasraw.SASM.IFTM`) items loaded in.
     """
-    settings = __default_settings
+    settings = _get_default_settings()
 
     sasm_list, iftm_list, secm_list, img_list = load_files(filename_list, settings)
 
     return iftm_list
 
-def load_series(filename_list, settings=None):
+def load_series(filename_list, settings=None, lazy=False, cache_dir=None):
     """
     Loads in series data. If all filenames provided at individual scattering
     profiles (e.g. .dat files or images that can be radially averaged into
@@ -309,6 +332,14 @@ def load_series(filename_list, settings=None):
         None. This is required if you are loading images into a series or if
         you wish to set the header style of the series loaded in, which is
         necessary for calculating the time point of each frame in the series.
+    lazy: bool, optional
+        Only used for .hdf5 series files. If True, the profiles in the
+        series are stored in memory-mapped files and individual profiles
+        are only made when they are used, which allows very long series to
+        be loaded without running out of memory. Default is False.
+    cache_dir: str, optional
+        The directory for the memory-mapped files used when lazy is True.
+        Defaults to the system temporary directory.
 
     Returns
     -------
@@ -323,7 +354,7 @@ def load_series(filename_list, settings=None):
         (.sec or .hdf5) at the same time.
     """
     if settings is None:
-        settings = __default_settings
+        settings = _get_default_settings()
 
     all_secm = True
     for name in filename_list:
@@ -331,6 +362,13 @@ def load_series(filename_list, settings=None):
             all_secm = False
             break
 
+    if lazy and all_secm:
+        series_list = [SASFileIO.loadSeriesFile(os.path.abspath(
+            os.path.expanduser(name)), settings, True, cache_dir)
+            for name in filename_list]
+
+        return series_list
+
     sasm_list, iftm_list, series_list, img_list = load_files(filename_list, settings)
 
     if not all_secm:
@@ -481,6 +519,107 @@ def load_counter_values(filename_list, settings, new_filename_list=[]):
 
     return counter_list
 
+def watch_directory(directory, poll_interval=2., stable_time=0.5,
+    use_inotify=True, event_queue=None):
+    """
+    Starts watching a directory for new and changed files, such as images
+    being written by a detector. Each file is reported once its size has
+    stopped changing. On Linux inotify is used, otherwise the directory is
+    polled, checking only files that are new since the last poll. Files in
+    the directory when watching starts are not reported.
+
+    Parameters
+    ----------
+    directory: str
+        The directory to watch.
+    poll_interval: float, optional
+        The time between checks for new files, in seconds.
+    stable_time: float, optional
+        How long a file's size and modification time must stay the same
+        before it is reported, in seconds.
+    use_inotify: bool, optional
+        Whether to use inotify when it is available.
+    event_queue: queue.Queue, optional
+        The queue to put the file events on. If not provided a new queue is
+        made.
+
+    Returns
+    -------
+    watcher: :class:`bioxtasraw.SASOnline.DirectoryWatcher`
+        The running watcher. New files are available from its ``events``
+        queue (or :py:meth:`getEvents`) as
+        :data:`bioxtasraw.SASOnline.FileEvent` items with the file path,
+        name, type ('new' or 'modified'), size and modification time. Call
+        :py:meth:`stop` when done.
+    """
+    watcher = SASOnline.DirectoryWatcher(directory, event_queue, poll_interval,
+        stable_time, use_inotify)
+    watcher.start()
+
+    return watcher
+
+def online_reduction(settings, directory=None, socket_address=None,
+    output_dir=None, buffer_profile=None, n_buffer_frames=0, n_workers=2,
+    max_queue_size=16, series_name='online_series'):
+    """
+    Starts headless online data reduction, for use without the RAW GUI. New
+    images are loaded, radially averaged and normalized by a pool of worker
+    threads, then subtracted, appended to a live series and saved in the
+    order they arrived. Images can come from a watched directory, a local
+    socket (one file path per line), or be added with the reducer's
+    ``submit`` method.
+
+    Parameters
+    ----------
+    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`
+        The RAW settings used to load and radially average the images.
+    directory: str, optional
+        A directory to watch for new images, as in
+        :py:func:`watch_directory`.
+    socket_address: str or tuple, optional
+        A unix domain socket path, or a (host, port) tuple for a TCP socket,
+        to listen on for image file paths.
+    output_dir: str, optional
+        If provided, each profile is saved in this directory as soon as it
+        is processed, and the series is saved when the reducer is stopped.
+    buffer_profile: :class:`bioxtasraw.SASM.SASM`, optional
+        The buffer profile subtracted from each profile.
+    n_buffer_frames: int, optional
+        If no buffer profile is provided and this is more than 0, the
+        average of the first n_buffer_frames profiles is used as the buffer.
+    n_workers: int, optional
+        The number of worker threads loading and radially averaging images.
+    max_queue_size: int, optional
+        The maximum number of images waiting at each stage. When the queues
+        are full, new images wait to be added.
+    series_name: str, optional
+        The name of the series, and of the saved series file.
+
+    Returns
+    -------
+    reducer: :class:`bioxtasraw.SASOnline.OnlineReducer`
+        The running reducer. The live series is available as
+        ``reducer.series``, the time taken by each processing stage from
+        ``reducer.getStageStats()``, and any errors as ``reducer.errors``.
+        ``reducer.setBaselineCorrection()`` baseline corrects the
+        subtracted profiles as they arrive. Call ``reducer.stop()`` to
+        finish processing and stop.
+    """
+    if output_dir is not None:
+        output_dir = os.path.abspath(os.path.expanduser(output_dir))
+
+    reducer = SASOnline.OnlineReducer(settings, output_dir, buffer_profile,
+        n_buffer_frames, n_workers, max_queue_size, series_name)
+    reducer.start()
+
+    if directory is not None:
+        reducer.watchDirectory(os.path.abspath(os.path.expanduser(directory)))
+
+    if socket_address is not None:
+        reducer.listenSocket(socket_address)
+
+    return reducer
+
 def load_mrc(filename_list):
     """
     Loads DENSS .mrc files.
@@ -500,6 +639,8 @@ def load_mrc(filename_list):
         A list of floats of the real space box width in Angstroms of the
         models.
     """
+    import bioxtasraw.DENSS as DENSS
+
     rhos = []
     sides = []
 
@@ -565,6 +706,80 @@ def integrate_image(img, settings, name, img_hdr={}, counters={}, load_path=''):
 
     return profile
 
+def integrate_image_stack(images, settings, img_hdrs=None, counters=None,
+    chunk_size=500):
+    """
+    Radially averages a stack of images, such as all of the frames in an
+    Eiger HDF5 master file, into 1D scattering profiles. Rather than making
+    a profile for every image, this returns the intensities and
+    uncertainties of all of the images as 2D arrays, which is much faster
+    for large numbers of images. Integration uses the same calibration and
+    normalization as :py:func:`integrate_image`, but profile post-processing
+    (profile zinger removal and glassy carbon absolute scaling with a
+    background) is not applied.
+
+    Parameters
+    ----------
+    images: :class:`numpy.array` or :class:`h5py.Dataset`
+        The images with shape (N, image rows, image columns). An HDF5 dataset
+        is read in chunks, so the whole stack doesn't need to fit in memory.
+    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`
+        The RAW settings to be used when integrating the images.
+    img_hdrs: list, optional
+        The image header associated with each image. May be required for
+        calibration and normalization.
+    counters: list, optional
+        The counters associated with each image. May be required for
+        calibration and normalization.
+    chunk_size: int, optional
+        The number of images integrated at once.
+
+    Returns
+    -------
+    q: :class:`numpy.array`
+        The q values of the profiles.
+    i: :class:`numpy.array`
+        The radially averaged intensities, with shape (N, len(q)).
+    err: :class:`numpy.array`
+        The uncertainties of the intensities, with shape (N, len(q)).
+    """
+    nframes = images.shape[0]
+
+    q = None
+    i = None
+    err = None
+
+    for start in range(0, nframes, chunk_size):
+        stop = min(start+chunk_size, nframes)
+
+        if img_hdrs is not None:
+            chunk_img_hdrs = img_hdrs[start:stop]
+        else:
+            chunk_img_hdrs = None
+
+        if counters is not None:
+            chunk_counters = counters[start:stop]
+        else:
+            chunk_counters = None
+
+        chunk_q, chunk_i, chunk_err = SASImage.integrateImageStack(
+            images[start:stop], settings, chunk_img_hdrs, chunk_counters)
+
+        if q is None:
+            q = chunk_q
+            i = np.empty((nframes, len(q)))
+            err = np.empty((nframes, len(q)))
+
+        i[start:stop] = chunk_i
+        err[start:stop] = chunk_err
+
+    if q is None:
+        q = np.array([])
+        i = np.empty((0, 0))
+        err = np.empty((0, 0))
+
+    return q, i, err
+
 def profiles_to_series(profiles, settings=None):
     """
     Converts a set of individual scattering profiles
@@ -589,7 +804,7 @@ def profiles_to_series(profiles, settings=None):
     """
 
     if settings is None:
-        settings = __default_settings
+        settings = _get_default_settings()
 
     filename_list = [sasm.getParameter('filename') for sasm in profiles]
     series = SECM.SECM(filename_list, profiles, range(len(profiles)), {},
@@ -597,7 +812,76 @@ def profiles_to_series(profiles, settings=None):
 
     return series
 
-def make_profile(q, i, err, name, q_err=None):
+def make_profile_stack(q, i, err, names, q_err=None):
+    """
+    Makes a profile stack (:class:`bioxtasraw.SASM.ProfileStack`) from
+    a q vector and 2D arrays of intensities and uncertainties, such as
+    those returned by :func:`integrate_image_stack`. Stacks can be
+    processed with :func:`subtract_stack`, :func:`rebin_stack`,
+    :func:`average_stack`, and :func:`weighted_average_stack`, which is
+    much faster than processing many individual profiles.
+
+    Parameters
+    ----------
+    q: iterable
+        The q vector shared by all of the profiles.
+    i: :class:`numpy.array`
+        The intensities of the profiles, with shape (N, len(q)).
+    err: :class:`numpy.array`
+        The uncertainties of the profiles, with shape (N, len(q)).
+    names: list
+        The names of the N profiles.
+    q_err: iterable, optional
+        The uncertainty vector in q shared by all of the profiles. Default
+        is None.
+
+    Returns
+    -------
+    stack: :class:`bioxtasraw.SASM.ProfileStack`
+        The profile stack. Individual profiles can be made from the stack
+        as needed using stack[index] or stack.getAllSASMs().
+    """
+
+    stack = SASM.ProfileStack(i, q, err, [{'filename': name} for name in names],
+        q_err)
+
+    return stack
+
+def profiles_to_stack(profiles, forced=False, full=False):
+    """
+    Converts a set of individual scattering profiles
+    (:class:`bioxtasraw.SASM.SASM`) with the same q vector into a profile
+    stack (:class:`bioxtasraw.SASM.ProfileStack`).
+
+    Parameters
+    ----------
+    profiles: list
+        A list of profiles (:class:`bioxtasraw.SASM.SASM`) to be converted
+        into a stack.
+    forced: bool, optional
+        If True, RAW will attempt to put the profiles in a stack even if the
+        q vectors do not agree, as for :func:`average`. Defaults to False.
+    full: bool, optional
+        If False, RAW will only use the portion of the profiles between the
+        defined q start and q end indices. If True, RAW will use the full q
+        range of the profiles. Defaults to False.
+
+    Returns
+    -------
+    stack: :class:`bioxtasraw.SASM.ProfileStack`
+        A stack made from the input profiles.
+
+    Raises
+    ------
+    SASExceptions.DataNotCompatible
+        If the profiles have different q vectors and not forced.
+    """
+
+    stack = SASProc.profilesToStack(profiles, forced, full)
+
+    return stack
+
+def make_profile(q, i, err, name, q_err=None, copy_data=True):
     """
     Makes a profile (:class:`bioxtasraw.SASM.SASM`) from q, I, and uncertainty
     vectors. All three input vectors must be the same length.
@@ -623,6 +907,13 @@ def make_profile(q, i, err, name, q_err=None):
         either None or an iterable that can be cast to a :class:`numpy.array',
         such as a list or :class:`numpy.array`. Default is None. Typically only
         used for SANS data.
+    copy_data: bool, optional
+        If True (default), the input vectors are copied into the profile. If
+        False, the profile uses the input :class:`numpy.array` objects
+        without copying them, so many profiles can share one q vector (for
+        example, when making profiles from the output of
+        :func:`integrate_image_stack`). The arrays must not be changed in
+        place while the profile uses them.
 
     Returns
     -------
@@ -631,7 +922,7 @@ def make_profile(q, i, err, name, q_err=None):
         the API.
     """
 
-    profile = SASM.SASM(i, q, err, {'filename': name}, q_err)
+    profile = SASM.SASM(i, q, err, {'filename': name}, q_err, copy_data)
 
     return profile
 
@@ -656,7 +947,7 @@ def save_profile(profile, fname=None, datadir='.', settings=None):
     """
     logger.debug('In save profile')
     if settings is None:
-        settings = __default_settings
+        settings = _get_default_settings()
 
     logger.debug('setting filename if necessary')
     if fname is not None:
@@ -686,7 +977,7 @@ def save_ift(ift, fname=None, datadir='.'):
         The directory to save the profile in. If no directory is provided,
         the current directory is used.
     """
-    settings = __default_settings
+    settings = _get_default_settings()
 
     if ift.getParameter('algorithm') == 'GNOM':
         newext = '.out'
@@ -779,12 +1070,14 @@ def save_report(fname, datadir='.', profiles=[], ifts=[], series=[],
         A list of paths to the summary files of denss runs from RAW (.csv files)
         to add to the report.
     """
+    import bioxtasraw.RAWReport as RAWReport
+
     datadir = os.path.abspath(os.path.expanduser(datadir))
 
     fname = os.path.splitext(fname)[0] + '.pdf'
 
     RAWReport.make_report_from_raw(fname, datadir, profiles, ifts, series,
-        __default_settings, dammif_data, denss_data)
+        _get_default_settings(), dammif_data, denss_data)
 
 def average(profiles, forced=False, copy_metadata=True):
     """
@@ -1060,6 +1353,188 @@ def merge(profiles, copy_metadata=True):
 
     return merged_profile
 
+def subtract_stack(stack, bkg_profile, copy_metadata=True):
+    """
+    Subtracts a background profile from all of the profiles in a stack.
+    This gives the same result as :func:`subtract` for each profile, but
+    the whole stack is subtracted at once.
+
+    Parameters
+    ----------
+    stack: :class:`bioxtasraw.SASM.ProfileStack`
+        The stack of profiles to be subtracted.
+    bkg_profile: :class:`bioxtasraw.SASM.SASM`
+        The background profile to subtract from the profiles. It must have
+        the same q vector as the stack.
+    copy_metadata: bool, optional
+        If True, RAW will copy add add to the metadata for the subtracted
+        profiles. If you don't need the metadata, set this to false.
+        Defaults to True.
+
+    Returns
+    -------
+    sub_stack: :class:`bioxtasraw.SASM.ProfileStack`
+        A stack of the subtracted profiles, in the same order as the input
+        stack.
+
+    Raises
+    ------
+    SASExceptions.DataNotCompatible
+        If the background profile has a different q vector than the stack.
+    """
+
+    sub_stack = SASProc.subtractStack(stack, bkg_profile,
+        copy_params=copy_metadata)
+
+    for params in sub_stack.getAllParameters():
+        params['filename'] = 'S_{}'.format(params['filename'])
+
+    return sub_stack
+
+def rebin_stack(stack, npts=100, rebin_factor=1, log_rebin=False,
+    copy_metadata=True):
+    """
+    Rebins all of the profiles in a stack, as for :func:`rebin`. The same
+    bins are used for every profile, so the whole stack is rebinned at once.
+
+    Parameters
+    ----------
+    stack: :class:`bioxtasraw.SASM.ProfileStack`
+        The stack of profiles to be rebinned.
+    npts: int, optional
+        The number of points in each rebinned profile. Only used if
+        rebin_factor is left to the default value of 1. Default is 100.
+    rebin_factor: int, optional
+        The factor by which to rebin each profile, as for :func:`rebin`.
+    log_rebin: bool, option.
+        Specifies whether the rebinning should be done in linear (False) or
+        logarithmic (True) space. Defaults to linear (False).
+    copy_metadata: bool, optional
+        If True, RAW will copy add add to the metadata for the rebinned
+        profiles. If you don't need the metadata, set this to false.
+        Defaults to True.
+
+    Returns
+    -------
+    rebinned_stack: :class:`bioxtasraw.SASM.ProfileStack`
+        A stack of the rebinned profiles, in the same order as the input
+        stack.
+    """
+
+    if rebin_factor != 1:
+        if rebin_factor != 0:
+            rb_pts = int(np.floor(len(stack.getQ())/rebin_factor))
+        else:
+            rb_pts = len(stack.getQ())
+
+        rb_fac = rebin_factor
+    else:
+        if npts >= 1:
+            rb_fac = int(np.floor(len(stack.getQ())/float(npts)))
+        else:
+            rb_fac = 1
+
+        rb_pts = npts
+
+    if log_rebin:
+        rebinned_stack = SASProc.logBinningStack(stack, rb_pts,
+            copy_params=copy_metadata)
+    else:
+        rebinned_stack = SASProc.rebinStack(stack, rb_fac,
+            copy_params=copy_metadata)
+
+    for params in rebinned_stack.getAllParameters():
+        params['filename'] = 'R_{}'.format(params['filename'])
+
+    return rebinned_stack
+
+def average_stack(stack, groups=None, copy_metadata=True):
+    """
+    Averages groups of profiles in a stack, for example consecutive windows
+    of frames of a series. This gives the same result as :func:`average`
+    for each group, but all of the groups are averaged at once.
+
+    Parameters
+    ----------
+    stack: :class:`bioxtasraw.SASM.ProfileStack`
+        The stack of profiles to average.
+    groups: list, optional
+        A list of groups of profiles to average, where each group is a
+        list (or :class:`numpy.array`) of indices of profiles in the stack.
+        Groups can overlap. If None (default), all of the profiles in the
+        stack are averaged.
+    copy_metadata: bool, optional
+        If True, RAW will copy add add to the metadata for the averaged
+        profiles. If you don't need the metadata, set this to false.
+        Defaults to True.
+
+    Returns
+    -------
+    avg_stack: :class:`bioxtasraw.SASM.ProfileStack`
+        A stack with the average profile of each group, in the same order as
+        the groups.
+    """
+
+    avg_stack = SASProc.averageStack(stack, groups, copy_params=copy_metadata)
+
+    for params in avg_stack.getAllParameters():
+        params['filename'] = 'A_{}'.format(params['filename'])
+
+    return avg_stack
+
+def weighted_average_stack(stack, groups=None, weight_by_error=True,
+    weight_counter='', weights=None, settings=None, copy_metadata=True):
+    """
+    Weighted averages of groups of profiles in a stack. This gives the same
+    result as :func:`weighted_average` for each group, but all of the groups
+    are averaged at once.
+
+    Parameters
+    ----------
+    stack: :class:`bioxtasraw.SASM.ProfileStack`
+        The stack of profiles to average.
+    groups: list, optional
+        A list of groups of profiles to average, as for
+        :func:`average_stack`. If None (default), all of the profiles in the
+        stack are averaged.
+    weight_by_error: bool, optional
+        If true, weight in the average is determined by the profiles'
+        uncertainties. If False, then the weighting is done by the weights
+        parameter or by the weight_counter. Defaults to True.
+    weight_counter: str, optional
+        If weight_by_error is False and no weights are provided, this is the
+        counter used to do the weighting, as for :func:`weighted_average`.
+    weights: iterable, optional
+        If weight_by_error is False, the weight of each profile in the
+        stack. This overrides the weight_counter. Default is None.
+    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`, optional
+        RAW settings containing relevant parameters. If provided, the
+        weight_by_error and weight_counter parameters will be overridden
+        with the values in the settings. Default is None.
+    copy_metadata: bool, optional
+        If True, RAW will copy add add to the metadata for the averaged
+        profiles. If you don't need the metadata, set this to false.
+        Defaults to True.
+
+    Returns
+    -------
+    avg_stack: :class:`bioxtasraw.SASM.ProfileStack`
+        A stack with the average profile of each group, in the same order as
+        the groups.
+    """
+
+    if settings is not None:
+        weight_by_error = settings.get('weightByError')
+        weight_counter = settings.get('weightCounter')
+
+    avg_stack = SASProc.weightedAverageStack(stack, weight_by_error,
+        weight_counter, groups, weights, copy_params=copy_metadata)
+
+    for params in avg_stack.getAllParameters():
+        params['filename'] = 'A_{}'.format(params['filename'])
+
+    return avg_stack
+
 def superimpose(profiles, ref_profile, scale=True, offset=False):
     """
     Superimposes the profiles onto the reference profile using either a scale,
@@ -1234,6 +1709,98 @@ def auto_guinier(profile, error_weight=True, single_fit=True, settings=None):
 
     return (rg, i0, rg_err, i0_err, qmin, qmax, qRg_min, qRg_max, idx_min, idx_max, r_sqr)
 
+def auto_guinier_batch(q, i, err, error_weight=True, single_fit=True,
+    settings=None):
+    """
+    Automatically calculates the Rg and I(0) values from the Guinier fit,
+    as for :py:func:`auto_guinier`, for many profiles that share a q vector,
+    such as every frame of a series or every well of a plate. The range
+    search runs for all profiles in a single compiled kernel, in parallel,
+    so this is much faster than calling :py:func:`auto_guinier` on each
+    profile. Unlike :py:func:`auto_guinier`, no profile analysis
+    dictionaries are updated.
+
+    Parameters
+    ----------
+    q: :class:`numpy.array`
+        The q vector shared by all of the profiles.
+    i: :class:`numpy.array`
+        The intensities of the profiles, with shape (N, len(q)).
+    err: :class:`numpy.array`
+        The uncertainties of the profiles, with shape (N, len(q)).
+    error_weight: bool, optional
+        If True (default), then the Guinier fit is calculated in an error
+        weighted fashion. If not, the Guinier fit is calculated without
+        error weight. This is overridden by the value in the settings if
+        a settings object is provided.
+    single_fit: bool, optional
+        As for :py:func:`auto_guinier`.
+    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`, optional
+        RAW settings containing relevant parameters. If provided, the
+        error_weight parameter will be overridden with the value in the
+        settings. Default is None.
+
+    Returns
+    -------
+    rg: :class:`numpy.array`
+        The Rg value of the fit for each profile.
+    i0: :class:`numpy.array`
+        The I(0) value of the fit for each profile.
+    rg_err: :class:`numpy.array`
+        The uncertainty in Rg, calculated as for :py:func:`auto_guinier`.
+    i0_err: :class:`numpy.array`
+        The uncertainty in I(0), calculated as for :py:func:`auto_guinier`.
+    qmin: :class:`numpy.array`
+        The minimum q value of the Guinier fit for each profile.
+    qmax: :class:`numpy.array`
+        The maximum q value of the Guinier fit for each profile.
+    qRg_min: :class:`numpy.array`
+        The q*Rg value at the minimmum q value of the Guinier fit.
+    qRg_max: :class:`numpy.array`
+        The q*Rg value at the maximum q value of the Guinier fit.
+    idx_min: :class:`numpy.array`
+        The minimum index of the q vector used for Guinier fit.
+    idx_max: :class:`numpy.array`
+        The maximum index of the q vector used for the GUinier fit.
+    r_sqr: :class:`numpy.array`
+        The r^2 value of the fit.
+
+    For any profile where no Guinier range is found, all values are -1.
+    """
+
+    if settings is not None:
+        error_weight = settings.get('errorWeight')
+
+    q = np.ascontiguousarray(q, dtype=np.float64)
+    i = np.ascontiguousarray(i, dtype=np.float64)
+    err = np.ascontiguousarray(err, dtype=np.float64)
+
+    rg_auto, rger_auto, i0_auto, i0er_auto, idx_min, idx_max = SASCalc.autoRgBatch(
+        q, i, err, single_fit, error_weight)
+
+    rg_fit, i0_fit, rger_fit, i0er_fit, r_sqr = SASCalc.calcRgBatch(q, i, err,
+        idx_min, idx_max, error_weight)
+
+    found = idx_min != -1
+
+    if single_fit:
+        rg = np.where(found, rg_fit, -1.)
+        i0 = np.where(found, i0_fit, -1.)
+    else:
+        rg = np.where(found, rg_auto, -1.)
+        i0 = np.where(found, i0_auto, -1.)
+
+    rg_err = np.where(found, np.maximum(rger_fit, rger_auto), -1.)
+    i0_err = np.where(found, np.maximum(i0er_fit, i0er_auto), -1.)
+
+    qmin = np.where(found, q[np.where(found, idx_min, 0)], -1.)
+    qmax = np.where(found, q[np.where(found, idx_max, 0)], -1.)
+    qRg_min = np.where(found, qmin*rg, -1.)
+    qRg_max = np.where(found, qmax*rg, -1.)
+
+    return (rg, i0, rg_err, i0_err, qmin, qmax, qRg_min, qRg_max, idx_min,
+        idx_max, r_sqr)
+
 def guinier_fit(profile, idx_min, idx_max, error_weight=True, settings=None):
     """
     Calculates the Rg and I(0) values from the Guinier fit defined by the
@@ -1852,7 +2419,7 @@ def mw_bayes(profile, rg=None, i0=None, first=None, atsas_dir=None,
         The Bayesian estimated probability that the M.W. for the scattering
         profile is within the confidence interval.
     """
-    settings = __default_settings
+    settings = _get_default_settings()
 
     if atsas_dir is None:
         atsas_dir = settings.get('ATSASDir')
@@ -1944,6 +2511,122 @@ def mw_bayes(profile, rg=None, i0=None, first=None, atsas_dir=None,
 
     return mw, mw_prob, ci_lower, ci_upper, ci_prob
 
+def _get_batch_values(value, nprofiles):
+    if value is None or np.isscalar(value):
+        values = [value]*nprofiles
+    else:
+        values = list(value)
+
+    return values
+
+def _get_batch_guinier_values(profiles, rg, i0, first):
+    rgs = _get_batch_values(rg, len(profiles))
+    i0s = _get_batch_values(i0, len(profiles))
+    firsts = _get_batch_values(first, len(profiles))
+
+    for j, profile in enumerate(profiles):
+        if rgs[j] is None or i0s[j] is None or firsts[j] is None:
+            guinier_dict = profile.getParameter('analysis')['guinier']
+
+            if rgs[j] is None:
+                rgs[j] = float(guinier_dict['Rg'])
+
+            if i0s[j] is None:
+                i0s[j] = float(guinier_dict['I0'])
+
+            if firsts[j] is None:
+                firsts[j] = max(0, int(guinier_dict['nStart']) - profile.getQrange()[0])
+
+    return rgs, i0s, firsts
+
+def _run_atsas_batch(profiles, submit, atsas_dir, n_proc, runner,
+    failed_result=()):
+    if runner is None:
+        if atsas_dir is None:
+            atsas_dir = _get_default_settings().get('ATSASDir')
+
+        batch_runner = SASCalc.ATSASRunner(atsas_dir, n_proc)
+    else:
+        batch_runner = runner
+
+    try:
+        futures = [submit(batch_runner, j, profile)
+            for j, profile in enumerate(profiles)]
+
+        results = []
+
+        for future in futures:
+            try:
+                results.append(future.result())
+            except SASExceptions.ATSASError:
+                results.append(failed_result)
+
+    finally:
+        if runner is None:
+            batch_runner.close()
+
+    return results
+
+def mw_bayes_batch(profiles, rg=None, i0=None, first=None, atsas_dir=None,
+    n_proc=None, runner=None):
+    """
+    Calculates the M.W. of many profiles using the Bayesian inference method
+    implemented in datmw in the ATSAS package, as for :py:func:`mw_bayes`.
+    The profiles are run in parallel by an ATSAS runner
+    (:class:`bioxtasraw.SASCalc.ATSASRunner`), which stages the input files
+    in memory where possible and caches the results. Unlike
+    :py:func:`mw_bayes`, no profile analysis dictionaries are updated.
+    This requires a separate installation of the ATSAS package to use.
+
+    Parameters
+    ----------
+    profiles: list
+        A list of profiles (:class:`bioxtasraw.SASM.SASM`) to calculate the
+        M.W. for. This can also be a :class:`bioxtasraw.SASM.ProfileStack`.
+    rg: float or list, optional
+        The Rg to be used in calculating the M.W., either one value for all
+        of the profiles or a list with a value for each profile. If not
+        provided, then the Rg is taken from the Guinier fit of each profile.
+    i0: float or list, optional
+        The I(0) to be used in calculating the M.W., as for rg.
+    first: int or list, optional
+        The first point in each profile to use, as for rg. If not provided,
+        this is the start of the Guinier fit of each profile.
+    atsas_dir: str, optional
+        The directory of the atsas programs (the bin directory). If not provided,
+        the API uses the auto-detected directory. Ignored if a runner is
+        provided.
+    n_proc: int, optional
+        The number of datmw processes to run at once. Defaults to the number
+        of cpus. Ignored if a runner is provided.
+    runner: :class:`bioxtasraw.SASCalc.ATSASRunner`, optional
+        An ATSAS runner to use. Providing a runner lets results be reused
+        between calls. If not provided, a runner is made for this call.
+
+    Returns
+    -------
+    results: list
+        A list with the (mw, mw_prob, ci_lower, ci_upper, ci_prob) values,
+        as returned by :py:func:`mw_bayes`, for each profile. All of the
+        values are -1 for any profile where datmw fails.
+    """
+    rgs, i0s, firsts = _get_batch_guinier_values(profiles, rg, i0, first)
+
+    def submit(batch_runner, j, profile):
+        return batch_runner.datmw(profile.getQ(), profile.getI(),
+            profile.getErr(), rgs[j], i0s[j], firsts[j], 'bayes')
+
+    results = []
+
+    for res in _run_atsas_batch(profiles, submit, atsas_dir, n_proc, runner):
+        if len(res) > 0:
+            mw, mw_score, ci_lower, ci_upper, ci_score = res
+            results.append((mw, mw_score*100, ci_lower, ci_upper, ci_score*100))
+        else:
+            results.append((-1, -1, -1, -1, -1))
+
+    return results
+
 def mw_datclass(profile, rg=None, i0=None, first=None, atsas_dir=None,
     use_i0_from='guinier', write_profile=True, datadir=None, filename=None):
     """
@@ -2002,7 +2685,7 @@ def mw_datclass(profile, rg=None, i0=None, first=None, atsas_dir=None,
     dmax: float
         The datclass estimated Dmax of the profile.
     """
-    settings = __default_settings
+    settings = _get_default_settings()
 
     if atsas_dir is None:
         atsas_dir = settings.get('ATSASDir')
@@ -2081,12 +2764,64 @@ def mw_datclass(profile, rg=None, i0=None, first=None, atsas_dir=None,
             analysis_dict['molecularWeight'] = mw_dict
             profile.setParameter('analysis', analysis_dict)
 
-    else:
-        mw = -1
-        shape = None
-        dmax = -1
+    else:
+        mw = -1
+        shape = None
+        dmax = -1
+
+    return mw, shape, dmax
+
+def mw_datclass_batch(profiles, rg=None, i0=None, first=None, atsas_dir=None,
+    n_proc=None, runner=None):
+    """
+    Calculates the M.W. of many profiles using the shape and size method
+    implemented in datclass in the ATSAS package, as for
+    :py:func:`mw_datclass`. The profiles are run in parallel by an ATSAS
+    runner, as for :py:func:`mw_bayes_batch`. Unlike :py:func:`mw_datclass`,
+    no profile analysis dictionaries are updated. This requires a separate
+    installation of the ATSAS package to use.
+
+    Parameters
+    ----------
+    profiles: list
+        A list of profiles (:class:`bioxtasraw.SASM.SASM`) to calculate the
+        M.W. for. This can also be a :class:`bioxtasraw.SASM.ProfileStack`.
+    rg: float or list, optional
+        As for :py:func:`mw_bayes_batch`.
+    i0: float or list, optional
+        As for :py:func:`mw_bayes_batch`.
+    first: int or list, optional
+        As for :py:func:`mw_bayes_batch`.
+    atsas_dir: str, optional
+        As for :py:func:`mw_bayes_batch`.
+    n_proc: int, optional
+        As for :py:func:`mw_bayes_batch`.
+    runner: :class:`bioxtasraw.SASCalc.ATSASRunner`, optional
+        As for :py:func:`mw_bayes_batch`.
+
+    Returns
+    -------
+    results: list
+        A list with the (mw, shape, dmax) values, as returned by
+        :py:func:`mw_datclass`, for each profile. The values are -1, None,
+        and -1 for any profile where datclass fails.
+    """
+    rgs, i0s, firsts = _get_batch_guinier_values(profiles, rg, i0, first)
+
+    def submit(batch_runner, j, profile):
+        return batch_runner.datclass(profile.getQ(), profile.getI(),
+            profile.getErr(), rgs[j], i0s[j], firsts[j])
+
+    results = []
+
+    for res in _run_atsas_batch(profiles, submit, atsas_dir, n_proc, runner):
+        if len(res) > 0:
+            shape, mw, dmax = res
+            results.append((mw, shape, dmax))
+        else:
+            results.append((-1, None, -1))
 
-    return mw, shape, dmax
+    return results
 
 def auto_dmax(profile, dmax_thresh=0.01, dmax_low_bound=0.5, dmax_high_bound=1.5,
     settings=None, use_atsas=True, single_proc=True):
@@ -2132,7 +2867,7 @@ def auto_dmax(profile, dmax_thresh=0.01, dmax_low_bound=0.5, dmax_high_bound=1.5
     """
 
     if settings is None:
-        settings = __default_settings
+        settings = _get_default_settings()
 
     analysis_dict = profile.getParameter('analysis')
     try:
@@ -2583,6 +3318,7 @@ def denss_ift(profile, dmax=None, alpha=None, extrapolate=True, idx_min=None, id
     alpha: float
         The alpha value for the IFT.
     """
+    import bioxtasraw.DENSS as DENSS
 
     if settings is not None:
         extrapolate = settings.get('diftExtrapolate')
@@ -2774,7 +3510,7 @@ def datgnom(profile, rg=None, idx_min=None, idx_max=None, atsas_dir=None,
     quality: str
         The GNOM qualitative interpretation of the total estimate.
     """
-    settings = __default_settings
+    settings = _get_default_settings()
 
     if atsas_dir is None:
         atsas_dir = settings.get('ATSASDir')
@@ -2907,6 +3643,71 @@ def datgnom(profile, rg=None, idx_min=None, idx_max=None, atsas_dir=None,
 
     return ift, dmax, rg, i0, rg_err, i0_err, total_est, chi_sq, alpha, quality
 
+def datgnom_batch(profiles, rg=None, idx_min=None, idx_max=None,
+    atsas_dir=None, n_proc=None, runner=None):
+    """
+    Calculates IFTs of many profiles using datgnom from the ATSAS package,
+    as for :py:func:`datgnom`. The profiles are run in parallel by an ATSAS
+    runner, as for :py:func:`mw_bayes_batch`. Unlike :py:func:`datgnom`, no
+    profile analysis dictionaries are updated. This requires a separate
+    installation of the ATSAS package to use.
+
+    Parameters
+    ----------
+    profiles: list
+        A list of profiles (:class:`bioxtasraw.SASM.SASM`) to calculate the
+        IFTs for. This can also be a :class:`bioxtasraw.SASM.ProfileStack`.
+    rg: float or list, optional
+        The Rg to be used in calculating the IFT, either one value for all
+        of the profiles or a list with a value for each profile. If not
+        provided, then the Rg is taken from the Guinier fit of each profile.
+    idx_min: int or list, optional
+        The index of the q vector that corresponds to the minimum q point
+        to be used in the IFT, as for rg. Defaults to the first point in
+        the q vector.
+    idx_max: int or list, optional
+        The index of the q vector that corresponds to the maximum q point
+        to be used in the IFT, as for rg. If not provided, datgnom
+        truncates the profiles at q=8/Rg.
+    atsas_dir: str, optional
+        As for :py:func:`mw_bayes_batch`.
+    n_proc: int, optional
+        As for :py:func:`mw_bayes_batch`.
+    runner: :class:`bioxtasraw.SASCalc.ATSASRunner`, optional
+        As for :py:func:`mw_bayes_batch`.
+
+    Returns
+    -------
+    ifts: list
+        A list of the IFTs (:class:`bioxtasraw.SASM.IFTM`) calculated by
+        datgnom, one for each profile. The IFT is None for any profile
+        where datgnom fails.
+    """
+    rgs = _get_batch_values(rg, len(profiles))
+    idx_mins = _get_batch_values(idx_min, len(profiles))
+    idx_maxs = _get_batch_values(idx_max, len(profiles))
+
+    for j, profile in enumerate(profiles):
+        if rgs[j] is None:
+            rgs[j] = float(profile.getParameter('analysis')['guinier']['Rg'])
+
+        if idx_mins[j] is None:
+            idx_mins[j] = 0
+
+    def submit(batch_runner, j, profile):
+        return batch_runner.datgnom(profile.getQ(), profile.getI(),
+            profile.getErr(), rgs[j], idx_mins[j], idx_maxs[j])
+
+    ifts = _run_atsas_batch(profiles, submit, atsas_dir, n_proc, runner,
+        None)
+
+    for ift, profile in zip(ifts, profiles):
+        if ift is not None:
+            ift_name = os.path.splitext(profile.getParameter('filename'))[0] + '.out'
+            ift.setParameter('filename', ift_name)
+
+    return ifts
+
 def gnom(profile, dmax, rg=None, idx_min=None, idx_max=None, dmax_zero=True, alpha=0,
     atsas_dir=None, use_rg_from='guinier', use_guinier_start=True,
     cut_dam=False, write_profile=True, datadir=None, filename=None,
@@ -3027,7 +3828,7 @@ def gnom(profile, dmax, rg=None, idx_min=None, idx_max=None, dmax_zero=True, alp
     """
 
     if settings is None:
-        settings = __default_settings
+        settings = _get_default_settings()
 
     if atsas_dir is None:
         atsas_dir = settings.get('ATSASDir')
@@ -3379,7 +4180,7 @@ def ambimeter(ift, qRg_max=4, save_models='none', save_prefix=None,
     """
 
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     score, categories, evaluation = SASCalc.run_ambimeter_from_ift(ift, atsas_dir,
         qRg_max, save_models, model_format, save_prefix, datadir, write_ift,
@@ -3507,7 +4308,7 @@ def dammif(ift, prefix, datadir, mode='Slow', symmetry='P1', anisometry='Unknown
     """
 
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     if abort_event is None:
         abort_event = threading.Event()
@@ -3759,7 +4560,7 @@ def dammin(ift, prefix, datadir, mode='Slow', symmetry='P1', anisometry='Unknown
     """
 
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     if abort_event is None:
         abort_event = threading.Event()
@@ -4000,7 +4801,7 @@ def damaver(files, prefix, datadir, symmetry='P1', enantiomorphs='YES',
 
     """
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     if abort_event is None:
         abort_event = threading.Event()
@@ -4201,7 +5002,7 @@ def damclust(files, prefix, datadir, symmetry='P1', atsas_dir=None,
 
     """
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     if abort_event is None:
         abort_event = threading.Event()
@@ -4303,7 +5104,7 @@ def supcomb(target, ref_file, datadir, mode='fast', superposition='ALL',
     """
 
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     if abort_event is None:
         abort_event = threading.Event()
@@ -4415,7 +5216,7 @@ def cifsup(target, ref_file, datadir, method='ICP', selection='ALL',
     """
 
     if atsas_dir is None:
-        atsas_dir = __default_settings.get('ATSASDir')
+        atsas_dir = _get_default_settings().get('ATSASDir')
 
     if abort_event is None:
         abort_event = threading.Event()
@@ -4576,7 +5377,7 @@ def crysol(models, profiles=None, lm=20, ns=101, smax=0.5, dns=0.334, dro=0.03,
     """
 
     if settings is None:
-        use_settings = __default_settings
+        use_settings = _get_default_settings()
     else:
         use_settings = settings
 
@@ -4898,164 +5699,20 @@ def crysol(models, profiles=None, lm=20, ns=101, smax=0.5, dns=0.334, dro=0.03,
 
     return crysol_results
 
-def denss(ift, prefix, datadir, mode='Slow', symmetry=0, sym_axis='X',
-    sym_type='Cyclical', initial_model=None, n_electrons=10000, settings=None,
-    voxel=5, oversampling=3, steps=None,
-    recenter=True, recenter_step=list(range(501,8002, 500)),
-    recenter_mode='com', positivity=True, extrapolate=True, shrinkwrap=True,
-    sw_sigma_start=None, sw_sigma_end=None, sw_sigma_decay=0.99,
-    sw_sigma_thresh=0.2, sw_iter=20, sw_min_step=None, connected=True,
-    connectivity_step=None, connected_features=1, chi_end_frac=0.001,
-    cut_output=False, write_xplor=False, sym_step=[3000, 5000, 7000, 9000],
-    seed=None, abort_event=None, gpu=False):
+def _get_denss_input(ift, mode='Slow', symmetry=0, sym_axis='X',
+    sym_type='Cyclical', n_electrons=10000, settings=None, voxel=5,
+    oversampling=3, steps=None, recenter=True,
+    recenter_step=list(range(501,8002, 500)), recenter_mode='com',
+    positivity=True, extrapolate=True, shrinkwrap=True, sw_sigma_start=None,
+    sw_sigma_end=None, sw_sigma_decay=0.99, sw_sigma_thresh=0.2, sw_iter=20,
+    sw_min_step=None, connected=True, connectivity_step=None,
+    connected_features=1, chi_end_frac=0.001, cut_output=False,
+    write_xplor=False, sym_step=[3000, 5000, 7000, 9000], seed=None,
+    gpu=False):
     """
-    Generates an electron density reconstruction using DENSS. Function blocks
-    until DENSS finishes. Can be used to refine an existing model.
-
-    Parameters
-    ----------
-    ift: :class:`bioxtasraw.SASM.IFTM`
-        The IFT to be used as DENSS input.
-    prefix: str
-        The output prefix for the DENSS model.
-    datadir: str
-        The output directory for the DENSS model.
-    mode: {'Fast', 'Slow' 'Custom'} str, optional
-        The DENSS mode. Note that some of the advanced settings require that
-        DENSS be in 'Custom' mode to use. Defaults to slow.
-    symmetry: int, optional
-        Rotational symmetry applied as n-fold symmetry about the sym_axis.
-        Default is 0, i.e. no symmetry.
-    sym_axis: {'X', 'Y', 'Z'} str, optional
-        The symmetry axis used if a symmetry is specified. Correspond to the
-        xyz principal axes.
-    sym_type: {'Cyclical', 'Dihedral'}
-        The symmetry type to use, either cyclical or dihedral.
-    initial_model: class:`numpy.array`, optional
-        Initial electron density model as a numpy array. If input is provided,
-        then the model will be refined.
-    n_electrons: int, optional
-        Number of electrons in the molecule. If provided, the output density
-        will be scaled so that the sum of the density across the occupied volume
-        is equal to this value. If no value is provided 10000 is used.
-    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`, optional
-        RAW settings containing relevant parameters. If provided, every model
-        parameter except mode, symmetry, and sym_axis, and n_electrons is
-        overridden with the value in the settings file. Default is None.
-    voxel: float, optional
-        The voxel size for the model. Only used in Custom mode.
-    oversampling: int, optional
-        The sampling ratio.
-    steps: int, optional
-        Maximum number of iterations of the denss algorithm. Only used
-        in Custom mode.
-    recenter: bool, optional
-        Whether the particle should be recentered at the origin during
-        reconstruction. Default is True.
-    recenter_step: list, optional
-        A list of integers specifying the steps at which recentering
-        should be carried out. Only used in custom mode.
-    recenter_mode: {'com', 'max'} str, optional
-        Recenter based on the center of mass (com) or maximum density (max).
-        Default is com.
-    positivity: bool, optional
-        Enforces positive density. Only used in Custom mode. Default is True.
-        Set to False in Membrane mode.
-    extrapolate: bool, optional
-        Whether to extrapolate the measured scattering profile based on the
-        voxel size. Default is True.
-    shrinkwrap: bool, optional
-        Whether to apply the shrinkwrap algorithm to determine the underlying
-        support. Default is True. Not recommended to change.
-    sw_sigma_start: float, optional
-        The starting value to use for blurring during the shrinkwrap algorithm.
-    sw_sigma_end: float, optional
-        The ending value to use for blurring during the shrinkwrap algorithm.
-    sw_sigma_decay: float, optional
-        How quickly the sw_sigma value transitions from start to end.
-    sw_sigma_thresh: float, optional
-        The minimum threshold for inclusion of a voxel in the support during
-        the shrinkwrap algorithm. Membrane mode sets this to 0.1.
-    sw_iter: int, optional
-        How often the shrinkwrap algorithm is applied. Not recommended to
-        change.
-    sw_min_step: int, optional
-        The first step at which the shrinkwrap algorithm is applied. Only used
-        in Custom mode.
-    connected: bool, optional
-        Whether connectivity is enforced for the reconstruction. Default is
-        True.
-    connectivity_step: list, optional
-        A list of integers specifying the steps at which connectivity is
-        enforced. Only used in Custom mode.
-    connected_features: int, optional
-        The number of features (density blobs) to allow during the connectivity
-        steps. Only used in Custom mode. Deafult is 1.
-    chi_end_frac: float, optional
-        The convergence criteria. Set as the minimum threshold of the chi
-        squared standard deviation in the last 100 steps, as a fraction of
-        the median chi squared in those steps.
-    cut_output: bool, optional
-        Whether to remove unused parts of the search space when writing the
-        output electron density files. Default is False.
-    write_xplor:  bool, optional
-        Whether to write the output density as xplor files and mrc files, or
-        just mrc files. Default is False.
-    sym_step: list, optional
-        A list of integers specifying the steps at which the symmetry
-        constraint should be applied.
-    seed: int, optional
-        The random seed to be used for the DENSS reconstruction. If None
-        (default) than a new seed is generated.
-    abort_event: :class:`threading.Event`, optional
-        A :class:`threading.Event` or :class:`multiprocessing.Event`. If this
-        event is set it will abort the denss run.
-    gpu: bool, optional
-        Whether to use GPU computing for DENSS. CuPy must be installed.
-
-    Returns
-    -------
-    rho: :class:`numpy.array`
-        The calculated electron density of the model.
-    chi_sq: float
-        The final reduced chi^2 value of the fit of the density scattering
-        profile to the data (not the regularized IFT intensity)
-    rg: float
-        The radius of gyration of the model.
-    support_vol: float
-        The support volume of the mode.
-    side: float
-        The real space box width in Angstroms of the reconstruction.
-    q_fit: :class:`numpy.array`
-        The q values, including any extrapolation, of the model fit to the data.
-    I_fit: :class:`numpy.array`
-        The I values, including any extrapolation, of the model fit to the data.
-    I_extrap: :class:`numpy.array`
-        The experimental intensity, including any extrapolation, used in the
-        reconstruction.
-    err_extrap: :class:`numpy.array`
-        The experimental uncertainty, including any extrapolation, used in the
-        reconstruction.
-    all_chi_sq: :class:`numpy.array`
-        The value of chi squared at all iterations of the DENSS algorithm.
-        Useful to check convergence.
-    all_rg: :class:`numpy.array`
-        The value of rg at all iterations of the DENSS algorithm. Useful to
-        check convergence.
-    all_support_vol: :class:`numpy.array`
-        The value of support volume at all iterations of the DENSS algorithm.
-        Useful to check convergence.
-    fit: :class:`numpy.array`
-        A numpy array where the first column is q, the second is the data (not
-        the regularized IFT) intensity, the third column is the data uncertainty,
-        and the fourth column is the fit of the model density to the data.
+    Gets the DENSS input data and settings from an IFT and the arguments of
+    :func:`denss`.
     """
-
-    datadir = os.path.abspath(os.path.expanduser(datadir))
-
-    if abort_event is None:
-        abort_event = threading.Event()
-
     if settings is not None:
         denss_settings = {
             'voxel'             : settings.get('denssVoxel'),
@@ -5214,19 +5871,188 @@ def denss(ift, prefix, datadir, mode='Slow', symmetry=0, sym_axis='X',
         if denss_settings['voxel'] == 'None':
             denss_settings['voxel'] = dmax * denss_settings['oversample']/64
 
-        if denss_settings['swMinStep'] == 'None':
-            denss_settings['swMinStep'] = 0
+        if denss_settings['swMinStep'] == 'None':
+            denss_settings['swMinStep'] = 0
+
+        if denss_settings['conSteps'] == 'None':
+            denss_settings['conSteps'] = '[{}]'.format(1000+denss_settings['swMinStep'])
+
+    if denss_settings['swSigmaStart'] == 'None' or denss_settings['swSigmaStart'] is None:
+        shrinkwrap_sigma_start_in_vox = shrinkwrap_sigma_start_in_A / denss_settings['voxel']
+        denss_settings['swSigmaStart'] = shrinkwrap_sigma_start_in_vox
+
+    if denss_settings['swSigmaEnd'] == 'None' or denss_settings['swSigmaEnd'] is None:
+        shrinkwrap_sigma_end_in_vox = shrinkwrap_sigma_end_in_A / denss_settings['voxel']
+        denss_settings['swSigmaEnd'] = shrinkwrap_sigma_end_in_vox
+
+    return q, I, sigq, D, q_raw, i_raw, err_raw, denss_settings
+
+def denss(ift, prefix, datadir, mode='Slow', symmetry=0, sym_axis='X',
+    sym_type='Cyclical', initial_model=None, n_electrons=10000, settings=None,
+    voxel=5, oversampling=3, steps=None,
+    recenter=True, recenter_step=list(range(501,8002, 500)),
+    recenter_mode='com', positivity=True, extrapolate=True, shrinkwrap=True,
+    sw_sigma_start=None, sw_sigma_end=None, sw_sigma_decay=0.99,
+    sw_sigma_thresh=0.2, sw_iter=20, sw_min_step=None, connected=True,
+    connectivity_step=None, connected_features=1, chi_end_frac=0.001,
+    cut_output=False, write_xplor=False, sym_step=[3000, 5000, 7000, 9000],
+    seed=None, abort_event=None, gpu=False):
+    """
+    Generates an electron density reconstruction using DENSS. Function blocks
+    until DENSS finishes. Can be used to refine an existing model.
+
+    Parameters
+    ----------
+    ift: :class:`bioxtasraw.SASM.IFTM`
+        The IFT to be used as DENSS input.
+    prefix: str
+        The output prefix for the DENSS model.
+    datadir: str
+        The output directory for the DENSS model.
+    mode: {'Fast', 'Slow' 'Custom'} str, optional
+        The DENSS mode. Note that some of the advanced settings require that
+        DENSS be in 'Custom' mode to use. Defaults to slow.
+    symmetry: int, optional
+        Rotational symmetry applied as n-fold symmetry about the sym_axis.
+        Default is 0, i.e. no symmetry.
+    sym_axis: {'X', 'Y', 'Z'} str, optional
+        The symmetry axis used if a symmetry is specified. Correspond to the
+        xyz principal axes.
+    sym_type: {'Cyclical', 'Dihedral'}
+        The symmetry type to use, either cyclical or dihedral.
+    initial_model: class:`numpy.array`, optional
+        Initial electron density model as a numpy array. If input is provided,
+        then the model will be refined.
+    n_electrons: int, optional
+        Number of electrons in the molecule. If provided, the output density
+        will be scaled so that the sum of the density across the occupied volume
+        is equal to this value. If no value is provided 10000 is used.
+    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`, optional
+        RAW settings containing relevant parameters. If provided, every model
+        parameter except mode, symmetry, and sym_axis, and n_electrons is
+        overridden with the value in the settings file. Default is None.
+    voxel: float, optional
+        The voxel size for the model. Only used in Custom mode.
+    oversampling: int, optional
+        The sampling ratio.
+    steps: int, optional
+        Maximum number of iterations of the denss algorithm. Only used
+        in Custom mode.
+    recenter: bool, optional
+        Whether the particle should be recentered at the origin during
+        reconstruction. Default is True.
+    recenter_step: list, optional
+        A list of integers specifying the steps at which recentering
+        should be carried out. Only used in custom mode.
+    recenter_mode: {'com', 'max'} str, optional
+        Recenter based on the center of mass (com) or maximum density (max).
+        Default is com.
+    positivity: bool, optional
+        Enforces positive density. Only used in Custom mode. Default is True.
+        Set to False in Membrane mode.
+    extrapolate: bool, optional
+        Whether to extrapolate the measured scattering profile based on the
+        voxel size. Default is True.
+    shrinkwrap: bool, optional
+        Whether to apply the shrinkwrap algorithm to determine the underlying
+        support. Default is True. Not recommended to change.
+    sw_sigma_start: float, optional
+        The starting value to use for blurring during the shrinkwrap algorithm.
+    sw_sigma_end: float, optional
+        The ending value to use for blurring during the shrinkwrap algorithm.
+    sw_sigma_decay: float, optional
+        How quickly the sw_sigma value transitions from start to end.
+    sw_sigma_thresh: float, optional
+        The minimum threshold for inclusion of a voxel in the support during
+        the shrinkwrap algorithm. Membrane mode sets this to 0.1.
+    sw_iter: int, optional
+        How often the shrinkwrap algorithm is applied. Not recommended to
+        change.
+    sw_min_step: int, optional
+        The first step at which the shrinkwrap algorithm is applied. Only used
+        in Custom mode.
+    connected: bool, optional
+        Whether connectivity is enforced for the reconstruction. Default is
+        True.
+    connectivity_step: list, optional
+        A list of integers specifying the steps at which connectivity is
+        enforced. Only used in Custom mode.
+    connected_features: int, optional
+        The number of features (density blobs) to allow during the connectivity
+        steps. Only used in Custom mode. Deafult is 1.
+    chi_end_frac: float, optional
+        The convergence criteria. Set as the minimum threshold of the chi
+        squared standard deviation in the last 100 steps, as a fraction of
+        the median chi squared in those steps.
+    cut_output: bool, optional
+        Whether to remove unused parts of the search space when writing the
+        output electron density files. Default is False.
+    write_xplor:  bool, optional
+        Whether to write the output density as xplor files and mrc files, or
+        just mrc files. Default is False.
+    sym_step: list, optional
+        A list of integers specifying the steps at which the symmetry
+        constraint should be applied.
+    seed: int, optional
+        The random seed to be used for the DENSS reconstruction. If None
+        (default) than a new seed is generated.
+    abort_event: :class:`threading.Event`, optional
+        A :class:`threading.Event` or :class:`multiprocessing.Event`. If this
+        event is set it will abort the denss run.
+    gpu: bool, optional
+        Whether to use GPU computing for DENSS. CuPy must be installed.
+
+    Returns
+    -------
+    rho: :class:`numpy.array`
+        The calculated electron density of the model.
+    chi_sq: float
+        The final reduced chi^2 value of the fit of the density scattering
+        profile to the data (not the regularized IFT intensity)
+    rg: float
+        The radius of gyration of the model.
+    support_vol: float
+        The support volume of the mode.
+    side: float
+        The real space box width in Angstroms of the reconstruction.
+    q_fit: :class:`numpy.array`
+        The q values, including any extrapolation, of the model fit to the data.
+    I_fit: :class:`numpy.array`
+        The I values, including any extrapolation, of the model fit to the data.
+    I_extrap: :class:`numpy.array`
+        The experimental intensity, including any extrapolation, used in the
+        reconstruction.
+    err_extrap: :class:`numpy.array`
+        The experimental uncertainty, including any extrapolation, used in the
+        reconstruction.
+    all_chi_sq: :class:`numpy.array`
+        The value of chi squared at all iterations of the DENSS algorithm.
+        Useful to check convergence.
+    all_rg: :class:`numpy.array`
+        The value of rg at all iterations of the DENSS algorithm. Useful to
+        check convergence.
+    all_support_vol: :class:`numpy.array`
+        The value of support volume at all iterations of the DENSS algorithm.
+        Useful to check convergence.
+    fit: :class:`numpy.array`
+        A numpy array where the first column is q, the second is the data (not
+        the regularized IFT) intensity, the third column is the data uncertainty,
+        and the fourth column is the fit of the model density to the data.
+    """
+    import bioxtasraw.DENSS as DENSS
 
-        if denss_settings['conSteps'] == 'None':
-            denss_settings['conSteps'] = '[{}]'.format(1000+denss_settings['swMinStep'])
+    datadir = os.path.abspath(os.path.expanduser(datadir))
 
-    if denss_settings['swSigmaStart'] == 'None' or denss_settings['swSigmaStart'] is None:
-        shrinkwrap_sigma_start_in_vox = shrinkwrap_sigma_start_in_A / denss_settings['voxel']
-        denss_settings['swSigmaStart'] = shrinkwrap_sigma_start_in_vox
+    if abort_event is None:
+        abort_event = threading.Event()
 
-    if denss_settings['swSigmaEnd'] == 'None' or denss_settings['swSigmaEnd'] is None:
-        shrinkwrap_sigma_end_in_vox = shrinkwrap_sigma_end_in_A / denss_settings['voxel']
-        denss_settings['swSigmaEnd'] = shrinkwrap_sigma_end_in_vox
+    (q, I, sigq, D, q_raw, i_raw, err_raw,
+        denss_settings) = _get_denss_input(ift, mode, symmetry, sym_axis,
+        sym_type, n_electrons, settings, voxel, oversampling, steps, recenter,
+        recenter_step, recenter_mode, positivity, extrapolate, shrinkwrap,
+        sw_sigma_start, sw_sigma_end, sw_sigma_decay, sw_sigma_thresh, sw_iter,
+        sw_min_step, connected, connectivity_step, connected_features,
+        chi_end_frac, cut_output, write_xplor, sym_step, seed, gpu)
 
     denss_data = DENSS.runDenss(q, I, sigq, D, q_raw, i_raw, err_raw, prefix,
         datadir, denss_settings, initial_model, gui=False, abort_event=abort_event)
@@ -5259,8 +6085,139 @@ def denss(ift, prefix, datadir, mode='Slow', symmetry=0, sym_axis='X',
         I_fit, I_extrap, err_extrap, all_chi_sq, all_rg, all_support_vol,
         fit)
 
+def denss_ensemble(ift, prefix, datadir, nruns=20, n_proc=1, average=True,
+    resume=False, abort_event=None, align_method='minimize', **denss_kwargs):
+    """
+    Runs an ensemble of DENSS reconstructions from the same IFT, and averages
+    them, as is done in the GUI. All of the work is done in a single pool of
+    processes: reconstructions start as soon as a processor is free, and the
+    enantiomer selection and alignment for the average are done as
+    reconstructions finish. Function blocks until the ensemble is complete.
+
+    Each finished reconstruction is checkpointed in the output directory,
+    and the checkpoints are removed when the ensemble finishes. If an
+    ensemble is interrupted, running it again with the same IFT, prefix,
+    datadir, and settings and resume=True only runs the reconstructions
+    that hadn't finished. Checkpoints made from a different IFT or settings
+    are not used.
+
+    Parameters
+    ----------
+    ift: :class:`bioxtasraw.SASM.IFTM`
+        The IFT to be used as DENSS input.
+    prefix: str
+        The output prefix for the DENSS models. Individual models are saved
+        as prefix_01, prefix_02, etc, and the average as prefix_average.
+    datadir: str
+        The output directory for the DENSS models.
+    nruns: int, optional
+        The number of reconstructions to run. Defaults to 20. At least four
+        are required if average is True.
+    n_proc: int, optional
+        The number of processors to use. This could be up to as many cores
+        as your computer has.
+    average: bool, optional
+        Whether to average the reconstructions. Defaults to True.
+    resume: bool, optional
+        Whether to load previously finished reconstructions from their
+        checkpoint files instead of running them again. Defaults to False.
+    abort_event: :class:`threading.Event`, optional
+        A :class:`threading.Event` or :class:`multiprocessing.Event`. If this
+        event is set it will abort the ensemble.
+    align_method: {'minimize', 'fft'}, optional
+        The method used to align the densities. 'minimize' (the default)
+        does a coarse grid search followed by minimization of the overlap
+        score, as in the DENSS package. 'fft' uses FFT cross-correlation to
+        find the best translation for each trial rotation, which searches a
+        finer rotation grid and is faster, particularly for large maps.
+    denss_kwargs: optional
+        Any of the keyword arguments for the reconstruction accepted by
+        :func:`denss`, such as mode, symmetry, n_electrons, or settings,
+        except initial_model. If a seed is provided, each reconstruction uses
+        seed plus the run index (starting at 0) as its seed.
+
+    Returns
+    -------
+    rhos: list
+        The electron density of each reconstruction.
+    sides: list
+        The real space box width in Angstroms of each reconstruction.
+    chi_sq: :class:`numpy.array`
+        The final reduced chi^2 value of each reconstruction.
+    rg: :class:`numpy.array`
+        The radius of gyration of each reconstruction.
+    support_vol: :class:`numpy.array`
+        The support volume of each reconstruction.
+    average_rho: :class:`numpy.array`
+        The average electron density. None if average is False, as are all
+        of the following return values.
+    mean_cor: float
+        The mean correlation score of the models.
+    std_cor: float
+        The standard deviation of the model correlation scores.
+    threshold: float
+        The threshold used to reject models from the average.
+    res: float
+        The estimated model resolution in Angstrom from the Fourier shell
+        correlation.
+    scores: :class:`numpy.array`
+        An array of the correlation scores of each reconstruction.
+    fsc: :class:`numpy.array`
+        The average Fourier shell correlation between each model and a
+        average reference model. This is used to estimate the resolution.
+    """
+    import bioxtasraw.DENSS as DENSS
+
+    datadir = os.path.abspath(os.path.expanduser(datadir))
+
+    (q, I, sigq, D, q_raw, i_raw, err_raw,
+        denss_settings) = _get_denss_input(ift, **denss_kwargs)
+
+    ensemble = DENSS.DenssEnsemble(q, I, sigq, D, q_raw, i_raw, err_raw,
+        prefix, datadir, denss_settings, nruns, n_proc, average, resume,
+        abort_event, align_method)
+
+    if not ensemble.run():
+        return ([], [], np.array([-1]), np.array([-1]), np.array([-1]), None,
+            None, None, None, None, None, None)
+
+    rhos = []
+    sides = []
+    chi_sq = []
+    rg = []
+    support_vol = []
+
+    for result in ensemble.results:
+        last_index = max(np.where(result[6] !=0)[0])
+
+        rhos.append(result[8])
+        sides.append(result[9])
+        chi_sq.append(result[11])
+        rg.append(result[6][last_index])
+        support_vol.append(result[7][last_index])
+
+    chi_sq = np.array(chi_sq)
+    rg = np.array(rg)
+    support_vol = np.array(support_vol)
+
+    if average:
+        (average_rho, mean_cor, std_cor, threshold, res,
+            fsc) = ensemble.average_results
+        scores = np.array(ensemble.scores)
+    else:
+        average_rho = None
+        mean_cor = None
+        std_cor = None
+        threshold = None
+        res = None
+        scores = None
+        fsc = None
+
+    return (rhos, sides, chi_sq, rg, support_vol, average_rho, mean_cor,
+        std_cor, threshold, res, scores, fsc)
+
 def denss_average(densities, side, prefix, datadir, n_proc=1,
-    abort_event=None):
+    abort_event=None, align_method='minimize'):
     """
     Averages multiple electron densities to produce a single average density.
     Uses the averaging procedure from the DENSS package. Function blocks until
@@ -5283,6 +6240,12 @@ def denss_average(densities, side, prefix, datadir, n_proc=1,
     abort_event: :class:`multiprocessing.Manager.Event`, optional
         A :class:`multiprocessing.ManagerEvent` If this event is set it will abort
         the denss average run.
+    align_method: {'minimize', 'fft'}, optional
+        The method used to align the densities. 'minimize' (the default)
+        does a coarse grid search followed by minimization of the overlap
+        score, as in the DENSS package. 'fft' uses FFT cross-correlation to
+        find the best translation for each trial rotation, which searches a
+        finer rotation grid and is faster, particularly for large maps.
 
     Returns
     -------
@@ -5305,6 +6268,7 @@ def denss_average(densities, side, prefix, datadir, n_proc=1,
         The average Fourier shell correlation between each model and a
         average reference model. This is used to estimate the resolution.
     """
+    import bioxtasraw.DENSS as DENSS
 
     datadir = os.path.abspath(os.path.expanduser(datadir))
 
@@ -5317,62 +6281,33 @@ def denss_average(densities, side, prefix, datadir, n_proc=1,
         densities = np.array(densities)
 
     allrhos, scores = DENSS.run_enantiomers(densities, n_proc,
-        single_proc=single_proc, abort_event=abort_event, gui=False)
+        single_proc=single_proc, abort_event=abort_event, gui=False,
+        method=align_method)
 
     if abort_event is not None and abort_event.is_set():
         return np.array([-1]), -1, -1, -1, -1, np.array([-1]), np.array([-1])
 
     refrho = DENSS.binary_average(allrhos, n_proc, single_proc=single_proc,
-        abort_event=abort_event)
+        abort_event=abort_event, method=align_method)
 
     if abort_event is not None and abort_event.is_set():
         return np.array([-1]), -1, -1, -1, -1, np.array([-1]), np.array([-1])
 
     aligned, scores = DENSS.align_multiple(refrho, allrhos, n_proc,
-        single_proc=single_proc, abort_event=abort_event)
+        single_proc=single_proc, abort_event=abort_event, method=align_method)
 
     if abort_event is not None and abort_event.is_set():
         return np.array([-1]), -1, -1, -1, -1, np.array([-1]), np.array([-1])
 
-    #filter rhos with scores below the mean - 2*standard deviation.
-    mean_cor = np.mean(scores)
-    std_cor = np.std(scores)
-    threshold = mean_cor - 2*std_cor
-
-    aligned = aligned[scores>threshold]
-    average_rho = np.mean(aligned,axis=0)
-
-    DENSS.write_mrc(average_rho, side, os.path.join(datadir, prefix+'_average.mrc'))
-
-    #rather than compare two halves, average all fsc's to the reference
-    fscs = []
-    for calc_map in range(len(aligned)):
-        fscs.append(DENSS.calc_fsc(aligned[calc_map],refrho,side))
-    fscs = np.array(fscs)
-    fsc = np.mean(fscs,axis=0)
-    x = np.linspace(fsc[0,0],fsc[-1,0],100)
-    y = np.interp(x, fsc[:,0], fsc[:,1])
-    resi = np.argmin(y>=0.5)
-    resx = np.interp(0.5,[y[resi+1],y[resi]],[x[resi+1],x[resi]])
-    resn = round(float(1./resx),1)
-    np.savetxt(os.path.join(datadir, prefix+'_fsc.dat'),fsc,delimiter=" ",
-        fmt="%.5e",header="1/resolution, FSC; Resolution=%.1f A" % resn)
-
-    with open(os.path.join(datadir, '{}_average.log'.format(prefix)), 'w') as f:
-        f.write( "Mean of correlation scores: %.3f\n" % mean_cor)
-        f.write( "Standard deviation of scores: %.3f\n" % std_cor)
-        f.write('Total number of input maps for alignment: %i\n' % allrhos.shape[0])
-        f.write('Number of aligned maps accepted: %i\n' % aligned.shape[0])
-        f.write(('Correlation score between average and reference: %.3f\n'
-            % (1./DENSS.rho_overlap_score(average_rho, refrho))))
-        f.write("Resolution: %.1f " % resn + 'Angstrom\n')
-
+    (average_rho, mean_cor, std_cor, threshold, resn,
+        fsc) = DENSS.average_aligned(aligned, scores, refrho, side, prefix,
+        datadir)
 
     return average_rho, mean_cor, std_cor, threshold, resn, scores, fsc
 
 def denss_align(density, side, ref_file, ref_datadir='.',  prefix='',
     save_datadir='.', save=True, center=True, resolution=15.0, enantiomer=True,
-    n_proc=1, abort_event=None):
+    n_proc=1, abort_event=None, align_method='minimize'):
     """
     Aligns each input electron density against a reference model. The
     reference model can either be a PDB model (.pdb) or electron density (.mrc).
@@ -5415,6 +6350,12 @@ def denss_align(density, side, ref_file, ref_datadir='.',  prefix='',
     abort_event: :class:`multiprocessing.Manager.Event`, optional
         A :class:`multiprocessing.Manager.Event` If this event is set it will abort
         the denss alignment run.
+    align_method: {'minimize', 'fft'}, optional
+        The method used to align the densities. 'minimize' (the default)
+        does a coarse grid search followed by minimization of the overlap
+        score, as in the DENSS package. 'fft' uses FFT cross-correlation to
+        find the best translation for each trial rotation, which searches a
+        finer rotation grid and is faster, particularly for large maps.
 
     Returns
     -------
@@ -5423,6 +6364,7 @@ def denss_align(density, side, ref_file, ref_datadir='.',  prefix='',
     scores: float
         The correlation score of the model to the reference model.
     """
+    import bioxtasraw.DENSS as DENSS
 
     ref_datadir = os.path.abspath(os.path.expanduser(ref_datadir))
     save_datadir = os.path.abspath(os.path.expanduser(save_datadir))
@@ -5440,7 +6382,7 @@ def denss_align(density, side, ref_file, ref_datadir='.',  prefix='',
     aligned_rhos, scores = DENSS.run_align(rho_list, side_list, ref_name,
         center=center, resolution=resolution, enantiomer=enantiomer,
         cores=n_proc, single_proc=single_proc, gui=False,
-        abort_event=abort_event)
+        abort_event=abort_event, method=align_method)
 
     if abort_event is not None and abort_event.is_set():
         return np.array([-1]), -1
@@ -5473,7 +6415,9 @@ def pdb2sas(models,
     save_output=False,
     output_dir=None,
     abort_event=None,
-    readback_queue=None):
+    readback_queue=None,
+    debye_method=None,
+    debye_dr=0.02):
     """
     Calculates the theoretical scattering profile from an atomic or bead model
     using the theoretiacl profile calculator from DENSS (pdb2mrc).
@@ -5541,6 +6485,15 @@ def pdb2sas(models,
     readback_queue: :class:`queue.Queue`, optional
         If provided, any command line output (STDIN, STDERR) is placed in the
         queue.
+    debye_method: {'histogram', 'exact'} str, optional
+        If provided, the in vacuo scattering of the model atoms is also
+        calculated with the Debye formula (DENSS PDB2SAS), at the same q values
+        as the theoretical curve. 'exact' sums over every pair of atoms,
+        'histogram' uses histograms of the pair distances and is much faster
+        for large models. Default is None, which skips the calculation.
+    debye_dr: float, optional
+        The distance bin width in Angstrom for the 'histogram' Debye method.
+        Default is 0.02.
 
     Returns
     -------
@@ -5552,10 +6505,13 @@ def pdb2sas(models,
         first is the theoretical curve at default intensity values. If a fit
         to data was done, the second item is the theoretical curve scaled to
         the data. If a fit to data was not done, the second item is None.
+        If a debye_method is provided, the list has a third item, the
+        in vacuo Debye scattering profile.
     """
+    import bioxtasraw.DENSS as DENSS
 
     if settings is None:
-        use_settings = __default_settings
+        use_settings = _get_default_settings()
     else:
         use_settings = settings
 
@@ -5678,6 +6634,11 @@ def pdb2sas(models,
 
                     pdb2mrc_results[name] = [theory, fit]
 
+                    if debye_method is not None:
+                        pdb2mrc_results[name].append(DENSS.pdb2sas_to_sasm(
+                            pdb2mrc_i.pdb, theory.getQ(), debye_method,
+                            debye_dr))
+
                     if prefix is None:
                         prefix = name
 
@@ -5711,6 +6672,10 @@ def pdb2sas(models,
                 theory, fit = DENSS.pdb2mrc_to_sasm(pdb2mrc)
                 pdb2mrc_results[name] = [theory, None]
 
+                if debye_method is not None:
+                    pdb2mrc_results[name].append(DENSS.pdb2sas_to_sasm(
+                        pdb2mrc.pdb, theory.getQ(), debye_method, debye_dr))
+
                 if prefix is None:
                     prefix = name
 
@@ -5738,7 +6703,8 @@ def pdb2sas(models,
 # Operations on series
 
 
-def svd(series, profile_type='sub', framei=None, framef=None, norm=True):
+def svd(series, profile_type='sub', framei=None, framef=None, norm=True,
+    svd_method='full', n_sv=10):
     """
     Runs singular value decomposition (SVD) on the input series.
 
@@ -5762,6 +6728,13 @@ def svd(series, profile_type='sub', framei=None, framef=None, norm=True):
     norm: bool, optional
         Whether error normalized intensity should be used for EFA. Defaults
         to True. Recommended to not change this.
+    svd_method: {'full', 'randomized', 'truncated'} str, optional
+        'full' calculates the full SVD. 'randomized' (a randomized SVD) and
+        'truncated' (ARPACK) only calculate the first n_sv singular values
+        and vectors, which is much faster for long series.
+    n_sv: int, optional
+        The number of singular values to calculate if svd_method is
+        'randomized' or 'truncated'. Defaults to 10.
 
     Returns
     -------
@@ -5816,7 +6789,10 @@ def svd(series, profile_type='sub', framei=None, framef=None, norm=True):
         raise SASExceptions.EFAError(('Initial SVD matrix contained nans or '
             'infinities. SVD could not be carried out'))
 
-    svd_U, svd_s, svd_Vt = np.linalg.svd(D, full_matrices = True)
+    if svd_method == 'full':
+        svd_U, svd_s, svd_Vt = np.linalg.svd(D, full_matrices = True)
+    else:
+        svd_U, svd_s, svd_Vt = SASCalc.truncatedSVD(D, n_sv, svd_method)
 
     svd_V = svd_Vt.T
 
@@ -5825,7 +6801,7 @@ def svd(series, profile_type='sub', framei=None, framef=None, norm=True):
 def regals(series, comp_settings, profile_type='sub', framei=None,
     framef=None, x_vals=None, min_iter=25, max_iter=1000, tol=0.0001,
     conv_type='Chi^2', use_previous_results=False,
-    previous_results=None):
+    previous_results=None, trace_file=None):
     """
     Runs regularized alternating least squares (REGALS) on the input series to
     deconvolve overlapping components in the data.
@@ -5902,6 +6878,9 @@ def regals(series, comp_settings, profile_type='sub', framei=None,
         The mixture output from a previous REGALS run, which will be used as
         the initial profile and concentration vectors for this REGALS run. Only
         used of use_previous_results is True.
+    trace_file: str, optional
+        If provided, the elapsed time and chi^2 of each iteration are saved
+        to this file as a csv.
 
     Returns
     -------
@@ -5936,13 +6915,88 @@ def regals(series, comp_settings, profile_type='sub', framei=None,
     (regals_profiles, regals_ifts, concs, reg_concs, mixture, params,
         residual) = SASCalc.run_full_regals(series, comp_settings, profile_type,
         framei, framef, x_vals, min_iter, max_iter, tol, conv_type,
-        use_previous_results, previous_results)
+        use_previous_results, previous_results, trace_file)
 
     return regals_profiles, regals_ifts, concs, reg_concs, mixture, params, residual
 
+def regals_multistart(series, comp_settings_list, profile_type='sub',
+    framei=None, framef=None, x_vals=None, min_iter=25, max_iter=1000,
+    tol=0.0001, conv_type='Chi^2', nprocs=None, warm_start=True,
+    previous_results=None, trace_file=None):
+    """
+    Runs regularized alternating least squares (REGALS) on the input series
+    for several sets of component settings in parallel. This is useful for
+    scanning the regularization lambdas or the number of components. The
+    best result can then be passed to :func:`regals` as previous_results to
+    make the final profiles and concentrations.
+
+    Parameters
+    ----------
+    series: list or :class:`bioxtasraw.SECM.SECM`
+        The input series to be deconvolved. It should either be a list
+        of individual scattering profiles (:class:`bioxtasraw.SASM.SASM`) or
+        a single series object (:class:`bioxtasraw.SECM.SECM`).
+    comp_settings_list: list
+        A list where each entry is a complete set of REGALS component
+        settings, as described for the comp_settings input of :func:`regals`.
+    profile_type: {'unsub', 'sub', 'baseline'} str, optional
+        Only used if a :class:`bioxtasraw.SECM.SECM` is provided for the series
+        argument. Determines which type of profile to use from the series
+        for the REGALS. Unsubtracted profiles - 'unsub', subtracted profiles -
+        'sub', baseline corrected profiles - 'baseline'.
+    framei: int, optional
+        The initial frame in the series to use for REGALS. If not provided,
+        it defaults to the first frame in the series.
+    framef: int, optional
+        The final frame in the series to use for REGALS. If not provided, it
+        defaults to the last frame in the series.
+    min_iter: int, optional
+        The minimum number of iterations of the REGALS algorithm to run. Defaults
+        to 25.
+    max_iter: int, optional
+        The maximum number of iterations of the REGALS algorithm to run. Defaults
+        to 1000.
+    tol: float, optional
+        The relative tolerance to use for the 'Chi^2' convergence criteria.
+        Defaults to 0.0001.
+    conv_type: str, optional
+        The convergence type to use. Can be either 'Iterations' or 'Chi^2'.
+    nprocs: int, optional
+        The number of REGALS runs to do at once. If not provided, all but
+        one of the available cores are used.
+    warm_start: bool, optional
+        Whether to start each run from the best (lowest chi^2) finished
+        result with the same number of components. Defaults to True.
+    previous_results: :class:`bioxtasraw.REGALS.mixture`, optional
+        The mixture output from a previous REGALS run, used as the starting
+        point for runs with the same number of components until a better
+        result is found. Only used if warm_start is True.
+    trace_file: str, optional
+        If provided, the elapsed time and chi^2 of each iteration of each
+        run are saved to this file as a csv.
+
+    Returns
+    -------
+    results: list
+        A list with an entry for each item in comp_settings_list. Each entry
+        is a tuple of (mixture, params, residual), as described in
+        :func:`regals`.
+    """
+    if nprocs is None:
+        nprocs = 0
+
+    framei, framef, x_vals, q, q_err, intensity, sigma = SASCalc.get_regals_data(
+        series, profile_type, framei, framef, x_vals)
+
+    results = SASCalc.run_regals_multistart(comp_settings_list, q, x_vals,
+        intensity, sigma, min_iter, max_iter, tol, conv_type, nprocs,
+        warm_start, previous_results, trace_file)
+
+    return results
+
 def efa(series, ranges, profile_type='sub', framei=None, framef=None,
     method='Hybrid', niter=1000, tol=1e-12, norm=True, force_positive=None,
-    previous_results=None):
+    previous_results=None, svd_method='full'):
     """
     Runs evolving factor analysis (EFA) on the input series to deconvolve
     overlapping elution peaks in the data.
@@ -5998,6 +7052,10 @@ def efa(series, ranges, profile_type='sub', framei=None, framef=None,
         is a dictionary of the previous results, corresponding to the
         rotation_data dictionary returned by this function. Defaults to None,
         which should be used if no previous results are available.
+    svd_method: {'full', 'randomized', 'truncated'} str, optional
+        The SVD used for the rotation. 'full' calculates the full SVD, while
+        'randomized' and 'truncated' only calculate the singular vectors
+        needed for the EFA ranges, which is much faster for long series.
 
     Returns
     -------
@@ -6036,14 +7094,14 @@ def efa(series, ranges, profile_type='sub', framei=None, framef=None,
 
     efa_profiles, converged, conv_data, rotation_data = SASCalc.run_full_efa(series,
         ranges, profile_type, framei, framef, method, niter, tol, norm,
-        force_positive, previous_results)
+        force_positive, previous_results, svd_method)
 
     return efa_profiles, converged, conv_data, rotation_data
 
 
 def find_buffer_range(series, profile_type='unsub', int_type='total', q_val=None,
     q_range=None, window_size=5, settings=None, sim_test='CorMap',
-    sim_cor='Bonferroni', sim_thresh=0.01):
+    sim_cor='Bonferroni', sim_thresh=0.01, nprocs=None):
     """
     Automatically determine the appropriate buffer range from subtraction from
     the input series. This is designed to work with SEC-SAXS data, but may work
@@ -6092,6 +7150,9 @@ def find_buffer_range(series, profile_type='unsub', int_type='total', q_val=None
         Sets the p value threshold for the similarity test. A higher value is
         a more strict test (range from 0-1). Is overridden if settings are
         provided.
+    nprocs: int, optional
+        The number of threads used to test candidate ranges. Defaults to
+        the number of processors in the computer -1 (minimum 1).
 
     Returns
     -------
@@ -6102,6 +7163,9 @@ def find_buffer_range(series, profile_type='unsub', int_type='total', q_val=None
     region_end: int
         The ending index of the buffer region found.
     """
+    if nprocs is None:
+        nprocs = 0
+
     if settings is not None:
         sim_thresh = settings.get('similarityThreshold')
         sim_test = settings.get('similarityTest')
@@ -6129,7 +7193,7 @@ def find_buffer_range(series, profile_type='unsub', int_type='total', q_val=None
         intensity = np.array([sasm.getIofQRange(q1, q2) for sasm in buffer_sasms])
 
     success, region_start, region_end = SASCalc.findBufferRange(buffer_sasms,
-        intensity, window_size, sim_test, sim_cor, sim_thresh)
+        intensity, window_size, sim_test, sim_cor, sim_thresh, nprocs)
 
     return success, region_start, region_end
 
@@ -6482,7 +7546,8 @@ def set_buffer_range(series, buffer_range, int_type='total', q_val=None,
 def series_calc(sub_profiles, window_size=5, settings=None, error_weight=True,
     vp_density=0.83*10**(-3), vp_cutoff='Default', vp_qmax=0.5,
     vc_protein=True, vc_cutoff='Manual', vc_qmax=0.3, vc_a_prot=1.0,
-    vc_b_prot=0.1231, vc_a_rna=0.808, vc_b_rna=0.00934):
+    vc_b_prot=0.1231, vc_a_rna=0.808, vc_b_rna=0.00934, single_proc=True,
+    nprocs=None):
     """
     Calculates Rg and MW for the input subtracted profiles. If you are working
     with a :class:`SECM.SECM` series object then use :func:`set_buffer_range`
@@ -6535,6 +7600,14 @@ def series_calc(sub_profiles, window_size=5, settings=None, error_weight=True,
     vc_b_rna: float
         The volume of correlation B coefficient for RNA. Not recommended to
         be changed. Note that here B is defined as 1/B from the original paper.
+    single_proc: bool, optional
+        Whether to use one or multiple processors for the Rg and M.W.
+        calculations. Defaults to True. Multiple processors are only
+        worthwhile for long series.
+    nprocs: int, optional
+        If specified, and single_proc is False, determines the number of
+        processors to use. Otherwise defaults to number of processors in the
+        computer -1 (minimum 1).
 
     Returns
     -------
@@ -6591,12 +7664,15 @@ def series_calc(sub_profiles, window_size=5, settings=None, error_weight=True,
         else:
             vc_protein = False
 
+    if nprocs is None:
+        nprocs = 0
+
     use_sub_profiles = [True for profile in sub_profiles]
 
     success, results = SASCalc.run_secm_calcs(sub_profiles, use_sub_profiles,
         window_size, vc_protein, error_weight, vp_density, vp_cutoff,
         vp_qmax, vc_cutoff, vc_qmax, vc_a_prot, vc_b_prot, vc_a_rna,
-        vc_b_rna)
+        vc_b_rna, single_proc=single_proc, nprocs=nprocs)
 
     if success:
         rg = results['rg']
@@ -6619,7 +7695,8 @@ def series_calc(sub_profiles, window_size=5, settings=None, error_weight=True,
 
 def find_sample_range(series, profile_type='sub', window_size=5,
     int_type='total', q_val=None, q_range=None, rg=None, vcmw=None, vpmw=None,
-    settings=None, sim_test='CorMap', sim_cor='Bonferroni', sim_thresh=0.01):
+    settings=None, sim_test='CorMap', sim_cor='Bonferroni', sim_thresh=0.01,
+    nprocs=None):
     """
     Automatically determine the appropriate sample range to average from
     the input series. This is designed to work with SEC-SAXS data, but may
@@ -6677,6 +7754,9 @@ def find_sample_range(series, profile_type='sub', window_size=5,
         Sets the p value threshold for the similarity test. A higher value is
         a more strict test (range from 0-1). Is overridden if settings are
         provided.
+    nprocs: int, optional
+        The number of threads used to test candidate ranges. Defaults to
+        the number of processors in the computer -1 (minimum 1).
 
     Returns
     -------
@@ -6687,6 +7767,9 @@ def find_sample_range(series, profile_type='sub', window_size=5,
     region_end: int
         The ending index of the sample region found.
     """
+    if nprocs is None:
+        nprocs = 0
+
     if settings is not None:
         sim_thresh = settings.get('similarityThreshold')
         sim_test = settings.get('similarityTest')
@@ -6719,7 +7802,7 @@ def find_sample_range(series, profile_type='sub', window_size=5,
 
     success, region_start, region_end = SASCalc.findSampleRange(sub_profiles,
         intensity, rg, vcmw, vpmw, window_size, sim_test, sim_cor,
-        sim_thresh)
+        sim_thresh, nprocs)
 
     return success, region_start, region_end
 
@@ -6948,7 +8031,7 @@ def set_sample_range(series, sample_range, profile_type='sub'):
 
 def find_baseline_range(series, baseline_type='Integral', profile_type='sub',
     window_size=5, int_type='total', q_val=None, q_range=None, settings=None,
-    sim_test='CorMap', sim_cor='Bonferroni', sim_thresh=0.01):
+    sim_test='CorMap', sim_cor='Bonferroni', sim_thresh=0.01, nprocs=None):
     """
     Automatically determine an appropriate range for the baseline
     correction. Currently only works for integral baseline corrections.
@@ -6998,6 +8081,9 @@ def find_baseline_range(series, baseline_type='Integral', profile_type='sub',
         Sets the p value threshold for the similarity test. A higher value is
         a more strict test (range from 0-1). Is overridden if settings are
         provided.
+    nprocs: int, optional
+        The number of threads used to test candidate ranges. Defaults to
+        the number of processors in the computer -1 (minimum 1).
 
     Returns
     -------
@@ -7015,6 +8101,9 @@ def find_baseline_range(series, baseline_type='Integral', profile_type='sub',
         value if not end_found.
     """
 
+    if nprocs is None:
+        nprocs = 0
+
     if settings is not None:
         sim_thresh = settings.get('similarityThreshold')
         sim_test = settings.get('similarityTest')
@@ -7050,7 +8139,8 @@ def find_baseline_range(series, baseline_type='Integral', profile_type='sub',
 
     (start_failed, end_failed, region1_start, region1_end, region2_start,
         region2_end) = SASCalc.findBaselineRange(sub_profiles, intensity,
-        baseline_type, window_size, start_region, sim_test, sim_cor, sim_thresh)
+        baseline_type, window_size, start_region, sim_test, sim_cor, sim_thresh,
+        nprocs)
 
     start_found = not start_failed
     end_found = not end_failed
@@ -7483,3 +8573,77 @@ def set_baseline_correction(series, start_range, end_range, baseline_type,
 
     return (bl_cor_profiles, rg, rger, i0, i0er, vcmw, vcmwer, vpmw, bl_corr,
         fit_results)
+
+def update_baseline_correction(series, int_type='total', q_val=None,
+    q_range=None, settings=None, min_iter=100, max_iter=2000,
+    calc_thresh=1.02, first_frame=None):
+    """
+    Updates the baseline correction of a series that is growing, for example
+    during online data collection. The series must already have a baseline
+    correction set by :py:func:`set_baseline_correction`. Profiles added to
+    the series since then are baseline corrected with the same ranges and
+    baseline type, and only profiles that are new or changed are corrected.
+    The results are the same as setting the baseline correction for the
+    whole series. The Rg and M.W. values of the series are not recalculated.
+
+    Parameters
+    ----------
+    series: :class:`bioxtasraw.SECM.SECM`
+        The series to update. It must have both unsubtracted and subtracted
+        profiles.
+    int_type: {'total', 'mean', 'q_val', 'q_range'} str, optional
+        The intensity type used to decide whether a baseline corrected
+        profile is used to calculate Rg and MW. Use of q_val or q_range
+        requires the corresponding parameter to be provided.
+    q_val: float, optional
+        If int_type is 'q_val', the q value used for the intensity is set by
+        this parameter.
+    q_range: list, optional
+        This should have two entries, both floats. The first is the minimum q
+        value of the range, the second the maximum q value of the range. If
+        int_type is 'q_range', the q range used for the intensity is set by
+        this parameter.
+    settings: :class:`bioxtasraw.RAWSettings.RAWSettings`, optional
+        RAW settings containing relevant parameters. If provided, min_iter,
+        max_iter and calc_thresh are overridden by the values in the
+        settings.
+    min_iter: int, optional
+        The minimum number of iterations for calculating the integral baseline
+        correction. Overridden if settings are provided.
+    max_iter: int, optional
+        The maximum number of iterations for calculating the integral baseline
+        correction. Overridden if settings are provided.
+    calc_thresh: float, optional
+        If the ratio of the baseline corrected profile intensity to the
+        intensity of the start range is greater than this threshold, the
+        profile is used to calculate Rg and MW. Overridden if settings are
+        provided.
+    first_frame: int, optional
+        The first subtracted profile that is new or has changed since the
+        last update. Defaults to the profiles added since the last update.
+
+    Returns
+    -------
+    bl_cor_profiles: list
+        A list of the baseline corrected profiles that were updated, from
+        first_frame on.
+    first_frame: int
+        The index in the series of the first updated baseline corrected
+        profile.
+    """
+    if settings is not None:
+        min_iter = settings.get('IBaselineMinIter')
+        max_iter = settings.get('IBaselineMaxIter')
+        calc_thresh = settings.get('secCalcThreshold')
+
+    series.acquireSemaphore()
+
+    try:
+        first_frame = SASCalc.updateSeriesBaseline(series, min_iter, max_iter,
+            int_type, q_val, q_range, calc_thresh, first_frame)
+
+        bl_cor_profiles = series.baseline_subtracted_sasm_list[first_frame:]
+    finally:
+        series.releaseSemaphore()
+
+    return bl_cor_profiles, first_frame
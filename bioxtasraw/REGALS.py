@@ -148,6 +148,70 @@ class mixture:
         if len(self.lambda_profile) == 0:
             self.lambda_profile = np.zeros(self.Nc)
 
+        # The component basis products that the concentration/profile
+        # problems reuse every step. Copies of the mixture share the cache,
+        # since the components are never modified.
+        self._cache = {}
+
+    def __deepcopy__(self, memo):
+        new_mix = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new_mix
+
+        for key, value in self.__dict__.items():
+            if key == '_cache':
+                new_mix._cache = value
+            else:
+                setattr(new_mix, key, deepcopy(value, memo))
+
+        return new_mix
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = {}
+
+    def _concentration_basis(self):
+        if 'concentration' not in self._cache:
+            A = [comp.concentration.A for comp in self.components]
+            AA = [[A[k1].T @ A[k2] for k2 in range(self.Nc)] for k1 in range(self.Nc)]
+            self._cache['concentration'] = (A, AA)
+
+        return self._cache['concentration']
+
+    def _profile_basis(self, w):
+        cached = self._cache.get('profile')
+
+        if cached is None or not np.array_equal(cached[0], w):
+            A = [comp.profile.A for comp in self.components]
+            A = [sp.diags(w,0) @ Ai for Ai in A]
+            AA = [[A[k1].T @ A[k2] for k2 in range(self.Nc)] for k1 in range(self.Nc)]
+            cached = (w, A, AA)
+            self._cache['profile'] = cached
+
+        return cached[1:]
+
+    def _regularizer(self, reg_type, lambdas):
+        key = ('H_' + reg_type, tuple(lambdas))
+        H = self._cache.get(key)
+
+        if H is None:
+            if reg_type == 'concentration':
+                L = [comp.concentration.L for comp in self.components]
+            else:
+                L = [comp.profile.L for comp in self.components]
+
+            B = [Lk * (lbdk ** 0.5) for Lk, lbdk in zip(L, lambdas)]
+            B = sp.block_diag(B)
+            H = B.T @ B
+
+            self._cache[key] = H
+
+        return H
+
     @property
     def Nc(self):
         return len(self.components)
@@ -232,13 +296,13 @@ class mixture:
 
         w = 1 / np.mean(err,1)
 
-        A = [comp.concentration.A for comp in self.components]
+        A, AtA = self._concentration_basis()
 
         D = w[:,np.newaxis] * I
         y = self.profiles
         y = w[:,np.newaxis] * y
 
-        AA = [[(y[:,k1] @ y[:,k2]) * (A[k1].T @ A[k2]) for k2 in range(self.Nc)] for k1 in range(self.Nc)]
+        AA = [[(y[:,k1] @ y[:,k2]) * AtA[k1][k2] for k2 in range(self.Nc)] for k1 in range(self.Nc)]
         AA = sp.vstack(tuple(sp.hstack(tuple(AAi)) for AAi in AA))
 
         if calc_Ab == True:
@@ -252,13 +316,12 @@ class mixture:
 
         w = 1 / np.mean(err,1)
 
-        A = [comp.profile.A for comp in self.components]
-        A = [sp.diags(w,0) @ Ai for Ai in A]
+        A, AtA = self._profile_basis(w)
 
         D = w[:,np.newaxis] * I
         c = self.concentrations
 
-        AA = [[sp.csr_matrix((c[:,k1] @ c[:,k2]) * (A[k1].T @ A[k2])) for k2 in range(self.Nc)] for k1 in range(self.Nc)]
+        AA = [[sp.csr_matrix((c[:,k1] @ c[:,k2]) * AtA[k1][k2]) for k2 in range(self.Nc)] for k1 in range(self.Nc)]
         AA = sp.vstack(tuple(sp.hstack(tuple(AAi)) for AAi in AA))
 
         if calc_Ab == True:
@@ -297,17 +360,11 @@ class mixture:
 
     @property
     def H_concentration(self):
-        L = [comp.concentration.L for comp in self.components]
-        B = [Lpk * (lbdpk ** 0.5) for Lpk, lbdpk in zip(L, self.lambda_concentration)]
-        B = sp.block_diag(B)
-        return B.T @ B
+        return self._regularizer('concentration', self.lambda_concentration)
 
     @property
     def H_profile(self):
-        L = [comp.profile.L for comp in self.components]
-        B = [Lpr * (lbdpr ** 0.5) for Lpr, lbdpr in zip(L, self.lambda_profile)]
-        B = sp.block_diag(B)
-        return B.T @ B
+        return self._regularizer('profile', self.lambda_profile)
 
     @property
     def concentrations(self):
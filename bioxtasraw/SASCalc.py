@@ -40,19 +40,22 @@ import os
 import time
 import subprocess
 import threading
+import multiprocessing
+import collections
+import hashlib
 import platform
 import re
 import math
 import traceback
 import copy
 import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, Future
 
 import numpy as np
 import scipy.interpolate
-import scipy.signal
-import scipy.stats as stats
 from scipy.constants import Avogadro
-from numba import jit
+from numba import jit, prange
 
 raw_path = os.path.abspath(os.path.join('.', __file__, '..', '..'))
 if raw_path not in os.sys.path:
@@ -173,6 +176,124 @@ def calcRg(q, i, err, transform=True, error_weight=True):
 
     return RG, I0, RGer, I0er, a, b
 
+@jit(nopython=True, cache=True, parallel=False)
+def calcRgWindow(x, y, yerr, start, stop, error_weight=True):
+    """
+    Gives the same result as calcRg(x[start:stop], y[start:stop],
+    yerr[start:stop], transform=False) with the points where y isn't finite
+    removed. The sums for the fit are done in a single pass over the window,
+    in the same order, without making temporary arrays. autoRg_inner fits
+    many windows, and for short windows making the arrays took most of the
+    time.
+    """
+    sums = np.zeros(11)
+    addRgWindowSums(x, y, yerr, start, stop, sums)
+
+    return calcRgWindowSums(x, y, start, stop, sums, error_weight)
+
+@jit(nopython=True, cache=True, parallel=False)
+def addRgWindowSums(x, y, yerr, start, stop, sums):
+    """
+    Adds the points from start to stop to the sums for a calcRgWindow fit.
+    sums holds the number of points, whether any point has zero uncertainty,
+    the sums of x, x^2, y, and xy, and the weighted sums of 1, y, x, x^2,
+    and xy. Adding the points of a window to the sums of a shorter window
+    with the same start gives the same sums as adding them all at once.
+    """
+    for k in range(start, stop):
+        if np.isfinite(y[k]):
+            sums[0] = sums[0] + 1
+
+            sums[2] = sums[2] + x[k]
+            sums[3] = sums[3] + x[k]**2
+            sums[4] = sums[4] + y[k]
+            sums[5] = sums[5] + x[k]*y[k]
+
+            # With a zero uncertainty the fit isn't weighted
+            if yerr[k] == 0:
+                sums[1] = 1
+            else:
+                weight = 1./(yerr[k])**2.
+
+                sums[6] = sums[6] + weight
+                sums[7] = sums[7] + weight*y[k]
+                sums[8] = sums[8] + weight*x[k]
+                sums[9] = sums[9] + weight*x[k]**2.
+                sums[10] = sums[10] + weight*x[k]*y[k]
+
+@jit(nopython=True, cache=True, parallel=False)
+def calcRgWindowSums(x, y, start, stop, sums, error_weight=True):
+    """
+    Does the calcRgWindow fit for the window from start to stop, given the
+    sums for the window from addRgWindowSums.
+    """
+    n = sums[0]
+
+    x_sum = sums[2]
+    xsq_sum = sums[3]
+    y_sum = sums[4]
+    xy_sum = sums[5]
+
+    w_sum = sums[6]
+    wy_sum = sums[7]
+    wx_sum = sums[8]
+    wxsq_sum = sums[9]
+    wxy_sum = sums[10]
+
+    if error_weight and sums[1] == 1:
+        error_weight = False
+
+    if error_weight:
+        delta = w_sum*wxsq_sum-(wx_sum)**2.
+
+        if delta != 0:
+            a = (wxsq_sum*wy_sum - wx_sum*wxy_sum)/delta
+            b = (w_sum*wxy_sum - wx_sum*wy_sum)/delta
+
+            cov_a = wxsq_sum/delta
+            cov_b = w_sum/delta
+        else:
+            a = -1
+            b = -1
+            cov_a = -1
+            cov_b = -1
+
+    else:
+        delta = n*xsq_sum - x_sum**2.
+
+        if delta !=0:
+            a = (xsq_sum*y_sum - x_sum*xy_sum)/delta
+            b = (n*xy_sum-x_sum*y_sum)/delta
+
+            res_sum = 0.
+            for k in range(start, stop):
+                if np.isfinite(y[k]):
+                    res_sum = res_sum + (y[k]-a-b*x[k])**2.
+
+            cov_y = (1./(n-2.))*res_sum
+            cov_a = cov_y*(xsq_sum/delta)
+            cov_b = cov_y*(n/delta)
+        else:
+            a = -1
+            b = -1
+            cov_a = -1
+            cov_b = -1
+
+    if b < 0:
+        RG=np.sqrt(-3.*b)
+        I0=np.exp(a)
+
+        RGer=np.absolute(0.5*(np.sqrt(-3./b)))*np.sqrt(np.absolute(cov_b))
+        I0er=I0*np.sqrt(np.absolute(cov_a))
+
+    else:
+        RG = -1
+        I0 = -1
+        RGer = -1
+        I0er = -1
+
+    return RG, I0, RGer, I0er, a, b
+
 def estimate_guinier_error(q, i, err, transform=True, error_weight=True):
     if transform:
         #Start out by transforming as usual.
@@ -415,6 +536,17 @@ def porodVolume(q, i, err, rg, i0, start = 0, stop = -1, interp = True, rg_qmin=
 
     return pVolume
 
+# The search criteria used by autoRg, in the order they are tried. If no fit
+# is found, the criteria are relaxed. Columns are min_window, min_qrg, max_qrg,
+# quality_thresh, and data_range_scale.
+autorg_criteria = np.array([
+    [10, 1.0, 1.35, 0.6, 0],
+    [5, 1.0, 1.35, 0.5, 0],
+    [10, 1.0, 1.35, 0.6, 100],
+    [10, 1.2, 1.5, 0.3, 100],
+    [5, 1.2, 1.5, 0.3, 100],
+    ])
+
 def autoRg(sasm, single_fit=False, error_weight=True):
     #This function automatically calculates the radius of gyration and scattering intensity at zero angle
     #from a given scattering profile. It roughly follows the method used by the autorg function in the atsas package
@@ -425,26 +557,12 @@ def autoRg(sasm, single_fit=False, error_weight=True):
 
     qmin = 0
 
-    try:
-        rg, rger, i0, i0er, idx_min, idx_max = autoRg_inner(q, i, err, qmin,
-            single_fit, error_weight, min_window=10, min_qrg=1.0, max_qrg=1.35,
-            quality_thresh=0.6, data_range_scale=0, corr_coefht=2.,
-            win_length_weight=1.0)
-    except Exception: #Catches unexpected numba errors, I hope
-        traceback.print_exc()
-        rg = -1
-        rger = -1
-        i0 = -1
-        i0er = -1
-        idx_min = -1
-        idx_max = -1
-
-    if rg == -1:
-        #If we don't find a fit, relax the criteria
+    for min_window, min_qrg, max_qrg, quality_thresh, data_range_scale in autorg_criteria:
         try:
             rg, rger, i0, i0er, idx_min, idx_max = autoRg_inner(q, i, err, qmin,
-                single_fit, error_weight, min_window=5, min_qrg=1.0, max_qrg=1.35,
-                quality_thresh=0.5, data_range_scale=0, corr_coefht=2.,
+                single_fit, error_weight, min_window=int(min_window),
+                min_qrg=min_qrg, max_qrg=max_qrg, quality_thresh=quality_thresh,
+                data_range_scale=data_range_scale, corr_coefht=2.,
                 win_length_weight=1.0)
         except Exception: #Catches unexpected numba errors, I hope
             traceback.print_exc()
@@ -455,56 +573,186 @@ def autoRg(sasm, single_fit=False, error_weight=True):
             idx_min = -1
             idx_max = -1
 
-    if rg == -1:
+        if rg != -1:
+            break
         #If we don't find a fit, relax the criteria
-        try:
-            rg, rger, i0, i0er, idx_min, idx_max = autoRg_inner(q, i, err, qmin,
-                single_fit, error_weight, min_window=10, min_qrg=1.0, max_qrg=1.35,
-                quality_thresh=0.6, data_range_scale=100, corr_coefht=2.,
-                win_length_weight=1.0)
-        except Exception: #Catches unexpected numba errors, I hope
-            traceback.print_exc()
-            rg = -1
-            rger = -1
-            i0 = -1
-            i0er = -1
-            idx_min = -1
-            idx_max = -1
 
-    if rg == -1:
-        #If we don't find a fit, relax the criteria
-        try:
-            rg, rger, i0, i0er, idx_min, idx_max = autoRg_inner(q, i, err, qmin,
-                single_fit, error_weight, min_window=10, min_qrg=1.2, max_qrg=1.5,
-                quality_thresh=0.3, data_range_scale=100, corr_coefht=2.,
-                win_length_weight=1.0)
-        except Exception: #Catches unexpected numba errors, I hope
-            traceback.print_exc()
-            rg = -1
-            rger = -1
-            i0 = -1
-            i0er = -1
-            idx_min = -1
-            idx_max = -1
+    return rg, rger, i0, i0er, idx_min, idx_max
+
+def autoRgBatch(q, i, err, single_fit=False, error_weight=True, chunk_size=1000):
+    """
+    Runs autoRg on many profiles that share a q vector, giving the same
+    results. The search for all of the profiles in a chunk is done in a
+    single compiled kernel, which runs the profiles in parallel. Each
+    profile takes about as long as it does in autoRg, so any large speedup
+    over calling autoRg for each profile comes from running on more cores.
+    On a single core the two take about the same time.
+
+    Parameters
+    ----------
+    q: :class:`numpy.array`
+        The q vector shared by all of the profiles.
+    i: :class:`numpy.array`
+        The intensities of the profiles, with shape (N, len(q)).
+    err: :class:`numpy.array`
+        The uncertainties of the profiles, with shape (N, len(q)).
+    single_fit: bool, optional
+        As for autoRg.
+    error_weight: bool, optional
+        As for autoRg.
+    chunk_size: int, optional
+        The number of profiles sent to the kernel at once.
+
+    Returns
+    -------
+    rg, rger, i0, i0er, idx_min, idx_max: :class:`numpy.array`
+        Arrays of length N with the autoRg results for each profile. Values
+        are -1 for profiles where no fit was found.
+    """
+    q = np.ascontiguousarray(q, dtype=np.float64)
+    i = np.ascontiguousarray(i, dtype=np.float64)
+    err = np.ascontiguousarray(err, dtype=np.float64)
+
+    nprofiles = i.shape[0]
+
+    rg = np.full(nprofiles, -1.)
+    rger = np.full(nprofiles, -1.)
+    i0 = np.full(nprofiles, -1.)
+    i0er = np.full(nprofiles, -1.)
+    idx_min = np.full(nprofiles, -1, dtype=np.int64)
+    idx_max = np.full(nprofiles, -1, dtype=np.int64)
+
+    for start in range(0, nprofiles, chunk_size):
+        stop = min(start+chunk_size, nprofiles)
 
-    if rg == -1:
-        #If we don't find a fit, relax the criteria
         try:
-            rg, rger, i0, i0er, idx_min, idx_max = autoRg_inner(q, i, err, qmin,
-                single_fit, error_weight, min_window=5, min_qrg=1.2, max_qrg=1.5,
-                quality_thresh=0.3, data_range_scale=100, corr_coefht=2.,
-                win_length_weight=1.0)
-        except Exception: #Catches unexpected numba errors, I hope
-            traceback.print_exc()
-            rg = -1
-            rger = -1
-            i0 = -1
-            i0er = -1
-            idx_min = -1
-            idx_max = -1
+            results = autoRg_batch_inner(q, i[start:stop], err[start:stop],
+                single_fit, error_weight, autorg_criteria)
+        except Exception:
+            # An error in one profile aborts the whole kernel, so fall back
+            # to running the chunk one profile at a time
+            results = autoRg_batch_fallback(q, i[start:stop], err[start:stop],
+                single_fit, error_weight)
+
+        (rg[start:stop], rger[start:stop], i0[start:stop], i0er[start:stop],
+            idx_min[start:stop], idx_max[start:stop]) = results
+
+    return rg, rger, i0, i0er, idx_min, idx_max
+
+def autoRg_batch_fallback(q, i, err, single_fit, error_weight):
+    nprofiles = i.shape[0]
+
+    rg = np.full(nprofiles, -1.)
+    rger = np.full(nprofiles, -1.)
+    i0 = np.full(nprofiles, -1.)
+    i0er = np.full(nprofiles, -1.)
+    idx_min = np.full(nprofiles, -1, dtype=np.int64)
+    idx_max = np.full(nprofiles, -1, dtype=np.int64)
+
+    for k in range(nprofiles):
+        sasm = SASM.SASM(i[k], q, err[k], {})
+
+        (rg[k], rger[k], i0[k], i0er[k], idx_min[k],
+            idx_max[k]) = autoRg(sasm, single_fit, error_weight)
+
+    return rg, rger, i0, i0er, idx_min, idx_max
+
+@jit(nopython=True, cache=True, parallel=True)
+def autoRg_batch_inner(q, i, err, single_fit, error_weight, criteria):
+    nprofiles = i.shape[0]
+
+    rg = np.full(nprofiles, -1.)
+    rger = np.full(nprofiles, -1.)
+    i0 = np.full(nprofiles, -1.)
+    i0er = np.full(nprofiles, -1.)
+    idx_min = np.full(nprofiles, -1, dtype=np.int64)
+    idx_max = np.full(nprofiles, -1, dtype=np.int64)
+
+    for k in prange(nprofiles):
+        for c in range(criteria.shape[0]):
+            res = autoRg_inner(q, i[k], err[k], 0, single_fit, error_weight,
+                int(criteria[c, 0]), criteria[c, 1], criteria[c, 2],
+                criteria[c, 3], criteria[c, 4], 2., 1.0)
+
+            if res[0] != -1:
+                rg[k] = res[0]
+                rger[k] = res[1]
+                i0[k] = res[2]
+                i0er[k] = res[3]
+                idx_min[k] = res[4]
+                idx_max[k] = res[5]
+                break
 
     return rg, rger, i0, i0er, idx_min, idx_max
 
+@jit(nopython=True, cache=True, parallel=True)
+def calcRgBatch(q, i, err, idx_min, idx_max, error_weight=True):
+    """
+    Calculates the Guinier fit for many profiles that share a q vector,
+    each over its own range (e.g. from autoRgBatch). Returns arrays of
+    Rg, I0, Rg error, I0 error, and fit r^2. Values are -1 for profiles
+    with no range (idx_min == -1).
+    """
+    nprofiles = i.shape[0]
+
+    rg = np.full(nprofiles, -1.)
+    i0 = np.full(nprofiles, -1.)
+    rger = np.full(nprofiles, -1.)
+    i0er = np.full(nprofiles, -1.)
+    r_sqr = np.full(nprofiles, -1.)
+
+    for k in prange(nprofiles):
+        if idx_min[k] != -1:
+            n1 = idx_min[k]
+            n2 = idx_max[k]+1
+
+            RG, I0, RGer, I0er, a, b = calcRg(q[n1:n2], i[k, n1:n2],
+                err[k, n1:n2], True, error_weight)
+
+            rg[k] = RG
+            i0[k] = I0
+            rger[k] = RGer
+            i0er[k] = I0er
+
+            x = np.square(q[n1:n2])
+            y = np.log(i[k, n1:n2])
+            error = y - linear_func(x, a, b)
+            r_sqr[k] = 1 - np.square(error).sum()/np.square(y-y.mean()).sum()
+
+    return rg, i0, rger, i0er, r_sqr
+
+@jit(nopython=True, cache=True, parallel=False)
+def calcWindowResiduals(x, y, yerr, start, stop, a, b):
+    """
+    Gets the residuals of the linear fit a+b*x to y from start to stop, and
+    the r^2 and chi^2 of the fit, summing in the same order as the array
+    sums in autoRg_inner but without making temporary arrays.
+    """
+    residual = np.empty(stop-start)
+
+    y_sum = 0.
+    res_sq_sum = 0.
+    chi_sqr = 0.
+
+    for k in range(start, stop):
+        res = y[k]-(a+b*x[k])
+        residual[k-start] = res
+
+        y_sum = y_sum + y[k]
+        res_sq_sum = res_sq_sum + res*res
+        chi_sqr = chi_sqr + (res/yerr[k])*(res/yerr[k])
+
+    y_mean = y_sum/(stop-start)
+
+    tot_sq_sum = 0.
+
+    for k in range(start, stop):
+        tot_sq_sum = tot_sq_sum + (y[k]-y_mean)*(y[k]-y_mean)
+
+    r_sqr = 1 - res_sq_sum/tot_sq_sum
+
+    return residual, r_sqr, chi_sqr
+
 @jit(nopython=True, cache=True, parallel=False)
 def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
     min_qrg=1.0, max_qrg=1.35, quality_thresh=0.6, data_range_scale=0,
@@ -573,6 +821,10 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
     il = np.log(i)
     iler = np.absolute(err/i)
 
+    # The ranks of an increasing q^2 don't need to be sorted out when
+    # checking the residuals for trends with spearmanr
+    qs_increasing = np.all(qs[1:] > qs[:-1])
+
     #Pick a minimum fitting window size. 10 is consistent with atsas autorg.
     min_window = min_window
 
@@ -624,31 +876,43 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
 
     success = np.zeros(num_fits)
 
-    current_fit = 0
+    # The number of fits before the fits of each window size
+    fit_offsets = [0 for k in range(len(window_list))]
+
+    for k in range(1, len(window_list)):
+        fit_offsets[k] = fit_offsets[k-1] + max(int(math.ceil((data_end
+            -window_list[k-1]-data_start)/float(data_step))), 0)
+
+    sums = np.zeros(11)
+
     #This function takes every window size in the window list, stepts it through the data range, and
     #fits it to get the RG and I0. If basic conditions are met, qmin*RG<1 and qmax*RG<1.35, and RG>0.1,
-    #We keep the fit.
-    for w in window_list:
-        for start in range(data_start,data_end-w, data_step):
-            x = qs[start:start+w]
-            y = il[start:start+w]
-            yerr = iler[start:start+w]
+    #We keep the fit. For each start point the windows are fit from shortest to longest, so the fit
+    #sums for each window carry on from those of the last one. The fits are stored in the same order
+    #as fitting every start point for each window size in turn.
+    for start in range(data_start, data_end-window_list[0], data_step):
+        sums[:] = 0
+        stop = start
 
-            #Remove NaN and Inf values:
-            x = x[np.where(np.isfinite(y))]
-            yerr = yerr[np.where(np.isfinite(y))]
-            y = y[np.where(np.isfinite(y))]
+        for j in range(len(window_list)):
+            w = window_list[j]
 
+            if start >= data_end-w:
+                break
 
-            RG, I0, RGer, I0er, a, b = calcRg(x, y, yerr, transform=False, error_weight=error_weight)
+            addRgWindowSums(qs, il, iler, stop, start+w, sums)
+            stop = start+w
 
-            if RG>0.1 and q[start]*RG<min_qrg and q[start+w-1]*RG<max_qrg and RGer/RG <= 1:
-                residual = il[start:start+w]-linear_func(qs[start:start+w], a, b)
+            current_fit = fit_offsets[j] + (start-data_start)//data_step
 
-                r_sqr = 1 - np.square(residual).sum()/np.square(il[start:start+w]-il[start:start+w].mean()).sum()
+            RG, I0, RGer, I0er, a, b = calcRgWindowSums(qs, il, start,
+                start+w, sums, error_weight)
+
+            if RG>0.1 and q[start]*RG<min_qrg and q[start+w-1]*RG<max_qrg and RGer/RG <= 1:
+                residual, r_sqr, chi_sqr = calcWindowResiduals(qs, il, iler,
+                    start, start+w, a, b)
 
                 if r_sqr > .15:
-                    chi_sqr = np.square((residual)/iler[start:start+w]).sum()
 
                     #All of my reduced chi_squared values are too small, so I suspect something isn't right with that.
                     #Values less than one tend to indicate either a wrong degree of freedom, or a serious overestimate
@@ -657,7 +921,10 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
                     reduced_chi_sqr = chi_sqr/dof
 
                     #Ideally this would be a pvalue, but I'd have to invest in a lot of intrastructure to actually calculate that in a jitted function
-                    corr_coef = 1- spearmanr(residual, qs[start:start+w])
+                    if qs_increasing:
+                        corr_coef = 1- spearmanrIncreasing(residual)
+                    else:
+                        corr_coef = 1- spearmanr(residual, qs[start:start+w])
 
                     start_list[current_fit] = start
                     w_list[current_fit] = w
@@ -676,7 +943,18 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
 
                     success[current_fit] = 1
 
-            current_fit = current_fit + 1
+    # The range refinement below uses the Rg of the last fit and the last
+    # window size from fitting each window size in turn, so get those
+    w = window_list[-1]
+
+    for j in range(len(window_list)-1, -1, -1):
+        n_starts = int(math.ceil((data_end-window_list[j]-data_start)/float(data_step)))
+
+        if n_starts > 0:
+            start = data_start + (n_starts-1)*data_step
+            RG = calcRgWindow(qs, il, iler, start, start+window_list[j],
+                error_weight)[0]
+            break
 
     if np.sum(success) > 0:
 
@@ -768,18 +1046,8 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
             while qual > quality_scale*max_quality and idx_max_ref < len(q):
 
                 idx_max_ref = idx_max_ref +1
-                x = qs[idx_min:idx_max_ref+1]
-                y = il[idx_min:idx_max_ref+1]
-                yerr = iler[idx_min:idx_max_ref+1]
-
-                #Remove NaN and Inf values:
-                x = x[np.where(np.isfinite(y))]
-                yerr = yerr[np.where(np.isfinite(y))]
-                y = y[np.where(np.isfinite(y))]
-
-
-                RG, I0, RGer, I0er, a, b = calcRg(x, y, yerr, transform=False,
-                    error_weight=error_weight)
+                RG, I0, RGer, I0er, a, b = calcRgWindow(qs, il, iler, idx_min,
+                    idx_max_ref+1, error_weight)
 
                 if RG>0.1 and q[idx_min]*RG<min_qrg and q[idx_max_ref]*RG<max_qrg_ref and RGer/RG <= 1:
                     residual = il[idx_min:idx_max_ref+1]- linear_func(qs[idx_min:idx_max_ref+1], a, b)
@@ -795,7 +1063,10 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
                         dof = w - 2.
                         reduced_chi_sqr = chi_sqr/dof
 
-                        corr_coef = 1- spearmanr(residual, qs[idx_min:idx_max_ref+1])
+                        if qs_increasing:
+                            corr_coef = 1- spearmanrIncreasing(residual)
+                        else:
+                            corr_coef = 1- spearmanr(residual, qs[idx_min:idx_max_ref+1])
 
                         qmaxrg_score = 1-abs((q[idx_max_ref]*RG-1.3)/1.3)
                         qminrg_score = 1-q[idx_min]*RG
@@ -838,18 +1109,8 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
             while qual > 0.97*max_quality and idx_min_ref > 0:
 
                 idx_min_ref = idx_min_ref -1
-                x = qs[idx_min_ref:idx_max+1]
-                y = il[idx_min_ref:idx_max+1]
-                yerr = iler[idx_min_ref:idx_max+1]
-
-                #Remove NaN and Inf values:
-                x = x[np.where(np.isfinite(y))]
-                yerr = yerr[np.where(np.isfinite(y))]
-                y = y[np.where(np.isfinite(y))]
-
-
-                RG, I0, RGer, I0er, a, b = calcRg(x, y, yerr, transform=False,
-                    error_weight=error_weight)
+                RG, I0, RGer, I0er, a, b = calcRgWindow(qs, il, iler,
+                    idx_min_ref, idx_max+1, error_weight)
 
                 if RG>0.1 and q[idx_min_ref]*RG<min_qrg and q[idx_max]*RG<max_qrg_ref and RGer/RG <= 1:
 
@@ -866,7 +1127,10 @@ def autoRg_inner(q, i, err, qmin, single_fit, error_weight, min_window=10,
                         dof = w - 2.
                         reduced_chi_sqr = chi_sqr/dof
 
-                        corr_coef = 1- spearmanr(residual, qs[idx_min_ref:idx_max+1])
+                        if qs_increasing:
+                            corr_coef = 1- spearmanrIncreasing(residual)
+                        else:
+                            corr_coef = 1- spearmanr(residual, qs[idx_min_ref:idx_max+1])
 
                         qmaxrg_score = 1-abs((q[idx_max]*RG-1.3)/1.3)
                         qminrg_score = 1-q[idx_min_ref]*RG
@@ -958,6 +1222,22 @@ def spearmanr(array1, array2):
 
     return rho
 
+@jit(nopython=True, cache=True)
+def spearmanrIncreasing(array1):
+    """
+    Gives the same result as spearmanr(array1, array2) for a strictly
+    increasing array2, whose ranks are just 0 to n-1, without sorting it.
+    """
+    rank1 = rankdata(array1)
+
+    n = rank1.size
+
+    dsq = (rank1-np.arange(n))**2
+
+    rho = 1. - (6*dsq.sum())/(n*(n**2-1))
+
+    return rho
+
 
 def calcVcMW(sasm, temp_rg, i0, temp_qmax, a_prot, b_prot, a_rna, b_rna,
     protein=True, interp=True, unit=''):
@@ -1514,16 +1794,7 @@ def runDatgnom(rg, atsasDir, path, datname, outname, first_pt, last_pt):
         if not isinstance(error, str):
             error = str(error, encoding='UTF-8')
 
-        error = error.strip()
-
-        if (error == 'Cannot define Dmax' or error=='Could not find Rg'
-            or error=='No intensity values (positive) found'
-            or error == 'LOADATF --E- No data lines recognized.'
-            or error == 'error: rg not specified'
-            or 'error' in error):
-            datgnom_success = False
-        else:
-            datgnom_success = True
+        datgnom_success = not _datgnomFailed(error)
 
         if datgnom_success:
             try:
@@ -1540,6 +1811,15 @@ def runDatgnom(rg, atsasDir, path, datname, outname, first_pt, last_pt):
         raise SASExceptions.NoATSASError('Cannot find datgnom.')
 
 
+def _datgnomFailed(error):
+    error = error.strip()
+
+    return (error == 'Cannot define Dmax' or error=='Could not find Rg'
+        or error=='No intensity values (positive) found'
+        or error == 'LOADATF --E- No data lines recognized.'
+        or error == 'error: rg not specified'
+        or 'error' in error)
+
 def writeGnomCFG(fname, outname, dmax, args):
     #This writes the GNOM CFG file, using the arguments passed into the function.
     datadir = os.path.dirname(fname)
@@ -1656,31 +1936,34 @@ def runDatmw(rg, i0, first, method, atsasDir, path, datname):
         if error != '':
             raise SASExceptions.NoATSASError('Error running datmw.')
 
-        ret_values = ()
+        return _parseDatmwOutput(output, method)
+
+    else:
+        raise SASExceptions.NoATSASError('Cannot find datmw.')
 
-        if output != '':
-            if method == 'bayes':
-                mw, mw_score, ci_lower, ci_upper, ci_score, _ = output.split()
+def _parseDatmwOutput(output, method):
+    ret_values = ()
 
-                mw = float(mw.strip())/1000.
-                mw_score = float(mw_score.strip())
-                ci_lower = float(ci_lower.strip())/1000.
-                ci_upper = float(ci_upper.strip())/1000.
-                ci_score = float(ci_score.strip())
+    if output != '':
+        if method == 'bayes':
+            mw, mw_score, ci_lower, ci_upper, ci_score, _ = output.split()
 
-                ret_values = (mw, mw_score, ci_lower, ci_upper, ci_score)
+            mw = float(mw.strip())/1000.
+            mw_score = float(mw_score.strip())
+            ci_lower = float(ci_lower.strip())/1000.
+            ci_upper = float(ci_upper.strip())/1000.
+            ci_score = float(ci_score.strip())
 
-            elif method == 'shapesize':
-                mw, _ = output.split()
+            ret_values = (mw, mw_score, ci_lower, ci_upper, ci_score)
 
-                mw = float(mw.strip())/1000.
+        elif method == 'shapesize':
+            mw, _ = output.split()
 
-                ret_values = (mw)
+            mw = float(mw.strip())/1000.
 
-        return ret_values
+            ret_values = (mw)
 
-    else:
-        raise SASExceptions.NoATSASError('Cannot find datmw.')
+    return ret_values
 
 def runDatclass(rg, i0, first, atsasDir, path, datname):
     #This runs the ATSAS package DATCLASS program, to find the M.W. using
@@ -1716,27 +1999,30 @@ def runDatclass(rg, i0, first, atsasDir, path, datname):
         if error != '':
             raise SASExceptions.NoATSASError('Error running datclass.')
 
-        ret_values = ()
+        return _parseDatclassOutput(output)
 
-        if output != '':
-            shape, mw, dmax, _ = output.split()
+    else:
+        raise SASExceptions.NoATSASError('Cannot find datclass.')
 
-            shape=shape.strip()
-            try:
-                mw = float(mw.strip())/1000.
-            except ValueError:
-                mw = -1
-            try:
-                dmax = float(dmax.strip())
-            except ValueError:
-                dmax = -1
+def _parseDatclassOutput(output):
+    ret_values = ()
 
-            ret_values = (shape, mw, dmax)
+    if output != '':
+        shape, mw, dmax, _ = output.split()
 
-        return ret_values
+        shape=shape.strip()
+        try:
+            mw = float(mw.strip())/1000.
+        except ValueError:
+            mw = -1
+        try:
+            dmax = float(dmax.strip())
+        except ValueError:
+            dmax = -1
 
-    else:
-        raise SASExceptions.NoATSASError('Cannot find datclass.')
+        ret_values = (shape, mw, dmax)
+
+    return ret_values
 
 def runDammif(fname, prefix, args, path, atsasDir):
     #Note: This run dammif command must be run with the current working directory as the directory
@@ -2628,159 +2914,673 @@ def run_crysol(fnames, path, atsasDir, exp_fnames=None, prefix=None, lm=20,
         raise SASExceptions.NoATSASError('Cannot find crysol.')
 
 
-def run_secm_calcs(subtracted_sasm_list, use_subtracted_sasm, window_size,
-    is_protein, error_weight, vp_density, vp_cutoff, vp_qmax, vc_cutoff,
-    vc_qmax, vc_a_prot, vc_b_prot, vc_a_rna, vc_b_rna):
+ATSASResult = collections.namedtuple('ATSASResult', ['returncode', 'output',
+    'error', 'files'])
 
-    #Now calculate the RG, I0, and MW for each SASM
-    rg = np.zeros(len(subtracted_sasm_list),dtype=float)
-    rger = np.zeros(len(subtracted_sasm_list),dtype=float)
-    i0 = np.zeros(len(subtracted_sasm_list),dtype=float)
-    i0er = np.zeros(len(subtracted_sasm_list),dtype=float)
-    vcmw = np.zeros(len(subtracted_sasm_list),dtype=float)
-    vcmwer = np.zeros(len(subtracted_sasm_list),dtype=float)
-    vpmw = np.zeros(len(subtracted_sasm_list),dtype=float)
-    vp = np.zeros(len(subtracted_sasm_list),dtype=float)
-    vpcor = np.zeros(len(subtracted_sasm_list),dtype=float)
+def getATSASStagingDir():
+    """
+    Returns the directory used for the input and output files of ATSAS
+    programs run by :class:`ATSASRunner`. This is the RAM backed /dev/shm
+    if it is available, so the many small files of per-profile runs
+    never go to disk, or the system temporary directory otherwise.
+    """
+    shm_dir = '/dev/shm'
 
-    if window_size == 1:
-        for a in range(len(subtracted_sasm_list)):
-            current_sasm = subtracted_sasm_list[a]
-            use_current_sasm = use_subtracted_sasm[a]
-
-            if use_current_sasm:
-                #use autorg to find the Rg and I0
-                rg[a], rger[a], i0[a], i0er[a], idx_min, idx_max = autoRg(current_sasm,
-                    error_weight=error_weight)
-
-                #Now use the rambo tainer 2013 method to calculate molecular weight
-                if rg[a] > 0:
-                    vcqmax = calcVqmax(current_sasm.getQ(),
-                        current_sasm.getI(), rg[a], i0[a], vc_cutoff, vc_qmax)
-
-                    vcmw[a], vcmwer[a], junk1, junk2 = calcVcMW(current_sasm, rg[a],
-                        i0[a], vcqmax, vc_a_prot, vc_b_prot, vc_a_rna, vc_b_rna,
-                        is_protein)
-
-                    vpqmax = calcVqmax(current_sasm.getQ(),
-                        current_sasm.getI(), rg[a], i0[a], vp_cutoff, vp_qmax)
-
-                    vpmw[a], vp[a], vpcor[a] = calcVpMW(current_sasm.getQ(),
-                        current_sasm.getI(), current_sasm.getErr(), rg[a], i0[a],
-                        current_sasm.getQ()[idx_min], vp_density, vpqmax)
-                else:
-                    vcmw[a], vcmwer[a] = -1, -1
-                    vpmw[a], vp[a], vpcor[a] = -1, -1, -1
+    if os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK):
+        staging_dir = shm_dir
+    else:
+        staging_dir = tempfile.gettempdir()
 
-            else:
-                rg[a], rger[a], i0[a], i0er[a] = -1, -1, -1, -1
-                vcmw[a], vcmwer[a] = -1, -1,
-                vpmw[a], vp[a], vpcor[a] = -1, -1, -1
+    return staging_dir
 
-    else:
-        for a in range(len(subtracted_sasm_list)-(window_size-1)):
+def makeATSASDatFile(q, i, err):
+    """
+    Returns the contents of a .dat file with the input data, in the same
+    format as the data section of :func:`SASFileIO.writeRadFile`, for use
+    as an input file of an ATSAS program.
+    """
+    lines = ['### DATA:\n#\n', '# %d\n' % len(q),
+        '#{:^13}  {:^14}  {:^14}\n'.format('Q', 'I(Q)', 'Error')]
 
-            current_sasm_list = subtracted_sasm_list[a:a+window_size]
+    lines.extend('%.8E  %.8E  %.8E\n' % (q_val, i_val, err_val)
+        for q_val, i_val, err_val in zip(q, i, err))
 
-            truth_test = use_subtracted_sasm[a:a+window_size]
+    lines.append('\n')
 
-            index = a+(window_size-1)//2
+    return ''.join(lines)
 
-            if np.all(truth_test):
-                try:
-                    current_sasm = SASProc.average(current_sasm_list, copy_params=False)
-                except SASExceptions.DataNotCompatible:
-                    return False, {}
+class ATSASRunner(object):
+    """
+    Runs ATSAS programs on many inputs in parallel, for example datgnom or
+    datmw on every frame of a series. Jobs are run by a pool of at most
+    n_proc concurrent processes. Each job writes its input files to, and
+    reads its output files from, a private directory in the staging
+    directory (see :func:`getATSASStagingDir`), which is removed when the
+    job finishes. Programs are run directly rather than through a shell,
+    and their output is read in a single buffered read and returned as
+    lines.
+
+    Results are cached, keyed on a hash of the program, arguments, and
+    input files, so submitting the same job again (for example the same
+    frame with the same Rg) returns the cached result without running the
+    program.
+
+    The runner only requires a directory of executables with the ATSAS
+    program names, so it can be used with stand in programs.
+    """
 
-                #use autorg to find the Rg and I0
-                (rg[index], rger[index], i0[index], i0er[index], idx_min,
-                    idx_max) = autoRg(current_sasm, error_weight=error_weight)
+    def __init__(self, atsas_dir, n_proc=None, staging_dir=None,
+        cache_size=10000):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        atsas_dir: str
+            The directory of the ATSAS programs.
+        n_proc: int, optional
+            The maximum number of programs run at once. Defaults to the
+            number of cpus.
+        staging_dir: str, optional
+            The directory in which job input and output files are made.
+            Defaults to :func:`getATSASStagingDir`.
+        cache_size: int, optional
+            The maximum number of cached results.
+        """
+        if n_proc is None or n_proc < 1:
+            n_proc = multiprocessing.cpu_count()
+
+        if staging_dir is None:
+            staging_dir = getATSASStagingDir()
+
+        self.atsas_dir = atsas_dir
+        self.n_proc = n_proc
+
+        self._staging_dir = tempfile.mkdtemp(prefix='raw_atsas_', dir=staging_dir)
+        self._env = setATSASEnv(atsas_dir)
+        self._executor = ThreadPoolExecutor(n_proc)
+
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_size = cache_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Waits for submitted jobs to finish, then shuts down the job pool and
+        removes the staging directory.
+        """
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+
+    def clearCache(self):
+        """Clears the cached results."""
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _getProgram(self, program):
+        if platform.system() == 'Windows':
+            program = program + '.exe'
+
+        program_path = os.path.join(self.atsas_dir, program)
+
+        if not os.path.exists(program_path):
+            raise SASExceptions.NoATSASError('Cannot find {}.'.format(program))
+
+        return program_path
+
+    def submit(self, program, args, inputs=None, outputs=None, parser=None):
+        """
+        Submits a job to run an ATSAS program.
+
+        Parameters
+        ----------
+        program: str
+            The name of the ATSAS program, e.g. 'datgnom'.
+        args: list
+            The command line arguments for the program. Input and output
+            files are given by their names in the job directory.
+        inputs: dict, optional
+            A dictionary of input file names and contents (strings), which
+            are written to the job directory before the program is run.
+        outputs: list, optional
+            The names of the output files that are read after the program
+            finishes. Missing output files are ignored.
+        parser: function, optional
+            If provided, this is called with the :class:`ATSASResult` of
+            the job, and the value it returns is the job result. Parsers
+            should be module level functions, as the parser name is part
+            of the cache key.
+
+        Returns
+        -------
+        future: :class:`concurrent.futures.Future`
+            A future for the job result, which is an :class:`ATSASResult`
+            with the program return code, lists of lines of the standard
+            output and error, and a dictionary of lists of lines of the
+            output files, or the value returned by the parser.
+        """
+        if inputs is None:
+            inputs = {}
+
+        if outputs is None:
+            outputs = []
+
+        program_path = self._getProgram(program)
+
+        key = self._getKey(program, args, inputs, outputs, parser)
+
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+
+                future = Future()
+                future.set_result(copy.deepcopy(self._cache[key]))
+
+                return future
+
+        return self._executor.submit(self._run, program_path, args, inputs,
+            outputs, parser, key)
 
-                #Now use the rambo tainer 2013 method to calculate molecular weight
-                if rg[index] > 0:
-                    vcqmax = calcVqmax(current_sasm.getQ(),
-                        current_sasm.getI(), rg[a], i0[a], vc_cutoff, vc_qmax)
+    def _getKey(self, program, args, inputs, outputs, parser):
+        digest = hashlib.sha1()
 
-                    vcmw[index], vcmwer[index], junk1, junk2 = calcVcMW(current_sasm,
-                        rg[index], i0[index], vcqmax, vc_a_prot, vc_b_prot,
-                        vc_a_rna, vc_b_rna, is_protein)
+        digest.update(repr((program, list(args), list(outputs))).encode('utf-8'))
 
-                    vpqmax = calcVqmax(current_sasm.getQ(),
-                        current_sasm.getI(), rg[index], i0[index], vp_cutoff, vp_qmax)
+        if parser is not None:
+            digest.update('{}.{}'.format(parser.__module__,
+                parser.__name__).encode('utf-8'))
 
-                    vpmw[index], vp[index], vpcor[index] = calcVpMW(current_sasm.getQ(),
-                        current_sasm.getI(), current_sasm.getErr(), rg[index], i0[index],
-                        current_sasm.getQ()[idx_min], vp_density, vpqmax)
-                else:
-                    vcmw[index], vcmwer[index] = -1, -1
-                    vpmw[index], vp[index], vpcor[index] = -1, -1, -1
-            else:
-                rg[index], rger[index], i0[index], i0er[index] = -1, -1, -1, -1
-                vcmw[index], vcmwer[index] = -1, -1,
-                vpmw[index], vp[index], vpcor[index] = -1, -1, -1
+        for name in sorted(inputs):
+            digest.update(name.encode('utf-8'))
+            digest.update(inputs[name].encode('utf-8'))
 
-    #Set everything that's nonsense to -1
-    rg[rg<=0] = -1
-    rger[rg==-1] = -1
-    i0[i0<=0] = -1
-    i0er[i0==-1] = -1
+        return digest.hexdigest()
+
+    def _run(self, program_path, args, inputs, outputs, parser, key):
+        job_dir = tempfile.mkdtemp(dir=self._staging_dir)
 
-    vcmw[vcmw<=0] = -1
-    vcmw[rg<=0] = -1
-    vcmw[i0<=0] = -1
-    vcmwer[vcmw==-1] = -1
+        try:
+            for name, contents in inputs.items():
+                with open(os.path.join(job_dir, name), 'w') as f:
+                    f.write(contents)
 
-    vpmw[vpmw<=0] = -1
-    vpmw[vcmw==-1] = -1
-    vp[vp<=0] = -1
-    vp[vcmw==-1] = -1
-    vpcor[vpcor<=0] = -1
-    vpcor[vcmw==-1] = -1
+            process = subprocess.Popen([program_path] + [str(arg) for arg in args],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=job_dir,
+                env=self._env, universal_newlines=True)
 
-    results = {'rg':    rg,
-        'rger':         rger,
-        'i0':           i0,
-        'i0er':         i0er,
-        'vcmw':         vcmw,
-        'vcmwer':       vcmwer,
-        'vpmw':         vpmw,
-        'window_size':  window_size,
-        'is_protein':   is_protein,
-        'vp_density':   vp_density,
-        }
+            output, error = process.communicate()
 
-    return True, results
+            files = {}
 
-def smooth_data(data, window_length=51, order=5):
-    smoothed_data = scipy.signal.savgol_filter(data, window_length, order)
-    return smoothed_data
+            for name in outputs:
+                out_file = os.path.join(job_dir, name)
 
-def find_peaks(data, height=0.4, width=10, rel_height=0.5):
-    """Finds peaks, expects normalized to max=1 smoothed data as input."""
-    peaks = scipy.signal.find_peaks(data, height=height, width=width,
-        rel_height=rel_height)
-    return peaks
+                if os.path.isfile(out_file):
+                    with open(out_file, 'r') as f:
+                        files[name] = f.readlines()
 
-def integral_baseline(sasms, start_range, end_range, max_iter, min_iter):
-    end_frames = list(range(end_range[0], end_range[1]+1))
-    end_sasms = [sasms[j] for j in end_frames]
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
 
-    sasm_bl = SASProc.average(end_sasms, forced=True, copy_params=False)
-    i_bl = sasm_bl.getI()
+        result = ATSASResult(process.returncode, output.splitlines(),
+            error.splitlines(), files)
 
-    win_len = len(sasms)//2
-    if win_len % 2 == 0:
-        win_len = win_len+1
-    win_len = min(51, win_len)
+        if parser is not None:
+            result = parser(result)
 
-    order = min(5, win_len-1)
+        with self._cache_lock:
+            self._cache[key] = copy.deepcopy(result)
 
-    intensity = np.array([sasm.getI() for sasm in sasms[start_range[-1]:end_range[0]+1]])
-    intensity = np.apply_along_axis(smooth_data, 0, intensity, win_len, order)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
 
-    b = np.zeros_like(intensity)
+        return result
 
-    j = 0
+    def datgnom(self, q, i, err, rg, first_pt=None, last_pt=None):
+        """
+        Submits a datgnom job, as for :func:`runDatgnom`. The result is
+        the IFT (:class:`SASM.IFTM`), or None if datgnom fails.
+        """
+        args = ['-o', 'datgnom.out', '-r', rg]
+
+        if first_pt is not None:
+            args.append('--first={}'.format(first_pt+1))
+
+        if last_pt is not None:
+            args.append('--last={}'.format(last_pt+1))
+
+        args.append('profile.dat')
+
+        return self.submit('datgnom', args,
+            {'profile.dat': makeATSASDatFile(q, i, err)}, ['datgnom.out'],
+            _parseDatgnomResult)
+
+    def datmw(self, q, i, err, rg, i0, first, method='bayes'):
+        """
+        Submits a datmw job, as for :func:`runDatmw`. The result is the
+        tuple of values returned by :func:`runDatmw`.
+        """
+        args = ['--method={}'.format(method), '--rg={}'.format(rg),
+            '--i0={}'.format(i0), '--first={}'.format(first+1), 'profile.dat']
+
+        if method == 'bayes':
+            parser = _parseDatmwBayesResult
+        else:
+            parser = _parseDatmwShapesizeResult
+
+        return self.submit('datmw', args,
+            {'profile.dat': makeATSASDatFile(q, i, err)}, parser=parser)
+
+    def datclass(self, q, i, err, rg, i0, first):
+        """
+        Submits a datclass job, as for :func:`runDatclass`. The result is
+        the tuple of values returned by :func:`runDatclass`.
+        """
+        args = ['--rg={}'.format(rg), '--i0={}'.format(i0),
+            '--first={}'.format(first+1), 'profile.dat']
+
+        return self.submit('datclass', args,
+            {'profile.dat': makeATSASDatFile(q, i, err)},
+            parser=_parseDatclassResult)
+
+def _parseDatgnomResult(result):
+    iftm = None
+
+    if not _datgnomFailed('\n'.join(result.error)) and 'datgnom.out' in result.files:
+        try:
+            iftm = SASFileIO.parse_out_file(result.files['datgnom.out'])
+        except Exception:
+            iftm = None
+
+    return iftm
+
+def _parseDatmwBayesResult(result):
+    if ''.join(result.error).strip() != '':
+        raise SASExceptions.ATSASError('Error running datmw.')
+
+    try:
+        ret_values = _parseDatmwOutput('\n'.join(result.output), 'bayes')
+    except ValueError:
+        # Unexpected output only fails this profile
+        ret_values = ()
+
+    return ret_values
+
+def _parseDatmwShapesizeResult(result):
+    if ''.join(result.error).strip() != '':
+        raise SASExceptions.ATSASError('Error running datmw.')
+
+    try:
+        ret_values = _parseDatmwOutput('\n'.join(result.output), 'shapesize')
+    except ValueError:
+        # Unexpected output only fails this profile
+        ret_values = ()
+
+    return ret_values
+
+def _parseDatclassResult(result):
+    if ''.join(result.error).strip() != '':
+        raise SASExceptions.ATSASError('Error running datclass.')
+
+    try:
+        ret_values = _parseDatclassOutput('\n'.join(result.output))
+    except ValueError:
+        # Unexpected output only fails this profile
+        ret_values = ()
+
+    return ret_values
+
+# Results of the series window calculations (autorg and M.W.), keyed on a
+# digest of the window data and the calculation parameters, so that windows
+# whose inputs haven't changed aren't recalculated. See run_secm_calcs.
+_secm_calc_cache = collections.OrderedDict()
+_secm_calc_cache_lock = threading.Lock()
+_secm_calc_cache_size = 100000
+
+def _getSecmCalcCache(key):
+    with _secm_calc_cache_lock:
+        value = _secm_calc_cache.get(key)
+
+        if value is not None:
+            _secm_calc_cache.move_to_end(key)
+
+    return value
+
+def _setSecmCalcCache(key, value):
+    with _secm_calc_cache_lock:
+        _secm_calc_cache[key] = value
+
+        while len(_secm_calc_cache) > _secm_calc_cache_size:
+            _secm_calc_cache.popitem(last=False)
+
+def clearSecmCalcCache():
+    """Clears the cached series window calculation results."""
+    with _secm_calc_cache_lock:
+        _secm_calc_cache.clear()
+
+def _secmWindowDigest(q, i, err, analysis):
+    digest = hashlib.sha1()
+
+    for data in (q, i, err):
+        digest.update(np.ascontiguousarray(data, dtype=float).tobytes())
+
+    if 'guinier' in analysis:
+        digest.update(repr(sorted(analysis['guinier'].items())).encode('utf-8'))
+
+    return digest.hexdigest()
+
+def _secmWindowRg(args):
+    q, i, err, analysis, error_weight = args
+
+    sasm = SASM.SASM(i, q, err, {'analysis': analysis})
+
+    return autoRg(sasm, error_weight=error_weight)
+
+def _secmWindowMW(args):
+    (q, i, err, analysis, rg, i0, idx_min, vq_rg, vq_i0, is_protein,
+        vp_density, vp_cutoff, vp_qmax, vc_cutoff, vc_qmax, vc_a_prot,
+        vc_b_prot, vc_a_rna, vc_b_rna) = args
+
+    sasm = SASM.SASM(i, q, err, {'analysis': analysis})
+
+    vcqmax = calcVqmax(q, i, vq_rg, vq_i0, vc_cutoff, vc_qmax)
+
+    vcmw, vcmwer, junk1, junk2 = calcVcMW(sasm, rg, i0, vcqmax, vc_a_prot,
+        vc_b_prot, vc_a_rna, vc_b_rna, is_protein)
+
+    vpqmax = calcVqmax(q, i, rg, i0, vp_cutoff, vp_qmax)
+
+    vpmw, vp, vpcor = calcVpMW(q, i, err, rg, i0, q[idx_min], vp_density,
+        vpqmax)
+
+    return vcmw, vcmwer, vpmw
+
+def _getSecmWindows(subtracted_sasm_list, window_size, windows):
+    """
+    Gets the (q, i, err, analysis) data for each requested window start.
+    For windows of more than one profile the averages are calculated for
+    all windows at once as rolling sums over a frames x q block, if all of
+    the profiles share the same q vector. The sums are accumulated in the
+    same order as SASProc.average, so the results are identical.
+    """
+    window_data = {}
+
+    if len(windows) == 0:
+        return window_data
+
+    if window_size == 1:
+        for a in windows:
+            sasm = subtracted_sasm_list[a]
+            analysis = sasm.getParameter('analysis')
+
+            if 'guinier' in analysis:
+                analysis = {'guinier': analysis['guinier']}
+            else:
+                analysis = {}
+
+            window_data[a] = (sasm.getQ(), sasm.getI(), sasm.getErr(), analysis)
+
+        return window_data
+
+    first = min(windows)
+    last = max(windows) + window_size
+    sasms = subtracted_sasm_list[first:last]
+
+    q = sasms[0].getQ()
+    same_q = all(len(sasm.getQ()) == len(q) and np.array_equal(sasm.getQ(), q)
+        for sasm in sasms)
+
+    if same_q:
+        all_i = np.array([sasm.getI() for sasm in sasms])
+        all_err = np.square(np.array([sasm.getErr() for sasm in sasms]))
+
+        n_win = len(sasms) - window_size + 1
+
+        sum_i = all_i[:n_win].copy()
+        sum_err = all_err[:n_win].copy()
+
+        for k in range(1, window_size):
+            sum_i += all_i[k:k+n_win]
+            sum_err += all_err[k:k+n_win]
+
+        avg_i = sum_i/window_size
+        avg_err = np.sqrt(sum_err)/window_size
+
+        for a in windows:
+            window_data[a] = (q, avg_i[a-first], avg_err[a-first], {})
+
+    else:
+        for a in windows:
+            avg_sasm = SASProc.average(subtracted_sasm_list[a:a+window_size],
+                copy_params=False)
+
+            window_data[a] = (avg_sasm.getQ(), avg_sasm.getI(),
+                avg_sasm.getErr(), {})
+
+    return window_data
+
+def run_secm_calcs(subtracted_sasm_list, use_subtracted_sasm, window_size,
+    is_protein, error_weight, vp_density, vp_cutoff, vp_qmax, vc_cutoff,
+    vc_qmax, vc_a_prot, vc_b_prot, vc_a_rna, vc_b_rna, single_proc=True,
+    nprocs=0, first_frame=0, prev_results=None):
+    """
+    Calculates Rg, I(0), and M.W. for each sliding window of window_size
+    profiles in the list. Results are assigned to the center profile of
+    each window. Windows are averaged all at once, and windows whose data
+    and parameters are unchanged since a previous call are taken from a
+    cache. If single_proc is False the autorg and M.W. calculations are
+    run in a multiprocessing pool with nprocs processes (0 uses all but
+    one of the available cores).
+
+    For online data collection, first_frame can be set to the index of the
+    first new profile. Windows made up entirely of earlier profiles are
+    then not recalculated, and their values are taken from prev_results
+    (the results of a previous call for the same list), or set to -1 if
+    prev_results is None.
+    """
+    n_sasms = len(subtracted_sasm_list)
+
+    #Now calculate the RG, I0, and MW for each SASM
+    rg = np.zeros(n_sasms,dtype=float)
+    rger = np.zeros(n_sasms,dtype=float)
+    i0 = np.zeros(n_sasms,dtype=float)
+    i0er = np.zeros(n_sasms,dtype=float)
+    vcmw = np.zeros(n_sasms,dtype=float)
+    vcmwer = np.zeros(n_sasms,dtype=float)
+    vpmw = np.zeros(n_sasms,dtype=float)
+
+    half_window = (window_size-1)//2
+    n_windows = max(n_sasms-(window_size-1), 0)
+
+    windows = []
+
+    for a in range(n_windows):
+        index = a+half_window
+
+        if a+window_size-1 < first_frame:
+            for key, data in (('rg', rg), ('rger', rger), ('i0', i0),
+                ('i0er', i0er), ('vcmw', vcmw), ('vcmwer', vcmwer),
+                ('vpmw', vpmw)):
+                if prev_results is not None and index < len(prev_results[key]):
+                    data[index] = prev_results[key][index]
+                else:
+                    data[index] = -1
+
+        elif np.all(use_subtracted_sasm[a:a+window_size]):
+            windows.append(a)
+
+        else:
+            rg[index], rger[index], i0[index], i0er[index] = -1, -1, -1, -1
+            vcmw[index], vcmwer[index], vpmw[index] = -1, -1, -1
+
+    try:
+        window_data = _getSecmWindows(subtracted_sasm_list, window_size,
+            windows)
+    except SASExceptions.DataNotCompatible:
+        return False, {}
+
+    digests = {a: _secmWindowDigest(*window_data[a]) for a in windows}
+
+    mp_pool = None
+
+    try:
+        #use autorg to find the Rg and I0
+        rg_results = {}
+        rg_tasks = []
+
+        for a in windows:
+            key = ('rg', digests[a], error_weight)
+            result = _getSecmCalcCache(key)
+
+            if result is not None:
+                rg_results[a] = result
+            else:
+                q, i, err, analysis = window_data[a]
+                rg_tasks.append((a, key, (q, i, err, analysis, error_weight)))
+
+        if rg_tasks and not single_proc:
+            mp_pool = _makeSecmCalcPool(nprocs)
+
+        for (a, key, task), result in zip(rg_tasks,
+            _mapSecmCalc(_secmWindowRg, [t[2] for t in rg_tasks], mp_pool)):
+            rg_results[a] = result
+            _setSecmCalcCache(key, result)
+
+        for a in windows:
+            index = a+half_window
+            rg[index], rger[index], i0[index], i0er[index] = rg_results[a][:4]
+
+        #Now use the rambo tainer 2013 method to calculate molecular weight.
+        #Note that the Vc qmax uses the Rg and I0 at the window start index.
+        mw_results = {}
+        mw_tasks = []
+
+        for a in windows:
+            index = a+half_window
+
+            if rg[index] > 0:
+                idx_min = rg_results[a][4]
+                params = (rg[index], i0[index], idx_min, rg[a], i0[a],
+                    is_protein, vp_density, vp_cutoff, vp_qmax, vc_cutoff,
+                    vc_qmax, vc_a_prot, vc_b_prot, vc_a_rna, vc_b_rna)
+
+                key = ('mw', digests[a]) + params
+                result = _getSecmCalcCache(key)
+
+                if result is not None:
+                    mw_results[a] = result
+                else:
+                    mw_tasks.append((a, key, window_data[a]+params))
+            else:
+                mw_results[a] = (-1, -1, -1)
+
+        if mw_tasks and not single_proc and mp_pool is None:
+            mp_pool = _makeSecmCalcPool(nprocs)
+
+        for (a, key, task), result in zip(mw_tasks,
+            _mapSecmCalc(_secmWindowMW, [t[2] for t in mw_tasks], mp_pool)):
+            mw_results[a] = result
+            _setSecmCalcCache(key, result)
+
+        for a in windows:
+            index = a+half_window
+            vcmw[index], vcmwer[index], vpmw[index] = mw_results[a]
+
+    finally:
+        if mp_pool is not None:
+            mp_pool.close()
+            mp_pool.join()
+
+    #Set everything that's nonsense to -1
+    rg[rg<=0] = -1
+    rger[rg==-1] = -1
+    i0[i0<=0] = -1
+    i0er[i0==-1] = -1
+
+    vcmw[vcmw<=0] = -1
+    vcmw[rg<=0] = -1
+    vcmw[i0<=0] = -1
+    vcmwer[vcmw==-1] = -1
+
+    vpmw[vpmw<=0] = -1
+    vpmw[vcmw==-1] = -1
+
+    results = {'rg':    rg,
+        'rger':         rger,
+        'i0':           i0,
+        'i0er':         i0er,
+        'vcmw':         vcmw,
+        'vcmwer':       vcmwer,
+        'vpmw':         vpmw,
+        'window_size':  window_size,
+        'is_protein':   is_protein,
+        'vp_density':   vp_density,
+        }
+
+    return True, results
+
+def _makeSecmCalcPool(nprocs):
+    if nprocs == 0:
+        n_proc = max(multiprocessing.cpu_count()-1, 1)
+    else:
+        n_proc = min(nprocs, multiprocessing.cpu_count())
+
+    return multiprocessing.Pool(processes=n_proc)
+
+def _mapSecmCalc(func, tasks, mp_pool):
+    if mp_pool is not None and len(tasks) > 1:
+        chunksize = max(len(tasks)//(4*multiprocessing.cpu_count()), 1)
+        results = mp_pool.map(func, tasks, chunksize)
+    else:
+        results = [func(task) for task in tasks]
+
+    return results
+
+def smooth_data(data, window_length=51, order=5):
+    import scipy.signal
+
+    smoothed_data = scipy.signal.savgol_filter(data, window_length, order)
+    return smoothed_data
+
+def find_peaks(data, height=0.4, width=10, rel_height=0.5):
+    """Finds peaks, expects normalized to max=1 smoothed data as input."""
+    import scipy.signal
+
+    peaks = scipy.signal.find_peaks(data, height=height, width=width,
+        rel_height=rel_height)
+    return peaks
+
+def _smoothingWindow(n_frames):
+    win_len = n_frames//2
+    if win_len % 2 == 0:
+        win_len = win_len+1
+    win_len = min(51, win_len)
+
+    order = min(5, win_len-1)
+
+    return win_len, order
+
+def integral_baseline(sasms, start_range, end_range, max_iter, min_iter):
+    end_frames = list(range(end_range[0], end_range[1]+1))
+    end_sasms = [sasms[j] for j in end_frames]
+
+    sasm_bl = SASProc.average(end_sasms, forced=True, copy_params=False)
+    i_bl = sasm_bl.getI()
+
+    win_len, order = _smoothingWindow(len(sasms))
+
+    intensity = np.array([sasm.getI() for sasm in sasms[start_range[-1]:end_range[0]+1]])
+    intensity = np.apply_along_axis(smooth_data, 0, intensity, win_len, order)
+
+    b = np.zeros_like(intensity)
+
+    j = 0
     tols = []
     converged = False
 
@@ -2837,8 +3637,18 @@ def linear_baseline(sasms, start_range, end_range):
 
 ###############################################################################
 #EFA below here
-def runEFA(A, forward=True):
-    """Runs the forward or backward evolving factor calculations."""
+def runEFA(A, forward=True, svd_method='full', n_sv=10):
+    """
+    Runs the forward or backward evolving factor calculations. With
+    svd_method 'full' a dense SVD is calculated for every window. With
+    'incremental' the SVD of each window is a rank one update of the
+    previous window's, truncated to a little more than n_sv singular
+    values, and only the first n_sv singular values are returned (the
+    remaining rows of the output are zero). Singular values well above the
+    noise are very close to the dense results, while those at the noise
+    level can be underestimated by a few percent, as the noise discarded
+    by the truncation is lost.
+    """
     slist = np.zeros_like(A)
 
     jmax = A.shape[1]
@@ -2846,15 +3656,114 @@ def runEFA(A, forward=True):
     if not forward:
         A = A[:,::-1]
 
-    for j in range(jmax):
-        s = np.linalg.svd(A[:, :j+1], full_matrices = False, compute_uv = False)
-        slist[:s.size, j] = s
+    if svd_method == 'incremental':
+        for j, s in enumerate(incrementalSingularValues(A, n_sv)):
+            k = min(s.size, n_sv)
+            slist[:k, j] = s[:k]
 
-        if j > 0:
-            slist[s.size-1:, j-1] = s[-1]
+            if j > 0 and s.size <= n_sv:
+                slist[s.size-1:n_sv, j-1] = s[-1]
+
+    else:
+        for j in range(jmax):
+            s = np.linalg.svd(A[:, :j+1], full_matrices = False, compute_uv = False)
+            slist[:s.size, j] = s
+
+            if j > 0:
+                slist[s.size-1:, j-1] = s[-1]
 
     return slist
 
+def incrementalSingularValues(A, n_sv, n_extra=20):
+    """
+    Generates the singular values of A[:, :j+1] for each column j of A.
+    A truncated SVD of the growing matrix is updated with each new column
+    (Brand, Linear Algebra Appl. 415, 20 (2006)), keeping n_sv+n_extra
+    singular values, so each step costs O(m*k + k**3) rather than a full
+    SVD. Only the left singular vectors are needed for the update.
+    """
+    max_sv = min(n_sv+n_extra, A.shape[0])
+
+    U = np.zeros((A.shape[0], 0))
+    s = np.zeros(0)
+
+    for j in range(A.shape[1]):
+        a = A[:, j]
+
+        # Project out the current basis twice, for numerical stability
+        p = np.dot(U.T, a)
+        e = a - np.dot(U, p)
+        p2 = np.dot(U.T, e)
+        e = e - np.dot(U, p2)
+        p = p + p2
+
+        rho = np.linalg.norm(e)
+
+        k = s.size
+        K = np.zeros((k+1, k+1))
+        K[:k, :k] = np.diag(s)
+        K[:k, k] = p
+        K[k, k] = rho
+
+        K_U, s, K_Vt = np.linalg.svd(K)
+
+        if rho > np.finfo(float).eps*max(np.linalg.norm(a), 1):
+            basis = np.column_stack((U, e/rho))
+        else:
+            basis = np.column_stack((U, np.zeros_like(a)))
+
+        keep = min(k+1, max_sv)
+
+        U = np.dot(basis, K_U[:, :keep])
+        s = s[:keep]
+
+        yield s
+
+def truncatedSVD(A, n_sv, method='randomized', n_oversamples=20, n_iter=7,
+    seed=0):
+    """
+    Calculates the first n_sv singular values and vectors of A. The
+    'randomized' method projects A onto a random subspace refined by power
+    iterations (Halko, Martinsson, and Tropp, SIAM Rev. 53, 217 (2011)).
+    The 'truncated' method uses ARPACK, through scipy.sparse.linalg.svds.
+    Returns U, s, and Vt as numpy.linalg.svd does with full_matrices=False,
+    but with only n_sv singular values.
+    """
+    if method not in ('randomized', 'truncated'):
+        raise ValueError('Unknown SVD method: {}'.format(method))
+
+    if n_sv >= min(A.shape):
+        U, s, Vt = np.linalg.svd(A, full_matrices=False)
+
+    elif method == 'truncated':
+        import scipy.sparse.linalg
+
+        U, s, Vt = scipy.sparse.linalg.svds(A, k=n_sv)
+
+        order = np.argsort(s)[::-1]
+        U = U[:, order]
+        s = s[order]
+        Vt = Vt[order]
+
+    else:
+        n_cols = min(n_sv+n_oversamples, min(A.shape))
+
+        random_state = np.random.RandomState(seed)
+        Q = np.dot(A, random_state.standard_normal((A.shape[1], n_cols)))
+        Q = np.linalg.qr(Q)[0]
+
+        for i in range(n_iter):
+            Q = np.linalg.qr(np.dot(A.T, Q))[0]
+            Q = np.linalg.qr(np.dot(A, Q))[0]
+
+        B_U, s, Vt = np.linalg.svd(np.dot(Q.T, A), full_matrices=False)
+
+        U = np.dot(Q, B_U[:, :n_sv])
+        s = s[:n_sv]
+        Vt = Vt[:n_sv]
+
+    return U, s, Vt
+
 def runRotation(D, intensity, err, ranges, force_positive, svd_v, previous_results=None,
     method='Hybrid', niter=1000, tol=1e-12):
     """
@@ -3117,7 +4026,7 @@ def initHybridEFA(M, num_sv, D, C, converged, V_bar):
 
 def run_full_efa(series, ranges, profile_type='sub', framei=None, framef=None,
     method='Hybrid', niter=1000, tol=1e-12, norm=True, force_positive=None,
-    previous_results=None):
+    previous_results=None, svd_method='full'):
     """
     Runs evolving factor analysis (EFA) on the input series to deconvolve
     overlapping elution peaks in the data.
@@ -3173,6 +4082,10 @@ def run_full_efa(series, ranges, profile_type='sub', framei=None, framef=None,
         is a dictionary of the previous results, corresponding to the
         rotation_data dictionary returned by this function. Defaults to None,
         which should be used if no previous results are available.
+    svd_method: {'full', 'randomized', 'truncated'} str, optional
+        The SVD used for the rotation. 'full' calculates the full SVD, while
+        'randomized' and 'truncated' only calculate the singular vectors
+        needed for the EFA ranges, which is much faster for long series.
 
     Returns
     -------
@@ -3213,7 +4126,7 @@ def run_full_efa(series, ranges, profile_type='sub', framei=None, framef=None,
         force_positive = [True for i in range(len(ranges))]
 
     if framei is None:
-            framei = 0
+        framei = 0
     if framef is None:
         if isinstance(series, SECM.SECM):
             framef = len(series.getAllSASMs())-1
@@ -3239,7 +4152,8 @@ def run_full_efa(series, ranges, profile_type='sub', framei=None, framef=None,
         ranges = np.array(ranges)
 
     (svd_U, svd_s, svd_V, svd_U_autocor, svd_V_autocor, intensity, err, svd_a,
-        success) = SVDonSASMs(sasm_list, do_binning=False, do_autocorr=False)
+        success) = SVDonSASMs(sasm_list, do_binning=False, do_autocorr=False,
+        svd_method=svd_method, n_sv=len(ranges))
 
     converged, conv_data, rotation_data = runRotation(svd_a, intensity,
         err, ranges, force_positive, svd_V, previous_results=previous_results,
@@ -3302,14 +4216,214 @@ def run_full_efa(series, ranges, profile_type='sub', framei=None, framef=None,
 
     return efa_profiles, converged, conv_data, rotation_data
 
+class RangeSearch(object):
+    """
+    Shared state for the automated buffer, sample, and baseline range
+    searches. The candidate windows of a search overlap heavily, so the
+    CorMap p value of each frame against each reference frame, and the
+    SVD results for each window, are calculated once and reused by every
+    window that needs them. Candidate windows are validated in batches
+    in a thread pool, and the search stops with the first batch that has
+    a valid window, returning the same window as a serial search would.
+    """
+
+    def __init__(self, sasms, nprocs=0):
+        """
+        Parameters
+        ----------
+        sasms: list
+            The full list of profiles being searched. Frame indices used
+            with the search are indices into this list.
+        nprocs: int, optional
+            The number of threads used to validate candidate windows. 0
+            uses all but one of the available cores, 1 validates windows
+            serially.
+        """
+        self.sasms = sasms
+
+        if nprocs == 0:
+            self.nprocs = max(multiprocessing.cpu_count()-1, 1)
+        else:
+            self.nprocs = max(min(nprocs, multiprocessing.cpu_count()), 1)
+
+        self._executor = None
+        self._pvals = {}
+        self._scaled = {}
+        self._svd = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def first_valid(self, validate, region_starts):
+        """
+        Returns the first start in region_starts for which validate(start)
+        is True, or None if there isn't one.
+        """
+        if self.nprocs > 1 and len(region_starts) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.nprocs)
+
+            for j in range(0, len(region_starts), self.nprocs):
+                batch = region_starts[j:j+self.nprocs]
+
+                for start, valid in zip(batch, self._executor.map(validate, batch)):
+                    if valid:
+                        return start
+
+        else:
+            for start in region_starts:
+                if validate(start):
+                    return start
+
+        return None
+
+    def similarity(self, ref, frames, qrange, sim_thresh, superimpose=False):
+        """
+        Equivalent to run_similarity_test for the CorMap test of the
+        profiles at the frames indices against the profile at the ref
+        index. qrange is a tuple of the start and end q indices used for
+        all profiles, or None to use the profiles' own q ranges. If
+        superimpose is True the profiles are scaled to the reference first.
+        """
+        pvals = self.cormap_pvals(ref, frames, qrange, superimpose)
+
+        similar = not np.any(pvals<sim_thresh)
+
+        return similar, np.argwhere(pvals<sim_thresh).flatten()
+
+    def cormap_pvals(self, ref, frames, qrange, superimpose=False):
+        cache = self._pvals.setdefault((ref, qrange, superimpose), {})
+
+        missing = [frame for frame in frames if frame not in cache]
+
+        if missing:
+            ref_sasm = self.sasms[ref]
+
+            if qrange is None:
+                ref_qi, ref_qf = ref_sasm.getQrange()
+            else:
+                ref_qi, ref_qf = qrange
+
+            ref_q = np.round(ref_sasm.q[ref_qi:ref_qf], 5)
+            ref_i = ref_sasm.i[ref_qi:ref_qf]
+
+            matched = []
+            block = []
+
+            for frame in missing:
+                sasm = self.sasms[frame]
+
+                if qrange is None:
+                    qi, qf = sasm.getQrange()
+                else:
+                    qi, qf = qrange
+
+                if ((sasm.q is ref_sasm.q and (qi, qf) == (ref_qi, ref_qf))
+                    or np.array_equal(np.round(sasm.q[qi:qf], 5), ref_q)):
+                    if superimpose:
+                        intensity = self._superimposed(ref, frame)
+                    else:
+                        intensity = sasm.i
+
+                    matched.append(frame)
+                    block.append(intensity[qi:qf])
+
+                else:
+                    cache[frame] = -1.
+
+            if matched:
+                runs = SASProc.cormap_longest_runs(ref_i, np.array(block,
+                    dtype=float))
+                cache.update(zip(matched, SASProc.cormap_probs(len(ref_i),
+                    runs)))
+
+        return np.array([cache[frame] for frame in frames])
+
+    def _superimposed(self, ref, frame):
+        intensity = self._scaled.get((ref, frame))
+
+        if intensity is None:
+            sasm = self.sasms[frame].copy_no_metadata()
+            SASProc.superimpose(self.sasms[ref], [sasm], 'Scale')
+
+            intensity = sasm.i
+            self._scaled[(ref, frame)] = intensity
+
+        return intensity
+
+    def singular_values(self, frames):
+        """
+        Equivalent to significantSingularValues for the profiles of a
+        contiguous window of frames.
+        """
+        key = (frames[0], len(frames))
+        svd_results = self._svd.get(key)
+
+        if svd_results is None:
+            svd_results = significantSingularValues([self.sasms[frame]
+                for frame in frames])
+            self._svd[key] = svd_results
+
+        return svd_results
+
+def _makeSimilarityTest(sasms, frame_idx, ref_idx, sim_test, sim_cor,
+    sim_thresh, superimpose, search):
+    """
+    Returns a function that runs the similarity test of the profiles in
+    sasms against the profile at ref_idx for a given q range (a tuple of
+    q indices, or None for each profile's current q range). If a
+    RangeSearch is provided the results come from its shared cache.
+    """
+    if search is not None:
+        ref_frame = frame_idx[ref_idx]
+
+        def similarity_test(qrange):
+            return search.similarity(ref_frame, frame_idx, qrange, sim_thresh,
+                superimpose)
+
+    else:
+        ref_sasm = sasms[ref_idx].copy_no_metadata()
+        test_sasms = [sasm.copy_no_metadata() for sasm in sasms]
+
+        if superimpose:
+            SASProc.superimpose(ref_sasm, test_sasms, 'Scale')
+
+        qi, qf = ref_sasm.getQrange()
+
+        def similarity_test(qrange):
+            if qrange is not None:
+                ref_sasm.setQrange(qrange)
+                for sasm in test_sasms:
+                    sasm.setQrange(qrange)
+
+            similar, outliers = run_similarity_test(ref_sasm, test_sasms,
+                sim_test, sim_cor, sim_thresh)
+
+            if qrange is not None:
+                ref_sasm.setQrange((qi, qf))
+                for sasm in test_sasms:
+                    sasm.setQrange((qi, qf))
+
+            return similar, outliers
+
+    return similarity_test
+
 def validateBuffer(sasms, frame_idx, intensity, sim_test, sim_cor, sim_thresh,
-    fast):
+    fast, search=None):
+    import scipy.stats as stats
+
     median = np.median(intensity)
     median_i_idx = (np.absolute(intensity-median)).argmin()
 
-    ref_sasm = sasms[median_i_idx].copy_no_metadata()
-    buffer_sasms = [sasm.copy_no_metadata() for sasm in sasms]
-    qi, qf = ref_sasm.getQrange()
+    qi, qf = sasms[median_i_idx].getQrange()
 
     #Test for frame correlation
     if len(sasms) > 1:
@@ -3352,28 +4466,16 @@ def validateBuffer(sasms, frame_idx, intensity, sim_test, sim_cor, sim_thresh,
 
     #Test for regional frame similarity
     if len(sasms) > 1:
+        similarity_test = _makeSimilarityTest(sasms, frame_idx, median_i_idx,
+            sim_test, sim_cor, sim_thresh, False, search)
+
         if qf-qi>200:
-            ref_sasm.setQrange((qi, qi+100))
-            for sasm in buffer_sasms:
-                sasm.setQrange((qi, qi+100))
-            low_q_similar, low_q_outliers = run_similarity_test(ref_sasm,
-                buffer_sasms, sim_test, sim_cor, sim_thresh)
+            low_q_similar, low_q_outliers = similarity_test((qi, qi+100))
 
             if fast and not low_q_similar:
-                ref_sasm.setQrange((qi, qf))
-                for sasm in buffer_sasms:
-                    sasm.setQrange((qi, qf))
                 return False, {}, {}, intI_results
 
-            ref_sasm.setQrange((qf-100, qf))
-            for sasm in buffer_sasms:
-                sasm.setQrange((qf-100, qf))
-            high_q_similar, high_q_outliers = run_similarity_test(ref_sasm,
-                buffer_sasms, sim_test, sim_cor, sim_thresh)
-
-            ref_sasm.setQrange((qi, qf))
-            for sasm in buffer_sasms:
-                sasm.setQrange((qi, qf))
+            high_q_similar, high_q_outliers = similarity_test((qf-100, qf))
 
             if fast and not high_q_similar:
                 return False, {}, {}, intI_results
@@ -3392,7 +4494,10 @@ def validateBuffer(sasms, frame_idx, intensity, sim_test, sim_cor, sim_thresh,
 
     #Test for more than one significant singular value
     if len(sasms) > 1:
-        svd_results = significantSingularValues(sasms)
+        if search is not None:
+            svd_results = search.singular_values(frame_idx)
+        else:
+            svd_results = significantSingularValues(sasms)
 
         if fast and not svd_results['svals']==1:
             return False, {}, svd_results, intI_results
@@ -3402,8 +4507,10 @@ def validateBuffer(sasms, frame_idx, intensity, sim_test, sim_cor, sim_thresh,
 
     #Test for all frame similarity
     if len(sasms) > 1:
-        all_similar, all_outliers = run_similarity_test(ref_sasm,
-            buffer_sasms, sim_test, sim_cor, sim_thresh)
+        if qf-qi>200:
+            all_similar, all_outliers = similarity_test((qi, qf))
+        else:
+            all_similar, all_outliers = similarity_test(None)
     else:
         all_similar = True
         all_outliers = []
@@ -3500,10 +4607,22 @@ def prepareSASMsforSVD(sasms, err_norm=True, do_binning=True, bin_to=100):
 
     return svd_a, i, err, q
 
-def doSVDonSASMs(svd_a, do_autocorr=True):
+def doSVDonSASMs(svd_a, do_autocorr=True, svd_method='full', n_sv=10):
+    """
+    Runs the SVD of svd_a. With svd_method 'full' the full dense SVD is
+    calculated. With 'randomized' or 'truncated' (see truncatedSVD) only
+    the first n_sv singular values and vectors are calculated, which is
+    much faster for long series.
+    """
+    if svd_method not in ('full', 'randomized', 'truncated'):
+        raise ValueError('Unknown SVD method: {}'.format(svd_method))
+
     if np.all(np.isfinite(svd_a)):
         try:
-            svd_U, svd_s, svd_Vt = np.linalg.svd(svd_a, full_matrices = True)
+            if svd_method == 'full':
+                svd_U, svd_s, svd_Vt = np.linalg.svd(svd_a, full_matrices = True)
+            else:
+                svd_U, svd_s, svd_Vt = truncatedSVD(svd_a, n_sv, svd_method)
             success = True
         except Exception:
             success = False
@@ -3536,16 +4655,19 @@ def doSVDonSASMs(svd_a, do_autocorr=True):
     return svd_U, svd_s, svd_V, svd_U_autocor, svd_V_autocor, success
 
 
-def SVDonSASMs(sasms, err_norm=True, do_binning=True, bin_to=100, do_autocorr=True):
+def SVDonSASMs(sasms, err_norm=True, do_binning=True, bin_to=100, do_autocorr=True,
+    svd_method='full', n_sv=10):
     svd_a, i, err, q = prepareSASMsforSVD(sasms, err_norm, do_binning, bin_to)
 
     svd_U, svd_s, svd_V, svd_U_autocor, svd_V_autocor, success = doSVDonSASMs(svd_a,
-        do_autocorr)
+        do_autocorr, svd_method, n_sv)
 
     return svd_U, svd_s, svd_V, svd_U_autocor, svd_V_autocor, i, err, svd_a, success
 
 def findSignificantSingularValues(svd_s, svd_U_autocor, svd_V_autocor):
      #Attempts to figure out the significant number of singular values
+        import scipy.stats as stats
+
         point1 = 0
         point2 = 0
         point3 = 0
@@ -3622,7 +4744,13 @@ def findSignificantSingularValues(svd_s, svd_U_autocor, svd_V_autocor):
 
 
 def findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
-    sim_thresh):
+    sim_thresh, nprocs=0):
+    with RangeSearch(buffer_sasms, nprocs) as search:
+        return _findBufferRange(buffer_sasms, intensity, avg_window, sim_test,
+            sim_cor, sim_thresh, search)
+
+def _findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
+    sim_thresh, search):
     region_start = None
     region_end = None
 
@@ -3696,7 +4824,8 @@ def findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
     #Initial search
     failed, region_start, region_end = inner_find_buffer_range(intensity,
         buffer_sasms, start_point, end_point, start_window_size,
-        min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, True)
+        min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, True,
+        search)
 
     if use_peak_search and not search_full_length and failed:
         #Start search to the right from edge of rightmost peak and go to end
@@ -3709,7 +4838,8 @@ def findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
         else:
             failed, region_start, region_end = inner_find_buffer_range(intensity,
                 buffer_sasms, start_point, end_point, start_window_size,
-                min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, False)
+                min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, False,
+                search)
 
     if use_peak_search and not search_full_length and failed:
         #Start search to the left from edge of main peak and go to the left edge of the first peak
@@ -3726,7 +4856,8 @@ def findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
             if end_point != start_point:
                 failed, region_start, region_end = inner_find_buffer_range(intensity,
                     buffer_sasms, start_point, end_point, start_window_size,
-                    min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, True)
+                    min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, True,
+                    search)
 
             else:
                 failed = True
@@ -3746,7 +4877,8 @@ def findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
             if end_point != start_point:
                 failed, region_start, region_end = inner_find_buffer_range(intensity,
                     buffer_sasms, start_point, end_point, start_window_size,
-                    min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, False)
+                    min_window_width, peak_pos, sim_test, sim_cor, sim_thresh, False,
+                    search)
             else:
                 failed = True
 
@@ -3756,7 +4888,10 @@ def findBufferRange(buffer_sasms, intensity, avg_window, sim_test, sim_cor,
 
 def inner_find_buffer_range(intensity, buffer_sasms, start_point, end_point,
     start_window_size, min_window_width, peaks, sim_test, sim_cor, sim_thresh,
-    flip_regions):
+    flip_regions, search=None):
+
+    if search is None:
+        search = RangeSearch(buffer_sasms, 1)
 
     found_region = False
     failed = False
@@ -3766,6 +4901,19 @@ def inner_find_buffer_range(intensity, buffer_sasms, start_point, end_point,
     region_start = None
     region_end = None
 
+    def validate(idx):
+        region_sasms = buffer_sasms[idx:idx+window_size+1]
+        frame_idx = list(range(idx, idx+window_size+1))
+        region_intensity = intensity[idx:idx+window_size+1]
+
+        if len(peaks) == 0 or np.all([peak not in frame_idx for peak in peaks]):
+            valid = validateBuffer(region_sasms, frame_idx, region_intensity,
+                sim_test, sim_cor, sim_thresh, True, search)[0]
+        else:
+            valid = False
+
+        return valid
+
     while not found_region and not failed:
         step_size = max(1, int(round(window_size/4.)))
         region_starts = list(range(start_point, end_point, step_size))
@@ -3773,22 +4921,12 @@ def inner_find_buffer_range(intensity, buffer_sasms, start_point, end_point,
         if flip_regions:
             region_starts = region_starts[::-1]
 
-        for idx in region_starts:
-            region_sasms = buffer_sasms[idx:idx+window_size+1]
-            frame_idx = list(range(idx, idx+window_size+1))
-            region_intensity = intensity[idx:idx+window_size+1]
+        idx = search.first_valid(validate, region_starts)
+        found_region = idx is not None
 
-            if len(peaks) == 0 or np.all([peak not in frame_idx for peak in peaks]):
-                found_region, similarity_results, svd_results, intI_results = validateBuffer(region_sasms,
-                    frame_idx, region_intensity, sim_test, sim_cor, sim_thresh, True)
-
-            else:
-                found_region = False
-
-            if found_region:
-                region_start = idx
-                region_end = idx+window_size
-                break
+        if found_region:
+            region_start = idx
+            region_end = idx+window_size
 
         window_size = int(round(window_size/2.))
 
@@ -3798,13 +4936,12 @@ def inner_find_buffer_range(intensity, buffer_sasms, start_point, end_point,
     return failed, region_start, region_end
 
 def validateSample(sub_sasms, frame_idx, intensity, rg, vcmw, vpmw,
-    sim_test, sim_cor, sim_thresh, fast):
+    sim_test, sim_cor, sim_thresh, fast, search=None):
+    import scipy.stats as stats
+
     max_i_idx = np.argmax(intensity)
 
-    ref_sasm = sub_sasms[max_i_idx].copy_no_metadata()
-    superimpose_sub_sasms = [sasm.copy_no_metadata() for sasm in sub_sasms]
-    SASProc.superimpose(ref_sasm, superimpose_sub_sasms, 'Scale')
-    qi, qf = ref_sasm.getQrange()
+    qi, qf = sub_sasms[max_i_idx].getQrange()
 
     if np.any(rg==-1):
         param_range_valid = False
@@ -3874,29 +5011,16 @@ def validateSample(sub_sasms, frame_idx, intensity, rg, vcmw, vpmw,
 
     #Test for regional frame similarity
     if len(sub_sasms) > 1:
+        similarity_test = _makeSimilarityTest(sub_sasms, frame_idx, max_i_idx,
+            sim_test, sim_cor, sim_thresh, True, search)
+
         if qf-qi>200:
-            ref_sasm.setQrange((qi, qi+100))
-            for sasm in superimpose_sub_sasms:
-                sasm.setQrange((qi, qi+100))
-            low_q_similar, low_q_outliers = run_similarity_test(ref_sasm,
-                superimpose_sub_sasms, sim_test, sim_cor, sim_thresh)
+            low_q_similar, low_q_outliers = similarity_test((qi, qi+100))
 
             if fast and not low_q_similar:
-                ref_sasm.setQrange((qi, qf))
-                for sasm in superimpose_sub_sasms:
-                    sasm.setQrange((qi, qf))
                 return False, {}, param_results, {}, {}
 
-            ref_sasm.setQrange((qf-100, qf))
-            for sasm in superimpose_sub_sasms:
-                sasm.setQrange((qf-100, qf))
-
-            high_q_similar, high_q_outliers = run_similarity_test(ref_sasm,
-                superimpose_sub_sasms, sim_test, sim_cor, sim_thresh)
-
-            ref_sasm.setQrange((qi, qf))
-            for sasm in superimpose_sub_sasms:
-                sasm.setQrange((qi, qf))
+            high_q_similar, high_q_outliers = similarity_test((qf-100, qf))
 
             if fast and not high_q_similar:
                 return False, {}, param_results, {}, {}
@@ -3915,7 +5039,10 @@ def validateSample(sub_sasms, frame_idx, intensity, rg, vcmw, vpmw,
 
     #Test for more than one significant singular value
     if len(sub_sasms) > 1:
-        svd_results = significantSingularValues(sub_sasms)
+        if search is not None:
+            svd_results = search.singular_values(frame_idx)
+        else:
+            svd_results = significantSingularValues(sub_sasms)
     else:
         svd_results = {'svals': 1}
 
@@ -3963,8 +5090,10 @@ def validateSample(sub_sasms, frame_idx, intensity, rg, vcmw, vpmw,
 
     #Test for all frame similarity
     if len(sub_sasms) > 1:
-        all_similar, all_outliers = run_similarity_test(ref_sasm,
-            superimpose_sub_sasms, sim_test, sim_cor, sim_thresh)
+        if qf-qi>200:
+            all_similar, all_outliers = similarity_test((qi, qf))
+        else:
+            all_similar, all_outliers = similarity_test(None)
     else:
         all_similar = True
         all_outliers = []
@@ -3985,7 +5114,13 @@ def validateSample(sub_sasms, frame_idx, intensity, rg, vcmw, vpmw,
     return valid, similarity_results, param_results, svd_results, sn_results
 
 def findSampleRange(sub_sasms, intensity, rg, vcmw, vpmw, avg_window, sim_test,
-    sim_cor, sim_thresh):
+    sim_cor, sim_thresh, nprocs=0):
+    with RangeSearch(sub_sasms, nprocs) as search:
+        return _findSampleRange(sub_sasms, intensity, rg, vcmw, vpmw,
+            avg_window, sim_test, sim_cor, sim_thresh, search)
+
+def _findSampleRange(sub_sasms, intensity, rg, vcmw, vpmw, avg_window, sim_test,
+    sim_cor, sim_thresh, search):
     win_len = len(intensity)//2
     if win_len % 2 == 0:
         win_len = win_len+1
@@ -4017,6 +5152,18 @@ def findSampleRange(sub_sasms, intensity, rg, vcmw, vpmw, avg_window, sim_test,
     found_region = False
     failed = False
 
+    def validate(idx):
+        region_sasms = sub_sasms[idx:idx+window_size+1]
+        region_intensity = intensity[idx:idx+window_size+1]
+        frame_idx = list(range(idx, idx+window_size+1))
+        rg_region = rg[idx:idx+window_size+1]
+        vcmw_region = vcmw[idx:idx+window_size+1]
+        vpmw_region = vpmw[idx:idx+window_size+1]
+
+        return validateSample(region_sasms, frame_idx, region_intensity,
+            rg_region, vcmw_region, vpmw_region, sim_test, sim_cor,
+            sim_thresh, True, search)[0]
+
     while not found_region and not failed:
         step_size = max(1, int(round(window_size/8.)))
 
@@ -4038,25 +5185,12 @@ def findSampleRange(sub_sasms, intensity, rg, vcmw, vpmw, avg_window, sim_test,
                 if mid_point - i*step_size > 0:
                     region_starts.append(mid_point-i*step_size)
 
-        for idx in region_starts:
-            region_sasms = sub_sasms[idx:idx+window_size+1]
-            region_intensity = intensity[idx:idx+window_size+1]
-            frame_idx = list(range(idx, idx+window_size+1))
-            rg_region = rg[idx:idx+window_size+1]
-            vcmw_region = vcmw[idx:idx+window_size+1]
-            vpmw_region = vpmw[idx:idx+window_size+1]
-            # valid, similarity_results, param_results, svd_results, sn_results = self._validateSample(region_sasms,
-            #     , True)
-            (valid, similarity_results, param_results, svd_results,
-                sn_results) = validateSample(region_sasms, frame_idx,
-                region_intensity, rg_region, vcmw_region, vpmw_region,
-                sim_test, sim_cor, sim_thresh, True)
-            found_region = valid
-
-            if found_region:
-                region_start = idx
-                region_end = idx+window_size
-                break
+        idx = search.first_valid(validate, region_starts)
+        found_region = idx is not None
+
+        if found_region:
+            region_start = idx
+            region_end = idx+window_size
 
         window_size = int(round(window_size/2.))
 
@@ -4072,13 +5206,13 @@ def findSampleRange(sub_sasms, intensity, rg, vcmw, vpmw, avg_window, sim_test,
     return success, region_start, region_end
 
 def validateBaseline(sasms, frame_idx, intensity, bl_type, ref_sasms, start,
-    sim_test, sim_cor, sim_thresh, fast):
+    sim_test, sim_cor, sim_thresh, fast, search=None):
     other_results = {}
 
     if bl_type == 'Integral':
         valid, similarity_results, svd_results, intI_results = validateBuffer(sasms,
             frame_idx, intensity, sim_test, sim_cor, sim_thresh,
-    fast)
+    fast, search)
 
         if fast and not valid:
             return valid, similarity_results, svd_results, intI_results, other_results
@@ -4195,7 +5329,13 @@ def validateBaseline(sasms, frame_idx, intensity, bl_type, ref_sasms, start,
     return valid, similarity_results, svd_results, intI_results, other_results
 
 def findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
-    sim_test, sim_cor, sim_thresh):
+    sim_test, sim_cor, sim_thresh, nprocs=0):
+    with RangeSearch(sub_sasms, nprocs) as search:
+        return _findBaselineRange(sub_sasms, intensity, bl_type, avg_window,
+            start_region, sim_test, sim_cor, sim_thresh, search)
+
+def _findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
+    sim_test, sim_cor, sim_thresh, search):
     region1_start = -1
     region1_end = -1
     region2_start = -1
@@ -4232,25 +5372,29 @@ def findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
         if end_point + window_size > len(intensity) - 1 - window_size:
             end_point = len(intensity) - 1 - window_size
 
+    def validate(idx, window_size, ref_sasms=None):
+        frame_idx = np.arange(idx, idx+window_size+1)
+
+        # The peak check is cheap, so windows with a peak aren't validated
+        if not np.all([peak not in frame_idx for peak in peaks]):
+            return False
+
+        region_sasms = sub_sasms[idx:idx+window_size+1]
+        region_intensity = intensity[idx:idx+window_size+1]
+
+        return validateBaseline(region_sasms, frame_idx, region_intensity,
+            bl_type, ref_sasms, ref_sasms is None, sim_test, sim_cor,
+            sim_thresh, True, search)[0]
+
     found_region = False
     start_failed = False
 
     if start_region is not None:
-        region_sasms = sub_sasms[start_region[0]:start_region[1]+1]
-        frame_idx = np.arange(start_region[0], start_region[1]+1)
-        region_intensity = intensity[start_region[0]:start_region[1]+1]
+        found_region = validate(start_region[0], start_region[1]-start_region[0])
 
-        (valid, similarity_results, svd_results, intI_results,
-            other_results) = validateBaseline(region_sasms, frame_idx,
-            region_intensity, bl_type, None, True, sim_test, sim_cor,
-            sim_thresh, True)
-
-        if np.all([peak not in frame_idx for peak in peaks]) and valid:
-            found_region = True
+        if found_region:
             region1_start = start_region[0]
             region1_end = start_region[1]
-        else:
-            found_region = False
 
 
     while not found_region and not start_failed:
@@ -4260,25 +5404,13 @@ def findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
 
         region_starts = region_starts[::-1]
 
-        for idx in region_starts:
-            region_sasms = sub_sasms[idx:idx+window_size+1]
-            frame_idx = np.arange(idx, idx+window_size+1)
-            region_intensity = intensity[idx:idx+window_size+1]
+        idx = search.first_valid(lambda start: validate(start, window_size),
+            region_starts)
+        found_region = idx is not None
 
-            (valid, similarity_results, svd_results, intI_results,
-                other_results) = validateBaseline(region_sasms, frame_idx,
-                region_intensity, bl_type, None, True, sim_test, sim_cor,
-                sim_thresh, True)
-
-            if np.all([peak not in frame_idx for peak in peaks]) and valid:
-                found_region = True
-            else:
-                found_region = False
-
-            if found_region:
-                region1_start = idx
-                region1_end = idx+window_size
-                break
+        if found_region:
+            region1_start = idx
+            region1_end = idx+window_size
 
         window_size = int(round(window_size/2.))
 
@@ -4306,6 +5438,9 @@ def findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
 
         end_point = len(intensity) - 1 - window_size
 
+    if start_failed:
+        start_sasms = None
+
     found_region = False
     end_failed = False
 
@@ -4314,31 +5449,13 @@ def findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
 
         region_starts = list(range(start_point, end_point, step_size))
 
-        for idx in region_starts:
-            region_sasms = sub_sasms[idx:idx+window_size+1]
-            frame_idx = np.arange(idx, idx+window_size+1)
-            region_intensity = intensity[idx:idx+window_size+1]
+        idx = search.first_valid(lambda start: validate(start, window_size,
+            start_sasms), region_starts)
+        found_region = idx is not None
 
-            if not start_failed:
-                (valid, similarity_results, svd_results, intI_results,
-                    other_results) = validateBaseline(region_sasms, frame_idx,
-                    region_intensity, bl_type, start_sasms, False, sim_test,
-                    sim_cor, sim_thresh, True)
-            else:
-                (valid, similarity_results, svd_results, intI_results,
-                    other_results) = validateBaseline(region_sasms, frame_idx,
-                    region_intensity, bl_type, None, True, sim_test, sim_cor,
-                    sim_thresh, True)
-
-            if np.all([peak not in frame_idx for peak in peaks]) and valid:
-                found_region = True
-            else:
-                found_region = False
-
-            if found_region:
-                region2_start = idx
-                region2_end = idx+window_size
-                break
+        if found_region:
+            region2_start = idx
+            region2_end = idx+window_size
 
         window_size = int(round(window_size/2.))
 
@@ -4348,172 +5465,216 @@ def findBaselineRange(sub_sasms, intensity, bl_type, avg_window, start_region,
     return (start_failed, end_failed, region1_start, region1_end, region2_start,
         region2_end)
 
-def processBaseline(unsub_sasms, sub_sasms, r1, r2, bl_type, min_iter, max_iter,
-    bl_extrap, int_type, qref, qrange, calc_threshold):
-    if bl_type == 'Integral':
-        fit_results = [] #Need to declare here for integral baselines which don't return fit_results
+class BaselineCorrection(object):
+    """
+    Incremental baseline correction for a series that grows during online
+    data collection. Call update each time profiles are added to the
+    series. The baseline is calculated once the series includes the end
+    range, and is only recalculated if the profiles it depends on change.
+    After that, only the profiles for new frames are corrected. The
+    results are the same as processBaseline for the whole series.
+    """
 
-        baselines = integral_baseline(sub_sasms, r1, r2, max_iter,
-            min_iter)
+    def __init__(self, r1, r2, bl_type, min_iter, max_iter, bl_extrap,
+        int_type, qref, qrange, calc_threshold):
+        self.r1 = r1
+        self.r2 = r2
+        self.bl_type = bl_type
+        self.min_iter = min_iter
+        self.max_iter = max_iter
+        self.bl_extrap = bl_extrap
+        self.int_type = int_type
+        self.qref = qref
+        self.qrange = qrange
+        self.calc_threshold = calc_threshold
+
+        self.bl_sasms = []
+        self.use_subtracted_sasms = []
+        self.bl_corr = []
+        self.fit_results = []
+
+        self._baselines = None
+        self._win_len = None
+        self._zero_sasm = None
+        self._ref_intensity = None
+
+    def update(self, unsub_sasms, sub_sasms, first_frame=None):
+        """
+        Updates the baseline correction for the profiles in the series.
+
+        Parameters
+        ----------
+        unsub_sasms: list
+            All of the unsubtracted profiles in the series.
+        sub_sasms: list
+            All of the subtracted profiles in the series.
+        first_frame: int, optional
+            The first frame that is new or has changed since the last
+            update. Defaults to the number of frames corrected so far.
+
+        Returns
+        -------
+        first_frame: int
+            The first frame whose corrected profile is new or has changed.
+            The corrected profiles from that frame on are new in bl_sasms
+            and use_subtracted_sasms. If the series doesn't include the end
+            range yet nothing is corrected, and this is the number of
+            frames in the series.
+        """
+        n_frames = len(sub_sasms)
+
+        if first_frame is None:
+            first_frame = len(self.bl_sasms)
+        else:
+            first_frame = min(first_frame, len(self.bl_sasms))
 
-        bl_sasms = []
+        if n_frames <= self.r2[1]:
+            return n_frames
 
-        bl_corr = []
-        bl_q = copy.deepcopy(sub_sasms[0].getQ())
-        bl_err = np.zeros_like(baselines[0])
+        if self.bl_type == 'Integral':
+            win_len = _smoothingWindow(n_frames)[0]
 
-        for j, sasm in enumerate(sub_sasms):
-            q = copy.deepcopy(sasm.getQ())
+            if (self._baselines is None or first_frame <= self.r2[1]
+                or win_len != self._win_len):
+                self._baselines = integral_baseline(sub_sasms, self.r1,
+                    self.r2, self.max_iter, self.min_iter)
+                self._win_len = win_len
 
-            if j < r1[1]:
-                baseline = baselines[0]
-                i = copy.deepcopy(sasm.getI())
-                err = copy.deepcopy(sasm.getErr())
-            elif j >= r1[1] and j <= r2[0]:
-                baseline = baselines[j-r1[1]]
-                i = sasm.getI() - baseline
-                err = sasm.getErr() * i/sasm.getI()
+                bl_q = copy.deepcopy(sub_sasms[0].getQ())
+                bl_err = np.zeros_like(self._baselines[0])
 
-                newSASM = SASM.SASM(baseline, bl_q, bl_err, {})
-                bl_corr.append(newSASM)
-            else:
-                baseline = baselines[-1]
-                i = sasm.getI() - baseline
-                err = sasm.getErr() * i/sasm.getI()
+                self.bl_corr = [SASM.SASM(self._baselines[j-self.r1[1]], bl_q,
+                    bl_err, {}) for j in range(self.r1[1], self.r2[0]+1)]
 
+                first_frame = 0
 
-            parameters = copy.deepcopy(sasm.getAllParameters())
+        elif self.bl_type == 'Linear':
+            if not self.fit_results or first_frame <= self.r2[1]:
+                self.fit_results = linear_baseline(sub_sasms, self.r1, self.r2)
+                first_frame = 0
 
-            old_history = parameters['history']
+            fit_a = np.array([fit[0] for fit in self.fit_results])
+            fit_b = np.array([fit[1] for fit in self.fit_results])
 
-            history1 = []
-            history1.append(copy.deepcopy(sasm.getParameter('filename')))
+            bl_q = copy.deepcopy(sub_sasms[0].getQ())
+            bl_err = np.zeros_like(sub_sasms[0].getQ())
 
-            for key in old_history:
-                history1.append({key:old_history[key]})
+            if self.bl_extrap:
+                del self.bl_corr[first_frame:]
+            elif first_frame == 0:
+                self.bl_corr = []
 
-            history = {}
-            history['baseline_correction'] = {'initial_file':history1,
-                'type':bl_type}
+        if first_frame == 0:
+            self._zero_sasm = SASM.SASM(np.zeros_like(sub_sasms[0].getQ()),
+                sub_sasms[0].getQ(), sub_sasms[0].getErr(), {})
+            self._ref_intensity = None
 
-            parameters['history'] = history
+        del self.bl_sasms[first_frame:]
+        del self.use_subtracted_sasms[first_frame:]
 
-            newSASM = SASM.SASM(i, q, err, parameters, copy.deepcopy(sasm.getQErr()))
+        bl_unsub_sasms = []
 
-            bl_sasms.append(newSASM)
+        for j in range(first_frame, n_frames):
+            sasm = sub_sasms[j]
 
-    elif bl_type == 'Linear':
-        fit_results = linear_baseline(sub_sasms, r1, r2)
-        bl_sasms = []
-        bl_corr = []
+            if self.bl_type == 'Integral':
+                if j < self.r1[1]:
+                    baseline = None
+                    bkg_sasm = self._zero_sasm
+                else:
+                    k = min(j, self.r2[0])-self.r1[1]
+                    baseline = self._baselines[k]
+                    bkg_sasm = self.bl_corr[k]
+
+            elif self.bl_type == 'Linear':
+                if self.bl_extrap or (j >= self.r1[0] and j <= self.r2[1]):
+                    baseline = fit_a + fit_b*j
+                    bkg_sasm = SASM.SASM(baseline, bl_q, bl_err, {})
+                    self.bl_corr.append(bkg_sasm)
+                else:
+                    baseline = None
+                    bkg_sasm = self._zero_sasm
 
-        bl_q = copy.deepcopy(sub_sasms[0].getQ())
-        bl_err = np.zeros_like(sub_sasms[0].getQ())
+            self.bl_sasms.append(_baselineCorrectedSASM(sasm, baseline,
+                self.bl_type))
 
-        for j, sasm in enumerate(sub_sasms):
-            q = copy.deepcopy(sasm.getQ())
+            bl_unsub_sasms.append(SASProc.subtract(unsub_sasms[j], bkg_sasm,
+                forced=True, copy_params=False))
 
-            if bl_extrap:
-                baseline = np.array([linear_func(j, fit[0], fit[1]) for fit in fit_results])
-                i = sasm.getI() - baseline
-                err = sasm.getErr() * i/sasm.getI()
+        if self._ref_intensity is None:
+            start_frames = range(self.r1[0], self.r1[1]+1)
+            bl_unsub_ref_sasm = SASProc.average([bl_unsub_sasms[j-first_frame]
+                for j in start_frames], forced=True, copy_params=False)
 
-                bl_newSASM = SASM.SASM(baseline, bl_q, bl_err, {})
-                bl_corr.append(bl_newSASM)
+            self._ref_intensity = self._intensity(bl_unsub_ref_sasm)
 
+        for sasm in bl_unsub_sasms:
+            sasm_intensity = self._intensity(sasm)
+
+            if abs(sasm_intensity/self._ref_intensity) > self.calc_threshold:
+                self.use_subtracted_sasms.append(True)
             else:
-                if j >= r1[0] and j <= r2[1]:
-                    baseline = np.array([linear_func(j, fit[0], fit[1]) for fit in fit_results])
-                    i = sasm.getI() - baseline
-                    err = sasm.getErr() * i/sasm.getI()
+                self.use_subtracted_sasms.append(False)
 
-                    bl_newSASM = SASM.SASM(baseline, bl_q, bl_err, {})
-                    bl_corr.append(bl_newSASM)
-                else:
-                    i = copy.deepcopy(sasm.getI())
-                    err = copy.deepcopy(sasm.getErr())
-                    baseline = np.zeros_like(i)
+        return first_frame
 
+    def _intensity(self, sasm):
+        if self.int_type == 'total':
+            intensity = sasm.getTotalI()
+        elif self.int_type == 'mean':
+            intensity = sasm.getMeanI()
+        elif self.int_type == 'q_val':
+            intensity = sasm.getIofQ(self.qref)
+        elif self.int_type == 'q_range':
+            intensity = sasm.getIofQRange(self.qrange[0], self.qrange[1])
 
-            parameters = copy.deepcopy(sasm.getAllParameters())
+        return intensity
 
-            old_history = parameters['history']
+def _baselineCorrectedSASM(sasm, baseline, bl_type):
+    q = copy.deepcopy(sasm.getQ())
 
-            history1 = []
-            history1.append(copy.deepcopy(sasm.getParameter('filename')))
+    if baseline is None:
+        i = copy.deepcopy(sasm.getI())
+        err = copy.deepcopy(sasm.getErr())
+    else:
+        i = sasm.getI() - baseline
+        err = sasm.getErr() * i/sasm.getI()
 
-            for key in old_history:
-                history1.append({key:old_history[key]})
+    parameters = copy.deepcopy(sasm.getAllParameters())
 
-            history = {}
-            history['baseline_correction'] = {'initial_file':history1,
-                'type':bl_type}
+    old_history = parameters['history']
 
-            parameters['history'] = history
+    history1 = []
+    history1.append(copy.deepcopy(sasm.getParameter('filename')))
 
-            newSASM = SASM.SASM(i, q, err, parameters, copy.deepcopy(sasm.getQErr()))
+    for key in old_history:
+        history1.append({key:old_history[key]})
 
-            bl_sasms.append(newSASM)
+    history = {}
+    history['baseline_correction'] = {'initial_file':history1,
+        'type':bl_type}
 
+    parameters['history'] = history
 
-    sub_mean_i = np.array([sasm.getMeanI() for sasm in bl_sasms])
-    sub_total_i = np.array([sasm.getTotalI() for sasm in bl_sasms])
+    return SASM.SASM(i, q, err, parameters, copy.deepcopy(sasm.getQErr()))
 
-    use_subtracted_sasms = []
-    zeroSASM = SASM.SASM(np.zeros_like(sub_sasms[0].getQ()), sub_sasms[0].getQ(),
-        sub_sasms[0].getErr(), {})
-    bl_unsub_sasms = []
-
-    for j in range(len(unsub_sasms)):
-        if bl_type == 'Integral':
-            if j < r1[1]:
-                bkg_sasm = zeroSASM
-            elif j >= r1[1] and j <= r2[0]:
-                bkg_sasm = bl_corr[j-r1[1]]
-            else:
-                bkg_sasm = bl_corr[-1]
+def processBaseline(unsub_sasms, sub_sasms, r1, r2, bl_type, min_iter, max_iter,
+    bl_extrap, int_type, qref, qrange, calc_threshold):
+    bl_correction = BaselineCorrection(r1, r2, bl_type, min_iter, max_iter,
+        bl_extrap, int_type, qref, qrange, calc_threshold)
+    bl_correction.update(unsub_sasms, sub_sasms)
 
-        elif bl_type == 'Linear':
-            if bl_extrap:
-                bkg_sasm = bl_corr[j]
-            else:
-                if j >= r1[0] and j <= r2[1]:
-                    bkg_sasm = bl_corr[j-r1[0]]
-                else:
-                    bkg_sasm = zeroSASM
-
-        bl_unsub_sasms.append(SASProc.subtract(unsub_sasms[j], bkg_sasm,
-            forced=True, copy_params=False))
-
-    start_frames = list(range(r1[0], r1[1]+1))
-    bl_unsub_ref_sasm = SASProc.average([bl_unsub_sasms[j] for j in start_frames],
-        forced=True, copy_params=False)
-
-    if  int_type == 'total':
-        ref_intensity = bl_unsub_ref_sasm.getTotalI()
-    elif int_type == 'mean':
-        ref_intensity = bl_unsub_ref_sasm.getMeanI()
-    elif int_type == 'q_val':
-        ref_intensity = bl_unsub_ref_sasm.getIofQ(qref)
-    elif int_type == 'q_range':
-        q1 = qrange[0]
-        q2 = qrange[1]
-        ref_intensity = bl_unsub_ref_sasm.getIofQRange(q1, q2)
-
-    for sasm in bl_unsub_sasms:
-        if int_type == 'total':
-            sasm_intensity = sasm.getTotalI()
-        elif int_type == 'mean':
-            sasm_intensity = sasm.getMeanI()
-        elif int_type == 'q_val':
-            sasm_intensity = sasm.getIofQ(qref)
-        elif int_type == 'q_range':
-            sasm_intensity = sasm.getIofQRange(q1, q2)
-
-        if abs(sasm_intensity/ref_intensity) > calc_threshold:
-            use_subtracted_sasms.append(True)
-        else:
-            use_subtracted_sasms.append(False)
+    bl_sasms = bl_correction.bl_sasms
+    use_subtracted_sasms = bl_correction.use_subtracted_sasms
+    bl_corr = bl_correction.bl_corr
+
+    if bl_type == 'Linear':
+        fit_results = bl_correction.fit_results
+    else:
+        fit_results = [] #Need to declare here for integral baselines which don't return fit_results
+
+    sub_mean_i = np.array([sasm.getMeanI() for sasm in bl_sasms])
+    sub_total_i = np.array([sasm.getTotalI() for sasm in bl_sasms])
 
     bl_sub_mean_i = np.array([sasm.getMeanI() for sasm in bl_corr])
     bl_sub_total_i = np.array([sasm.getTotalI() for sasm in bl_corr])
@@ -4521,16 +5682,95 @@ def processBaseline(unsub_sasms, sub_sasms, r1, r2, bl_type, min_iter, max_iter,
     return (bl_sasms, use_subtracted_sasms, bl_corr, fit_results, sub_mean_i,
         sub_total_i, bl_sub_mean_i, bl_sub_total_i)
 
+def updateSeriesBaseline(secm, min_iter, max_iter, int_type, qref, qrange,
+    calc_threshold, first_frame=None):
+    """
+    Updates the baseline correction of a series for profiles added since it
+    was set, for example during online data collection. The series must
+    already be baseline corrected, and the new profiles are corrected with
+    the same ranges and baseline type. The :class:`BaselineCorrection` is
+    kept with the series, so only new or changed profiles are corrected.
+    It is recreated, and all profiles are corrected again, if the baseline
+    correction of the series was changed since the last update. The series
+    semaphore should be held by the caller.
+
+    Parameters
+    ----------
+    secm: :class:`bioxtasraw.SECM.SECM`
+        The series.
+    min_iter: int
+        The minimum number of iterations for an integral baseline.
+    max_iter: int
+        The maximum number of iterations for an integral baseline.
+    int_type: str
+        The intensity used to decide whether a corrected profile is used
+        to calculate parameters: 'total', 'mean', 'q_val' or 'q_range'.
+    qref: float
+        The q value used if int_type is 'q_val'.
+    qrange: tuple
+        The q range used if int_type is 'q_range'.
+    calc_threshold: float
+        The threshold, relative to the start range, above which a corrected
+        profile is used to calculate parameters.
+    first_frame: int, optional
+        The first subtracted profile that is new or has changed since the
+        last update. Defaults to the profiles after the last update.
+
+    Returns
+    -------
+    first_frame: int
+        The first frame whose baseline corrected profile was updated. If
+        no profiles were corrected this is the number of frames.
+    """
+    r1 = tuple(secm.baseline_start_range)
+    r2 = tuple(secm.baseline_end_range)
+
+    if qrange is not None:
+        qrange = tuple(qrange)
+
+    bl_settings = (r1, r2, secm.baseline_type, min_iter, max_iter,
+        secm.baseline_extrap, int_type, qref, qrange, calc_threshold)
+
+    bl_correction = secm.baseline_correction
+
+    if (bl_correction is None or bl_correction.bl_corr is not secm.baseline_corr
+        or (bl_correction.r1, bl_correction.r2, bl_correction.bl_type,
+        bl_correction.min_iter, bl_correction.max_iter,
+        bl_correction.bl_extrap, bl_correction.int_type, bl_correction.qref,
+        bl_correction.qrange, bl_correction.calc_threshold) != bl_settings):
+        bl_correction = BaselineCorrection(*bl_settings)
+        secm.baseline_correction = bl_correction
+        first_frame = None
+
+    first_frame = bl_correction.update(secm.getAllSASMs(),
+        secm.subtracted_sasm_list, first_frame)
+
+    if first_frame < len(bl_correction.bl_sasms):
+        n_replace = len(secm.baseline_subtracted_sasm_list) - first_frame
+
+        secm.appendBCSubtractedSASMs(bl_correction.bl_sasms[first_frame:],
+            bl_correction.use_subtracted_sasms[first_frame:], n_replace)
+
+        secm.baseline_corr = bl_correction.bl_corr
+        secm.baseline_fit_results = bl_correction.fit_results
+
+    return first_frame
+
 
 ###############################################################################
 # REGALS stuff
 
 def run_regals(M, intensity, sigma, min_iter=20, max_iter=1000, tol=0.001,
-    conv_type='Chi^2', callback=None, abort_event=None):
+    conv_type='Chi^2', callback=None, abort_event=None, trace=None):
+    """
+    Runs REGALS on the mixture M. If trace is a list, a tuple of (iteration,
+    elapsed time, chi^2) is appended to it after every iteration.
+    """
     R = REGALS.regals(intensity, sigma)
 
     chis = np.empty(max_iter)
     niter = 0
+    start_time = time.time()
 
     while True:
 
@@ -4541,6 +5781,9 @@ def run_regals(M, intensity, sigma, min_iter=20, max_iter=1000, tol=0.001,
         M, params, resid = R.step(M)
         chis[niter] = params['x2']
 
+        if trace is not None:
+            trace.append((niter+1, time.time()-start_time, params['x2']))
+
         # if (niter +1) % 1 == 0 or niter == 0:
         #     print('Iteration: {}, chi^2: {}'.format(niter+1, params['x2']))
 
@@ -4564,6 +5807,77 @@ def run_regals(M, intensity, sigma, min_iter=20, max_iter=1000, tol=0.001,
 
     return M, params, resid
 
+def run_regals_multistart(comp_settings_list, q, x, intensity, sigma,
+    min_iter=20, max_iter=1000, tol=0.001, conv_type='Chi^2', nprocs=0,
+    warm_start=True, prev_mixture=None, trace_file=None, abort_event=None):
+    """
+    Runs REGALS for each of several sets of component settings, such as a
+    sweep of lambda values or of the number of components, in a thread pool.
+    Runs are started in order, nprocs at a time. If warm_start is True, each
+    run is seeded (using match_regals_component_u) from the lowest chi^2
+    solution with the same number of components out of the runs that have
+    already finished, or from prev_mixture if there isn't one yet.
+
+    Returns a list of (mixture, params, resid) for each entry in
+    comp_settings_list, with None for any runs that weren't started before
+    abort_event was set. If trace_file is provided, the per iteration timing
+    and chi^2 of every run are saved to it.
+    """
+    if nprocs == 0:
+        nprocs = max(multiprocessing.cpu_count()-1, 1)
+    else:
+        nprocs = max(min(nprocs, multiprocessing.cpu_count()), 1)
+
+    results = [None for settings in comp_settings_list]
+    traces = [[] for settings in comp_settings_list]
+    best = {}
+
+    if prev_mixture is not None:
+        best[prev_mixture.Nc] = (np.inf, prev_mixture)
+
+    def run_one(j, seed):
+        comp_settings = copy.deepcopy(comp_settings_list[j])
+
+        # create_regals_mixture modifies the u vectors of the seed in place
+        mixture = create_regals_mixture(comp_settings, q, x, intensity, sigma,
+            seed is not None, copy.deepcopy(seed))[0]
+
+        return run_regals(mixture, intensity, sigma, min_iter, max_iter, tol,
+            conv_type, abort_event=abort_event, trace=traces[j])
+
+    with ThreadPoolExecutor(nprocs) as executor:
+        for start in range(0, len(comp_settings_list), nprocs):
+            if abort_event is not None and abort_event.is_set():
+                break
+
+            batch = range(start, min(start+nprocs, len(comp_settings_list)))
+            futures = []
+
+            for j in batch:
+                ncomps = len(comp_settings_list[j])
+
+                if warm_start and ncomps in best:
+                    seed = best[ncomps][1]
+                else:
+                    seed = None
+
+                futures.append(executor.submit(run_one, j, seed))
+
+            for j, future in zip(batch, futures):
+                results[j] = future.result()
+
+                mixture, params, resid = results[j]
+                ncomps = mixture.Nc
+
+                if ((ncomps not in best or params['x2'] < best[ncomps][0])
+                    and np.isfinite(params['x2'])):
+                    best[ncomps] = (params['x2'], mixture)
+
+    if trace_file is not None:
+        SASFileIO.saveREGALSTrace(trace_file, traces)
+
+    return results
+
 def create_regals_mixture(component_settings, q, x, intensity, sigma,
     seed_previous=False, prev_mixture=None):
     """
@@ -4958,10 +6272,43 @@ def make_regals_regularized_concs(mixture):
 
     return reg_concs
 
+def get_regals_data(series, profile_type='sub', framei=None, framef=None,
+    x_vals=None):
+    """
+    Gets the q vector and the intensity and sigma matrices used for REGALS
+    from a series or list of profiles.
+    """
+    if framei is None:
+            framei = 0
+    if framef is None:
+        if isinstance(series, SECM.SECM):
+            framef = len(series.getAllSASMs())-1
+        else:
+            framef = len(series)-1
+
+    ref_q = series.getSASMList(framei, framef)[0].getQ()
+    ref_q_err = series.getSASMList(framei, framef)[0].getQErr()
+
+    if x_vals is None:
+        x_vals = np.arange(framei, framef+1)
+
+    if isinstance(series, SECM.SECM):
+        sasm_list = series.getSASMList(framei, framef, profile_type)
+    else:
+        sasm_list = series[framei:framef+1]
+
+    i = np.array([sasm.getI() for sasm in sasm_list])
+    err = np.array([sasm.getErr() for sasm in sasm_list])
+
+    intensity = i.T #Because of how numpy does the SVD, to get U to be the scattering vectors and V to be the other, we have to transpose
+    sigma = err.T
+
+    return framei, framef, x_vals, ref_q, ref_q_err, intensity, sigma
+
 def run_full_regals(series, comp_settings, profile_type='sub', framei=None,
     framef=None, x_vals=None, min_iter=25, max_iter=1000, tol=0.0001,
     conv_type='Chi^2', use_previous_results=False,
-    previous_results=None):
+    previous_results=None, trace_file=None):
     """
     Runs regularized alternating least squares (REGALS) on the input series to
     deconvolve overlapping components in the data.
@@ -5038,6 +6385,9 @@ def run_full_regals(series, comp_settings, profile_type='sub', framei=None,
         The mixture output from a previous REGALS run, which will be used as
         the initial profile and concentration vectors for this REGALS run. Only
         used of use_previous_results is True.
+    trace_file: str, optional
+        If provided, the elapsed time and chi^2 of each iteration are saved
+        to this file as a csv.
 
     Returns
     -------
@@ -5069,35 +6419,8 @@ def run_full_regals(series, comp_settings, profile_type='sub', framei=None,
         intensities. This is a matrix where each column corresponds to an
         input intensity.
     """
-    if framei is None:
-            framei = 0
-    if framef is None:
-        if isinstance(series, SECM.SECM):
-            framef = len(series.getAllSASMs())-1
-        else:
-            framef = len(series)-1
-
-    ref_q = series.getSASMList(framei, framef)[0].getQ()
-    ref_q_err = series.getSASMList(framei, framef)[0].getQErr()
-
-    if x_vals is None:
-        x_vals = np.arange(framei, framef+1)
-
-    if isinstance(series, SECM.SECM):
-        sasm_list = series.getSASMList(framei, framef, profile_type)
-        filename = os.path.splitext(series.getParameter('filename'))[0]
-    else:
-        sasm_list = series[framei:framef+1]
-        names = [os.path.basename(sasm.getParameter('filename')) for sasm in series]
-        filename = os.path.commonprefix(names).rstrip('_')
-        if filename == '':
-            filename =  os.path.splitext(os.path.basename(series[0].getParameter('filename')))[0]
-
-    i = np.array([sasm.getI() for sasm in sasm_list])
-    err = np.array([sasm.getErr() for sasm in sasm_list])
-
-    intensity = i.T #Because of how numpy does the SVD, to get U to be the scattering vectors and V to be the other, we have to transpose
-    sigma = err.T
+    (framei, framef, x_vals, ref_q, ref_q_err, intensity,
+        sigma) = get_regals_data(series, profile_type, framei, framef, x_vals)
 
     if (use_previous_results and previous_results is not None and
         len(previous_results.u_profile) == len(comp_settings)):
@@ -5109,8 +6432,17 @@ def run_full_regals(series, comp_settings, profile_type='sub', framei=None,
         mixture, components = create_regals_mixture(comp_settings,
             ref_q, x_vals, intensity, sigma)
 
+    if trace_file is not None:
+        trace = []
+    else:
+        trace = None
+
     mixture, params, residual = run_regals(mixture, intensity, sigma,
-        min_iter=min_iter, max_iter=max_iter, tol=tol, conv_type=conv_type)
+        min_iter=min_iter, max_iter=max_iter, tol=tol, conv_type=conv_type,
+        trace=trace)
+
+    if trace_file is not None:
+        SASFileIO.saveREGALSTrace(trace_file, [trace])
 
     regals_profiles = make_regals_sasms(mixture, ref_q, intensity, sigma,
         series, framei, framef, ref_q_err)
@@ -41,11 +41,12 @@ import datetime
 from xml.dom import minidom
 import ast
 import traceback
+import tempfile
+import weakref
 
 import numpy as np
 import fabio
 from PIL import Image
-import matplotlib.backends.backend_pdf
 import h5py
 import pdbx.reader
 
@@ -1140,23 +1141,7 @@ def loadFile(filename, raw_settings, no_processing=False, return_all_images=True
 
          NB: This is the function used to load any type of file in RAW
     '''
-    try:
-        file_type = checkFileType(filename)
-        # print file_type
-    except IOError:
-        raise
-    except Exception as msg:
-        print(str(msg))
-        file_type = None
-
-    if file_type == 'hdf5':
-        try:
-            hdf5_file = fabio.open(filename)
-            file_type = 'image'
-        except Exception:
-            pass
-    else:
-        hdf5_file = None
+    file_type, hdf5_file = getFileType(filename)
 
     if file_type == 'image':
         try:
@@ -1193,6 +1178,30 @@ def loadFile(filename, raw_settings, no_processing=False, return_all_images=True
 
     return sasm, img
 
+def getFileType(filename):
+    ''' Finds the file type as in checkFileType, except that hdf5 files
+    that fabio can read as images are 'image' files. Returns the file type
+    and the opened fabio hdf5 file (or None). '''
+    try:
+        file_type = checkFileType(filename)
+        # print file_type
+    except IOError:
+        raise
+    except Exception as msg:
+        print(str(msg))
+        file_type = None
+
+    hdf5_file = None
+
+    if file_type == 'hdf5':
+        try:
+            hdf5_file = fabio.open(filename)
+            file_type = 'image'
+        except Exception:
+            pass
+
+    return file_type, hdf5_file
+
 def postProcessProfile(sasm, raw_settings, no_processing):
     """
     Does post-processing on profiles created from images.
@@ -1279,6 +1288,32 @@ def loadAsciiFile(filename, file_type):
 
 
 def loadImageFile(filename, raw_settings, hdf5_file=None, return_all_images=True):
+    loaded_data = []
+    sasm_list = []
+
+    for file_num, i, img, parameters in iterImageFrames(filename, raw_settings,
+        hdf5_file):
+
+        if return_all_images:
+            loaded_data.append(img)
+        elif not return_all_images and file_num == 0 and i == 0:
+            loaded_data.append(img)
+
+        sasm = processImage(img, parameters, raw_settings)
+
+        sasm_list.append(sasm)
+
+    return sasm_list, loaded_data
+
+def iterImageFrames(filename, raw_settings, hdf5_file=None):
+    """
+    Loads the images in an image file one at a time, along with the
+    parameters (headers, frame filename and load path) needed to process
+    them. For multi-frame hdf5 files only one frame is in memory at a time.
+
+    Yields (file frame number, image number, image, parameters) for each
+    image.
+    """
     hdr_fmt = raw_settings.get('ImageHdrFormat')
 
     if hdf5_file is not None:
@@ -1294,10 +1329,6 @@ def loadImageFile(filename, raw_settings, hdf5_file=None, return_all_images=True
     else:
         num_frames = 1
 
-
-    loaded_data = []
-    sasm_list = []
-
     for file_num in range(num_frames):
         if load_one_frame:
             new_data, new_hdr, _ = loadImage(filename, raw_settings, hdf5_file, file_num)
@@ -1305,11 +1336,6 @@ def loadImageFile(filename, raw_settings, hdf5_file=None, return_all_images=True
         else:
             new_data, new_hdr, _ = loadImage(filename, raw_settings, hdf5_file)
 
-        if return_all_images:
-            loaded_data.extend(new_data)
-        elif not return_all_images and file_num == 0:
-            loaded_data.append(new_data[0])
-
         offset = 0
 
         #Process all loaded images into sasms
@@ -1361,11 +1387,7 @@ def loadImageFile(filename, raw_settings, hdf5_file=None, return_all_images=True
                           'filename'    : new_filename,
                           'load_path'   : filename}
 
-            sasm = processImage(img, parameters, raw_settings)
-
-            sasm_list.append(sasm)
-
-    return sasm_list, loaded_data
+            yield file_num, i, img, parameters
 
 def processImage(img, parameters, raw_settings):
     for key in parameters['counters']:
@@ -1963,8 +1985,9 @@ def load_series_sasm(group, data_name, q_raw=None, use_group_q=True, q_err_raw=N
                 sasm_data['q_raw'] = q_vals
                 sasm_data['q_err_raw'] = None
         else:
-            sasm_data['q_raw'] = copy.copy(q_raw)
-            sasm_data['q_err_raw'] = copy.copy(q_err_raw)
+            # Profiles in the same group share the q vector
+            sasm_data['q_raw'] = q_raw
+            sasm_data['q_err_raw'] = q_err_raw
 
         data = load_dataset[()]
         sasm_data['i_raw'] = data[:,0]
@@ -1996,7 +2019,148 @@ def load_series_sasm(group, data_name, q_raw=None, use_group_q=True, q_err_raw=N
 
     return sasm_data
 
-def load_series_sasm_list(group, excluded_keys=['raw', 'q', 'q_err']):
+def _decode_series_string(val):
+    # Deals with a change in how h5py reads in strings between version 2 and 3.
+    if isinstance(val, bytes):
+        val = val.decode('utf-8')
+
+    return val
+
+def _load_series_parameters(val):
+    return loadDatHeader(_decode_series_string(val))
+
+def _series_columns_source(group):
+    # Gets the group holding the raw profiles of a columnar profile group,
+    # and the raw q vector
+    if 'raw' in group and 'intensity' in group['raw']:
+        data_group = group['raw']
+    else:
+        data_group = group
+
+    q_vals = data_group['q'][()]
+
+    if q_vals.ndim == 2:
+        q_raw = q_vals[:, 0]
+        q_err_raw = q_vals[:, 1]
+    else:
+        q_raw = q_vals
+        q_err_raw = None
+
+    return data_group, q_raw, q_err_raw
+
+def load_series_sasm_columns(group, frames=None):
+    """
+    Loads profiles saved in the columnar layout (see save_series_sasm_columns).
+    If frames is given, only those frames are read from the file.
+    """
+    if frames is None:
+        frames = slice(None)
+    else:
+        # h5py needs unique, increasing indices
+        frames, order = np.unique(frames, return_inverse=True)
+
+    data_group, q_raw, q_err_raw = _series_columns_source(group)
+
+    i_raw = data_group['intensity'][frames]
+    err_raw = data_group['error'][frames]
+    frame_info = group['frame_info'][frames]
+    parameters = group['parameters'][frames]
+
+    sasm_list = []
+
+    # The profiles share the q vector
+    for j in range(i_raw.shape[0]):
+        sasm_data = {
+            'q_raw'             : q_raw,
+            'q_err_raw'         : q_err_raw,
+            'i_raw'             : i_raw[j],
+            'err_raw'           : err_raw[j],
+            'parameters'        : _load_series_parameters(parameters[j]),
+            'scale_factor'      : float(frame_info['scale_factor'][j]),
+            'offset_value'      : float(frame_info['offset_value'][j]),
+            'q_scale_factor'    : float(frame_info['q_scale_factor'][j]),
+            'selected_qrange'   : [int(frame_info['qrange_start'][j]),
+                int(frame_info['qrange_end'][j])],
+            }
+
+        sasm_list.append(sasm_data)
+
+    if not isinstance(frames, slice):
+        sasm_list = [copy.deepcopy(sasm_list[k]) for k in order]
+
+    return sasm_list
+
+def _remove_file(fname):
+    try:
+        os.remove(fname)
+    except Exception:
+        pass
+
+def _series_memmap(dataset, cache_dir=None):
+    # Copies a frames x q dataset into a memory-mapped .npy file a chunk of
+    # frames at a time. The file is removed when the array is no longer used.
+    fd, fname = tempfile.mkstemp(suffix='.npy', prefix='raw_series_',
+        dir=cache_dir)
+    os.close(fd)
+
+    data = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float64,
+        shape=dataset.shape)
+
+    for start in range(0, dataset.shape[0], SECM.LazyProfileList.chunk_size):
+        end = start + SECM.LazyProfileList.chunk_size
+        data[start:end] = dataset[start:end]
+
+    data.flush()
+    del data
+
+    data = np.load(fname, mmap_mode='r')
+    weakref.finalize(data, _remove_file, fname)
+
+    return data
+
+def load_series_sasm_lazy(group, cache_dir=None):
+    """
+    Loads profiles saved in the columnar layout as a
+    bioxtasraw.SECM.LazyProfileList, with the intensity and error stored in
+    memory-mapped files in cache_dir (defaults to the system temporary
+    directory).
+    """
+    data_group, q_raw, q_err_raw = _series_columns_source(group)
+
+    frame_info = group['frame_info'][()]
+
+    # The parameter strings are only read in when a profile is made
+    parameters = group['parameters'][()]
+
+    if len(frame_info) > 0:
+        q_scale_factor = float(frame_info['q_scale_factor'][0])
+    else:
+        q_scale_factor = 1.0
+
+    qranges = np.column_stack((frame_info['qrange_start'],
+        frame_info['qrange_end']))
+
+    if 'counters' in group:
+        counters = group['counters'][()]
+    else:
+        counters = None
+
+    sasm_list = SECM.LazyProfileList(q_raw,
+        _series_memmap(data_group['intensity'], cache_dir),
+        _series_memmap(data_group['error'], cache_dir), parameters, q_err_raw,
+        q_scale_factor, frame_info['scale_factor'], frame_info['offset_value'],
+        qranges, _load_series_parameters, counters)
+
+    return sasm_list
+
+def load_series_sasm_list(group, excluded_keys=['raw', 'q', 'q_err'],
+    lazy=False, cache_dir=None):
+    if group.attrs.get('layout', '') == 'columnar':
+        if lazy:
+            return load_series_sasm_lazy(group, cache_dir)
+        else:
+            return load_series_sasm_columns(group)
+
     q_raw = None
     q_err_raw = None
     sasm_list = []
@@ -2024,10 +2188,64 @@ def load_series_sasm_list(group, excluded_keys=['raw', 'q', 'q_err']):
 
     return sasm_list
 
-def load_series(name):
+def _open_series(name):
+    # Older files store each profile as a separate small dataset, which is
+    # much faster to read with the whole file in memory. Columnar files are
+    # read directly so that only the requested data is loaded.
+    with h5py.File(name, 'r') as f:
+        columnar = f.attrs.get('series_layout', '') == 'columnar'
+
+    if columnar:
+        return h5py.File(name, 'r')
+    else:
+        return h5py.File(name, 'r', driver='core', backing_store=False)
+
+def load_series_frames(name, frames, profile_type='profiles'):
+    """
+    Loads individual profiles from a .hdf5 series file without reading in
+    the rest of the file. profile_type is the group to read from: 'profiles',
+    'subtracted_profiles', or 'baseline_subtracted_profiles'. frames is a
+    list of profile indices. Returns a list of profile dictionaries, which
+    can be turned into SASMs with makeSeriesSASM.
+    """
+    frames = [int(frame) for frame in frames]
+
+    with h5py.File(name, 'r') as f:
+        group = f[profile_type]
+
+        if group.attrs.get('layout', '') == 'columnar':
+            sasm_list = load_series_sasm_columns(group, frames)
+
+        else:
+            names = sorted([key for key in group if key not in ['raw', 'q',
+                'q_err', 'average_buffer_profile']])
+
+            q_raw = None
+            q_err_raw = None
+
+            if 'raw' in group and 'q' in group['raw']:
+                q_raw = group['raw']['q'][()]
+            elif 'q' in group:
+                q_raw = group['q'][()]
+
+            if q_raw is not None and q_raw.ndim == 2:
+                q_err_raw = q_raw[:,1]
+                q_raw = q_raw[:,0]
+
+            sasm_list = [load_series_sasm(group, names[frame], q_raw,
+                q_err_raw=q_err_raw) for frame in frames]
+
+    return sasm_list
+
+def load_series(name, lazy=False, cache_dir=None):
+    """
+    Loads a .hdf5 series file. If lazy is True, profile groups saved in the
+    columnar layout are loaded as bioxtasraw.SECM.LazyProfileList objects,
+    with the profile data in memory-mapped files in cache_dir.
+    """
     seriesm_data = {}
 
-    with h5py.File(name, 'r', driver='core', backing_store=False) as f:
+    with _open_series(name) as f:
         seriesm_data['series_type'] = str(f.attrs['series_type'])
         seriesm_data['parameters'] = loadDatHeader(f.attrs['parameters'])
 
@@ -2038,7 +2256,7 @@ def load_series(name):
         # Get data from unsubtracted group
         profiles = f['profiles']
         seriesm_data['sasm_list'] = load_series_sasm_list(profiles, ['raw', 'q',
-            'q_err', 'average_buffer_profile'])
+            'q_err', 'average_buffer_profile'], lazy, cache_dir)
 
         if len(profiles['average_buffer_profile']) > 0:
             seriesm_data['average_buffer_sasm'] = load_series_sasm(profiles,
@@ -2049,13 +2267,15 @@ def load_series(name):
         # Get data from subtracted group
 
         sub_profiles = f['subtracted_profiles']
-        seriesm_data['subtracted_sasm_list'] = load_series_sasm_list(sub_profiles)
+        seriesm_data['subtracted_sasm_list'] = load_series_sasm_list(sub_profiles,
+            lazy=lazy, cache_dir=cache_dir)
 
         seriesm_data['use_subtracted_sasm'] = sub_profiles.attrs['use_subtracted_sasm'][()]
 
         # Get data from baseline subtracted group
         baseline_profiles = f['baseline_subtracted_profiles']
-        seriesm_data['baseline_subtracted_sasm_list'] = load_series_sasm_list(baseline_profiles)
+        seriesm_data['baseline_subtracted_sasm_list'] = load_series_sasm_list(
+            baseline_profiles, lazy=lazy, cache_dir=cache_dir)
 
         seriesm_data['use_baseline_subtracted_sasm'] = baseline_profiles.attrs['use_baseline_subtracted_sasm'][()]
 
@@ -2099,7 +2319,8 @@ def load_series(name):
 
         # Get baseline
         baseline = f['baseline']
-        seriesm_data['baseline_corr'] = load_series_sasm_list(baseline['correction'])
+        seriesm_data['baseline_corr'] = load_series_sasm_list(baseline['correction'],
+            lazy=lazy, cache_dir=cache_dir)
 
         seriesm_data['baseline_fit_results'] = baseline['fit_parameters'][:]
 
@@ -2158,7 +2379,7 @@ def load_series(name):
 
     return seriesm_data
 
-def loadSeriesFile(filename, settings):
+def loadSeriesFile(filename, settings, lazy=False, cache_dir=None):
 
     name, ext = os.path.splitext(filename)
 
@@ -2184,7 +2405,7 @@ def loadSeriesFile(filename, settings):
             file.close()
 
     else:
-        secm_data = load_series(filename)
+        secm_data = load_series(filename, lazy, cache_dir)
 
     if secm_data is not None:
         new_secm, line_data, calc_line_data = makeSeriesFile(secm_data, settings)
@@ -2195,6 +2416,58 @@ def loadSeriesFile(filename, settings):
 
     return new_secm
 
+def makeSeriesSASM(sasm_data):
+    """
+    Makes a SASM from a profile dictionary read from a series file. The
+    SASM uses the arrays in the dictionary without copying them.
+    """
+    if 'q_binned' in sasm_data:
+        q = sasm_data['q_binned']
+        i = sasm_data['i_binned']
+        err = sasm_data['err_binned']
+        q_err = None
+    else:
+        q = sasm_data['q_raw']
+        i = sasm_data['i_raw']
+        err = sasm_data['err_raw']
+        q_err = sasm_data['q_err_raw']
+
+    new_sasm = SASM.SASM(i, q, err, sasm_data['parameters'], q_err,
+        copy_data=False)
+
+    new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
+        sasm_data['q_scale_factor'])
+
+    new_sasm.setQrange(sasm_data['selected_qrange'])
+
+    try:
+        new_sasm.setParameter('analysis', sasm_data['parameters_analysis'])
+    except KeyError:
+        pass
+
+    new_sasm._update()
+
+    return new_sasm
+
+def makeSeriesSASMList(sasm_data_list):
+    """
+    Makes a list of SASMs from a list of profile dictionaries read from a
+    series file. Placeholder (-1) items are kept, and lazy lists
+    (bioxtasraw.SECM.LazyProfileList) are returned as is.
+    """
+    if isinstance(sasm_data_list, SECM.LazyProfileList):
+        return sasm_data_list
+
+    sasm_list = []
+
+    for sasm_data in sasm_data_list:
+        if sasm_data != -1:
+            sasm_list.append(makeSeriesSASM(sasm_data))
+        else:
+            sasm_list.append(-1)
+
+    return sasm_list
+
 def makeSeriesFile(secm_data, settings):
 
     default_dict =     {
@@ -2232,42 +2505,14 @@ def makeSeriesFile(secm_data, settings):
         if key not in secm_data:
             secm_data[key] = default_dict[key]
 
-    sasm_list = []
-
-    for sasm_data in secm_data['sasm_list']:
-
-        if 'q_binned' in sasm_data:
-            q = sasm_data['q_binned']
-            i = sasm_data['i_binned']
-            err = sasm_data['err_binned']
-            q_err = None
-        else:
-            q = sasm_data['q_raw']
-            i = sasm_data['i_raw']
-            err = sasm_data['err_raw']
-            q_err = sasm_data['q_err_raw']
-
-        new_sasm = SASM.SASM(i, q, err, sasm_data['parameters'], q_err)
-
-        new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
-            sasm_data['q_scale_factor'])
-
-        new_sasm.setQrange(sasm_data['selected_qrange'])
-
-        try:
-            new_sasm.setParameter('analysis', sasm_data['parameters_analysis'])
-        except KeyError:
-            pass
-
-        new_sasm._update()
-
-        sasm_list.append(new_sasm)
+    sasm_list = makeSeriesSASMList(secm_data['sasm_list'])
 
     new_secm = SECM.SECM(secm_data['file_list'], sasm_list,
         secm_data['frame_list'], secm_data['parameters'], settings)
 
-    new_secm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
-            sasm_data['q_scale_factor'])
+    if len(sasm_list) > 0:
+        new_secm.setScaleValues(sasm_list[-1].getScale(), sasm_list[-1].getOffset(),
+            sasm_list[-1].getQScale())
 
     new_secm.series_type = secm_data['series_type']
     new_secm.window_size = secm_data['window_size']
@@ -2294,39 +2539,7 @@ def makeSeriesFile(secm_data, settings):
             secm_data['vpmw'])
 
 
-    subtracted_sasm_list = []
-
-    for sasm_data in secm_data['subtracted_sasm_list']:
-
-        if sasm_data != -1:
-            if 'q_binned' in sasm_data:
-                q = sasm_data['q_binned']
-                i = sasm_data['i_binned']
-                err = sasm_data['err_binned']
-                q_err = None
-            else:
-                q = sasm_data['q_raw']
-                i = sasm_data['i_raw']
-                err = sasm_data['err_raw']
-                q_err = sasm_data['q_err_raw']
-
-            new_sasm = SASM.SASM(i, q, err, sasm_data['parameters'], q_err)
-
-            new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
-                sasm_data['q_scale_factor'])
-
-            new_sasm.setQrange(sasm_data['selected_qrange'])
-
-            try:
-                new_sasm.setParameter('analysis', sasm_data['parameters_analysis'])
-            except KeyError:
-                pass
-
-            new_sasm._update()
-        else:
-            new_sasm = -1
-
-        subtracted_sasm_list.append(new_sasm)
+    subtracted_sasm_list = makeSeriesSASMList(secm_data['subtracted_sasm_list'])
 
     new_secm.setSubtractedSASMs(subtracted_sasm_list, secm_data['use_subtracted_sasm'])
 
@@ -2336,65 +2549,37 @@ def makeSeriesFile(secm_data, settings):
     new_secm.baseline_extrap = secm_data['baseline_extrap']
     new_secm.baseline_fit_results = secm_data['baseline_fit_results']
 
-    baseline_subtracted_sasm_list = []
-
-    for sasm_data in secm_data['baseline_subtracted_sasm_list']:
-
-        if sasm_data != -1:
-            if 'q_binned' in sasm_data:
-                q = sasm_data['q_binned']
-                i = sasm_data['i_binned']
-                err = sasm_data['err_binned']
-                q_err = None
-            else:
-                q = sasm_data['q_raw']
-                i = sasm_data['i_raw']
-                err = sasm_data['err_raw']
-                q_err = sasm_data['q_err_raw']
-
-            new_sasm = SASM.SASM(i, q, err, sasm_data['parameters'], q_err)
-
-            new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
-                sasm_data['q_scale_factor'])
-
-            new_sasm.setQrange(sasm_data['selected_qrange'])
-
-            try:
-                new_sasm.setParameter('analysis', sasm_data['parameters_analysis'])
-            except KeyError:
-                pass
-
-            new_sasm._update()
-        else:
-            new_sasm = -1
-
-        baseline_subtracted_sasm_list.append(new_sasm)
+    baseline_subtracted_sasm_list = makeSeriesSASMList(
+        secm_data['baseline_subtracted_sasm_list'])
 
     new_secm.setBCSubtractedSASMs(baseline_subtracted_sasm_list, secm_data['use_baseline_subtracted_sasm'])
 
-    baseline_corr = []
+    if isinstance(secm_data['baseline_corr'], SECM.LazyProfileList):
+        baseline_corr = secm_data['baseline_corr']
+    else:
+        baseline_corr = []
 
-    for sasm_data in secm_data['baseline_corr']:
+        for sasm_data in secm_data['baseline_corr']:
 
-        if sasm_data != -1:
-            new_sasm = SASM.SASM(sasm_data['i_raw'], sasm_data['q_raw'],
-                sasm_data['err_raw'], sasm_data['parameters'])
+            if sasm_data != -1:
+                new_sasm = SASM.SASM(sasm_data['i_raw'], sasm_data['q_raw'],
+                    sasm_data['err_raw'], sasm_data['parameters'])
 
-            new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
-                sasm_data['q_scale_factor'])
+                new_sasm.setScaleValues(sasm_data['scale_factor'], sasm_data['offset_value'],
+                    sasm_data['q_scale_factor'])
 
-            new_sasm.setQrange(sasm_data['selected_qrange'])
+                new_sasm.setQrange(sasm_data['selected_qrange'])
 
-            try:
-                new_sasm.setParameter('analysis', sasm_data['parameters_analysis'])
-            except KeyError:
-                pass
+                try:
+                    new_sasm.setParameter('analysis', sasm_data['parameters_analysis'])
+                except KeyError:
+                    pass
 
-            new_sasm._update()
-        else:
-            new_sasm = -1
+                new_sasm._update()
+            else:
+                new_sasm = -1
 
-        baseline_corr.append(new_sasm)
+            baseline_corr.append(new_sasm)
 
     new_secm.baseline_corr = baseline_corr
 
@@ -3661,6 +3846,10 @@ def save_series_sasm(profile_group, sasm_data, dataset_name, descrip='',
 
 def save_series_sasm_list(profile_group, sasm_list, frame_num_offset=0):
 
+    if _series_columns_ok(sasm_list):
+        save_series_sasm_columns(profile_group, sasm_list)
+        return
+
     if len(sasm_list) > 1:
         save_single_q = all([np.array_equal(sasm['q'], sasm_list[0]['q']) for sasm in sasm_list[1:]])
         save_single_q_raw = all([np.array_equal(sasm['q_raw'], sasm_list[0]['q_raw']) for sasm in sasm_list[1:]])
@@ -3730,6 +3919,174 @@ def save_series_sasm_list(profile_group, sasm_list, frame_num_offset=0):
         save_series_sasm(profile_group, sasm_data, "{:06d}".format(frame_num),
             save_single_q=save_single_q, save_single_q_raw=save_single_q_raw)
 
+# Per-frame values stored for columnar profile groups
+series_frame_info_dtype = np.dtype([
+    ('scale_factor', np.float64),
+    ('offset_value', np.float64),
+    ('q_scale_factor', np.float64),
+    ('qrange_start', np.int64),
+    ('qrange_end', np.int64),
+    ])
+
+series_chunk_frames = 64
+
+def _series_columns_ok(sasm_list):
+    # The columnar layout needs every profile in the group to share the same
+    # q vector, both for the processed and raw profiles
+    if len(sasm_list) == 0 or not all([isinstance(sasm, dict) for sasm in sasm_list]):
+        return False
+
+    first = sasm_list[0]
+
+    for key in ['q', 'q_err', 'q_raw', 'q_err_raw']:
+        for sasm in sasm_list[1:]:
+            if first[key] is None or sasm[key] is None:
+                if first[key] is not None or sasm[key] is not None:
+                    return False
+
+            elif not np.array_equal(sasm[key], first[key]):
+                return False
+
+    return True
+
+def _series_counters(sasm_list):
+    # Gets the numeric counters of each profile as a structured array, so they
+    # can be read without reading in the parameters of every profile
+    counters = [sasm['parameters'].get('counters', {}) for sasm in sasm_list]
+    names = sorted(set(str(key) for frame_counters in counters
+        for key in frame_counters))
+
+    values = np.full((len(names), len(sasm_list)), np.nan)
+
+    for j, frame_counters in enumerate(counters):
+        for k, name in enumerate(names):
+            try:
+                values[k, j] = float(frame_counters[name])
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    names = [name for k, name in enumerate(names)
+        if np.any(np.isfinite(values[k]))]
+    values = values[np.any(np.isfinite(values), axis=1)]
+
+    if len(names) == 0:
+        return None
+
+    data = np.empty(len(sasm_list), dtype=[(name, np.float64) for name in names])
+
+    for k, name in enumerate(names):
+        data[name] = values[k]
+
+    return data
+
+def _create_series_column(group, name, data, description):
+    chunks = (min(data.shape[0], series_chunk_frames),) + data.shape[1:]
+
+    dset = group.create_dataset(name, data=data, chunks=chunks,
+        compression='gzip', shuffle=True)
+    dset.attrs['description'] = description
+
+    return dset
+
+def save_series_sasm_columns(profile_group, sasm_list):
+    """
+    Saves a list of profiles that share a q vector in the columnar layout:
+    the intensities and uncertainties of all of the profiles are stored as
+    single chunked, compressed (frames x q) datasets, the scale, offset and
+    q range of each frame are stored in a structured array, as are the
+    numeric counters of each frame, and the parameters of each frame are
+    stored as one string per frame.
+    """
+    profile_group.attrs['layout'] = 'columnar'
+
+    q = sasm_list[0]['q']
+    q_err = sasm_list[0]['q_err']
+
+    if q_err is not None:
+        data = np.column_stack((q, q_err))
+    else:
+        data = q
+
+    q_dataset = profile_group.create_dataset('q', data=data)
+    q_dataset.attrs['description'] = ('the q vector for all profiles in the '
+        'intensity and error datasets in this group (note: named data, such as '
+        'the average buffer, will have a separate q vector in that dataset). '
+        'If present, column 1 is dQ.')
+
+    _create_series_column(profile_group, 'intensity',
+        np.vstack([sasm['i'] for sasm in sasm_list]), ('The intensity of each '
+        'scattering profile. Rows are profiles, columns correspond to q.'))
+
+    _create_series_column(profile_group, 'error',
+        np.vstack([sasm['err'] for sasm in sasm_list]), ('The uncertainty of '
+        'each scattering profile. Rows are profiles, columns correspond to q.'))
+
+    save_raw = not all([np.array_equal(sasm['q'], sasm['q_raw'])
+        and np.array_equal(sasm['i'], sasm['i_raw'])
+        and np.array_equal(sasm['err'], sasm['err_raw']) for sasm in sasm_list])
+
+    if save_raw:
+        if not 'raw' in profile_group.keys():
+            raw_group = profile_group.create_group('raw')
+        else:
+            raw_group = profile_group['raw']
+
+        q_raw = sasm_list[0]['q_raw']
+        q_err_raw = sasm_list[0]['q_err_raw']
+
+        if q_err_raw is not None:
+            data = np.column_stack((q_raw, q_err_raw))
+        else:
+            data = q_raw
+
+        q_raw_dataset = raw_group.create_dataset('q', data=data)
+        q_raw_dataset.attrs['description'] = ('the q vector for the raw '
+            'profiles in this group. If present, column 1 is dQ.')
+
+        _create_series_column(raw_group, 'intensity',
+            np.vstack([sasm['i_raw'] for sasm in sasm_list]), ('The intensity '
+            'of each scattering profile without scaling, offset, or q trimming.'))
+
+        _create_series_column(raw_group, 'error',
+            np.vstack([sasm['err_raw'] for sasm in sasm_list]), ('The '
+            'uncertainty of each scattering profile without scaling, offset, '
+            'or q trimming.'))
+
+    frame_info = np.zeros(len(sasm_list), dtype=series_frame_info_dtype)
+
+    for j, sasm in enumerate(sasm_list):
+        if save_raw:
+            frame_info[j] = (sasm['scale_factor'], sasm['offset_value'],
+                sasm['q_scale_factor'], sasm['selected_qrange'][0],
+                sasm['selected_qrange'][1])
+        else:
+            frame_info[j] = (1.0, 0.0, 1.0, 0, len(sasm['q']))
+
+    info_dataset = profile_group.create_dataset('frame_info', data=frame_info)
+    info_dataset.attrs['description'] = ('The scale factor, offset, q scale '
+        'factor, and selected q range of each profile, which are applied to '
+        'the raw profiles (if present) to give the profiles.')
+
+    counters = _series_counters(sasm_list)
+
+    if counters is not None:
+        counters_dataset = profile_group.create_dataset('counters',
+            data=counters)
+        counters_dataset.attrs['description'] = ('The numeric counter values '
+            '(from the parameters) of each profile, NaN if a profile does not '
+            'have the counter.')
+
+    try:
+        dtype = h5py.string_dtype() #h5py 2.10, python 3
+    except Exception:
+        dtype = h5py.special_dtype(vlen=str) #h5py < 2.10, python3
+
+    params_dataset = profile_group.create_dataset('parameters',
+        data=[formatHeader(sasm['parameters']) for sasm in sasm_list],
+        dtype=dtype)
+    params_dataset.attrs['description'] = ('The parameters (metadata) of each '
+        'profile, as a JSON string.')
+
 def save_series(save_name, seriesm, save_gui_data=False):
 
     seriesm_dict = seriesm.extractAll()
@@ -3768,6 +4125,7 @@ def save_series(save_name, seriesm, save_gui_data=False):
         f.attrs['raw_version'] = RAWGlobals.version
         f.attrs['parameters'] = formatHeader(seriesm_data['parameters'])
         f.attrs['series_type'] = seriesm_data['series_type']
+        f.attrs['series_layout'] = 'columnar'
 
         if save_gui_data:
             try:
@@ -4880,6 +5238,15 @@ def saveREGALSData(filename, panel_results):
         fsave.write(save_string)
 
 
+def saveREGALSTrace(filename, traces):
+    data = []
+
+    for run, trace in enumerate(traces):
+        for num_iter, elapsed, chi2 in trace:
+            data.append((run, num_iter, elapsed, chi2))
+
+    saveCSVFile(filename, data, '# Run,Iteration,Time_(s),Chi^2')
+
 def saveDammixData(filename, ambi_data, nsd_data, res_data, clust_num, clist_data,
                 dlist_data, model_data, setup_data, model_plots, plot_scale):
 
@@ -4925,6 +5292,8 @@ def saveDammixData(filename, ambi_data, nsd_data, res_data, clust_num, clist_dat
     with open(filename, 'w') as fsave:
         fsave.write(save_string)
 
+    import matplotlib.backends.backend_pdf
+
     pdf = matplotlib.backends.backend_pdf.PdfPages(os.path.splitext(filename)[0]+'.pdf')
 
     for data in model_plots:
@@ -4974,6 +5343,8 @@ def saveDenssData(filename, ambi_data, res_data, model_plots, setup_data,
     with open(filename, 'w') as fsave:
         fsave.write(save_string)
 
+    import matplotlib.backends.backend_pdf
+
     pdf = matplotlib.backends.backend_pdf.PdfPages(os.path.splitext(filename)[0]+'.pdf')
 
     for data in model_plots:
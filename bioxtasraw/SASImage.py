@@ -29,9 +29,25 @@ from io import open
 import sys
 import math
 import os
+import copy
+import collections
+import threading
+import weakref
+import zlib
 
 import numpy as np
+import scipy.sparse
 import pyFAI
+import pyFAI.azimuthalIntegrator
+import pyFAI.units
+
+try:
+    from pyFAI.method_registry import IntegrationMethod
+    from pyFAI.containers import ErrorModel
+except ImportError:
+    #Older pyFAI, the sparse integrator isn't used
+    IntegrationMethod = None
+    ErrorModel = None
 
 raw_path = os.path.abspath(os.path.join('.', __file__, '..', '..'))
 if raw_path not in os.sys.path:
@@ -49,18 +65,54 @@ import bioxtasraw.SASProc as SASProc
 def calcExpression(expr, img_hdr, file_hdr):
 
         if expr != '':
-            mathparser = SASParser.PyMathParser()
-            mathparser.addDefaultFunctions()
-            mathparser.addDefaultVariables()
-            mathparser.addSpecialVariables(file_hdr)
-            mathparser.addSpecialVariables(img_hdr)
-            mathparser.expression = expr
-
-            val = mathparser.evaluate()
+            compiled_expr = SASParser.getCompiledExpression(expr)
+
+            val = compiled_expr.evaluate(file_hdr, img_hdr)
             return val
         else:
             return None
 
+def calcExpressionStack(expr, img_hdrs, file_hdrs):
+    """
+    Evaluates an expression for a stack of headers, such as the counters for
+    every frame of a series, in a single vectorized call. Returns an array
+    with the value for each frame, or None if the expression is empty.
+    """
+    if expr == '':
+        return None
+
+    compiled_expr = SASParser.getCompiledExpression(expr)
+
+    nframes = len(img_hdrs)
+    stack_vars = {}
+
+    for name in compiled_expr.names:
+        vals = np.empty(nframes)
+        found = np.zeros(nframes, dtype=bool)
+
+        for j in range(nframes):
+            # The image header takes precedence over the file header
+            for hdr in (img_hdrs[j], file_hdrs[j]):
+                if hdr is not None and name in hdr:
+                    try:
+                        vals[j] = float(hdr[name])
+                        found[j] = True
+                        break
+                    except (TypeError, ValueError):
+                        pass
+
+        if np.all(found):
+            stack_vars[name] = vals
+
+        elif np.any(found):
+            # Headers differ between frames, so evaluate each frame
+            return np.array([float(calcExpression(expr, img_hdrs[j],
+                file_hdrs[j])) for j in range(nframes)])
+
+    val = compiled_expr.evaluate(stack_vars)
+
+    return np.broadcast_to(np.asarray(val, dtype=float), (nframes,)).copy()
+
 def getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys):
 
     bind_list = raw_settings.get('HeaderBindList')
@@ -104,152 +156,28 @@ def getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys):
 
     return result
 
-def integrateCalibrateNormalize(img, parameters, raw_settings):
-    use_hdr_config = raw_settings.get('UseHeaderForConfig')
-
-    img_hdr = parameters['imageHeader']
-    file_hdr = parameters['counters']
-
-    # Loads a different configuration file based on definition in the image header
-    if use_hdr_config:
-        prefix = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Config Prefix'])[0]
-
-        if prefix is None:
-           raise SASExceptions.ImageLoadError(['"Use header for new config load" is enabled in General Settings.\n',
-                                               'The binding "Config Prefix" was however not found in header,',
-                                               'not set in header options (See "Image/Header Format" in options) or not a number.'])
-        else:
-            prefix = str(int(prefix))
-
-        settings_folder = raw_settings.get('HdrLoadConfigDir')
-
-        # If the folder is not set.. look in the folder where the image is
-        if settings_folder == 'None' or settings_folder == '':
-            settings_folder, fname = os.path.split(parameters['load_path'])
-
-        settings_path = os.path.join(settings_folder, str(prefix) + '.cfg')
-
-        if not os.path.exists(settings_path):
-            raise SASExceptions.ImageLoadError(['"Use header for new config load" is enabled in General Settings.\n',
-                                                'Config file ' + settings_path + ' does not exist.',
-                                                'Check the path in the "General Settings" options. Clear the field to make RAW look for the config file in the same folder as the image.'])
-
-        RAWSettings.loadSettings(raw_settings, settings_path, auto_load = True)
-
-        mask_dict = raw_settings.get('Masks')
-        img_dim = raw_settings.get('MaskDimension')
-
-        #Create the masks
-        for each_key in mask_dict:
-            masks = mask_dict[each_key][1]
-
-            if masks is not None:
-                mask_img = SASMask.createMaskMatrix(img_dim, masks)
-                mask_param = mask_dict[each_key]
-                mask_param[0] = mask_img
-                mask_param[1] = masks
-                mask_param[2] = np.logical_not(mask_img)
-
-    else:
-        mask_dict = raw_settings.get('Masks')
-
-    # Get settings
-    use_hdr_mask = raw_settings.get('UseHeaderForMask')
-    use_hdr_calib = raw_settings.get('UseHeaderForCalib')
-
-    do_normalization = raw_settings.get('EnableNormalization')
-    normlist = raw_settings.get('NormalizationList')
-
-    do_flatfield = raw_settings.get('NormFlatfieldEnabled')
-    flatfield_image = raw_settings.get('NormFlatfieldImage')
-    do_darkcorrection = raw_settings.get('DarkCorrEnabled')
-    dark_image = raw_settings.get('DarkCorrImage')
-
-    do_solidangle = raw_settings.get('DoSolidAngleCorrection')
-    do_polarization = raw_settings.get('DoPolarizationCorrection')
-    polarization_factor = raw_settings.get('PolarizationFactor')
-
-    zinger_removal = raw_settings.get('ZingerRemovalRadAvg')
-    zinger_thres = raw_settings.get('ZingerRemovalRadAvgStd')
-    zinger_iter = raw_settings.get('ZingerRemovalRadAvgIter')
-
-    integration_method = raw_settings.get('IntegrationMethod')
-    angular_unit = raw_settings.get('AngularUnit')
-    error_model = raw_settings.get('ErrorModel')
-    use_image_for_variance = raw_settings.get('UseImageForVariance')
-    ai = raw_settings.get('AzimuthalIntegrator')
-
-    if not do_polarization:
-        polarization_factor = None
-
-    if use_image_for_variance:
-        variance = img
-        error_model = None
-    else:
-        variance = None
-
-    if not do_flatfield:
-        flatfield_image = None
-
-    if not do_darkcorrection:
-        dark_image = None
-
-    #Absolute scale values
-    abs_scale_water = raw_settings.get('NormAbsWater')
-    abs_scale_water_factor = float(raw_settings.get('NormAbsWaterConst'))
-    abs_scale_gc = raw_settings.get('NormAbsCarbon')
-    abs_scale_gc_ignore_bkg = raw_settings.get('NormAbsCarbonIgnoreBkg')
-    abs_scale_gc_factor = float(raw_settings.get('NormAbsCarbonConst'))
-
+def getCalibrationValues(raw_settings, img_hdr, file_hdr):
+    """
+    Gets the detector calibration values, taking them from the image or
+    file header when the settings say to.
+
+    Returns
+    -------
+    calibration: tuple
+        (sample detector distance, x pixel size, y pixel size, wavelength,
+        x center, y center, detector tilt, detector tilt plane rotation)
+    """
     sd_distance = raw_settings.get('SampleDistance')
     pixel_size_x = raw_settings.get('DetectorPixelSizeX')
     pixel_size_y = raw_settings.get('DetectorPixelSizeY')
     wavelength = raw_settings.get('WaveLength')
-    bin_size = int(raw_settings.get('Binsize'))
-    bin_type = raw_settings.get('BinType')
     x_c = float(raw_settings.get('Xcenter'))
     y_c = float(raw_settings.get('Ycenter'))
     det_tilt = raw_settings.get('DetectorTilt')
     det_tilt_plan_rot = raw_settings.get('DetectorTiltPlanRot')
 
-
-    # Load mask
-    if use_hdr_mask:
-        # ********************
-        # If the file is a SAXSLAB file, then get mask parameters from the header and modify the mask
-        # then apply it...
-        #
-        # Mask should be not be changed, but should be created here. If no mask information is found, then
-        # use the user created mask. There should be a force user mask setting.
-        #
-        # ********************
-        try:
-            mask_patches = SASMask.createMaskFromHdr(img, img_hdr, flipped = raw_settings.get('DetectorFlipped90'))
-            bs_mask_patches = mask_dict['BeamStopMask'][1]
-            tbs_mask = mask_dict['TransparentBSMask'][0]
-
-            if bs_mask_patches is not None:
-                all_mask_patches = mask_patches + bs_mask_patches
-            else:
-                all_mask_patches = mask_patches
-
-            bs_mask = SASMask.createMaskMatrix(img.shape, all_mask_patches)
-
-            if bs_mask is not None:
-                bs_mask = np.logical_not(bs_mask) #Invert mask for pyFAI
-
-        except KeyError:
-            raise SASExceptions.HeaderMaskLoadError('bsmask_configuration not found in header.')
-
-    else:
-        bs_mask = mask_dict['BeamStopMask'][2]
-        tbs_mask = mask_dict['TransparentBSMask'][0]
-
-    if bs_mask is None:
-        bs_mask = np.zeros(img.shape)
-
     # Get values from image header if applicable
-    if use_hdr_calib:
+    if raw_settings.get('UseHeaderForCalib'):
         result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr,
             keys=['Sample Detector Distance', 'Detector X Pixel Size',
             'Detector Y Pixel Size', 'Wavelength', 'Beam X Center',
@@ -286,206 +214,840 @@ def integrateCalibrateNormalize(img, parameters, raw_settings):
         if pixel_size_y < 1:
             pixel_size_y = pixel_size_y*1000
 
-    # ********* WARNING WARNING WARNING ****************#
-    # Hmm.. axes start from the lower left, but array coords starts
-    # from upper left:
-    #####################################################
-    y_c = img.shape[0]-y_c
+    return (sd_distance, pixel_size_x, pixel_size_y, wavelength, x_c, y_c,
+        det_tilt, det_tilt_plan_rot)
+
+class IntegrationPlan(object):
+    """
+    Everything needed to radially average images from one detector
+    configuration: the mask, geometry, corrections, binning and error model.
+    The plan reads the settings and sets up the integrator once, so that
+    integrating each image is just a pixel to q bin sparse matrix-vector
+    product. Plans should be obtained from :py:func:`getIntegrationPlan`,
+    which caches them by the settings, masks and geometry they use.
+    """
+
+    def __init__(self, raw_settings, img_shape, calibration, bs_mask=None):
+        """
+        Parameters
+        ----------
+        raw_settings: :class:`bioxtasraw.RAWSettings.RawGuiSettings`
+            The settings to use.
+        img_shape: tuple
+            The shape of the images to be integrated.
+        calibration: tuple
+            The calibration values, as returned by
+            :py:func:`getCalibrationValues`.
+        bs_mask: numpy.array, optional
+            A beamstop mask to use instead of the one in the settings, in
+            pyFAI format (nonzero values are masked).
+        """
+        self.img_shape = tuple(img_shape)
+        self.calibration = calibration
 
-    # Find the maximum distance to the edge in the image:
-    # img = np.float64(img)
-    ylen, xlen = img.shape
+        mask_dict = raw_settings.get('Masks')
 
-    xlen = int(xlen)
-    ylen = int(ylen)
-    maxlen1 = int(max(xlen - x_c, ylen - y_c, xlen - (xlen - x_c), ylen - (ylen - y_c)))
+        if bs_mask is None:
+            bs_mask = mask_dict['BeamStopMask'][2]
 
-    diag1 = int(np.sqrt((xlen-x_c)**2 + y_c**2))
-    diag2 = int(np.sqrt((x_c**2 + y_c**2)))
-    diag3 = int(np.sqrt((x_c**2 + (ylen-y_c)**2)))
-    diag4 = int(np.sqrt((xlen-x_c)**2 + (ylen-y_c)**2))
+        if bs_mask is None:
+            bs_mask = np.zeros(self.img_shape)
 
-    maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
+        self.bs_mask = bs_mask
 
-    if bin_type == 'Linear' and bin_size != 1:
-        npts = maxlen//bin_size
-    else:
-        npts = maxlen
+        tbs_mask = mask_dict['TransparentBSMask'][0]
 
+        if tbs_mask is not None:
+            self.roi_mask = tbs_mask == 1
+        else:
+            self.roi_mask = None
 
-    # Create radially averaged file metadata
-    parameters['normalizations'] = {}
-    if do_solidangle:
-        parameters['normalizations']['Solid_Angle_Correction'] = 'On'
-
-    parameters['normalizations']['Polarization'] = {'Used' : do_polarization}
-    if do_polarization:
-        parameters['normalizations']['Polarization']['Factor'] = polarization_factor
-
-    calibrate_dict = {'Sample_Detector_Distance'    : sd_distance,
-                    'Detector_X_Pixel_Size'         : pixel_size_x,
-                    'Detector_Y_Pixel_Size'         : pixel_size_y,
-                    'Wavelength'                    : wavelength,
-                    'Beam_Center_X'                 : x_c,
-                    'Beam_Center_Y'                 : y_c,
-                    'Detector Tilt'                 : det_tilt,
-                    'Detector Tilt Plane Rotation'  : det_tilt_plan_rot,
-                    'Radial_Average_Method'         : 'pyFAI',
-                    'Integration Method'            : integration_method,
-                    }
-
-    parameters['calibration_params'] = calibrate_dict
-    parameters['raw_version'] = RAWGlobals.version
-    parameters['config_file'] = raw_settings.get('CurrentCfg')
-
-    if raw_settings.get('EnableMetadata'):
-        meta_list = raw_settings.get('MetadataList')
-        if meta_list is not None and len(meta_list) > 0:
-            metadata = {key:value for (key, value) in meta_list}
-            parameters['metadata'] = metadata
+        self.normlist = raw_settings.get('NormalizationList')
+        self.do_normalization = (raw_settings.get('EnableNormalization')
+            and self.normlist is not None)
 
-    # Calculate the ROI if applicable
-    if tbs_mask is not None:
-        roi_counter = img[tbs_mask==1].sum()
-        parameters['counters']['roi_counter'] = roi_counter
+        do_flatfield = raw_settings.get('NormFlatfieldEnabled')
+        flatfield_image = raw_settings.get('NormFlatfieldImage')
+        do_darkcorrection = raw_settings.get('DarkCorrEnabled')
+        dark_image = raw_settings.get('DarkCorrImage')
 
-    all_norms_mult = True
-    norm_factor = 1.0
-    #Calculate the normalization parameter if applicable
-    if normlist is not None and do_normalization:
-        parameters['normalizations']['Counter_norms'] = normlist
+        do_solidangle = raw_settings.get('DoSolidAngleCorrection')
+        do_polarization = raw_settings.get('DoPolarizationCorrection')
+        polarization_factor = raw_settings.get('PolarizationFactor')
 
-        for op, expr in normlist:
-            if op != '/' and op != '*':
-                all_norms_mult = False
-                break
+        self.zinger_removal = raw_settings.get('ZingerRemovalRadAvg')
+        self.zinger_thres = raw_settings.get('ZingerRemovalRadAvgStd')
+        self.zinger_iter = raw_settings.get('ZingerRemovalRadAvgIter')
 
-            else:
-                val = calcExpression(expr, img_hdr, file_hdr)
+        self.integration_method = raw_settings.get('IntegrationMethod')
+        self.angular_unit = raw_settings.get('AngularUnit')
+        error_model = raw_settings.get('ErrorModel')
+        self.use_image_for_variance = raw_settings.get('UseImageForVariance')
 
-                if val is not None:
-                    val = float(val)
-                else:
-                    raise ValueError
-                if op == '/':
-                    if val == 0:
-                        raise ValueError('Divide by Zero when normalizing')
-                    else:
-                        norm_factor = norm_factor/val
+        if not do_polarization:
+            polarization_factor = None
 
-                elif op == '*':
-                    if val == 0:
-                       raise ValueError('Multiply by Zero when normalizing')
-                    else:
-                        norm_factor = norm_factor*val
+        if self.use_image_for_variance:
+            error_model = None
 
-        if not all_norms_mult:
-            norm_factor = 1.0
+        if not do_flatfield:
+            flatfield_image = None
 
-    if abs_scale_water:
-        parameters['normalizations']['Absolute_scale'] = {}
-        parameters['normalizations']['Absolute_scale']['Method'] = 'Water'
-        parameters['normalizations']['Absolute_scale']['Absolute_scale_factor'] = abs_scale_water_factor
+        if not do_darkcorrection:
+            dark_image = None
 
-        norm_factor = norm_factor * abs_scale_water_factor
+        self.error_model = error_model
 
-    elif abs_scale_gc and abs_scale_gc_ignore_bkg:
-        parameters['normalizations']['Absolute_scale'] = {}
-        parameters['normalizations']['Absolute_scale']['Method'] = 'Glassy_carbon'
-        parameters['normalizations']['Absolute_scale']['Ignore_background'] = True
-        parameters['normalizations']['Absolute_scale']['Absolute_scale_factor'] = abs_scale_gc_factor
+        #Absolute scale values
+        abs_scale_water = raw_settings.get('NormAbsWater')
+        abs_scale_water_factor = float(raw_settings.get('NormAbsWaterConst'))
+        abs_scale_gc = raw_settings.get('NormAbsCarbon')
+        abs_scale_gc_ignore_bkg = raw_settings.get('NormAbsCarbonIgnoreBkg')
+        abs_scale_gc_factor = float(raw_settings.get('NormAbsCarbonConst'))
 
-        norm_factor = norm_factor * abs_scale_gc_factor
+        self.bin_size = int(raw_settings.get('Binsize'))
+        self.bin_type = raw_settings.get('BinType')
 
-    # pyFAI expects a divisible normalization factor
-    norm_factor = 1./norm_factor
+        (sd_distance, pixel_size_x, pixel_size_y, wavelength, x_c, y_c,
+            det_tilt, det_tilt_plan_rot) = calibration
 
-    #Put everything in appropriate units
-    wavelength = wavelength*1e-10 #convert wl to m
+        # ********* WARNING WARNING WARNING ****************#
+        # Hmm.. axes start from the lower left, but array coords starts
+        # from upper left:
+        #####################################################
+        y_c = self.img_shape[0]-y_c
 
-    if ai is None:
+        # Find the maximum distance to the edge in the image:
+        ylen, xlen = self.img_shape
+
+        xlen = int(xlen)
+        ylen = int(ylen)
+        maxlen1 = int(max(xlen - x_c, ylen - y_c, xlen - (xlen - x_c), ylen - (ylen - y_c)))
+
+        diag1 = int(np.sqrt((xlen-x_c)**2 + y_c**2))
+        diag2 = int(np.sqrt((x_c**2 + y_c**2)))
+        diag3 = int(np.sqrt((x_c**2 + (ylen-y_c)**2)))
+        diag4 = int(np.sqrt((xlen-x_c)**2 + (ylen-y_c)**2))
+
+        maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
+
+        if self.bin_type == 'Linear' and self.bin_size != 1:
+            self.npts = maxlen//self.bin_size
+        else:
+            self.npts = maxlen
+
+        # Radially averaged file metadata that doesn't depend on the image
+        normalizations = {}
+        if do_solidangle:
+            normalizations['Solid_Angle_Correction'] = 'On'
+
+        normalizations['Polarization'] = {'Used' : do_polarization}
+        if do_polarization:
+            normalizations['Polarization']['Factor'] = polarization_factor
+
+        self.all_norms_mult = True
+        if self.do_normalization:
+            normalizations['Counter_norms'] = self.normlist
+
+            for op, expr in self.normlist:
+                if op != '/' and op != '*':
+                    self.all_norms_mult = False
+                    break
+
+        self.abs_scale_factor = 1.0
+
+        if abs_scale_water:
+            normalizations['Absolute_scale'] = {}
+            normalizations['Absolute_scale']['Method'] = 'Water'
+            normalizations['Absolute_scale']['Absolute_scale_factor'] = abs_scale_water_factor
+
+            self.abs_scale_factor = abs_scale_water_factor
+
+        elif abs_scale_gc and abs_scale_gc_ignore_bkg:
+            normalizations['Absolute_scale'] = {}
+            normalizations['Absolute_scale']['Method'] = 'Glassy_carbon'
+            normalizations['Absolute_scale']['Ignore_background'] = True
+            normalizations['Absolute_scale']['Absolute_scale_factor'] = abs_scale_gc_factor
+
+            self.abs_scale_factor = abs_scale_gc_factor
+
+        self.normalizations = normalizations
+
+        self.calibrate_dict = {'Sample_Detector_Distance'    : sd_distance,
+                        'Detector_X_Pixel_Size'         : pixel_size_x,
+                        'Detector_Y_Pixel_Size'         : pixel_size_y,
+                        'Wavelength'                    : wavelength,
+                        'Beam_Center_X'                 : x_c,
+                        'Beam_Center_Y'                 : y_c,
+                        'Detector Tilt'                 : det_tilt,
+                        'Detector Tilt Plane Rotation'  : det_tilt_plan_rot,
+                        'Radial_Average_Method'         : 'pyFAI',
+                        'Integration Method'            : self.integration_method,
+                        }
+
+        self.config_file = raw_settings.get('CurrentCfg')
+
+        self.metadata = None
+        if raw_settings.get('EnableMetadata'):
+            meta_list = raw_settings.get('MetadataList')
+            if meta_list is not None and len(meta_list) > 0:
+                self.metadata = {key:value for (key, value) in meta_list}
+
+        #Put everything in appropriate units
+        wavelength = wavelength*1e-10 #convert wl to m
+
+        # Each plan has its own integrator, so building or using a plan
+        # never changes the settings or another plan
         ai = pyFAI.azimuthalIntegrator.AzimuthalIntegrator()
         ai.set_wavelength(wavelength)
+        ai.setFit2D(sd_distance, x_c, y_c, det_tilt, det_tilt_plan_rot,
+            pixel_size_x, pixel_size_y)
 
-    if wavelength != ai.get_wavelength():
-        ai.set_wavelength(wavelength)
+        self.ai = ai
+
+        if pixel_size_x == pixel_size_y and self.angular_unit == 'q_A^-1':
+            qmin_theta = SASCalib.calcTheta(sd_distance*1e-3, pixel_size_x*1e-6, 0)
+            qmin = ((4 * math.pi * math.sin(qmin_theta)) / (wavelength*1e10))
+
+            qmax_theta = SASCalib.calcTheta(sd_distance*1e-3, pixel_size_x*1e-6, maxlen)
+            qmax = ((4 * math.pi * math.sin(qmax_theta)) / (wavelength*1e10))
+
+            self.q_range = (qmin, qmax)
+
+        else:
+            self.q_range = None
+
+        self.integration_kwargs = {
+            'mask'                  : self.bs_mask,
+            'correctSolidAngle'     : do_solidangle,
+            'error_model'           : self.error_model,
+            'unit'                  : self.angular_unit,
+            'radial_range'          : self.q_range,
+            'method'                : self.integration_method,
+            'polarization_factor'   : polarization_factor,
+            'flat'                  : flatfield_image,
+            'dark'                  : dark_image,
+            }
+
+        self._sparse_integrator = None
+        self._q = None
+
+        if not self.zinger_removal:
+            try:
+                self._setupSparseIntegrator(do_solidangle, polarization_factor,
+                    flatfield_image, dark_image)
+            except Exception:
+                # Older pyFAI versions or unusual configurations fall back
+                # to the standard pyFAI integration
+                self._sparse_integrator = None
+
+    def _setupSparseIntegrator(self, do_solidangle, polarization_factor,
+        flatfield_image, dark_image):
+        """
+        Builds the pixel to bin sparse matrix and the per pixel correction
+        arrays for the pyFAI CSR methods. Other methods are integrated
+        with the standard pyFAI call.
+        """
+        if (IntegrationMethod is None or ErrorModel is None
+            or self.error_model not in ('poisson', None)):
+            return
+
+        method = IntegrationMethod.select_one_available(self.integration_method,
+            dim=1, default=None, degradable=False)
+
+        if (method is None or method.algo_lower != 'csr'
+            or method.impl_lower != 'cython'):
+            return
+
+        unit = pyFAI.units.to_unit(self.angular_unit)
+
+        if self.q_range is not None:
+            pos0_range = (self.q_range[0]/unit.scale, self.q_range[1]/unit.scale)
+        else:
+            pos0_range = None
+
+        split = method.split_lower
+        if split == 'pseudo':
+            split = 'full'
+
+        mask = np.ascontiguousarray(self.bs_mask)
+
+        integrator = self.ai.setup_sparse_integrator(self.img_shape, self.npts,
+            mask, pos0_range, None, mask_checksum=zlib.crc32(mask), unit=unit,
+            split=split, algo='CSR', empty=self.ai.empty, scale=False)
+
+        if not hasattr(integrator, 'integrate_ng'):
+            return
+
+        if do_solidangle:
+            self._solidangle = self.ai.solidAngleArray(self.img_shape, True)
+        else:
+            self._solidangle = None
+
+        if polarization_factor is not None:
+            self._polarization = self.ai.polarization(self.img_shape,
+                polarization_factor)
+        else:
+            self._polarization = None
+
+        self._flat = flatfield_image
+        self._dark = dark_image
+        self._unit_scale = unit.scale
+        self._stack_matrices = None
+
+        if self.error_model == 'poisson':
+            self._error_model = ErrorModel.POISSON
+        else:
+            self._error_model = ErrorModel.VARIANCE
+
+        self._sparse_integrator = integrator
+
+    def integrate(self, img, norm_factor=1.0):
+        """
+        Radially averages an image.
+
+        Parameters
+        ----------
+        img: numpy.array
+            The image to integrate. Must have the plan's image shape.
+        norm_factor: float, optional
+            The normalization factor, the radially averaged intensity is
+            divided by this value.
+
+        Returns
+        -------
+        q: numpy.array
+            The q (or other angular unit) values.
+        iq: numpy.array
+            The radially averaged intensity.
+        errorbars: numpy.array
+            The uncertainty in the radially averaged intensity.
+        """
+        if self.use_image_for_variance:
+            variance = img
+        else:
+            variance = None
+
+        sparse = (self._sparse_integrator is not None and
+            (img.dtype.kind != 'f' or np.isfinite(img).all()))
+
+        if sparse:
+            res = self._sparse_integrator.integrate_ng(img, variance=variance,
+                error_model=self._error_model, dark=self._dark, flat=self._flat,
+                solidangle=self._solidangle, polarization=self._polarization,
+                normalization_factor=norm_factor)
+
+            q = res.position*self._unit_scale
+            iq = res.intensity
+            errorbars = res.sigma
+
+        else:
+            integration_kwargs = dict(self.integration_kwargs)
+            integration_kwargs['variance'] = variance
+
+            #Carry out the integration
+            if not self.zinger_removal:
+                integrate_func = self.ai.integrate1d
+                integration_kwargs['normalization_factor'] = norm_factor
+
+            else:
+                integrate_func = self.ai.sigma_clip_ng
+
+                integration_kwargs['thres'] = self.zinger_thres
+                integration_kwargs['max_iter'] = self.zinger_iter
+
+                #Necessary for the legacy version, hopefully the ng will be available soon
+                # del integration_kwargs['variance']
+                # del integration_kwargs['radial_range']
+                # del integration_kwargs['error_model']
+
+                #Don't pass normalization_factor, works around a bug that should be fixed in pyFAI 0.22
+
+            q, iq, errorbars = integrate_func(img, self.npts, **integration_kwargs)
+
+            if self.zinger_removal:
+                iq /= norm_factor
+                errorbars /= norm_factor
+
+        errorbars = np.nan_to_num(errorbars)
+
+        # Profiles integrated with the same plan share one q vector
+        if self._q is not None and np.array_equal(q, self._q):
+            q = self._q
+        else:
+            self._q = q
+
+        return q, iq, errorbars
+
+    def _getStackMatrices(self):
+        """
+        Makes the scipy sparse matrices used to integrate many images at
+        once from the pyFAI sparse integrator.
+        """
+        if self._stack_matrices is None:
+            integrator = self._sparse_integrator
+            npix = int(np.prod(self.img_shape))
+
+            coef = scipy.sparse.csr_matrix((np.asarray(integrator.data,
+                dtype=np.float64), np.asarray(integrator.indices),
+                np.asarray(integrator.indptr)), shape=(self.npts, npix))
+
+            pixel_norm = np.ones(npix)
+
+            for correction in (self._solidangle, self._polarization, self._flat):
+                if correction is not None:
+                    pixel_norm = pixel_norm*np.ravel(correction)
+
+            # Pixels pyFAI can't normalize are treated as masked
+            bad_pixels = np.logical_not(np.isfinite(pixel_norm)) | (pixel_norm == 0)
+            if self._dark is not None:
+                bad_pixels = bad_pixels | np.logical_not(np.isfinite(np.ravel(self._dark)))
+
+            if bad_pixels.any():
+                coef = coef.dot(scipy.sparse.diags(np.logical_not(bad_pixels).astype(np.float64)))
+                pixel_norm[bad_pixels] = 0
+
+            coef_sqr = coef.copy()
+            coef_sqr.data = coef_sqr.data**2
+
+            norm_sum = coef.dot(pixel_norm)
+
+            if self._dark is not None:
+                dark = np.ravel(self._dark).astype(np.float64)
+                dark[bad_pixels] = 0
+            else:
+                dark = None
+
+            q = np.asarray(integrator.bin_centers)*self._unit_scale
+
+            self._stack_matrices = (coef, coef_sqr, norm_sum, dark, q)
+
+        return self._stack_matrices
+
+    def integrateStack(self, imgs, norm_factors=1.0):
+        """
+        Radially averages a stack of images at once. For the sparse pyFAI
+        methods all of the images are integrated in a single sparse
+        matrix product, otherwise each image is integrated in turn. The
+        errors match those from :py:meth:`integrate` for each error model.
+
+        Parameters
+        ----------
+        imgs: numpy.array
+            The images, with shape (N, image rows, image columns).
+        norm_factors: float or numpy.array, optional
+            The normalization factor for each image (or one for all of them).
+            The radially averaged intensity is divided by this value.
+
+        Returns
+        -------
+        q: numpy.array
+            The q (or other angular unit) values.
+        iq: numpy.array
+            The radially averaged intensities, with shape (N, len(q)).
+        errorbars: numpy.array
+            The uncertainties, with shape (N, len(q)).
+        """
+        imgs = np.asarray(imgs)
+        nframes = imgs.shape[0]
+        norm_factors = np.broadcast_to(np.asarray(norm_factors,
+            dtype=np.float64), (nframes,))
+
+        # Without a variance image only the poisson error model can be
+        # calculated from the stack, the other models go through pyFAI
+        stack_errors = (self.use_image_for_variance
+            or self.error_model == 'poisson')
+
+        if self._sparse_integrator is None or nframes == 0 or not stack_errors:
+            results = [self.integrate(imgs[j], norm_factors[j])
+                for j in range(nframes)]
+
+            if nframes > 0:
+                q = results[0][0]
+                iq = np.vstack([res[1] for res in results])
+                errorbars = np.vstack([res[2] for res in results])
+            else:
+                q = np.array([])
+                iq = np.empty((0, 0))
+                errorbars = np.empty((0, 0))
+
+            return q, iq, errorbars
+
+        coef, coef_sqr, norm_sum, dark, q = self._getStackMatrices()
+
+        frames = imgs.reshape(nframes, -1)
+
+        if frames.dtype.kind == 'f':
+            finite = np.isfinite(frames).all(axis=1)
+        else:
+            finite = np.ones(nframes, dtype=bool)
+
+        iq = np.zeros((nframes, len(q)))
+        errorbars = np.zeros((nframes, len(q)))
+
+        good = np.flatnonzero(finite)
+
+        if len(good) > 0:
+            good_frames = frames[good].astype(np.float64)
+
+            if self.use_image_for_variance:
+                variance = good_frames.T
+            else:
+                variance = np.maximum(good_frames, 1.).T
+
+            sum_variance = coef_sqr.dot(variance).T
+
+            if dark is not None:
+                good_frames -= dark
+
+            sum_signal = coef.dot(good_frames.T).T
+
+            filled = norm_sum != 0
+            norm = norm_sum[filled]*norm_factors[good][:, None]
+
+            iq[np.ix_(good, filled)] = sum_signal[:, filled]/norm
+            errorbars[np.ix_(good, filled)] = np.sqrt(sum_variance[:, filled])/norm
+
+            empty = self.ai.empty
+            if empty != 0:
+                iq[:, np.logical_not(filled)] = empty
+                errorbars[:, np.logical_not(filled)] = empty
+
+        # Frames with nan or inf values are integrated with pyFAI
+        for j in np.flatnonzero(np.logical_not(finite)):
+            q, iq[j], errorbars[j] = self.integrate(imgs[j], norm_factors[j])
+
+        errorbars = np.nan_to_num(errorbars)
+
+        return q, iq, errorbars
+
+    def normalizationFactor(self, img_hdr, file_hdr):
+        """
+        Calculates the normalization factor for an image from the header
+        values, the normalization list and the absolute scale. Returns the
+        divisible factor that pyFAI expects.
+        """
+        norm_factor = 1.0
+
+        #Calculate the normalization parameter if applicable
+        if self.do_normalization:
+            for op, expr in self.normlist:
+                if op != '/' and op != '*':
+                    break
+
+                else:
+                    val = calcExpression(expr, img_hdr, file_hdr)
+
+                    if val is not None:
+                        val = float(val)
+                    else:
+                        raise ValueError
+                    if op == '/':
+                        if val == 0:
+                            raise ValueError('Divide by Zero when normalizing')
+                        else:
+                            norm_factor = norm_factor/val
+
+                    elif op == '*':
+                        if val == 0:
+                           raise ValueError('Multiply by Zero when normalizing')
+                        else:
+                            norm_factor = norm_factor*val
+
+            if not self.all_norms_mult:
+                norm_factor = 1.0
+
+        norm_factor = norm_factor * self.abs_scale_factor
+
+        # pyFAI expects a divisible normalization factor
+        return 1./norm_factor
+
+    def normalizationFactors(self, img_hdrs, file_hdrs):
+        """
+        Calculates the normalization factors for a stack of images, as for
+        :py:func:`normalizationFactor`, with each expression evaluated once
+        for the whole stack.
+        """
+        norm_factors = np.ones(len(img_hdrs))
+
+        if self.do_normalization:
+            for op, expr in self.normlist:
+                if op != '/' and op != '*':
+                    break
+
+                else:
+                    vals = calcExpressionStack(expr, img_hdrs, file_hdrs)
+
+                    if vals is None or not np.all(np.isfinite(vals)):
+                        raise ValueError
+
+                    if op == '/':
+                        if np.any(vals == 0):
+                            raise ValueError('Divide by Zero when normalizing')
+                        else:
+                            norm_factors = norm_factors/vals
+
+                    elif op == '*':
+                        if np.any(vals == 0):
+                           raise ValueError('Multiply by Zero when normalizing')
+                        else:
+                            norm_factors = norm_factors*vals
+
+            if not self.all_norms_mult:
+                norm_factors[:] = 1.0
+
+        norm_factors = norm_factors * self.abs_scale_factor
+
+        # pyFAI expects a divisible normalization factor
+        return 1./norm_factors
+
+    def setParameters(self, parameters):
+        """
+        Adds the integration metadata to the parameters of a new profile.
+        """
+        parameters['normalizations'] = copy.deepcopy(self.normalizations)
+        parameters['calibration_params'] = dict(self.calibrate_dict)
+        parameters['raw_version'] = RAWGlobals.version
+        parameters['config_file'] = self.config_file
+
+        if self.metadata is not None:
+            parameters['metadata'] = dict(self.metadata)
+
+_integration_plans = collections.OrderedDict()
+_integration_plans_lock = threading.Lock()
+_max_integration_plans = 8
+
+# The checksums of the mask, flatfield and dark arrays, by array object. The
+# settings replace these arrays when they change, so each array is only
+# checksummed once, not for every image.
+_array_keys = {}
+_array_keys_lock = threading.Lock()
+
+# The settings an integration plan is made from. The masks and the flatfield
+# and dark images are keyed on their contents instead.
+_plan_settings = ['NormalizationList', 'EnableNormalization',
+    'NormFlatfieldEnabled', 'DarkCorrEnabled', 'DoSolidAngleCorrection',
+    'DoPolarizationCorrection', 'PolarizationFactor', 'ZingerRemovalRadAvg',
+    'ZingerRemovalRadAvgStd', 'ZingerRemovalRadAvgIter', 'IntegrationMethod',
+    'AngularUnit', 'ErrorModel', 'UseImageForVariance', 'NormAbsWater',
+    'NormAbsWaterConst', 'NormAbsCarbon', 'NormAbsCarbonIgnoreBkg',
+    'NormAbsCarbonConst', 'Binsize', 'BinType', 'CurrentCfg',
+    'EnableMetadata', 'MetadataList']
+
+def _arrayKey(arr):
+    if arr is None:
+        return None
+
+    arr_id = id(arr)
+
+    with _array_keys_lock:
+        ref, key = _array_keys.get(arr_id, (None, None))
+
+    if ref is not None and ref() is arr:
+        return key
+
+    carr = np.ascontiguousarray(arr)
+    key = (carr.shape, carr.dtype.str, zlib.crc32(carr))
+
+    def remove(ref):
+        with _array_keys_lock:
+            if _array_keys.get(arr_id, (None,))[0] is ref:
+                del _array_keys[arr_id]
 
     try:
-        ai_settings = ai.getFit2D()
-        reinitialize_ai = not (round(ai_settings['directDist'], 6) == round(sd_distance, 6)
-            and round(ai_settings['centerX'], 6) == round(x_c, 6)
-            and round(ai_settings['centerY'], 6) == round(y_c, 6)
-            and round(ai_settings['tilt'], 6) == round(det_tilt, 6)
-            and round(ai_settings['tiltPlanRotation'], 6) == round(det_tilt_plan_rot, 6)
-            and round(ai.get_pixel2()*1e6, 6) == round(pixel_size_x, 6)
-            and round(ai.get_pixel1()*1e6, 6) == round(pixel_size_y, 6))
-    except Exception:
-        reinitialize_ai = True
+        ref = weakref.ref(arr, remove)
+    except TypeError:
+        return key
+
+    with _array_keys_lock:
+        _array_keys[arr_id] = (ref, key)
+
+    return key
+
+def _planKey(raw_settings, img_shape, calibration, bs_mask):
+    """
+    Makes the cache key for an integration plan from everything the plan
+    uses, so that a plan is only reused when it would be made the same way.
+    """
+    mask_dict = raw_settings.get('Masks')
+
+    if bs_mask is None:
+        bs_mask = mask_dict['BeamStopMask'][2]
+
+    key = [img_shape, calibration, _arrayKey(bs_mask),
+        _arrayKey(mask_dict['TransparentBSMask'][0])]
+
+    key.extend(repr(raw_settings.get(setting)) for setting in _plan_settings)
+
+    if raw_settings.get('NormFlatfieldEnabled'):
+        key.append(_arrayKey(raw_settings.get('NormFlatfieldImage')))
+
+    if raw_settings.get('DarkCorrEnabled'):
+        key.append(_arrayKey(raw_settings.get('DarkCorrImage')))
+
+    return tuple(key)
+
+def getIntegrationPlan(raw_settings, img_shape, calibration, bs_mask=None):
+    """
+    Gets the integration plan for the given settings, image shape and
+    calibration. Plans are cached by the masks, geometry and integration
+    settings they use, so a new plan is made whenever any of those change.
+    The contents of a mask, flatfield or dark image array are only read the
+    first time the array is used, so if one is changed in place, rather than
+    replaced, :py:func:`clearIntegrationPlans` must be called.
+
+    Parameters
+    ----------
+    raw_settings: :class:`bioxtasraw.RAWSettings.RawGuiSettings`
+        The settings to use.
+    img_shape: tuple
+        The shape of the images to be integrated.
+    calibration: tuple
+        The calibration values, as returned by
+        :py:func:`getCalibrationValues`.
+    bs_mask: numpy.array, optional
+        A beamstop mask to use instead of the one in the settings, such as
+        a mask created from the image header.
+
+    Returns
+    -------
+    plan: :class:`IntegrationPlan`
+        The integration plan.
+    """
+    img_shape = tuple(img_shape)
+
+    key = _planKey(raw_settings, img_shape, calibration, bs_mask)
+
+    with _integration_plans_lock:
+        plan = _integration_plans.get(key, None)
+
+        if plan is None:
+            plan = IntegrationPlan(raw_settings, img_shape, calibration,
+                bs_mask)
+
+            _integration_plans[key] = plan
+
+            while len(_integration_plans) > _max_integration_plans:
+                _integration_plans.popitem(last=False)
+
+        else:
+            _integration_plans.move_to_end(key)
+
+    return plan
+
+def clearIntegrationPlans():
+    """
+    Clears all of the cached integration plans, and the stored checksums of
+    the mask, flatfield and dark image arrays.
+    """
+    with _integration_plans_lock:
+        _integration_plans.clear()
+
+    with _array_keys_lock:
+        _array_keys.clear()
+
+def integrateCalibrateNormalize(img, parameters, raw_settings):
+    use_hdr_config = raw_settings.get('UseHeaderForConfig')
+
+    img_hdr = parameters['imageHeader']
+    file_hdr = parameters['counters']
+
+    # Loads a different configuration file based on definition in the image header
+    if use_hdr_config:
+        prefix = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Config Prefix'])[0]
+
+        if prefix is None:
+           raise SASExceptions.ImageLoadError(['"Use header for new config load" is enabled in General Settings.\n',
+                                               'The binding "Config Prefix" was however not found in header,',
+                                               'not set in header options (See "Image/Header Format" in options) or not a number.'])
+        else:
+            prefix = str(int(prefix))
 
-    if reinitialize_ai:
-        ai.setFit2D(sd_distance, x_c, y_c, det_tilt, det_tilt_plan_rot, pixel_size_x,
-            pixel_size_y)
+        settings_folder = raw_settings.get('HdrLoadConfigDir')
+
+        # If the folder is not set.. look in the folder where the image is
+        if settings_folder == 'None' or settings_folder == '':
+            settings_folder, fname = os.path.split(parameters['load_path'])
+
+        settings_path = os.path.join(settings_folder, str(prefix) + '.cfg')
+
+        if not os.path.exists(settings_path):
+            raise SASExceptions.ImageLoadError(['"Use header for new config load" is enabled in General Settings.\n',
+                                                'Config file ' + settings_path + ' does not exist.',
+                                                'Check the path in the "General Settings" options. Clear the field to make RAW look for the config file in the same folder as the image.'])
 
-        raw_settings.set('AzimuthalIntegrator', ai)
+        RAWSettings.loadSettings(raw_settings, settings_path, auto_load = True)
 
-    if pixel_size_x == pixel_size_y and angular_unit == 'q_A^-1':
-        qmin_theta = SASCalib.calcTheta(sd_distance*1e-3, pixel_size_x*1e-6, 0)
-        qmin = ((4 * math.pi * math.sin(qmin_theta)) / (wavelength*1e10))
+        mask_dict = raw_settings.get('Masks')
+        img_dim = raw_settings.get('MaskDimension')
 
-        qmax_theta = SASCalib.calcTheta(sd_distance*1e-3, pixel_size_x*1e-6, maxlen)
-        qmax = ((4 * math.pi * math.sin(qmax_theta)) / (wavelength*1e10))
+        #Create the masks
+        for each_key in mask_dict:
+            masks = mask_dict[each_key][1]
 
-        q_range = (qmin, qmax)
+            if masks is not None:
+                mask_img = SASMask.createMaskMatrix(img_dim, masks)
+                mask_param = mask_dict[each_key]
+                mask_param[0] = mask_img
+                mask_param[1] = masks
+                mask_param[2] = np.logical_not(mask_img)
 
     else:
-        q_range = None
-
-    integration_kwargs = {
-        'mask'                  : bs_mask,
-        'variance'              : variance,
-        'correctSolidAngle'     : do_solidangle,
-        'error_model'           : error_model,
-        'unit'                  : angular_unit,
-        'radial_range'          : q_range,
-        'method'                : integration_method,
-        'normalization_factor'  : norm_factor,
-        'polarization_factor'   : polarization_factor,
-        'flat'                  : flatfield_image,
-        'dark'                  : dark_image,
-        }
-
-    #Carry out the integration
-    if not zinger_removal:
-        integrate_func = ai.integrate1d
+        mask_dict = raw_settings.get('Masks')
+
+    # Load mask
+    if raw_settings.get('UseHeaderForMask'):
+        # ********************
+        # If the file is a SAXSLAB file, then get mask parameters from the header and modify the mask
+        # then apply it...
+        #
+        # Mask should be not be changed, but should be created here. If no mask information is found, then
+        # use the user created mask. There should be a force user mask setting.
+        #
+        # ********************
+        try:
+            mask_patches = SASMask.createMaskFromHdr(img, img_hdr, flipped = raw_settings.get('DetectorFlipped90'))
+            bs_mask_patches = mask_dict['BeamStopMask'][1]
+
+            if bs_mask_patches is not None:
+                all_mask_patches = mask_patches + bs_mask_patches
+            else:
+                all_mask_patches = mask_patches
+
+            bs_mask = SASMask.createMaskMatrix(img.shape, all_mask_patches)
+
+            if bs_mask is not None:
+                bs_mask = np.logical_not(bs_mask) #Invert mask for pyFAI
+
+        except KeyError:
+            raise SASExceptions.HeaderMaskLoadError('bsmask_configuration not found in header.')
 
     else:
-        integrate_func = ai.sigma_clip_ng
+        bs_mask = None
 
-        integration_kwargs['thres'] = zinger_thres
-        integration_kwargs['max_iter'] = zinger_iter
+    calibration = getCalibrationValues(raw_settings, img_hdr, file_hdr)
 
-        #Necessary for the legacy version, hopefully the ng will be available soon
-        # del integration_kwargs['variance']
-        # del integration_kwargs['radial_range']
-        # del integration_kwargs['error_model']
+    plan = getIntegrationPlan(raw_settings, img.shape, calibration, bs_mask)
 
-        del integration_kwargs['normalization_factor'] #Work around a bug that should be fixed in pyFAI 0.22
+    # Create radially averaged file metadata
+    plan.setParameters(parameters)
 
-    q, iq, errorbars = integrate_func(img, npts, **integration_kwargs)
+    # Calculate the ROI if applicable
+    if plan.roi_mask is not None:
+        roi_counter = img[plan.roi_mask].sum()
+        parameters['counters']['roi_counter'] = roi_counter
 
-    if zinger_removal:
-        iq /= norm_factor
-        errorbars /= norm_factor
+    norm_factor = plan.normalizationFactor(img_hdr, file_hdr)
 
-    errorbars = np.nan_to_num(errorbars)
+    q, iq, errorbars = plan.integrate(img, norm_factor)
 
-    sasm = SASM.SASM(iq, q, errorbars, parameters)
+    sasm = SASM.SASM(iq, q, errorbars, parameters, copy_data=False)
 
     img_hdr = sasm.getParameter('imageHeader')
     file_hdr = sasm.getParameter('counters')
 
-    if normlist is not None and do_normalization and not all_norms_mult:
-        for each in normlist:
+    if plan.do_normalization and not plan.all_norms_mult:
+        for each in plan.normlist:
             op, expr = each
 
             val = calcExpression(expr, img_hdr, file_hdr)
@@ -513,7 +1075,138 @@ def integrateCalibrateNormalize(img, parameters, raw_settings):
             elif op == '-':
                 sasm.offsetRawIntensity(-val)
 
-    if bin_type == 'Log10' and bin_size != 1:
-        sasm = SASProc.logBinning(sasm, len(q)//bin_size)
+    if plan.bin_type == 'Log10' and plan.bin_size != 1:
+        sasm = SASProc.logBinning(sasm, len(q)//plan.bin_size)
 
     return sasm
+
+def integrateImageStack(imgs, raw_settings, img_hdrs=None, file_hdrs=None):
+    """
+    Radially averages, calibrates and normalizes a stack of images with the
+    same settings in one pass, returning arrays instead of profiles. Frames
+    are grouped by their calibration values, so each group is integrated
+    with a single integration plan.
+
+    Parameters
+    ----------
+    imgs: numpy.array
+        The images, with shape (N, image rows, image columns).
+    raw_settings: :class:`bioxtasraw.RAWSettings.RawGuiSettings`
+        The settings to use.
+    img_hdrs: list, optional
+        The image header for each image. Used for calibration and
+        normalization values.
+    file_hdrs: list, optional
+        The counters for each image. Used for calibration and normalization
+        values.
+
+    Returns
+    -------
+    q: numpy.array
+        The q values.
+    iq: numpy.array
+        The radially averaged intensities, with shape (N, len(q)).
+    errorbars: numpy.array
+        The uncertainties, with shape (N, len(q)).
+    """
+    if raw_settings.get('UseHeaderForConfig') or raw_settings.get('UseHeaderForMask'):
+        raise SASExceptions.ImageLoadError(['Image stacks can\'t be integrated '
+            'when loading the configuration or mask from the image header.'])
+
+    imgs = np.asarray(imgs)
+    nframes = imgs.shape[0]
+
+    if img_hdrs is None:
+        img_hdrs = [{} for j in range(nframes)]
+    if file_hdrs is None:
+        file_hdrs = [{} for j in range(nframes)]
+
+    groups = collections.OrderedDict()
+
+    for j in range(nframes):
+        calibration = getCalibrationValues(raw_settings, img_hdrs[j], file_hdrs[j])
+        groups.setdefault(calibration, []).append(j)
+
+    q = None
+    iq = None
+    errorbars = None
+
+    for calibration, index in groups.items():
+        plan = getIntegrationPlan(raw_settings, imgs.shape[1:], calibration)
+
+        group_img_hdrs = [img_hdrs[j] for j in index]
+        group_file_hdrs = [file_hdrs[j] for j in index]
+
+        norm_factors = plan.normalizationFactors(group_img_hdrs, group_file_hdrs)
+
+        if len(index) == nframes:
+            group_imgs = imgs
+        else:
+            group_imgs = imgs[index]
+
+        group_q, group_iq, group_err = plan.integrateStack(group_imgs,
+            norm_factors)
+
+        if plan.do_normalization and not plan.all_norms_mult:
+            for op, expr in plan.normlist:
+                vals = calcExpressionStack(expr, group_img_hdrs, group_file_hdrs)
+
+                if vals is None or not np.all(np.isfinite(vals)):
+                    raise ValueError
+
+                vals = vals[:, np.newaxis]
+
+                if op == '/':
+                    if np.any(vals == 0):
+                        raise ValueError('Divide by Zero when normalizing')
+
+                    group_iq = group_iq/vals
+                    group_err = group_err/vals
+
+                elif op == '+':
+                    group_iq = group_iq + vals
+
+                elif op == '*':
+                    if np.any(vals == 0):
+                       raise ValueError('Multiply by Zero when normalizing')
+
+                    group_iq = group_iq*vals
+                    group_err = group_err*vals
+
+                elif op == '-':
+                    group_iq = group_iq - vals
+
+        if plan.bin_type == 'Log10' and plan.bin_size != 1:
+            binned_iq = []
+            binned_err = []
+
+            for row in range(len(index)):
+                sasm = SASM.SASM(group_iq[row], group_q, group_err[row], {})
+                sasm = SASProc.logBinning(sasm, len(group_q)//plan.bin_size,
+                    copy_params=False)
+
+                binned_iq.append(sasm.getI())
+                binned_err.append(sasm.getErr())
+
+            group_q = sasm.getQ()
+            group_iq = np.vstack(binned_iq)
+            group_err = np.vstack(binned_err)
+
+        if q is None:
+            q = group_q
+            iq = np.empty((nframes, len(q)))
+            errorbars = np.empty((nframes, len(q)))
+
+        elif len(group_q) != len(q) or not np.allclose(group_q, q):
+            raise SASExceptions.DataNotCompatible('The images in the stack '
+                'have calibrations that give different q vectors.')
+
+        iq[index] = group_iq
+        errorbars[index] = group_err
+
+    if q is None:
+        q = np.array([])
+        iq = np.empty((0, 0))
+        errorbars = np.empty((0, 0))
+
+    return q, iq, errorbars
@@ -41,6 +41,209 @@ if raw_path not in os.sys.path:
 import bioxtasraw.SASExceptions as SASExceptions
 
 
+class Metadata(dict):
+    """
+    Copy-on-write dictionary used for the metadata parameters of profiles
+    and IFTs. Copying it (with copy.copy, copy.deepcopy, or :func:`share`)
+    only shares the values of the keys the API treats as read-only
+    (:attr:`shared_keys`: headers, counters and history), all other values
+    are deep copied as usual. A shared value that can be changed in place
+    is only copied, in whichever dictionary it is accessed from, the first
+    time it is accessed. So headers, counters and history that are copied
+    from profile to profile but never looked at are never copied. Shared
+    dictionaries are copied one level at a time, as a new Metadata that
+    shares all of its values.
+
+    Values that aren't shared behave exactly as in a regular dictionary.
+    Metadata pickles as a regular dictionary.
+    """
+
+    #: Keys whose values are shared, rather than copied, between copies
+    shared_keys = frozenset(['imageHeader', 'fileHeader', 'counters',
+        'history'])
+
+    __slots__ = ('_shared', '_share_all')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._shared = set()
+        self._share_all = False
+
+    @classmethod
+    def share_dict(cls, d, keys=None, share_all=None):
+        """
+        Makes a new Metadata that shares the values of the input dictionary
+        for the read-only keys, and deep copies all other values. If d is a
+        Metadata, the shared values are also copied on access in d. If d is
+        a regular dictionary, its shared values must not be changed in place
+        afterwards.
+
+        Parameters
+        ----------
+        d: dict
+            The dictionary to share.
+        keys: list, optional
+            The keys to share. By default all keys are shared.
+        share_all: bool, optional
+            Whether the values of all keys are shared, rather than just
+            those in :attr:`shared_keys`. This is used for dictionaries
+            nested in a read-only value. By default this is the same as
+            for d, or False if d is a regular dictionary.
+
+        Returns
+        -------
+        metadata: :class:`Metadata`
+            The new dictionary.
+        """
+        if share_all is None:
+            share_all = isinstance(d, Metadata) and d._share_all
+
+        if keys is None:
+            keys = list(dict.keys(d))
+
+        new = cls()
+        new._share_all = share_all
+
+        for key in keys:
+            value = dict.__getitem__(d, key)
+
+            if new._can_share(key):
+                dict.__setitem__(new, key, value)
+                new._shared.add(key)
+
+                if isinstance(d, Metadata):
+                    d._shared.add(key)
+            else:
+                dict.__setitem__(new, key, copy.deepcopy(value))
+
+        return new
+
+    def share(self, keys=None):
+        """
+        Returns a copy of the dictionary, or of just the specified keys,
+        which shares the read-only values with this dictionary until they
+        are accessed.
+        """
+        return Metadata.share_dict(self, keys)
+
+    def peek(self, key):
+        """
+        Returns the value for the key without copying it, for reading only.
+        The returned value must not be changed in place. For a read-only
+        key the value is marked as shared, so it is copied the next time it
+        is accessed through the dictionary, and the caller may keep a
+        reference to it. For other keys the caller must copy the value to
+        keep it.
+        """
+        if self._can_share(key):
+            self._shared.add(key)
+
+        return dict.__getitem__(self, key)
+
+    def _can_share(self, key):
+        return self._share_all or key in self.shared_keys
+
+    def _own(self, key):
+        value = dict.__getitem__(self, key)
+
+        if key in self._shared:
+            if isinstance(value, dict):
+                value = Metadata.share_dict(value, share_all=True)
+            else:
+                value = copy.deepcopy(value)
+
+            dict.__setitem__(self, key, value)
+            self._shared.discard(key)
+
+        return value
+
+    def __getitem__(self, key):
+        return self._own(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._own(key)
+        else:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self._own(key)
+        else:
+            self[key] = default
+            return default
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self._own(key)
+            dict.__delitem__(self, key)
+            return value
+        else:
+            return dict.pop(self, key, *args)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+
+        key = next(reversed(self))
+
+        return key, self.pop(key)
+
+    def __setitem__(self, key, value):
+        self._shared.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._shared.discard(key)
+
+    def update(self, *args, **kwargs):
+        if len(args) == 1 and isinstance(args[0], Metadata):
+            other = args[0]
+            for key in other:
+                if self._can_share(key):
+                    dict.__setitem__(self, key, other.peek(key))
+                    self._shared.add(key)
+                else:
+                    self[key] = copy.deepcopy(dict.__getitem__(other, key))
+        else:
+            for key, value in dict(*args).items():
+                self[key] = value
+
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._shared.clear()
+
+    def values(self):
+        for key in list(self._shared):
+            self._own(key)
+
+        return dict.values(self)
+
+    def items(self):
+        for key in list(self._shared):
+            self._own(key)
+
+        return dict.items(self)
+
+    def copy(self):
+        return self.share()
+
+    def __copy__(self):
+        return self.share()
+
+    def __deepcopy__(self, memo):
+        new = self.share()
+        memo[id(self)] = new
+        return new
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
 class SASM(object):
     """
     Small Angle Scattering Measurement (SASM) Object. Essentially a
@@ -62,7 +265,7 @@ class SASM(object):
         :func:`setQrange`. Typically only used with SANS data.
     """
 
-    def __init__(self, i, q, err, parameters, q_err=None):
+    def __init__(self, i, q, err, parameters, q_err=None, copy_data=True):
         """
         Constructor
 
@@ -79,13 +282,36 @@ class SASM(object):
             least {'filename': filename_with_no_path}. Other reserved keys are:
             'counters' : [(countername, value),...] Info from counter files
             'fileHeader' : [(label, value),...] Info from the header in the
-            loaded file
+            loaded file. A regular dictionary is stored as a
+            :class:`Metadata` with the same values.
+        q_err: numpy.array, optional
+            The q error vector.
+        copy_data: bool, optional
+            If True (default), the input vectors are copied. If False, the
+            profile uses the input arrays as they are, so they can be shared
+            with the caller and with other profiles (for example, one q
+            vector for all of the profiles from an integration). The
+            profile never changes shared arrays in place, and the scaled
+            vectors are the same arrays as the raw vectors until a scale,
+            offset, or q scale is applied. The caller must not change the
+            arrays in place while the profile uses them.
         """
 
         #Raw intensity variables
-        self._i_raw = np.array(i)
-        self._q_raw = np.array(q)
-        self._err_raw = np.array(err)
+        self._shared_data = not copy_data
+
+        if copy_data:
+            self._i_raw = np.array(i)
+            self._q_raw = np.array(q)
+            self._err_raw = np.array(err)
+        else:
+            self._i_raw = np.asarray(i)
+            self._q_raw = np.asarray(q)
+            self._err_raw = np.asarray(err)
+
+        if not isinstance(parameters, Metadata):
+            parameters = Metadata(parameters)
+
         self._parameters = parameters
 
 
@@ -99,15 +325,24 @@ class SASM(object):
             self._parameters['unit'] = ''
 
         #Modified intensity variables
-        self.i = self._i_raw.copy()
-        self.q = self._q_raw.copy()
-        self.err = self._err_raw.copy()
+        if copy_data:
+            self.i = self._i_raw.copy()
+            self.q = self._q_raw.copy()
+            self.err = self._err_raw.copy()
+        else:
+            self.i = self._i_raw
+            self.q = self._q_raw
+            self.err = self._err_raw
 
         #For SANS data with a qerr column
         try:
             if q_err is not None:
-                self._q_err_raw = np.array(q_err)
-                self.q_err = self._q_err_raw.copy()
+                if copy_data:
+                    self._q_err_raw = np.array(q_err)
+                    self.q_err = self._q_err_raw.copy()
+                else:
+                    self._q_err_raw = np.asarray(q_err)
+                    self.q_err = self._q_err_raw
             else:
                 self._q_err_raw = None
                 self.q_err = None
@@ -128,28 +363,15 @@ class SASM(object):
         self.is_plotted = False
         self._selected_q_range = (0, len(self._q_raw))
 
-        #Calculated values
-        try:
-            if len(self.q)>0:
-                self.total_intensity = np.trapz(self.getI(), self.getQ())
-                self.mean_intensity = self.getI().mean()
-            else:
-                self.total_intensity = -1
-                self.mean_intensity = -1
-
-        except Exception as e:
-            print(e)
-            self.total_intensity = -1
-            self.mean_intensity = -1
+        #Calculated values, computed when first used
+        self._total_intensity = None
+        self._mean_intensity = None
 
     def __deepcopy__(self, memo):
-        #Raw intensity variables
-        i_raw = copy.deepcopy(self._i_raw, memo)
-        q_raw = copy.deepcopy(self._q_raw, memo)
-        err_raw = copy.deepcopy(self._err_raw, memo)
+        #Raw intensity variables, which are copied by the constructor
         parameters = copy.deepcopy(self._parameters, memo)
 
-        newsasm = SASM(i_raw, q_raw, err_raw, parameters)
+        newsasm = SASM(self._i_raw, self._q_raw, self._err_raw, parameters)
 
         newsasm.setQrange(copy.deepcopy(self.getQrange(), memo))
         newsasm.setRawQErr(copy.deepcopy(self._q_err_raw, memo))
@@ -167,12 +389,9 @@ class SASM(object):
         Creates a deep copy of the SAMS without the metadata, which will usually
         be faster.
         """
-        i_raw = copy.deepcopy(self._i_raw)
-        q_raw = copy.deepcopy(self._q_raw)
-        err_raw = copy.deepcopy(self._err_raw)
         parameters = {'filename': copy.deepcopy(self.getParameter('filename'))}
 
-        newsasm = SASM(i_raw, q_raw, err_raw, parameters)
+        newsasm = SASM(self._i_raw, self._q_raw, self._err_raw, parameters)
 
         newsasm.setQrange(copy.deepcopy(self.getQrange()))
         newsasm.setRawQErr(copy.deepcopy(self._q_err_raw))
@@ -188,12 +407,25 @@ class SASM(object):
     def _update(self):
         ''' updates modified intensity after scale, normalization and offset changes '''
 
-        self.i = (self._i_raw * self._scale_factor) + self._offset_value
-        self.err = self._err_raw * abs(self._scale_factor)
-        self.q = self._q_raw * self._q_scale_factor
+        if (self._shared_data and self._scale_factor == 1
+            and self._offset_value == 0):
+            self.i = self._i_raw
+            self.err = self._err_raw
+        else:
+            self.i = (self._i_raw * self._scale_factor) + self._offset_value
+            self.err = self._err_raw * abs(self._scale_factor)
 
-        if self._q_err_raw is not None:
-            self.q_err = self._q_err_raw*self._q_scale_factor
+        if self._shared_data and self._q_scale_factor == 1:
+            self.q = self._q_raw
+
+            if self._q_err_raw is not None:
+                self.q_err = self._q_err_raw
+
+        else:
+            self.q = self._q_raw * self._q_scale_factor
+
+            if self._q_err_raw is not None:
+                self.q_err = self._q_err_raw*self._q_scale_factor
 
         # print self.err_line
 
@@ -216,19 +448,45 @@ class SASM(object):
             # Update the error bars
             barlinecols[0].set_segments(list(zip(list(zip(x,y-yerr)), list(zip(x,y+yerr)))))
 
-        #Calculated values
+        #Calculated values, computed when first used
+        self._total_intensity = None
+        self._mean_intensity = None
+
+    def _calcIntensities(self):
         try:
             if len(self.q)>0:
-                self.total_intensity = np.trapz(self.getI(), self.getQ())
-                self.mean_intensity = self.getI().mean()
+                self._total_intensity = np.trapz(self.getI(), self.getQ())
+                self._mean_intensity = self.getI().mean()
             else:
-                self.total_intensity = -1
-                self.mean_intensity = -1
+                self._total_intensity = -1
+                self._mean_intensity = -1
 
         except Exception as e:
             print(e)
-            self.total_intensity = -1
-            self.mean_intensity = -1
+            self._total_intensity = -1
+            self._mean_intensity = -1
+
+    @property
+    def total_intensity(self):
+        if self._total_intensity is None:
+            self._calcIntensities()
+
+        return self._total_intensity
+
+    @total_intensity.setter
+    def total_intensity(self, value):
+        self._total_intensity = value
+
+    @property
+    def mean_intensity(self):
+        if self._mean_intensity is None:
+            self._calcIntensities()
+
+        return self._mean_intensity
+
+    @mean_intensity.setter
+    def mean_intensity(self, value):
+        self._mean_intensity = value
 
     def getScale(self):
         """
@@ -252,6 +510,17 @@ class SASM(object):
         """
         return self._offset_value
 
+    def getQScale(self):
+        """
+        Returns the q scale factor for the profile.
+
+        Returns
+        -------
+        q_scale: float
+            The q scale factor.
+        """
+        return self._q_scale_factor
+
     def getLine(self):
         """
         Returns the plotted line for the profile. Only used in the RAW GUI.
@@ -395,19 +664,8 @@ class SASM(object):
         else:
             self._selected_q_range = list(map(int, qrange))
 
-            try:
-                if len(self.q)>0:
-                    self.total_intensity = np.trapz(self.getI(), self.getQ())
-                    self.mean_intensity = self.getI().mean()
-                else:
-                    self.total_intensity = -1
-                    self.mean_intensity = -1
-
-            except Exception as e:
-                print(e)
-                self.total_intensity = -1
-                self.mean_intensity = -1
-
+            self._total_intensity = None
+            self._mean_intensity = None
 
     def getQrange(self):
         """
@@ -432,6 +690,9 @@ class SASM(object):
         new_parameters: dict
             A dictionary containing the new parameters.
         """
+        if not isinstance(new_parameters, Metadata):
+            new_parameters = Metadata(new_parameters)
+
         self._parameters = new_parameters
 
     def getAllParameters(self):
@@ -507,6 +768,9 @@ class SASM(object):
         stds: The standard deviation threshold used to detect spikes.
         """
 
+        if self._shared_data:
+            self._i_raw = self._i_raw.copy()
+
         intensity = self._i_raw
 
         for i in range(window_length + start_idx, len(intensity)):
@@ -644,6 +908,49 @@ class SASM(object):
         self._q_scale_factor = q_scale_factor
         self._update()
 
+    def setScaledValues(self, i, err, q, scale_factor, offset_value, qrange,
+        mean_intensity, total_intensity):
+        """
+        Sets the already scaled intensity, error, and q vectors along with
+        the derived mean and total intensity. Used by series objects that
+        scale many profiles at once, so that the profile doesn't have to
+        recalculate values that were computed for the whole series. The
+        raw vectors are not changed.
+
+        Parameters
+        ----------
+        i: numpy.array
+            The scaled and offset intensity vector.
+        err: numpy.array
+            The scaled error vector.
+        q: numpy.array
+            The scaled q vector.
+        scale_factor: float
+            The scale factor used to generate the intensity and error.
+        offset_value: float
+            The offset used to generate the intensity.
+        qrange: tuple or list
+            The q range, as for :func:`setQrange`.
+        mean_intensity: float
+            The mean intensity in the q range.
+        total_intensity: float
+            The total intensity in the q range.
+        """
+        self._scale_factor = scale_factor
+        self._offset_value = offset_value
+
+        self.i = i
+        self.err = err
+        self.q = q
+
+        if self._q_err_raw is not None:
+            self.q_err = self._q_err_raw*self._q_scale_factor
+
+        self._selected_q_range = list(map(int, qrange))
+
+        self.mean_intensity = mean_intensity
+        self.total_intensity = total_intensity
+
     def scaleRawIntensity(self, scale):
         """
         Scales the raw intensity and error values. These are the intensity and
@@ -857,6 +1164,166 @@ class SASM(object):
         return q_err
 
 
+class ProfileStack(object):
+    """
+    A stack of scattering profiles that share a single q vector, such as the
+    frames of a series or the output of
+    :py:func:`bioxtasraw.RAWAPI.integrate_image_stack`. The intensities and
+    uncertainties of all of the profiles are held as (N, len(q)) arrays, so
+    that processing (see :py:func:`bioxtasraw.SASProc.subtractStack`,
+    :py:func:`bioxtasraw.SASProc.rebinStack`, and
+    :py:func:`bioxtasraw.SASProc.weightedAverageStack`) is done on the whole
+    stack at once. Individual profiles are only made as SASM objects when
+    they are requested.
+
+    Attributes
+    ----------
+    q: numpy.array
+        The q vector shared by all of the profiles.
+    i: numpy.array
+        The intensities of the profiles, with shape (N, len(q)).
+    err: numpy.array
+        The uncertainties of the profiles, with shape (N, len(q)).
+    q_err: numpy.array
+        The q error vector shared by all of the profiles, or None.
+    """
+
+    def __init__(self, i, q, err, parameters, q_err=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        i: numpy.array
+            The intensities, with shape (N, len(q)).
+        q: numpy.array
+            The q vector.
+        err: numpy.array
+            The uncertainties, with shape (N, len(q)).
+        parameters: list
+            A list of N metadata dictionaries, one for each profile, as for
+            the parameters of a :class:`SASM`. Each should contain at least
+            {'filename': filename_with_no_path}.
+        q_err: numpy.array, optional
+            The q error vector.
+
+        The input arrays are not copied. Profiles made from the stack use
+        the stack arrays, so they must not be changed in place.
+        """
+
+        self.q = np.asarray(q)
+        self.i = np.asarray(i)
+        self.err = np.asarray(err)
+
+        if q_err is not None:
+            self.q_err = np.asarray(q_err)
+        else:
+            self.q_err = None
+
+        if (self.i.ndim != 2 or self.i.shape != self.err.shape
+            or self.i.shape[1] != len(self.q) or len(parameters) != len(self.i)):
+            raise SASExceptions.DataNotCompatible('The stack intensities, '
+                'uncertainties, q vector, and parameters have different '
+                'sizes.')
+
+        self._parameters = [params if isinstance(params, Metadata)
+            else Metadata(params) for params in parameters]
+
+    def __len__(self):
+        return len(self.i)
+
+    def __getitem__(self, index):
+        """
+        Gets a single profile from the stack as a SASM if the index is an
+        integer, or a new stack with the selected profiles if the index is
+        a slice or an array of indices.
+        """
+        if isinstance(index, (int, np.integer)):
+            return self.getSASM(index)
+
+        index = np.arange(len(self))[index]
+
+        return ProfileStack(self.i[index], self.q, self.err[index],
+            [self._parameters[idx] for idx in index], self.q_err)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.getSASM(index)
+
+    def getSASM(self, index):
+        """
+        Makes a profile from the stack.
+
+        Parameters
+        ----------
+        index: int
+            The index of the profile in the stack.
+
+        Returns
+        -------
+        profile: :class:`SASM`
+            The profile. It shares its q, intensity, and uncertainty arrays
+            with the stack, and its metadata is a copy of the stack metadata
+            for the profile. A new SASM is made each time this is called.
+        """
+        return SASM(self.i[index], self.q, self.err[index],
+            self._parameters[index].share(), self.q_err, copy_data=False)
+
+    def getAllSASMs(self):
+        """
+        Makes all of the profiles in the stack, as for :func:`getSASM`.
+
+        Returns
+        -------
+        profiles: list
+            A list of :class:`SASM` profiles.
+        """
+        return [self.getSASM(index) for index in range(len(self))]
+
+    def getParameters(self, index):
+        """
+        Returns the metadata parameters of a profile in the stack.
+
+        Parameters
+        ----------
+        index: int
+            The index of the profile in the stack.
+
+        Returns
+        -------
+        parameters: dict
+            The metadata associated with the profile.
+        """
+        return self._parameters[index]
+
+    def getAllParameters(self):
+        """
+        Returns the metadata parameters of all of the profiles in the stack.
+
+        Returns
+        -------
+        parameters: list
+            A list of the metadata dictionaries of the profiles.
+        """
+        return self._parameters
+
+    def getQ(self):
+        """Gets the q vector shared by the profiles."""
+        return self.q
+
+    def getI(self):
+        """Gets the (N, len(q)) array of profile intensities."""
+        return self.i
+
+    def getErr(self):
+        """Gets the (N, len(q)) array of profile uncertainties."""
+        return self.err
+
+    def getQErr(self):
+        """Gets the q error vector shared by the profiles, or None."""
+        return self.q_err
+
+
 class IFTM(object):
     """
     Inverse Fourier transform measurement (IFTM) object. Contains the P(r), r
@@ -926,6 +1393,10 @@ class IFTM(object):
         self._i_fit_raw = np.array(i_fit)
         self._i_extrap_raw = np.array(i_extrap)
         self._q_extrap_raw = np.array(q_extrap)
+
+        if not isinstance(parameters, Metadata):
+            parameters = Metadata(parameters)
+
         self._parameters = parameters
 
         # Make an entry for analysis parameters i.e. Rg, I(0) etc:
@@ -1036,6 +1507,9 @@ class IFTM(object):
         new_parameters: dict
             A dictionary containing the new parameters.
         """
+        if not isinstance(new_parameters, Metadata):
+            new_parameters = Metadata(new_parameters)
+
         self._parameters = new_parameters
 
     def getAllParameters(self):
@@ -29,6 +29,8 @@ from builtins import object, range, map, zip
 from io import open
 
 import sys
+import collections
+import threading
 
 import numpy as np
 from numba import jit
@@ -59,7 +61,7 @@ class Mask(object):
 
     def setPoints(self, points):
         self._points = points
-        self._calcFillPoints()
+        self.coords = None
 
     def setId(self, id):
         self._mask_id = id
@@ -71,7 +73,28 @@ class Mask(object):
         return self._type
 
     def getFillPoints(self):
-        pass    # overridden when inherited
+        if getattr(self, 'coords', None) is None:
+            self._calcFillPoints()
+
+        return self.coords
+
+    def getFillMask(self, img_dim):
+        ''' Returns a boolean array of shape img_dim that is True for the
+        fill points of the mask. Overridden with array based versions when
+        inherited. '''
+        fill = np.zeros(img_dim, dtype=bool)
+
+        points = np.array(self.getFillPoints(), dtype=int).reshape(-1, 2)
+
+        inside = ((points[:,0] >= 0) & (points[:,0] < fill.shape[0])
+            & (points[:,1] >= 0) & (points[:,1] < fill.shape[1]))
+
+        fill[points[inside,0], points[inside,1]] = True
+
+        return fill
+
+    def _calcFillPoints(self):
+        self.coords = []  # overridden when inherited
 
     def getSaveFormat(self):
         pass   # overridden when inherited
@@ -124,7 +147,7 @@ class CircleMask(Mask):
         self._points = points
         self._radius = abs(points[1][0] - points[0][0])
 
-        self._calcFillPoints()
+        self.coords = None
 
     def _calcFillPoints(self):
 
@@ -148,10 +171,41 @@ class CircleMask(Mask):
                 self.coords.append( (int(q_lr1[1][i]), int(q_lr1[0])) )
                 self.coords.append( (int(q_lr2[1][i]), int(q_lr2[0])) )
 
-    def getFillPoints(self):
-        ''' Really Clumsy! Can be optimized alot! triplicates the points in the middle!'''
+    def getFillMask(self, img_dim):
+        ''' Fills the same lines of the Bresenham circle as _calcFillPoints,
+        but as array slices instead of individual points. '''
+        fill = np.zeros(img_dim, dtype=bool)
 
-        return self.coords
+        radiusC = abs(self._points[1][0] - self._points[0][0])
+
+        P = calcBresenhamCirclePoints(radiusC, self._points[0][1], self._points[0][0])
+
+        for i in range(0, len(P)//8):
+            Pp = P[i*8 : i*8 + 8]
+
+            start = int(Pp[1][1])
+            npts = max(int(Pp[0][1]+1) - start, 0)
+
+            if npts == 0:
+                continue
+
+            # Rows with a line of columns
+            _fillLine(fill, int(Pp[0][0]), start, start+npts, 0)
+
+            start2 = int(Pp[3][1])
+            stop2 = min(int(Pp[2][1]+1), start2+npts)
+            _fillLine(fill, int(Pp[2][0]), start2, stop2, 0)
+
+            # Columns with a line of rows
+            start3 = int(Pp[6][0])
+            stop3 = min(int(Pp[4][0]+1), start3+npts)
+            _fillLine(fill, int(Pp[4][1]), start3, stop3, 1)
+
+            start4 = int(Pp[7][0])
+            stop4 = min(int(Pp[5][0]+1), start4+npts)
+            _fillLine(fill, int(Pp[5][1]), start4, stop4, 1)
+
+        return fill
 
     def getSaveFormat(self):
         save = {'type'          :   self._type,
@@ -234,9 +288,20 @@ class RectangleMask(Mask):
                     for i in range(startPointX, endPointX + 1):
                         self.coords.append( (int(i), int(c)) )
 
-    def getFillPoints(self):
+    def getFillMask(self, img_dim):
+        fill = np.zeros(img_dim, dtype=bool)
 
-        return self.coords
+        startPoint, endPoint = self._points
+
+        x1, x2 = sorted((int(startPoint[1]), int(endPoint[1])))
+        y1, y2 = sorted((int(startPoint[0]), int(endPoint[0])))
+
+        xs = _clipSlice(x1, x2+1, fill.shape[0])
+        ys = _clipSlice(y1, y2+1, fill.shape[1])
+
+        fill[xs, ys] = True
+
+        return fill
 
     def getSaveFormat(self):
         save = {'type'          :   self._type,
@@ -274,9 +339,28 @@ class PolygonMask(Mask):
 
         self.coords = getCoords(p, (int(yDim), int(xDim)))
 
-    def getFillPoints(self):
+    def getFillMask(self, img_dim):
+        ''' Only tests the pixels in the bounding box of the polygon, the
+        rest can't be inside. '''
+        fill = np.zeros(img_dim, dtype=bool)
 
-        return self.coords
+        yDim, xDim = self._img_dimension
+
+        verts = np.array([list(each) for each in self._points], dtype=float)
+
+        pb = Polygeom(verts)
+
+        xmin, ymin = np.ceil(verts.min(axis=0))
+        xmax, ymax = np.floor(verts.max(axis=0))
+
+        xs = _clipSlice(int(xmin), int(xmax)+1, min(int(xDim), fill.shape[1]))
+        ys = _clipSlice(int(ymin), int(ymax)+1, min(int(yDim), fill.shape[0]))
+
+        if xs.stop > xs.start and ys.stop > ys.start:
+            fill[ys, xs] = npnpolyGrid(pb.verts, np.arange(xs.start, xs.stop),
+                np.arange(ys.start, ys.stop))
+
+        return fill
 
     def getSaveFormat(self):
         save = {'type'      :   self._type,
@@ -315,9 +399,56 @@ def calcBresenhamCirclePoints(radius, xOffset = 0, yOffset = 0):
 
     return points
 
+def _clipSlice(start, stop, length):
+    """ Makes a slice of the indices in [start, stop) that are in an axis of the given length """
+    start = min(max(start, 0), length)
+    stop = min(max(stop, start), length)
+
+    return slice(start, stop)
+
+def _fillLine(fill, idx, start, stop, axis):
+    """ Fills a line of pixels at index idx on the given axis, from start to stop """
+    if idx < 0 or idx >= fill.shape[axis]:
+        return
+
+    line = _clipSlice(start, stop, fill.shape[1-axis])
+
+    if axis == 0:
+        fill[idx, line] = True
+    else:
+        fill[line, idx] = True
+
+_mask_matrices = collections.OrderedDict()
+_mask_matrices_lock = threading.Lock()
+_max_mask_matrices = 8
+
+def _maskKey(img_dim, masks):
+    key = [tuple(int(each) for each in img_dim)]
+
+    for each in masks:
+        points = np.array([list(p) for p in each.getPoints()], dtype=float)
+
+        key.append((each.getType(), bool(each.isNegativeMask()),
+            tuple(each._img_dimension), points.shape, points.tobytes()))
+
+    return tuple(key)
+
 def createMaskMatrix(img_dim, masks):
     ''' creates a 2D binary matrix of the same size as the image,
-    corresponding to the mask pattern '''
+    corresponding to the mask pattern. Results are cached for each image
+    dimension and list of masks '''
+
+    try:
+        key = _maskKey(img_dim, masks)
+    except Exception:
+        key = None
+
+    if key is not None:
+        with _mask_matrices_lock:
+            mask = _mask_matrices.get(key, None)
+
+        if mask is not None:
+            return mask.astype(float)
 
     negmasks = []
     posmasks = []
@@ -335,33 +466,29 @@ def createMaskMatrix(img_dim, masks):
             negmasks.append(each)
 
             masks = negmasks
-        mask = np.zeros(img_dim)
+        mask = np.zeros(img_dim, dtype=bool)
     else:
-        mask = np.ones(img_dim)
-
-    maxy = mask.shape[1]
-    maxx = mask.shape[0]
+        mask = np.ones(img_dim, dtype=bool)
 
     for each in masks:
-        fillPoints = each.getFillPoints()
+        fill = each.getFillMask(mask.shape)
 
         if each.isNegativeMask() == True:
-            for eachp in fillPoints:
-                if eachp[0] < maxx and eachp[0] >= 0 and eachp[1] < maxy and eachp[1] >= 0:
-                    y = int(eachp[1])
-                    x = int(eachp[0])
-                    mask[(x,y)] = 1
+            mask[fill] = True
         else:
-            for eachp in fillPoints:
-                if eachp[0] < maxx and eachp[0] >= 0 and eachp[1] < maxy and eachp[1] >= 0:
-                    y = int(eachp[1])
-                    x = int(eachp[0])
-                    mask[(x,y)] = 0
+            mask[fill] = False
 
     #Mask is flipped (older RAW versions had flipped image)
     mask = np.flipud(mask)
 
-    return mask
+    if key is not None:
+        with _mask_matrices_lock:
+            _mask_matrices[key] = mask
+
+            while len(_mask_matrices) > _max_mask_matrices:
+                _mask_matrices.popitem(last=False)
+
+    return mask.astype(float)
 
 def createMaskFromHdr(img, img_hdr, flipped = False):
 
@@ -496,6 +623,43 @@ def npnpoly(verts,points):
     return out
 
 
+def npnpolyGrid(verts, x, y):
+    """Check whether the points of a grid are in the polygon. Gives the
+    same result as npnpoly for the points (x[j], y[i]), but is computed a
+    row at a time from where the polygon edges cross each row.
+
+    x - 1D array of consecutive integers
+    y - 1D array
+
+    Returns a len(y) x len(x) boolean array.
+    """
+    nx = len(x)
+
+    xpi = verts[:,0]
+    ypi = verts[:,1]
+
+    xpj = xpi[np.arange(xpi.size)-1]
+    ypj = ypi[np.arange(ypi.size)-1]
+
+    yy = y[:,np.newaxis]
+    maybe = ((ypi <= yy) & (yy < ypj)) | ((ypj <= yy) & (yy < ypi))
+
+    rows, edges = np.nonzero(maybe)
+
+    x_cross = (xpj[edges]-xpi[edges])*(y[rows] - ypi[edges]) \
+        / (ypj[edges] - ypi[edges]) + xpi[edges]
+
+    # Points with x < x_cross are toggled by the crossing
+    last = np.clip(np.ceil(x_cross) - x[0], 0, nx).astype(int)
+
+    toggles = np.zeros((len(y), nx+1), dtype=np.uint8)
+    np.add.at(toggles, (rows, last), 1)
+
+    crossings = np.cumsum(toggles[:,::-1], axis=1, dtype=np.uint8)[:,::-1]
+
+    return (crossings[:,1:] % 2).astype(bool)
+
+
 class Polygeom(np.ndarray):
     """
     Polygeom -- Polygon geometry class
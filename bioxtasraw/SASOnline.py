@@ -0,0 +1,1126 @@
+"""
+Created on October 16, 2026
+
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+This file contains the online mode functions that don't depend on the GUI,
+such as watching a directory for new files.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import object, range, map, zip
+from io import open
+
+import os
+import sys
+import copy
+import time
+import errno
+import select
+import socket
+import struct
+import threading
+import queue
+import collections
+import ctypes
+import ctypes.util
+import traceback
+
+raw_path = os.path.abspath(os.path.join('.', __file__, '..', '..'))
+if raw_path not in os.sys.path:
+    os.sys.path.append(raw_path)
+
+import bioxtasraw.SASCalc as SASCalc
+import bioxtasraw.SASFileIO as SASFileIO
+import bioxtasraw.SASProc as SASProc
+import bioxtasraw.SECM as SECM
+
+FileEvent = collections.namedtuple('FileEvent', ['path', 'name', 'type',
+    'size', 'mtime'])
+FileEvent.__doc__ = """
+A new ('new') or changed ('modified') file found by a
+:class:`DirectoryWatcher`.
+"""
+
+
+def filterFilename(filename, filter_list):
+    """
+    Checks a filename against the online mode filter list. Returns True if
+    the file should be loaded.
+
+    Parameters
+    ----------
+    filename: str
+        The name of the file.
+    filter_list: list
+        The online filters, as in the OnlineFilterList setting. Each filter
+        is a list of ['Ignore' or 'Open only with', text, location], where
+        location is 'At start', 'Anywhere' or 'At end'.
+    """
+    load = True
+
+    for item in filter_list:
+        if item[0] == 'Ignore':
+            if item[2] == 'At start':
+                if filename.startswith(item[1]):
+                    load = False
+            elif item[2] == 'Anywhere':
+                if filename.find(item[1]) != -1:
+                    load = False
+            else:
+                if filename.endswith(item[1]):
+                    load = False
+        else:
+            if item[2] == 'At start':
+                if not filename.startswith(item[1]):
+                    load = False
+            elif item[2] == 'Anywhere':
+                if not filename.find(item[1]) != -1:
+                    load = False
+            else:
+                if not filename.endswith(item[1]):
+                    load = False
+
+    return load
+
+
+class _PollingBackend(object):
+    """
+    Finds new and changed files by polling. The directory is only listed
+    when its modification time changes, and then only new files, or files
+    replaced by a new file, are found from the listing. Only those files,
+    and files that were still changing at the last check, have their size
+    and modification time checked. Every rescan_interval seconds all files
+    are checked, to find files rewritten in place after they stopped
+    changing.
+    """
+
+    # Directory modification times can have a resolution of a second or
+    # more, so recently modified directories are listed on every check
+    _mtime_slack = 2.
+
+    def __init__(self, directory, known, rescan_interval):
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+
+        self._dir_mtime = os.stat(directory).st_mtime
+        self._scan_time = time.time()
+        self._changing = set()
+
+        known = set(known)
+
+        self._inodes = {name: inode for name, inode in self._listFiles()
+            if name in known}
+        self._stats = {}
+
+        for name in self._inodes:
+            stat = self._stat(name)
+
+            if stat is not None:
+                self._stats[name] = stat
+
+    def _listFiles(self):
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+
+                    inode = entry.inode()
+                except OSError:
+                    continue
+
+                yield entry.name, inode
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+
+        return (st.st_size, st.st_mtime)
+
+    def wait(self, timeout):
+        """
+        Returns the names of the new and changed files, after waiting for
+        timeout.
+        """
+        time.sleep(timeout)
+
+        now = time.time()
+        changed = set()
+
+        dir_mtime = os.stat(self.directory).st_mtime
+        full_scan = now - self._scan_time >= self.rescan_interval
+
+        if (full_scan or dir_mtime != self._dir_mtime
+            or now - dir_mtime < self._mtime_slack):
+            self._dir_mtime = dir_mtime
+
+            files = dict(self._listFiles())
+
+            changed.update(name for name, inode in files.items()
+                if self._inodes.get(name, None) != inode)
+
+            self._inodes = files
+            self._stats = {name: stat for name, stat in self._stats.items()
+                if name in files}
+            self._changing.intersection_update(files)
+
+        if full_scan:
+            self._scan_time = now
+            check = list(self._inodes)
+        else:
+            check = changed | self._changing
+
+        for name in check:
+            stat = self._stat(name)
+
+            if stat is None:
+                continue
+
+            if self._stats.get(name, None) != stat:
+                changed.add(name)
+                self._changing.add(name)
+            else:
+                self._changing.discard(name)
+
+            self._stats[name] = stat
+
+        return sorted(changed)
+
+    def close(self):
+        pass
+
+
+class _InotifyBackend(object):
+    """
+    Uses Linux inotify to get the names of created, moved in and written
+    files in the directory.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    _event_header = struct.Struct('iIII')
+
+    _libc = None
+
+    def __init__(self, directory, known):
+        if _InotifyBackend._libc is None:
+            libc_name = ctypes.util.find_library('c')
+            if libc_name is None:
+                libc_name = 'libc.so.6'
+
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_uint32]
+
+            _InotifyBackend._libc = libc
+
+        self.directory = directory
+        self._known = set(known)
+
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+            | self.IN_CREATE)
+
+        wd = self._libc.inotify_add_watch(self._fd,
+            os.fsencode(directory), mask)
+
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, os.strerror(err))
+
+    def wait(self, timeout):
+        """
+        Returns the names of files with events, waiting up to timeout for
+        the first event.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+
+        if not readable:
+            return []
+
+        names = []
+        overflow = False
+
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = self._event_header.unpack_from(data, pos)
+                pos = pos + self._event_header.size
+
+                name = data[pos:pos+length].rstrip(b'\0')
+                pos = pos + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                elif name and not mask & self.IN_ISDIR:
+                    names.append(os.fsdecode(name))
+
+        if overflow:
+            # Events were lost, so look for new files in a listing
+            listed = set(os.listdir(self.directory))
+            names.extend(listed - self._known)
+
+        self._known.update(names)
+
+        return list(collections.OrderedDict.fromkeys(names))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class DirectoryWatcher(object):
+    """
+    Watches a directory for new and changed files in a background thread,
+    and puts a :data:`FileEvent` on a queue for each one. Uses inotify on
+    Linux, and otherwise polls the directory (see :attr:`rescan_interval`).
+    Files are only
+    handed off once their size and modification time haven't changed for
+    stable_time seconds, so files that are still being written aren't
+    loaded. The last handed off version of the most recent max_tracked
+    files is kept, so that unchanged files aren't handed off again.
+    """
+
+    max_tracked = 10000
+
+    #: Without inotify, how often all files are checked for changes, in
+    #: seconds. Between these checks only new files and files that are
+    #: still changing are checked.
+    rescan_interval = 60.
+
+    def __init__(self, directory, event_queue=None, poll_interval=2.,
+        stable_time=0.5, use_inotify=True):
+        """
+        Parameters
+        ----------
+        directory: str
+            The directory to watch.
+        event_queue: queue.Queue, optional
+            The queue that events are put on. If not provided, a new
+            unbounded queue is made, available as the ``events`` attribute.
+        poll_interval: float, optional
+            The time between checks for new files, in seconds.
+        stable_time: float, optional
+            How long a file's size and modification time must stay the same
+            before it is handed off, in seconds.
+        use_inotify: bool, optional
+            Whether to use inotify when it is available.
+        """
+        if event_queue is None:
+            event_queue = queue.Queue()
+
+        self.events = event_queue
+        self.poll_interval = poll_interval
+        self.stable_time = stable_time
+        self.use_inotify = use_inotify
+
+        self._directory = os.path.abspath(os.path.expanduser(directory))
+        self._backend = None
+        self._pending = collections.OrderedDict()
+        self._handed_off = collections.OrderedDict()
+        self._skip = {}
+        self._existing = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.error = None
+
+    def getDirectory(self):
+        return self._directory
+
+    def setDirectory(self, directory):
+        """
+        Changes the watched directory. Files already in the new directory are
+        not reported.
+        """
+        running = self.isRunning()
+
+        if running:
+            self.stop()
+
+        self._directory = os.path.abspath(os.path.expanduser(directory))
+
+        if running:
+            self.start()
+
+    def start(self):
+        """
+        Starts watching the directory. Files already in the directory are
+        not reported.
+        """
+        if self.isRunning():
+            return
+
+        self._makeBackend()
+
+        self._stop_event.clear()
+        self.error = None
+
+        self._thread = threading.Thread(target=self._run,
+            name='DirectoryWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops watching the directory.
+        """
+        self._stop_event.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def getEvents(self):
+        """
+        Returns all of the events currently in the queue, without waiting.
+        """
+        events = []
+
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+
+        return events
+
+    def skip(self, names):
+        """
+        Marks files, such as files saved by RAW into the watched directory,
+        so that their current version isn't reported.
+
+        Parameters
+        ----------
+        names: list
+            The file names (not full paths) to skip.
+        """
+        with self._lock:
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(self._directory, name))
+                except OSError:
+                    continue
+
+                self._skip[name] = (st.st_size, st.st_mtime)
+
+    def scanOnce(self, timeout=0):
+        """
+        Checks for new and changed files once, putting events for any stable
+        files on the queue. This is what the background thread calls, and
+        can be used to drive the watcher without a thread.
+        """
+        if self._backend is None:
+            self._makeBackend()
+
+        names = self._backend.wait(timeout)
+
+        now = time.time()
+
+        with self._lock:
+            for name in names:
+                if name not in self._pending:
+                    self._pending[name] = (None, now)
+
+            self._checkPending(now)
+
+    def _makeBackend(self):
+        known = os.listdir(self._directory)
+
+        with self._lock:
+            self._pending.clear()
+            self._handed_off.clear()
+            self._skip.clear()
+            self._existing = set(known)
+
+        backend = None
+
+        if self.use_inotify and sys.platform.startswith('linux'):
+            try:
+                backend = _InotifyBackend(self._directory, known)
+            except Exception:
+                backend = None
+
+        if backend is None:
+            backend = _PollingBackend(self._directory, known,
+                self.rescan_interval)
+
+        self._backend = backend
+
+    def _checkPending(self, now):
+        for name in list(self._pending.keys()):
+            last_stat, last_time = self._pending[name]
+
+            path = os.path.join(self._directory, name)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                # File was removed before it could be loaded
+                del self._pending[name]
+                self._handed_off.pop(name, None)
+                continue
+
+            if not os.path.isfile(path):
+                del self._pending[name]
+                continue
+
+            new_stat = (st.st_size, st.st_mtime)
+
+            if new_stat != last_stat:
+                self._pending[name] = (new_stat, now)
+                continue
+
+            if now - last_time < self.stable_time:
+                continue
+
+            del self._pending[name]
+
+            if self._skip.get(name, None) == new_stat:
+                del self._skip[name]
+                self._setHandedOff(name, new_stat)
+                continue
+
+            if self._handed_off.get(name, None) == new_stat:
+                continue
+
+            if name in self._handed_off or name in self._existing:
+                event_type = 'modified'
+            else:
+                event_type = 'new'
+
+            self._setHandedOff(name, new_stat)
+
+            self.events.put(FileEvent(path, name, event_type, new_stat[0],
+                new_stat[1]))
+
+    def _setHandedOff(self, name, stat):
+        self._handed_off.pop(name, None)
+        self._handed_off[name] = stat
+
+        while len(self._handed_off) > self.max_tracked:
+            self._handed_off.popitem(last=False)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self._pending:
+                    timeout = min(self.poll_interval, self.stable_time)
+                else:
+                    timeout = self.poll_interval
+
+                self.scanOnce(timeout)
+
+            except OSError as e:
+                # The directory may have been removed, keep trying in case
+                # it comes back
+                self.error = e
+                self._stop_event.wait(self.poll_interval)
+
+
+class StageTimer(object):
+    """
+    Thread safe counters of how long each stage of a processing pipeline
+    takes.
+    """
+
+    def __init__(self):
+        self._stats = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, count=1):
+        """
+        Adds the time taken for count items to the stage.
+        """
+        with self._lock:
+            if stage not in self._stats:
+                self._stats[stage] = {'count': 0, 'total': 0., 'max': 0.,
+                    'last': 0.}
+
+            stats = self._stats[stage]
+
+            stats['count'] = stats['count'] + count
+            stats['total'] = stats['total'] + seconds
+            stats['last'] = seconds/max(count, 1)
+            stats['max'] = max(stats['max'], stats['last'])
+
+    def getStats(self):
+        """
+        Returns a dictionary with the number of items (count), total time
+        (total), mean time (mean), maximum time (max) and most recent time
+        (last) for each stage, in seconds.
+        """
+        with self._lock:
+            stats = collections.OrderedDict()
+
+            for stage, values in self._stats.items():
+                stats[stage] = dict(values)
+
+                if values['count'] > 0:
+                    stats[stage]['mean'] = values['total']/values['count']
+                else:
+                    stats[stage]['mean'] = 0.
+
+        return stats
+
+
+class OnlineReducer(object):
+    """
+    Headless online data reduction. New files, from a watched directory, a
+    local socket, or :py:meth:`submit`, are loaded, radially averaged and
+    normalized by a pool of worker threads. The profiles are then, in the
+    order the files arrived, subtracted, appended to a live series and
+    written to disk. If a baseline correction is set with
+    :py:meth:`setBaselineCorrection`, the subtracted profiles are also
+    baseline corrected as they arrive. The queues between the stages are
+    bounded, so if the workers fall behind the sources block instead of
+    using more memory.
+    Each worker uses its own copy of the settings, made when the reducer is
+    started. The time taken by each stage is available from
+    :py:meth:`getStageStats`.
+    """
+
+    def __init__(self, raw_settings, output_dir=None, buffer_profile=None,
+        n_buffer_frames=0, n_workers=2, max_queue_size=16,
+        series_name='online_series'):
+        """
+        Parameters
+        ----------
+        raw_settings: :class:`bioxtasraw.RAWSettings.RawGuiSettings`
+            The settings used to load and radially average the images.
+        output_dir: str, optional
+            If provided, each profile is saved in this directory as soon as
+            it has been processed, and the series is saved when the reducer
+            is stopped.
+        buffer_profile: :class:`bioxtasraw.SASM.SASM`, optional
+            The buffer profile subtracted from each profile.
+        n_buffer_frames: int, optional
+            If no buffer profile is provided and this is more than 0, the
+            average of the first n_buffer_frames profiles is used as the
+            buffer.
+        n_workers: int, optional
+            The number of worker threads loading and radially averaging
+            images.
+        max_queue_size: int, optional
+            The maximum number of files waiting to be processed, and of
+            processed files waiting to be added to the series.
+        series_name: str, optional
+            The name of the series, also used for the saved series file.
+        """
+        self.raw_settings = raw_settings
+        self.output_dir = output_dir
+        self.buffer_profile = buffer_profile
+        self.n_buffer_frames = n_buffer_frames
+        self.n_workers = n_workers
+        self.series_name = series_name
+
+        self.series = None
+        self.errors = []
+        self.timer = StageTimer()
+
+        self._input = queue.Queue(max_queue_size)
+        self._output = queue.Queue(max_queue_size)
+        self._max_queue_size = max_queue_size
+
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        self._workers = []
+        self._collector = None
+        self._sources = []
+        self._watchers = []
+        self._sockets = []
+
+        self._unsub_profiles = []
+        self._sub_backlog = []
+
+        self._baseline = None
+
+    def start(self):
+        """
+        Starts the worker and collector threads.
+        """
+        self._stop_event.clear()
+
+        for j in range(self.n_workers):
+            # Loading can change the settings (e.g. a configuration from the
+            # image header), so each worker gets its own copy
+            worker_settings = copy.deepcopy(self.raw_settings)
+
+            worker = threading.Thread(target=self._runWorker,
+                args=(worker_settings,),
+                name='OnlineReducerWorker{}'.format(j))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._collector = threading.Thread(target=self._runCollector,
+            name='OnlineReducerCollector')
+        self._collector.daemon = True
+        self._collector.start()
+
+    def stop(self):
+        """
+        Stops the sources, finishes processing the files already submitted,
+        and saves the series if there is an output directory.
+        """
+        self._stop_event.set()
+
+        for watcher in self._watchers:
+            watcher.stop()
+
+        for source in self._sources:
+            source.join()
+
+        for sock in self._sockets:
+            address = sock.getsockname()
+
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+            if (sock.family == getattr(socket, 'AF_UNIX', None)
+                and os.path.exists(address)):
+                os.remove(address)
+
+        for worker in self._workers:
+            self._input.put(None)
+
+        for worker in self._workers:
+            worker.join()
+
+        if self._collector is not None:
+            self._output.put(None)
+            self._collector.join()
+
+        self._workers = []
+        self._collector = None
+        self._sources = []
+        self._watchers = []
+        self._sockets = []
+
+        if self.output_dir is not None and self.series is not None:
+            start = time.time()
+            SASFileIO.save_series(os.path.join(self.output_dir,
+                '{}.hdf5'.format(self.series_name)), self.series)
+            self.timer.add('write', time.time()-start)
+
+    def submit(self, filename, block=True, timeout=None):
+        """
+        Adds a file to be processed. Blocks while the input queue is full,
+        unless block is False.
+
+        Returns
+        -------
+        seq: int
+            The position of the file in the processing order.
+        """
+        with self._seq_lock:
+            seq = self._seq
+
+            # Submitting while holding the lock keeps the queue in order
+            self._input.put((seq, os.path.abspath(filename), time.time()),
+                block, timeout)
+
+            self._seq = self._seq + 1
+
+        return seq
+
+    def watchDirectory(self, directory, poll_interval=2., stable_time=0.5,
+        use_inotify=True):
+        """
+        Processes new files compatible with RAW in a directory, using a
+        :class:`DirectoryWatcher`. Files are only checked against the online
+        mode filters if online filtering is enabled in the settings.
+        """
+        events = queue.Queue(self._max_queue_size)
+
+        watcher = DirectoryWatcher(directory, events, poll_interval,
+            stable_time, use_inotify)
+        watcher.start()
+
+        self._watchers.append(watcher)
+
+        source = threading.Thread(target=self._runWatcherSource,
+            args=(events,), name='OnlineReducerWatcher')
+        source.daemon = True
+        source.start()
+
+        self._sources.append(source)
+
+        return watcher
+
+    def listenSocket(self, address):
+        """
+        Processes files sent to a local socket. Clients connect and send
+        one file path per line.
+
+        Parameters
+        ----------
+        address: str or tuple
+            A path for a unix domain socket, or a (host, port) tuple for a
+            TCP socket.
+        """
+        if isinstance(address, tuple):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        server.bind(address)
+        server.listen(5)
+        server.settimeout(0.5)
+
+        self._sockets.append(server)
+
+        source = threading.Thread(target=self._runSocketSource,
+            args=(server,), name='OnlineReducerSocket')
+        source.daemon = True
+        source.start()
+
+        self._sources.append(source)
+
+    def setBaselineCorrection(self, start_range, end_range, baseline_type,
+        bl_extrap=True, int_type='total', q_val=None, q_range=None):
+        """
+        Baseline corrects the subtracted profiles in the series as they
+        arrive, once the series includes the end range. Only new profiles
+        are corrected, using :func:`bioxtasraw.SASCalc.updateSeriesBaseline`,
+        and the results are the same as correcting the whole series. The
+        parameters are as for
+        :py:func:`bioxtasraw.RAWAPI.set_baseline_correction`. The number of
+        iterations for an integral baseline and the calculation threshold
+        are taken from the settings.
+        """
+        self._baseline = (list(start_range), list(end_range), baseline_type,
+            bl_extrap, int_type, q_val, q_range)
+
+    def getStageStats(self):
+        """
+        Returns the time statistics for each stage, as in
+        :py:meth:`StageTimer.getStats`. Stages are queue (waiting for a
+        worker), load, integrate, subtract, series, baseline and write.
+        """
+        return self.timer.getStats()
+
+    def _isCompatible(self, filename):
+        if self.raw_settings.get('EnableOnlineFiltering'):
+            if not filterFilename(os.path.split(filename)[1],
+                self.raw_settings.get('OnlineFilterList')):
+                return False
+
+        ext = os.path.splitext(filename)[1]
+
+        return ext in self.raw_settings.get('CompatibleFormats')
+
+    def _runWatcherSource(self, events):
+        while not self._stop_event.is_set():
+            try:
+                event = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if self._isCompatible(event.path):
+                self._submitUntilStopped(event.path)
+
+    def _runSocketSource(self, server):
+        while not self._stop_event.is_set():
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            with conn:
+                conn.settimeout(0.5)
+                data = b''
+
+                while not self._stop_event.is_set():
+                    try:
+                        new_data = conn.recv(4096)
+                    except socket.timeout:
+                        continue
+
+                    if not new_data:
+                        break
+
+                    data = data + new_data
+
+                    lines = data.split(b'\n')
+                    data = lines.pop()
+
+                    for line in lines:
+                        filename = line.decode().strip()
+
+                        if filename:
+                            self._submitUntilStopped(filename)
+
+                if data.strip():
+                    self._submitUntilStopped(data.decode().strip())
+
+    def _submitUntilStopped(self, filename):
+        while True:
+            try:
+                self.submit(filename, timeout=0.5)
+                break
+            except queue.Full:
+                if self._stop_event.is_set():
+                    self.errors.append((filename, 'Not processed, the reducer was stopped'))
+                    break
+
+    def _runWorker(self, raw_settings):
+        while True:
+            item = self._input.get()
+
+            if item is None:
+                break
+
+            seq, filename, submit_time = item
+
+            self.timer.add('queue', time.time()-submit_time)
+
+            try:
+                profiles = self._loadAndIntegrate(filename, raw_settings)
+                error = None
+            except Exception:
+                profiles = []
+                error = traceback.format_exc()
+
+            self._output.put((seq, filename, profiles, error))
+
+    def _loadAndIntegrate(self, filename, raw_settings):
+        start = time.time()
+
+        file_type, hdf5_file = SASFileIO.getFileType(filename)
+
+        if file_type != 'image':
+            profiles, img = SASFileIO.loadFile(filename, raw_settings)
+
+            if not isinstance(profiles, list):
+                profiles = [profiles]
+
+            self.timer.add('load', time.time()-start)
+
+            return profiles
+
+        frames = SASFileIO.iterImageFrames(filename, raw_settings,
+            hdf5_file)
+
+        profiles = []
+        load_time = 0.
+        integrate_time = 0.
+
+        start_point = raw_settings.get('StartPoint')
+        end_point = raw_settings.get('EndPoint')
+
+        while True:
+            try:
+                file_num, i, img, parameters = next(frames)
+            except StopIteration:
+                break
+
+            load_time = load_time + time.time() - start
+            start = time.time()
+
+            profile = SASFileIO.processImage(img, parameters, raw_settings)
+            SASFileIO.postProcessProfile(profile, raw_settings, False)
+
+            profile.setQrange((start_point, len(profile.getRawQ())-end_point))
+
+            profiles.append(profile)
+
+            integrate_time = integrate_time + time.time() - start
+            start = time.time()
+
+        load_time = load_time + time.time() - start
+
+        nprofiles = max(len(profiles), 1)
+        self.timer.add('load', load_time, nprofiles)
+        self.timer.add('integrate', integrate_time, nprofiles)
+
+        return profiles
+
+    def _runCollector(self):
+        waiting = {}
+        next_seq = 0
+
+        while True:
+            item = self._output.get()
+
+            if item is None:
+                break
+
+            waiting[item[0]] = item
+
+            while next_seq in waiting:
+                seq, filename, profiles, error = waiting.pop(next_seq)
+                next_seq = next_seq + 1
+
+                if error is not None:
+                    self.errors.append((filename, error))
+                    continue
+
+                if len(profiles) > 0:
+                    try:
+                        self._addProfiles(profiles)
+                    except Exception:
+                        error = traceback.format_exc()
+                        self.errors.append((filename, error))
+
+    def _addProfiles(self, profiles):
+        # Subtract and average
+        start = time.time()
+
+        if self.buffer_profile is None and self.n_buffer_frames > 0:
+            self._unsub_profiles.extend(profiles)
+
+            if len(self._unsub_profiles) >= self.n_buffer_frames:
+                self.buffer_profile = SASProc.average(
+                    self._unsub_profiles[:self.n_buffer_frames], forced=True)
+                self.buffer_profile.setParameter('filename',
+                    'A_{}_buffer'.format(self.series_name))
+
+                to_subtract = self._unsub_profiles
+            else:
+                to_subtract = []
+
+        elif self.buffer_profile is not None:
+            to_subtract = profiles
+
+        else:
+            to_subtract = []
+
+        sub_profiles = []
+
+        for profile in to_subtract:
+            sub_profile = SASProc.subtract(profile, self.buffer_profile,
+                forced=True)
+
+            name, ext = os.path.splitext(sub_profile.getParameter('filename'))
+            sub_profile.setParameter('filename', 'S_' + name)
+
+            sub_profiles.append(sub_profile)
+
+        if sub_profiles:
+            self._unsub_profiles = []
+
+        self.timer.add('subtract', time.time()-start, len(profiles))
+
+        # Add to the series
+        start = time.time()
+
+        filenames = [profile.getParameter('filename') for profile in profiles]
+
+        if self.series is None:
+            self.series = SECM.SECM(filenames, profiles, range(len(profiles)),
+                {}, self.raw_settings)
+            self.series.setParameter('filename', self.series_name)
+        else:
+            self.series.acquireSemaphore()
+            try:
+                nframes = len(self.series.frame_list)
+                self.series.append(filenames, profiles,
+                    range(nframes, nframes+len(profiles)))
+            finally:
+                self.series.releaseSemaphore()
+
+        if sub_profiles:
+            self.series.acquireSemaphore()
+            try:
+                self.series.appendSubtractedSASMs(sub_profiles,
+                    [True]*len(sub_profiles), 0)
+                self.series.average_buffer_sasm = self.buffer_profile
+            finally:
+                self.series.releaseSemaphore()
+
+        self.timer.add('series', time.time()-start, len(profiles))
+
+        # Baseline correct
+        if sub_profiles and self._baseline is not None:
+            start = time.time()
+
+            self._updateBaseline()
+
+            self.timer.add('baseline', time.time()-start, len(sub_profiles))
+
+        # Write the profiles
+        if self.output_dir is not None:
+            start = time.time()
+
+            SASFileIO.saveMeasurement(profiles, self.output_dir,
+                self.raw_settings)
+
+            if sub_profiles:
+                SASFileIO.saveMeasurement(sub_profiles, self.output_dir,
+                    self.raw_settings)
+
+            self.timer.add('write', time.time()-start, len(profiles))
+
+    def _updateBaseline(self):
+        (start_range, end_range, baseline_type, bl_extrap, int_type, q_val,
+            q_range) = self._baseline
+
+        self.series.acquireSemaphore()
+        try:
+            self.series.baseline_start_range = start_range
+            self.series.baseline_end_range = end_range
+            self.series.baseline_type = baseline_type
+            self.series.baseline_extrap = bl_extrap
+
+            SASCalc.updateSeriesBaseline(self.series,
+                self.raw_settings.get('IBaselineMinIter'),
+                self.raw_settings.get('IBaselineMaxIter'), int_type, q_val,
+                q_range, self.raw_settings.get('secCalcThreshold'))
+        finally:
+            self.series.releaseSemaphore()
@@ -21,6 +21,9 @@ from builtins import object, range, map, zip
 from io import open
 
 import math
+import threading
+
+import numpy as np
 
 class PyMathParser(object):
     '''
@@ -158,3 +161,155 @@ class PyMathParser(object):
             pass
         mylist.sort()
         return mylist
+
+def _arrayLog(x, base=None):
+    if base is None:
+        return np.log(x)
+    else:
+        return np.log(x)/np.log(base)
+
+class CompiledExpression(object):
+    '''
+    A mathematical expression that is compiled once, so that it can be
+    evaluated quickly for many headers. It supports the same functions and
+    variables as PyMathParser. Only the header values the expression
+    actually uses are converted to floats. If any of those values are
+    arrays, the expression is evaluated with numpy functions, so a whole
+    stack of headers can be evaluated in one call. Expressions should be
+    obtained from getCompiledExpression, which caches them.
+    '''
+
+    scalar_functions = {
+        'acos'      : math.acos,
+        'asin'      : math.asin,
+        'atan'      : math.atan,
+        'atan2'     : math.atan2,
+        'ceil'      : math.ceil,
+        'cos'       : math.cos,
+        'cosh'      : math.cosh,
+        'degrees'   : math.degrees,
+        'exp'       : math.exp,
+        'fabs'      : math.fabs,
+        'floor'     : math.floor,
+        'fmod'      : math.fmod,
+        'frexp'     : math.frexp,
+        'hypot'     : math.hypot,
+        'ldexp'     : math.ldexp,
+        'log'       : math.log,
+        'log10'     : math.log10,
+        'modf'      : math.modf,
+        'pow'       : pow,
+        'radians'   : math.radians,
+        'sin'       : math.sin,
+        'sinh'      : math.sinh,
+        'sqrt'      : math.sqrt,
+        'tan'       : math.tan,
+        'tanh'      : math.tanh,
+        }
+
+    array_functions = {
+        'acos'      : np.arccos,
+        'asin'      : np.arcsin,
+        'atan'      : np.arctan,
+        'atan2'     : np.arctan2,
+        'ceil'      : np.ceil,
+        'cos'       : np.cos,
+        'cosh'      : np.cosh,
+        'degrees'   : np.degrees,
+        'exp'       : np.exp,
+        'fabs'      : np.fabs,
+        'floor'     : np.floor,
+        'fmod'      : np.fmod,
+        'frexp'     : np.frexp,
+        'hypot'     : np.hypot,
+        'ldexp'     : np.ldexp,
+        'log'       : _arrayLog,
+        'log10'     : np.log10,
+        'modf'      : np.modf,
+        'pow'       : np.power,
+        'radians'   : np.radians,
+        'sin'       : np.sin,
+        'sinh'      : np.sinh,
+        'sqrt'      : np.sqrt,
+        'tan'       : np.tan,
+        'tanh'      : np.tanh,
+        }
+
+    default_variables = {'pi' : math.pi}
+
+    def __init__(self, expression):
+        '''
+        Constructor
+
+        Parameters
+        ----------
+        expression: str
+            The expression. Raises SyntaxError if it can't be compiled.
+        '''
+        self.expression = expression
+        self.code = compile(expression, '<expression>', 'eval')
+        self.names = self.code.co_names
+
+    def evaluate(self, *var_dicts):
+        '''
+        Evaluates the expression. Variables are looked up in the given
+        dictionaries (e.g. the file and image headers), with later
+        dictionaries taking precedence, and then in the default variables.
+        Values that can't be converted to a float are ignored. Values may
+        be arrays, in which case the result is an array.
+        '''
+        variables = {'__builtins__' : None}
+        is_array = False
+
+        for name in self.names:
+            if name in self.scalar_functions:
+                continue
+
+            for var_dict in reversed(var_dicts):
+                if var_dict is not None and name in var_dict:
+                    try:
+                        val = var_dict[name]
+
+                        if isinstance(val, (np.ndarray, list, tuple)):
+                            val = np.asarray(val, dtype=float)
+                            is_array = True
+                        else:
+                            val = float(val)
+
+                        variables[name] = val
+                        break
+                    except (TypeError, ValueError):
+                        pass
+
+            else:
+                if name in self.default_variables:
+                    variables[name] = self.default_variables[name]
+
+        if is_array:
+            functions = self.array_functions
+        else:
+            functions = self.scalar_functions
+
+        return eval(self.code, variables, functions)
+
+_compiled_expressions = {}
+_compiled_expressions_lock = threading.Lock()
+_max_compiled_expressions = 256
+
+def getCompiledExpression(expression):
+    '''
+    Gets the CompiledExpression for the expression string, compiling it
+    if it isn't already cached.
+    '''
+    with _compiled_expressions_lock:
+        compiled = _compiled_expressions.get(expression, None)
+
+        if compiled is None:
+            compiled = CompiledExpression(expression)
+
+            if len(_compiled_expressions) >= _max_compiled_expressions:
+                _compiled_expressions.clear()
+
+            _compiled_expressions[expression] = compiled
+
+    return compiled
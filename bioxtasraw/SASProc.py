@@ -32,8 +32,11 @@ from io import open
 import copy
 import traceback
 import os
+import threading
+import weakref
 import numpy as np
 import scipy.interpolate as interp
+import scipy.sparse
 import numba
 
 raw_path = os.path.abspath(os.path.join('.', __file__, '..', '..'))
@@ -78,15 +81,9 @@ def subtract(sasm1, sasm2, forced=False, full=False, copy_params=True):
 
         history = {}
 
-        history1 = []
-        history1.append(copy.deepcopy(sasm1.getParameter('filename')))
-        for key in sasm1.getParameter('history'):
-            history1.append({ key : copy.deepcopy(sasm1.getParameter('history')[key])})
+        history1 = history_entry(sasm1)
 
-        history2 = []
-        history2.append(copy.deepcopy(sasm2.getParameter('filename')))
-        for key in sasm2.getParameter('history'):
-            history2.append({key : copy.deepcopy(sasm2.getParameter('history')[key])})
+        history2 = history_entry(sasm2)
 
         history['subtraction'] = {'initial_file':history1, 'subtracted_file':history2}
 
@@ -157,13 +154,7 @@ def average(sasm_list, forced=False, copy_params=True, full=False):
             history_list = []
 
             for eachsasm in sasm_list:
-                each_history = []
-                each_history.append(copy.deepcopy(eachsasm.getParameter('filename')))
-
-                for key in eachsasm.getParameter('history'):
-                    each_history.append({key : copy.deepcopy(eachsasm.getParameter('history')[key])})
-
-                history_list.append(each_history)
+                history_list.append(history_entry(eachsasm))
 
             history['averaged_files'] = history_list
             avg_parameters['history'] = history
@@ -272,13 +263,7 @@ def weightedAverage(sasm_list, weightByError, weightCounter, forced=False,
         history_list = []
 
         for eachsasm in sasm_list:
-            each_history = []
-            each_history.append(copy.deepcopy(eachsasm.getParameter('filename')))
-
-            for key in eachsasm.getParameter('history'):
-                each_history.append({key : copy.deepcopy(eachsasm.getParameter('history')[key])})
-
-            history_list.append(each_history)
+            history_list.append(history_entry(eachsasm))
 
         history['averaged_files'] = history_list
         avg_parameters['history'] = history
@@ -447,13 +432,7 @@ def merge(sasm_star, sasm_list, copy_params=True):
         history_list = []
 
         for eachsasm in [s1, s2]:
-            each_history = []
-            each_history.append(copy.deepcopy(eachsasm.getParameter('filename')))
-
-            for key in eachsasm.getParameter('history'):
-                each_history.append({key : copy.deepcopy(eachsasm.getParameter('history')[key])})
-
-            history_list.append(each_history)
+            history_list.append(history_entry(eachsasm))
 
         history['merged_files'] = history_list
         merge_parameters['history'] = history
@@ -523,15 +502,9 @@ def interpolateToFit(sasm_star, sasm, copy_params=True):
 
         history = {}
 
-        history1 = []
-        history1.append(copy.deepcopy(s1.getParameter('filename')))
-        for key in s1.getParameter('history'):
-            history1.append({ key : copy.deepcopy(s1.getParameter('history')[key])})
+        history1 = history_entry(s1)
 
-        history2 = []
-        history2.append(copy.deepcopy(s2.getParameter('filename')))
-        for key in s2.getParameter('history'):
-            history2.append({key : copy.deepcopy(s2.getParameter('history')[key])})
+        history2 = history_entry(s2)
 
         history['interpolation'] = {'initial_file':history1, 'interpolated_to_q_of':history2}
 
@@ -570,25 +543,7 @@ def logBinning(sasm, no_points, copy_params=True):
         bins = np.empty_like(q)
 
     else:
-        bins_calc = False
-        min_pt = 1
-
-        while not bins_calc:
-            bins = np.geomspace(min_pt, total_pts, no_points+1-min_pt)
-
-            pos_min_diff = np.argwhere(np.ediff1d(bins)>1)[0][0]
-
-            if pos_min_diff == 0:
-                bins_calc = True
-
-            else:
-                pos_min_diff = pos_min_diff + 1
-                min_pt = int(np.floor(bins[pos_min_diff]))
-
-        bins = bins.astype(int)
-        bins[0] = min_pt
-
-        log_bins = np.concatenate((np.arange(min_pt, dtype=int), bins))
+        log_bins = get_log_bins(total_pts, no_points)
 
         binned_q = np.empty(log_bins.shape[0]-1)
         binned_i = np.empty(log_bins.shape[0]-1)
@@ -605,13 +560,7 @@ def logBinning(sasm, no_points, copy_params=True):
     if copy_params:
         parameters = copy.deepcopy(sasm.getAllParameters())
 
-        old_history = parameters['history']
-
-        history1 = []
-        history1.append(copy.deepcopy(sasm.getParameter('filename')))
-
-        for key in old_history:
-            history1.append({key:old_history[key]})
+        history1 = history_entry(sasm)
 
         history = {}
         history['log_binning'] = {'initial_file' : history1,
@@ -626,6 +575,34 @@ def logBinning(sasm, no_points, copy_params=True):
 
     return newSASM
 
+def get_log_bins(total_pts, no_points):
+    """
+    Returns the edges of the logarithmic bins used to bin a profile with
+    total_pts points to no_points points. Bins at low q are a single point
+    wide until the logarithmic bins are more than one point wide.
+    """
+    bins_calc = False
+    min_pt = 1
+
+    while not bins_calc:
+        bins = np.geomspace(min_pt, total_pts, no_points+1-min_pt)
+
+        pos_min_diff = np.argwhere(np.ediff1d(bins)>1)[0][0]
+
+        if pos_min_diff == 0:
+            bins_calc = True
+
+        else:
+            pos_min_diff = pos_min_diff + 1
+            min_pt = int(np.floor(bins[pos_min_diff]))
+
+    bins = bins.astype(int)
+    bins[0] = min_pt
+
+    log_bins = np.concatenate((np.arange(min_pt, dtype=int), bins))
+
+    return log_bins
+
 @numba.jit(nopython=True, cache=True)
 def inner_log_bin(q, i, err_sqr, q_err, binned_q, binned_i,
     binned_err, binned_q_err, log_bins):
@@ -683,13 +660,7 @@ def rebin(sasm, rebin_factor, copy_params=True):
     if copy_params:
         parameters = copy.deepcopy(sasm.getAllParameters())
 
-        old_history = parameters['history']
-
-        history1 = []
-        history1.append(copy.deepcopy(sasm.getParameter('filename')))
-
-        for key in old_history:
-            history1.append({key:old_history[key]})
+        history1 = history_entry(sasm)
 
         history = {}
         history['linear_binning'] = {'initial_file' : history1,
@@ -763,15 +734,9 @@ def divide(sasm1, sasm2, forced=False, full=False, copy_params=True):
 
         history = {}
 
-        history1 = []
-        history1.append(copy.deepcopy(sasm1.getParameter('filename')))
-        for key in sasm1.getParameter('history'):
-            history1.append({ key : copy.deepcopy(sasm1.getParameter('history')[key])})
+        history1 = history_entry(sasm1)
 
-        history2 = []
-        history2.append(copy.deepcopy(sasm2.getParameter('filename')))
-        for key in sasm2.getParameter('history'):
-            history2.append({key : copy.deepcopy(sasm2.getParameter('history')[key])})
+        history2 = history_entry(sasm2)
 
         history['division'] = {'initial_file':history1, 'subtracted_file':history2}
 
@@ -784,6 +749,336 @@ def divide(sasm1, sasm2, forced=False, full=False, copy_params=True):
 
     return newSASM
 
+def profilesToStack(sasm_list, forced=False, full=False):
+    """
+    Makes a :class:`bioxtasraw.SASM.ProfileStack` from a list of profiles
+    with the same q vector. The metadata of the profiles is shared with
+    the stack, rather than copied.
+    """
+    q_match = test_equal_q_ranges(sasm_list, full, 5)
+
+    if q_match:
+        stack_sasms = sasm_list
+
+    elif not q_match and forced:
+        stack_sasms = match_q_vals(sasm_list, full, 5)
+
+    else:
+        raise SASExceptions.DataNotCompatible('The profiles do not have the '
+            'same q vectors.')
+
+    if full:
+        q = stack_sasms[0].q
+        i = np.array([sasm.i for sasm in stack_sasms])
+        err = np.array([sasm.err for sasm in stack_sasms])
+        q_err = stack_sasms[0].q_err
+    else:
+        q = stack_sasms[0].getQ()
+        i = np.array([sasm.getI() for sasm in stack_sasms])
+        err = np.array([sasm.getErr() for sasm in stack_sasms])
+        q_err = stack_sasms[0].getQErr()
+
+    parameters = [sasm.getAllParameters().share() for sasm in sasm_list]
+
+    return SASM.ProfileStack(i, copy.deepcopy(q), err, parameters,
+        copy.deepcopy(q_err))
+
+def subtractStack(stack, sasm, copy_params=True):
+    """
+    Subtracts a background profile from every profile in a stack. The
+    result is the same as :func:`subtract` for each profile, but the
+    q vectors are only compared once and the subtraction is done on the
+    whole stack at once.
+    """
+    q = stack.getQ()
+    bkg_q = sasm.getQ()
+
+    if (len(q) != len(bkg_q)
+        or not np.all(np.round(q, 5) == np.round(bkg_q, 5))):
+        raise SASExceptions.DataNotCompatible('The profiles do not have the '
+            'same q vectors.')
+
+    i = stack.getI() - sasm.getI()
+    err = np.sqrt(np.square(stack.getErr()) + np.square(sasm.getErr()))
+
+    if copy_params:
+        bkg_params = sasm.getAllParameters()
+
+        parameters = []
+
+        for params in stack.getAllParameters():
+            sub_parameters = get_shared_values([params, bkg_params])
+
+            if 'analysis' in sub_parameters:
+                del sub_parameters['analysis']
+
+            sub_parameters['filename'] = params.get('filename')
+
+            history = {}
+            history['subtraction'] = {'initial_file': _history_entry(params),
+                'subtracted_file': history_entry(sasm)}
+
+            sub_parameters['history'] = history
+
+            parameters.append(sub_parameters)
+
+    else:
+        parameters = [{'filename': params.get('filename')}
+            for params in stack.getAllParameters()]
+
+    return SASM.ProfileStack(i, copy.deepcopy(q), err, parameters,
+        copy.deepcopy(stack.getQErr()))
+
+def averageStack(stack, groups=None, copy_params=True):
+    """
+    Averages groups of profiles in a stack, with the same result as
+    :func:`average` for each group. Groups is a list of lists (or arrays)
+    of indices of the profiles in the stack, and may overlap. If groups is
+    None, all of the profiles are averaged. Returns a stack with one
+    average profile for each group.
+    """
+    return weightedAverageStack(stack, False, None, groups, None, copy_params)
+
+def weightedAverageStack(stack, weightByError, weightCounter, groups=None,
+    weights=None, copy_params=True):
+    """
+    Weighted averages of groups of profiles in a stack, with the same result
+    as :func:`weightedAverage` for each group. Groups is as for
+    :func:`averageStack`. If not weightByError, the profiles are weighted by
+    the provided weights, one per profile, or if no weights are provided by
+    the weightCounter value in the header of each profile. If weightCounter
+    is None and no weights are provided, the profiles are weighted equally.
+    All of the groups are averaged at once, as sparse matrix products.
+    """
+    nframes = len(stack)
+
+    if groups is None:
+        groups = [np.arange(nframes)]
+
+    group_idx = [np.asarray(group, dtype=int).ravel() for group in groups]
+
+    rows = np.concatenate([np.full(len(group), j, dtype=int)
+        for j, group in enumerate(group_idx)])
+    cols = np.concatenate(group_idx)
+
+    all_i = stack.getI()
+    all_err = stack.getErr()
+
+    if weightByError:
+        group_mat = scipy.sparse.csr_matrix((np.ones(len(cols)), (rows, cols)),
+            shape=(len(group_idx), nframes))
+
+        err_weights = 1/np.square(all_err)
+        sum_weights = group_mat.dot(err_weights)
+
+        avg_i = group_mat.dot(all_i*err_weights)/sum_weights
+        avg_err = np.sqrt(1/sum_weights)
+
+    else:
+        if weights is None and weightCounter is not None:
+            weights = np.array([_counter_weight(params, weightCounter)
+                for params in stack.getAllParameters()])
+        elif weights is None:
+            weights = np.ones(nframes)
+        else:
+            weights = np.asarray(weights, dtype=float)
+
+        group_mat = scipy.sparse.csr_matrix((weights[cols], (rows, cols)),
+            shape=(len(group_idx), nframes))
+        sqr_mat = scipy.sparse.csr_matrix((np.square(weights[cols]),
+            (rows, cols)), shape=(len(group_idx), nframes))
+
+        sum_weights = np.asarray(group_mat.sum(axis=1))
+
+        avg_i = group_mat.dot(all_i)/sum_weights
+        avg_err = np.sqrt(sqr_mat.dot(np.square(all_err)))/sum_weights
+
+    stack_params = stack.getAllParameters()
+    parameters = []
+
+    for group in group_idx:
+        group_params = [stack_params[idx] for idx in group]
+
+        if copy_params:
+            if len(group_params) == 1:
+                avg_parameters = group_params[0].share()
+            else:
+                avg_parameters = get_shared_values(group_params)
+
+                if 'analysis' in avg_parameters:
+                    del avg_parameters['analysis']
+
+                avg_parameters['filename'] = group_params[0].get('filename')
+
+                history = {}
+                history['averaged_files'] = [_history_entry(params)
+                    for params in group_params]
+                avg_parameters['history'] = history
+
+        else:
+            avg_parameters = {'filename': group_params[0].get('filename')}
+
+        parameters.append(avg_parameters)
+
+    return SASM.ProfileStack(avg_i, copy.deepcopy(stack.getQ()), avg_err,
+        parameters, copy.deepcopy(stack.getQErr()))
+
+def _counter_weight(params, weightCounter):
+    file_hdr = params.get('counters', {})
+    img_hdr = params.get('imageHeader', {})
+
+    if weightCounter in file_hdr:
+        value = file_hdr[weightCounter]
+    else:
+        value = img_hdr[weightCounter]
+
+    try:
+        weight = float(value)
+    except ValueError:
+        raise SASExceptions.DataNotCompatible('Not all weight '
+            'counter values were numbers.')
+
+    return weight
+
+def rebinStack(stack, rebin_factor, copy_params=True):
+    """
+    Rebins every profile in a stack by the rebin factor, as for
+    :func:`rebin`. The same bins are used for all of the profiles, so the
+    whole stack is binned at once.
+    """
+    rebin_factor = int(rebin_factor)
+
+    if rebin_factor < 1:
+        rebin_factor = 1
+
+    len_iq = len(stack.getQ())
+
+    no_of_bins = int(np.floor(len_iq / rebin_factor))
+
+    if no_of_bins < 1:
+        no_of_bins = 1
+
+    end_idx = no_of_bins * rebin_factor
+
+    new_q = _bin_sum(stack.getQ(), rebin_factor, end_idx)/rebin_factor
+    new_i = _bin_sum(stack.getI(), rebin_factor, end_idx)/rebin_factor
+
+    err_sqr = np.square(stack.getErr()[:, :end_idx])
+    new_err = np.sqrt(_bin_sum(err_sqr, rebin_factor, end_idx))/rebin_factor
+
+    if stack.getQErr() is not None:
+        q_err_sqr = np.square(stack.getQErr()[:end_idx])
+        new_q_err = np.sqrt(_bin_sum(q_err_sqr, rebin_factor, end_idx))/rebin_factor
+    else:
+        new_q_err = None
+
+    parameters = _binned_stack_parameters(stack, 'linear_binning', len_iq,
+        no_of_bins, copy_params)
+
+    return SASM.ProfileStack(new_i, new_q, new_err, parameters, new_q_err)
+
+def _bin_sum(data, rebin_factor, end_idx):
+    # Adding strided slices is much faster than summing over a short last axis
+    binned = data[..., 0:end_idx:rebin_factor].copy()
+
+    for first_idx in range(1, min(rebin_factor, data.shape[-1])):
+        binned += data[..., first_idx:end_idx:rebin_factor]
+
+    return binned
+
+def logBinningStack(stack, no_points, copy_params=True):
+    """
+    Rebins every profile in a stack to the number of points with logarithmic
+    bins, as for :func:`logBinning`. The bins are calculated once and used
+    for the whole stack.
+    """
+    no_points = int(no_points)
+
+    q = stack.getQ()
+    q_err = stack.getQErr()
+
+    total_pts = len(q)
+
+    if no_points <=1:
+        no_points = total_pts
+
+    if no_points >= total_pts:
+        binned_q = copy.deepcopy(q)
+        binned_i = stack.getI().copy()
+        binned_err = stack.getErr().copy()
+        binned_q_err = copy.deepcopy(q_err)
+
+    else:
+        log_bins = get_log_bins(total_pts, no_points)
+
+        starts = log_bins[:-1]
+        npts = np.ediff1d(log_bins)
+
+        binned_q = np.add.reduceat(q[:log_bins[-1]], starts)/npts
+        binned_i = np.add.reduceat(stack.getI()[:, :log_bins[-1]], starts,
+            axis=1)/npts
+        binned_err = np.add.reduceat(np.square(stack.getErr()[:, :log_bins[-1]]),
+            starts, axis=1)
+        binned_err = np.sqrt(binned_err)/npts
+
+        if q_err is not None:
+            binned_q_err = np.add.reduceat(np.square(q_err[:log_bins[-1]]),
+                starts)
+            binned_q_err = np.sqrt(binned_q_err)/npts
+        else:
+            binned_q_err = None
+
+    parameters = _binned_stack_parameters(stack, 'log_binning', total_pts,
+        len(binned_q), copy_params)
+
+    return SASM.ProfileStack(binned_i, binned_q, binned_err, parameters,
+        binned_q_err)
+
+def _binned_stack_parameters(stack, key, initial_points, final_points,
+    copy_params):
+    parameters = []
+
+    for params in stack.getAllParameters():
+        if copy_params:
+            new_params = params.share()
+
+            history = {}
+            history[key] = {'initial_file' : _history_entry(params),
+                'initial_points' : initial_points, 'final_points': final_points}
+
+            new_params['history'] = history
+
+        else:
+            new_params = {'filename' : params.get('filename')}
+
+        parameters.append(new_params)
+
+    return parameters
+
+def history_entry(sasm):
+    """
+    The filename and history of a profile, as recorded in the history of a
+    profile made from it. Each entry in the profile history is shared with
+    the new history rather than copied, so a chain of processing steps
+    references the records of the earlier steps instead of nesting copies
+    of them.
+    """
+    return _history_entry(sasm.getAllParameters())
+
+def _history_entry(parameters):
+    if 'history' not in parameters:
+        history = {}
+    elif isinstance(parameters, SASM.Metadata):
+        history = parameters.peek('history')
+    else:
+        history = parameters['history']
+
+    entry = [parameters.get('filename')]
+    entry.extend(SASM.Metadata.share_dict(history, [key], share_all=True)
+        for key in history)
+
+    return entry
+
 def get_shared_header(sasm_list):
     params_list = [sasm.getAllParameters() for sasm in sasm_list]
 
@@ -806,17 +1101,21 @@ def get_shared_values(dict_list):
     shared_params = {}
 
     for key in shared_keys:
-        if isinstance(dict_list[0][key], dict):
-            svals = get_shared_values([d[key] for d in dict_list])
+        #Values are only read, so they are not copied out of the metadata
+        values = [d.peek(key) if isinstance(d, SASM.Metadata) else d[key]
+            for d in dict_list]
+
+        if isinstance(values[0], dict):
+            svals = get_shared_values(values)
 
             if svals:
                 shared_params[key] = svals
 
         else:
-            if all(param[key] == dict_list[0][key] for param in dict_list):
-                shared_params[key] = dict_list[0][key]
+            if all(value == values[0] for value in values):
+                shared_params[key] = values[0]
 
-    return shared_params
+    return SASM.Metadata.share_dict(shared_params)
 
 def cormap_pval(data1, data2):
     """Calculate the probability for a couple of dataset to be equivalent
@@ -837,15 +1136,104 @@ def cormap_pval(data1, data2):
     if data1.shape != data2.shape:
         raise SASExceptions.CorMapError
 
-    diff_data = data2 - data1
-    c = measure_longest(diff_data)
-    n = diff_data.size
+    c = cormap_longest_runs(data1, np.atleast_2d(data2))[0]
+    n = data1.size
 
-    if c>0:
-        prob = sascalc_exts.LROH.probaB(n, c)
-    else:
-        prob = 1
-    return n, c, round(prob,6)
+    prob = cormap_probs(n, np.array([c]))[0]
+
+    return n, c, prob
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def cormap_longest_runs(ref_data, data):
+    """
+    Finds the longest run of consecutive positive, negative, or zero
+    differences between each row of data and ref_data, as for
+    measure_longest. Data that are all equal give 0.
+    """
+    n_rows, n_pts = data.shape
+    longest_runs = np.zeros(n_rows, dtype=np.int64)
+
+    for row in range(n_rows):
+        longest = 0
+        run = 0
+        prev_sign = 2
+        all_zero = True
+
+        for j in range(n_pts):
+            diff = data[row, j] - ref_data[j]
+
+            if diff > 0:
+                sign = 1
+            elif diff < 0:
+                sign = -1
+            else:
+                sign = 0
+
+            if diff != 0:
+                all_zero = False
+
+            if sign == prev_sign:
+                run += 1
+            else:
+                run = 1
+                prev_sign = sign
+
+            if run > longest:
+                longest = run
+
+        if all_zero:
+            longest = 0
+
+        longest_runs[row] = longest
+
+    return longest_runs
+
+# Tables of the CorMap probability for each longest run length, c, for a
+# given number of points, n, filled in as needed.
+_cormap_prob_tables = {}
+_cormap_prob_lock = threading.Lock()
+
+def cormap_probs(n, c):
+    """
+    Gets the CorMap probability for n points and an array of longest run
+    lengths, c. Equivalent to the probability from cormap_pval.
+    """
+    n = int(n)
+    c_max = int(c.max()) if c.size > 0 else 0
+
+    with _cormap_prob_lock:
+        table = _cormap_prob_tables.get(n)
+
+        if table is None or len(table) <= c_max:
+            start = 0 if table is None else len(table)
+            new_vals = [round(sascalc_exts.LROH.probaB(n, val), 6) if val > 0
+                else 1 for val in range(start, c_max+1)]
+
+            if table is None:
+                table = np.array(new_vals, dtype=float)
+            else:
+                table = np.concatenate((table, np.array(new_vals, dtype=float)))
+
+            _cormap_prob_tables[n] = table
+
+    return table[c]
+
+def _cormap_q_groups(sasm_list):
+    """
+    Groups profiles whose q vectors (rounded to 5 decimals, as in the
+    pairwise comparison) match, so that q vectors are only checked once
+    per profile. Returns an array of group labels.
+    """
+    labels = np.zeros(len(sasm_list), dtype=int)
+    groups = {}
+
+    for index, sasm in enumerate(sasm_list):
+        qmin, qmax = sasm.getQrange()
+        key = np.round(sasm.q[qmin:qmax], 5).tobytes()
+
+        labels[index] = groups.setdefault(key, len(groups))
+
+    return labels
 
 #This code to find the contiguous regions of the data is based on these
 #questions from stack overflow:
@@ -891,6 +1279,99 @@ def measure_longest(data):
         max_len = 0
     return max_len
 
+class CorMapMatrix(object):
+    """
+    Pairwise CorMap longest run matrix for a list of profiles. The matrix
+    is incremental: when it is updated with a new list, pairs of profiles
+    that were in the previous list are reused, and only rows for new
+    profiles are calculated. Profiles are matched by identity, along with
+    their intensity vector and q range, so a profile that has been scaled
+    or trimmed since the last update is recalculated. Only weak references
+    to the profiles are kept, so the matrix doesn't keep them alive.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._runs = np.zeros((0, 0), dtype=np.int64)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(sasm):
+        return (weakref.ref(sasm), weakref.ref(sasm.i),
+            tuple(sasm.getQrange()))
+
+    def update(self, sasm_list):
+        """
+        Updates the matrix for the profiles in sasm_list.
+
+        Parameters
+        ----------
+        sasm_list: list
+            A list of bioxtasraw.SASM.SASM objects.
+
+        Returns
+        -------
+        runs: numpy.array
+            An NxN array of the longest run for each pair of profiles.
+            Pairs that can't be compared because their q vectors are
+            different are -1.
+        n_pts: numpy.array
+            The number of points in each profile.
+        """
+        with self._lock:
+            keys = [self._key(sasm) for sasm in sasm_list]
+            old_index = {id(key[0]()): index for index, key
+                in enumerate(self._keys) if key[0]() is not None}
+
+            n_sasms = len(sasm_list)
+            runs = -1*np.ones((n_sasms, n_sasms), dtype=np.int64)
+
+            reused = []
+            new = []
+
+            for index, sasm in enumerate(sasm_list):
+                old = old_index.get(id(sasm), -1)
+
+                if (old >= 0 and self._keys[old][0]() is sasm
+                    and self._keys[old][1]() is sasm.i
+                    and self._keys[old][2] == keys[index][2]):
+                    reused.append((index, old))
+                else:
+                    new.append(index)
+
+            if reused:
+                new_idx, old_idx = np.array(reused).T
+                runs[np.ix_(new_idx, new_idx)] = self._runs[np.ix_(old_idx, old_idx)]
+
+            if new:
+                labels = _cormap_q_groups(sasm_list)
+
+                for label in np.unique(labels[new]):
+                    members = np.flatnonzero(labels == label)
+
+                    block = np.array([sasm_list[k].i[keys[k][2][0]:keys[k][2][1]]
+                        for k in members], dtype=float)
+
+                    for k in new:
+                        if labels[k] == label:
+                            row = np.flatnonzero(members == k)[0]
+                            row_runs = cormap_longest_runs(block[row], block)
+
+                            runs[k, members] = row_runs
+                            runs[members, k] = row_runs
+
+            self._keys = keys
+            self._runs = runs
+
+            n_pts = np.array([len(sasm.i[key[2][0]:key[2][1]])
+                for sasm, key in zip(sasm_list, keys)])
+
+        return runs, n_pts
+
+# Shared matrix used by run_cormap_all, so that repeated comparisons of
+# overlapping sets of profiles only calculate the new pairs.
+_cormap_matrix = CorMapMatrix()
+
 def run_cormap_all(sasm_list, correction='None'):
     pvals = np.ones((len(sasm_list), len(sasm_list)))
     corrected_pvals = np.ones_like(pvals)
@@ -901,76 +1382,62 @@ def run_cormap_all(sasm_list, correction='None'):
 
     item_data = []
 
-    for index1 in range(len(sasm_list)):
-        sasm1 = sasm_list[index1]
-        qmin1, qmax1 = sasm1.getQrange()
-        i1 = sasm1.i[qmin1:qmax1]
-        for index2 in range(1, len(sasm_list[index1:])):
-            sasm2 = sasm_list[index1+index2]
-            qmin2, qmax2 = sasm2.getQrange()
-            i2 = sasm2.i[qmin2:qmax2]
-
-            if np.all(np.round(sasm1.q[qmin1:qmax1], 5) == np.round(sasm2.q[qmin2:qmax2], 5)):
-                try:
-                    n, c, prob = cormap_pval(i1, i2)
-                except SASExceptions.CorMapError:
-                    n = 0
-                    c = -1
-                    prob = -1
-                    failed_comparisons.append((sasm1.getParameter('filename'),
-                        sasm2.getParameter('filename')))
+    runs, n_pts = _cormap_matrix.update(sasm_list)
 
-            else:
-                n = 0
-                c = -1
-                prob = -1
-                failed_comparisons.append((sasm1.getParameter('filename'),
-                    sasm2.getParameter('filename')))
-
-            pvals[index1, index1+index2] = prob
-            pvals[index1+index2, index1] = prob
-
-            if correction == 'Bonferroni':
-                c_prob = prob*m_val
-                if c_prob > 1:
-                    c_prob = 1
-                elif c_prob < -1:
-                    c_prob = -1
-                corrected_pvals[index1, index1+index2] = c_prob
-                corrected_pvals[index1+index2, index1] = c_prob
+    index1, index2 = np.triu_indices(len(sasm_list), 1)
+    pair_runs = runs[index1, index2]
+    pair_probs = -1*np.ones(len(pair_runs))
 
-            else:
-                c_prob=1
+    valid = pair_runs >= 0
+
+    for n in np.unique(n_pts[index1[valid]]):
+        n_mask = valid & (n_pts[index1] == n)
+        pair_probs[n_mask] = cormap_probs(n, pair_runs[n_mask])
+
+    pvals[index1, index2] = pair_probs
+    pvals[index2, index1] = pair_probs
+
+    if correction == 'Bonferroni':
+        pair_c_probs = pair_probs*m_val
+        pair_c_probs[pair_c_probs > 1] = 1
+        pair_c_probs[pair_c_probs < -1] = -1
+
+        corrected_pvals[index1, index2] = pair_c_probs
+        corrected_pvals[index2, index1] = pair_c_probs
+    else:
+        pair_c_probs = np.ones(len(pair_probs))
 
-            item_data.append([str(index1), str(index1+index2),
-                sasm1.getParameter('filename'), sasm2.getParameter('filename'),
-                c, prob, c_prob]
-                )
+    filenames = [sasm.getParameter('filename') for sasm in sasm_list]
+
+    for k in range(len(pair_runs)):
+        i1 = index1[k]
+        i2 = index2[k]
+
+        if not valid[k]:
+            failed_comparisons.append((filenames[i1], filenames[i2]))
+
+        item_data.append([str(i1), str(i2), filenames[i1], filenames[i2],
+            pair_runs[k], pair_probs[k], pair_c_probs[k]])
 
     return item_data, pvals, corrected_pvals, failed_comparisons
 
 def run_cormap_ref(sasm_list, ref_sasm, correction='None'):
-    pvals = np.ones(len(sasm_list), dtype=float)
+    pvals = -1*np.ones(len(sasm_list), dtype=float)
     failed_comparisons = []
 
-    for index, sasm in enumerate(sasm_list):
-        if np.all(np.round(sasm.getQ(), 5) == np.round(ref_sasm.getQ(), 5)):
-            try:
-                n, c, prob = cormap_pval(ref_sasm.getI(), sasm.getI())
-            except SASExceptions.CorMapError:
-                n = 0
-                c = -1
-                prob = -1
-                failed_comparisons.append((ref_sasm.getParameter('filename'),
-                    sasm.getParameter('filename')))
-        else:
-            n = 0
-            c = -1
-            prob = -1
-            failed_comparisons.append((ref_sasm.getParameter('filename'),
-                sasm.getParameter('filename')))
+    labels = _cormap_q_groups([ref_sasm] + list(sasm_list))[1:]
+    matched = np.flatnonzero(labels == 0)
+
+    if len(matched) > 0:
+        ref_i = ref_sasm.getI()
+        block = np.array([sasm_list[k].getI() for k in matched], dtype=float)
+
+        runs = cormap_longest_runs(ref_i, block)
+        pvals[matched] = cormap_probs(len(ref_i), runs)
 
-        pvals[index] = prob
+    for index in np.flatnonzero(labels != 0):
+        failed_comparisons.append((ref_sasm.getParameter('filename'),
+            sasm_list[index].getParameter('filename')))
 
     if correction == 'Bonferroni':
         corrected_pvals = pvals*len(sasm_list)
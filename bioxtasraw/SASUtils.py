@@ -45,8 +45,6 @@ import math
 import time
 
 import numpy as np
-import matplotlib as mpl
-import matplotlib.font_manager as fm
 import pyFAI
 
 try:
@@ -631,6 +629,8 @@ def sphere_intensity(q, R):
     return (4*np.pi*R**3/3)**2*(3*np.pi*(np.sin(q*R)-(q*R)*np.cos(q*R))/(q*R)**3)**2
 
 def get_mpl_fonts():
+        import matplotlib as mpl
+        import matplotlib.font_manager as fm
 
         fonts = []
 
@@ -663,6 +663,7 @@ def get_mpl_fonts():
         return fonts, default_plot_font
 
 def update_mpl_style(forced=None):
+    import matplotlib as mpl
 
     if forced is None:
         system_settings = wx.SystemSettings()
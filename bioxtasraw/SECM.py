@@ -34,6 +34,8 @@ import os
 import copy
 import threading
 import itertools
+import weakref
+import operator
 
 import numpy as np
 
@@ -43,6 +45,667 @@ if raw_path not in os.sys.path:
 
 import bioxtasraw.SASExceptions as SASExceptions
 import bioxtasraw.SASProc as SASProc
+import bioxtasraw.SASM as SASM
+
+class ProfileBlock(object):
+    """
+    Contiguous frames x q storage for a list of profiles that share a q
+    vector. The raw intensity and error of each profile are rows of a 2D
+    array, so scale, offset, and q range changes can be applied to a whole
+    series at once with array operations instead of one profile at a time.
+    """
+
+    def __init__(self, sasm_list):
+        """
+        Constructor. Copies the raw intensity and error of each profile
+        into the block, and sets each profile's raw vectors to the
+        corresponding rows of the block.
+
+        Parameters
+        ----------
+        sasm_list: list
+            A list of bioxtasraw.SASM.SASM objects which can be stored in a
+            block, as determined by :func:`canBlock`.
+        """
+        self.sasm_list = list(sasm_list)
+
+        self.q_raw = np.asarray(self.sasm_list[0].getRawQ())
+        self.q_scale = self.sasm_list[0].getQScale()
+
+        self.i_raw = np.array([sasm.getRawI() for sasm in self.sasm_list],
+            dtype=float)
+        self.err_raw = np.array([sasm.getRawErr() for sasm in self.sasm_list],
+            dtype=float)
+
+        for j, sasm in enumerate(self.sasm_list):
+            sasm.setRawQ(self.q_raw)
+            sasm.setRawI(self.i_raw[j])
+            sasm.setRawErr(self.err_raw[j])
+
+        self.i = None
+        self.err = None
+        self.q = None
+        self.qrange = None
+
+    @staticmethod
+    def canBlock(sasm_list):
+        """
+        Checks whether a list of profiles can be stored in a block. They
+        must all have the same q vector and q scale, and none of them can
+        have plotted error bars (which are updated on a per-profile basis).
+
+        Parameters
+        ----------
+        sasm_list: list
+            A list of bioxtasraw.SASM.SASM objects.
+
+        Returns
+        -------
+        can_block: bool
+            True if the profiles can be stored in a block.
+        """
+        if len(sasm_list) == 0:
+            return False
+
+        q_raw = sasm_list[0].getRawQ()
+        q_scale = sasm_list[0].getQScale()
+
+        for sasm in sasm_list:
+            if sasm.err_line is not None or sasm.getQScale() != q_scale:
+                return False
+
+            sasm_q = sasm.getRawQ()
+
+            if (sasm_q is not q_raw and (len(sasm_q) != len(q_raw)
+                or not np.array_equal(sasm_q, q_raw))):
+                return False
+
+            if (len(sasm.getRawI()) != len(q_raw)
+                or len(sasm.getRawErr()) != len(q_raw)):
+                return False
+
+        return True
+
+    def matches(self, sasm_list):
+        """
+        Checks whether the block still holds the raw data of the given
+        profiles, i.e. the list hasn't changed and no profile has had its
+        raw data or q scale set since the block was made.
+
+        Parameters
+        ----------
+        sasm_list: list
+            A list of bioxtasraw.SASM.SASM objects.
+
+        Returns
+        -------
+        matches: bool
+            True if the block matches the list.
+        """
+        if len(sasm_list) != len(self.sasm_list):
+            return False
+
+        for sasm, block_sasm in zip(sasm_list, self.sasm_list):
+            if (sasm is not block_sasm or sasm.getRawI().base is not self.i_raw
+                or sasm.getRawErr().base is not self.err_raw
+                or sasm.getRawQ() is not self.q_raw
+                or sasm.getQScale() != self.q_scale
+                or sasm.err_line is not None):
+                return False
+
+        return True
+
+    def isCurrent(self, sasm_list):
+        """
+        Checks whether the scaled values of the block are the ones in use by
+        the given profiles, i.e. no profile has been individually scaled,
+        offset, or trimmed since the last :func:`update`.
+
+        Parameters
+        ----------
+        sasm_list: list
+            A list of bioxtasraw.SASM.SASM objects.
+
+        Returns
+        -------
+        current: bool
+            True if the scaled values of the block are current.
+        """
+        if self.i is None or not self.matches(sasm_list):
+            return False
+
+        for sasm in sasm_list:
+            if (sasm.i.base is not self.i or sasm.q is not self.q
+                or list(sasm.getQrange()) != list(self.qrange)):
+                return False
+
+        return True
+
+    def update(self, scale_factor, offset_value, qrange):
+        """
+        Scales, offsets, and trims all of the profiles in the block.
+
+        Parameters
+        ----------
+        scale_factor: float
+            The scale factor to apply to the intensity and error.
+        offset_value: float
+            The offset to apply to the intensity.
+        qrange: tuple or list
+            The q range, as for :func:`SASM.setQrange`.
+
+        Returns
+        -------
+        mean_i: numpy.array
+            The mean intensity of each profile.
+        total_i: numpy.array
+            The total intensity of each profile.
+        """
+        if qrange[0] < 0 or qrange[1] > (len(self.q_raw)):
+            msg = ('Qrange: ' + str(qrange) + ' is not a valid q-range for a '
+                'q-vector of length ' + str(len(self.q_raw)-1))
+            raise SASExceptions.InvalidQrange(msg)
+
+        scale_factor = abs(scale_factor)
+
+        self.i = self.i_raw*scale_factor + offset_value
+        self.err = self.err_raw*scale_factor
+        self.q = self.q_raw*self.q_scale
+        self.qrange = [int(qrange[0]), int(qrange[1])]
+
+        start, end = self.qrange
+        q = self.q[start:end]
+        i = self.i[:, start:end]
+
+        if len(self.q) > 0:
+            total_i = np.trapz(i, q, axis=1)
+            mean_i = i.mean(axis=1)
+        else:
+            total_i = -1*np.ones(len(self.sasm_list))
+            mean_i = -1*np.ones(len(self.sasm_list))
+
+        for j, sasm in enumerate(self.sasm_list):
+            sasm.setScaledValues(self.i[j], self.err[j], self.q, scale_factor,
+                offset_value, self.qrange, mean_i[j], total_i[j])
+
+        return mean_i, total_i
+
+    def getIofQ(self, qref):
+        """
+        Gets the intensity of each profile at the q value closest to qref,
+        as for :func:`SASM.getIofQ`.
+
+        Parameters
+        ----------
+        qref: float
+            The reference q to get the intensity at.
+
+        Returns
+        -------
+        intensity: numpy.array
+            The intensity of each profile at the reference q.
+        """
+        start, end = self.qrange
+        index = np.argmin(np.absolute(self.q[start:end]-qref))
+
+        return self.i[:, start+index]
+
+    def getIofQRange(self, q1, q2):
+        """
+        Gets the total integrated intensity of each profile in the q range
+        from q1 to q2, as for :func:`SASM.getIofQRange`.
+
+        Parameters
+        ----------
+        q1: float
+            The starting q value in the q range
+        q2: float
+            The ending q value in the q range.
+
+        Returns
+        -------
+        total_intensity: numpy.array
+            The total intensity of each profile in the q range.
+        """
+        start, end = self.qrange
+        q = self.q[start:end]
+        index1 = np.argmin(np.absolute(q-q1))
+        index2 = np.argmin(np.absolute(q-q2))
+
+        return np.trapz(self.i[:, start+index1:start+index2+1],
+            q[index1:index2+1], axis=1)
+
+
+class LazyProfileList(object):
+    """
+    A list-like sequence of profiles that share a q vector, for very long
+    series. The raw intensity and error of the profiles are stored as frames
+    x q arrays, usually memory-mapped from disk, and the per-frame scale,
+    offset, and q range are stored as small arrays. A profile
+    (bioxtasraw.SASM.SASM) is only made when it is accessed, and is kept
+    only as long as something else holds a reference to it. The summary
+    values of the series (mean intensity, total intensity, etc) are
+    calculated from the arrays a chunk of frames at a time.
+
+    Changes made to a profile that aren't made through the series (such
+    as setting a parameter) only last as long as the profile is held.
+    Profiles appended to the list (e.g. in online mode) are held in memory
+    as normal profiles.
+    """
+
+    chunk_size = 1000
+
+    def __init__(self, q_raw, i_raw, err_raw, parameters, q_err_raw=None,
+        q_scale_factor=1.0, scale_factors=None, offset_values=None,
+        qranges=None, load_parameters=None, counters=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        q_raw: numpy.array
+            The q vector shared by all of the profiles.
+        i_raw: numpy.array
+            A frames x q array of the raw intensity of each profile. Can be
+            any array that supports numpy slicing, such as a numpy.memmap.
+        err_raw: numpy.array
+            A frames x q array of the raw error of each profile.
+        parameters: list
+            The parameters of each profile. Items can either be dictionaries
+            or strings to be read in by load_parameters.
+        q_err_raw: numpy.array, optional
+            The q error vector shared by all of the profiles.
+        q_scale_factor: float, optional
+            The q scale factor of the profiles.
+        scale_factors: numpy.array, optional
+            The scale factor of each profile. Defaults to 1.
+        offset_values: numpy.array, optional
+            The offset of each profile. Defaults to 0.
+        qranges: numpy.array, optional
+            A frames x 2 array of the q range of each profile. Defaults to
+            the full q range.
+        load_parameters: function, optional
+            A function that turns a parameter string into a dictionary.
+        counters: numpy.array, optional
+            A structured array of the numeric counter values of each
+            profile, NaN if a profile doesn't have a counter. Used to get
+            counter values without reading in the parameters of every
+            profile.
+        """
+        n_frames = i_raw.shape[0]
+
+        self.q_raw = np.asarray(q_raw)
+        self.q_err_raw = q_err_raw
+        self.q_scale_factor = q_scale_factor
+        self.i_raw = i_raw
+        self.err_raw = err_raw
+        self.parameters = list(parameters)
+        self.load_parameters = load_parameters
+
+        if scale_factors is None:
+            scale_factors = np.ones(n_frames)
+        if offset_values is None:
+            offset_values = np.zeros(n_frames)
+        if qranges is None:
+            qranges = np.tile([0, len(self.q_raw)], (n_frames, 1))
+
+        self.scale_factors = np.array(scale_factors, dtype=float)
+        self.offset_values = np.array(offset_values, dtype=float)
+        self.qranges = np.array(qranges, dtype=int).reshape((n_frames, 2))
+        self.counters = counters
+
+        self._appended = []
+        self._sasms = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return self.i_raw.shape[0] + len(self._appended)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[j] for j in range(*index.indices(len(self)))]
+
+        index = operator.index(index)
+        n_frames = len(self)
+
+        if index < 0:
+            index = index + n_frames
+
+        if index < 0 or index >= n_frames:
+            raise IndexError('Profile index out of range')
+
+        n_stored = self.i_raw.shape[0]
+
+        if index >= n_stored:
+            return self._appended[index - n_stored]
+
+        sasm = self._sasms.get(index)
+
+        if sasm is None:
+            sasm = self._makeSASM(index)
+            self._sasms[index] = sasm
+
+        return sasm
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
+    def __deepcopy__(self, memo):
+        # The stored arrays aren't modified, so they can be shared
+        copy_list = LazyProfileList(self.q_raw, self.i_raw, self.err_raw,
+            copy.deepcopy(self.parameters, memo), self.q_err_raw,
+            self.q_scale_factor, self.scale_factors, self.offset_values,
+            self.qranges, self.load_parameters, self.counters)
+
+        copy_list._appended = copy.deepcopy(self._appended, memo)
+
+        return copy_list
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['i_raw'] = np.asarray(self.i_raw)
+        state['err_raw'] = np.asarray(self.err_raw)
+        state['_sasms'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sasms = weakref.WeakValueDictionary()
+
+    def _getParameters(self, index):
+        parameters = self.parameters[index]
+
+        if not isinstance(parameters, dict):
+            parameters = self.load_parameters(parameters)
+        else:
+            parameters = copy.deepcopy(parameters)
+
+        return parameters
+
+    def _makeSASM(self, index):
+        # All of the profiles share the q vector
+        sasm = SASM.SASM(np.array(self.i_raw[index]), self.q_raw,
+            np.array(self.err_raw[index]), self._getParameters(index),
+            self.q_err_raw, copy_data=False)
+
+        sasm.setScaleValues(self.scale_factors[index], self.offset_values[index],
+            self.q_scale_factor)
+        sasm.setQrange(self.qranges[index])
+
+        return sasm
+
+    def extend(self, sasm_list):
+        """
+        Appends profiles to the list. These are kept in memory.
+
+        Parameters
+        ----------
+        sasm_list: list
+            A list of bioxtasraw.SASM.SASM objects.
+        """
+        self._appended.extend(sasm_list)
+
+    def truncate(self, n_frames):
+        """
+        Removes all but the first n_frames profiles from the list. The
+        stored arrays aren't copied, the list just uses fewer of their
+        frames.
+
+        Parameters
+        ----------
+        n_frames: int
+            The number of profiles to keep.
+        """
+        n_frames = max(int(n_frames), 0)
+        n_stored = self.i_raw.shape[0]
+
+        if n_frames >= n_stored:
+            del self._appended[n_frames-n_stored:]
+            return
+
+        self.i_raw = self.i_raw[:n_frames]
+        self.err_raw = self.err_raw[:n_frames]
+        self.parameters = self.parameters[:n_frames]
+        self.scale_factors = self.scale_factors[:n_frames]
+        self.offset_values = self.offset_values[:n_frames]
+        self.qranges = self.qranges[:n_frames]
+
+        if self.counters is not None:
+            self.counters = self.counters[:n_frames]
+
+        self._appended = []
+
+        for index in list(self._sasms.keys()):
+            if index >= n_frames:
+                self._sasms.pop(index, None)
+
+    def iterCounters(self, names):
+        """
+        Yields the named counters of each profile. For stored profiles these
+        are read from the counter array, if available, so the parameters of
+        the profiles aren't read in.
+
+        Parameters
+        ----------
+        names: list
+            The names of the counters to get.
+
+        Yields
+        ------
+        counters: dict
+            The counters of the profile that are in names. Counters that
+            the profile doesn't have are left out.
+        """
+        n_stored = self.i_raw.shape[0]
+
+        if self.counters is not None:
+            fields = [name for name in names if name in self.counters.dtype.names]
+            values = [np.asarray(self.counters[name]) for name in fields]
+
+            for j in range(n_stored):
+                yield {name: val[j] for name, val in zip(fields, values)
+                    if np.isfinite(val[j])}
+
+        else:
+            for j in range(n_stored):
+                counters = self._getParameters(j).get('counters', {})
+                yield {name: counters[name] for name in names if name in counters}
+
+        for sasm in self._appended:
+            counters = sasm.getAllParameters().get('counters', {})
+            yield {name: counters[name] for name in names if name in counters}
+
+    def _chunks(self):
+        # Yields the start and end index, scaled intensity, and q vector for
+        # each group of stored frames that share a q range
+        q = self.q_raw*self.q_scale_factor
+
+        for start in range(0, self.i_raw.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, self.i_raw.shape[0])
+
+            i = (np.asarray(self.i_raw[start:end])
+                *np.abs(self.scale_factors[start:end, None])
+                + self.offset_values[start:end, None])
+
+            qranges, groups = np.unique(self.qranges[start:end], axis=0,
+                return_inverse=True)
+
+            for j, qrange in enumerate(qranges):
+                rows = np.flatnonzero(groups == j)
+
+                yield start + rows, i[rows], q, qrange
+
+    def update(self, scale_factor, offset_value, qrange=None):
+        """
+        Sets the scale, offset, and (if provided) q range of all of the
+        profiles.
+
+        Parameters
+        ----------
+        scale_factor: float
+            The scale factor to apply to the intensity and error.
+        offset_value: float
+            The offset to apply to the intensity.
+        qrange: tuple or list, optional
+            The q range, as for :func:`SASM.setQrange`.
+
+        Returns
+        -------
+        mean_i: numpy.array
+            The mean intensity of each profile.
+        total_i: numpy.array
+            The total intensity of each profile.
+        """
+        if qrange is not None and (qrange[0] < 0 or qrange[1] > (len(self.q_raw))):
+            msg = ('Qrange: ' + str(qrange) + ' is not a valid q-range for a '
+                'q-vector of length ' + str(len(self.q_raw)-1))
+            raise SASExceptions.InvalidQrange(msg)
+
+        self.scale_factors[:] = scale_factor
+        self.offset_values[:] = offset_value
+
+        if qrange is not None:
+            self.qranges[:] = [int(qrange[0]), int(qrange[1])]
+
+        for index, sasm in list(self._sasms.items()):
+            sasm.setScaleValues(self.scale_factors[index],
+                self.offset_values[index], self.q_scale_factor)
+            sasm.setQrange(self.qranges[index])
+
+        for sasm in self._appended:
+            sasm.scale(scale_factor)
+            sasm.offset(offset_value)
+
+            if qrange is not None:
+                sasm.setQrange(qrange)
+
+        return self.getMeanTotalI()
+
+    def getMeanTotalI(self):
+        """
+        Gets the mean and total intensity of each profile.
+
+        Returns
+        -------
+        mean_i: numpy.array
+            The mean intensity of each profile.
+        total_i: numpy.array
+            The total intensity of each profile.
+        """
+        mean_i = np.empty(len(self))
+        total_i = np.empty(len(self))
+
+        for rows, i, q, qrange in self._chunks():
+            start, end = qrange
+
+            if len(q) > 0:
+                total_i[rows] = np.trapz(i[:, start:end], q[start:end], axis=1)
+                mean_i[rows] = i[:, start:end].mean(axis=1)
+            else:
+                total_i[rows] = -1
+                mean_i[rows] = -1
+
+        n_stored = self.i_raw.shape[0]
+
+        for j, sasm in enumerate(self._appended):
+            mean_i[n_stored+j] = sasm.getMeanI()
+            total_i[n_stored+j] = sasm.getTotalI()
+
+        return mean_i, total_i
+
+    def getIofQ(self, qref):
+        """
+        Gets the intensity of each profile at the q value closest to qref,
+        as for :func:`SASM.getIofQ`.
+
+        Parameters
+        ----------
+        qref: float
+            The reference q to get the intensity at.
+
+        Returns
+        -------
+        intensity: numpy.array
+            The intensity of each profile at the reference q.
+        """
+        intensity = np.empty(len(self))
+
+        for rows, i, q, qrange in self._chunks():
+            start, end = qrange
+            index = np.argmin(np.absolute(q[start:end]-qref))
+
+            intensity[rows] = i[:, start+index]
+
+        n_stored = self.i_raw.shape[0]
+
+        for j, sasm in enumerate(self._appended):
+            intensity[n_stored+j] = sasm.getIofQ(qref)
+
+        return intensity
+
+    def getIofQRange(self, q1, q2):
+        """
+        Gets the total integrated intensity of each profile in the q range
+        from q1 to q2, as for :func:`SASM.getIofQRange`.
+
+        Parameters
+        ----------
+        q1: float
+            The starting q value in the q range
+        q2: float
+            The ending q value in the q range.
+
+        Returns
+        -------
+        total_intensity: numpy.array
+            The total intensity of each profile in the q range.
+        """
+        intensity = np.empty(len(self))
+
+        for rows, i, q, qrange in self._chunks():
+            start, end = qrange
+            q_sub = q[start:end]
+            index1 = np.argmin(np.absolute(q_sub-q1))
+            index2 = np.argmin(np.absolute(q_sub-q2))
+
+            intensity[rows] = np.trapz(i[:, start+index1:start+index2+1],
+                q_sub[index1:index2+1], axis=1)
+
+        n_stored = self.i_raw.shape[0]
+
+        for j, sasm in enumerate(self._appended):
+            intensity[n_stored+j] = sasm.getIofQRange(q1, q2)
+
+        return intensity
+
+
+def _profileList(sasm_list):
+    # Lazy lists are kept as they are, anything else is copied to a list
+    if isinstance(sasm_list, LazyProfileList):
+        return sasm_list
+    else:
+        return list(sasm_list)
+
+def _replaceProfiles(sasm_list, n_keep, new_sasm_list):
+    # Keeps the first n_keep profiles and adds the new ones after them. The
+    # list is changed in place, so lazy lists don't read in their profiles.
+    if isinstance(sasm_list, LazyProfileList):
+        sasm_list.truncate(n_keep)
+    else:
+        del sasm_list[n_keep:]
+
+    sasm_list.extend(new_sasm_list)
+
+    return sasm_list
+
+def _copyProfileList(sasm_list):
+    # Copies a list of profiles without the profile history. Lazy lists share
+    # their stored data, so a deep copy is cheap.
+    if isinstance(sasm_list, LazyProfileList):
+        return copy.deepcopy(sasm_list)
+    else:
+        return [sasm.copy_no_metadata() for sasm in sasm_list]
+
 
 class SECM(object):
     """
@@ -101,6 +764,10 @@ class SECM(object):
         that case, each item is the linear fit results a, b, and
         corresponding covariances for a given q value. There is one item
         per q value of the input profiles.
+    baseline_correction: :class:`bioxtasraw.SASCalc.BaselineCorrection`
+        The state of the baseline correction while the series is growing,
+        kept by :func:`bioxtasraw.SASCalc.updateSeriesBaseline`. None if the
+        baseline correction hasn't been updated since it was set.
     sample_range: list
         A list defining the set sample range. The list is made up of a set
         of sub-ranges, each defined by an entry in the list. Each sub-range
@@ -172,9 +839,16 @@ class SECM(object):
                 filename =  os.path.splitext(os.path.basename(self._file_list[0]))[0]
             self._parameters['filename'] = filename
 
+        # Contiguous frames x q storage for the profile lists, see _update
+        self._profile_blocks = {}
+        self._getProfileBlock('unsub', self._sasm_list)
+
         #Extract initial mean and total intensity variables
-        self.mean_i = np.array([sasm.getMeanI() for sasm in self._sasm_list])
-        self.total_i = np.array([sasm.getTotalI() for sasm in self._sasm_list])
+        if isinstance(self._sasm_list, LazyProfileList):
+            self.mean_i, self.total_i = self._sasm_list.getMeanTotalI()
+        else:
+            self.mean_i = np.array([sasm.getMeanI() for sasm in self._sasm_list])
+            self.total_i = np.array([sasm.getTotalI() for sasm in self._sasm_list])
 
         #Make sure we have as many frame numbers as sasm objects
 
@@ -236,6 +910,7 @@ class SECM(object):
         self.baseline_type = ''
         self.baseline_extrap = True
         self.baseline_fit_results = []
+        self.baseline_correction = None
 
         self.baseline_subtracted_sasm_list = []
         self.use_baseline_subtracted_sasm = []
@@ -272,77 +947,181 @@ class SECM(object):
         state = self.__dict__.copy()
         # Remove the unpicklable entries.
         del state['my_semaphore']
+        state['_profile_blocks'] = {}
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
         self.my_semaphore = threading.Semaphore()
+        self._profile_blocks = {}
 
 
     def _update(self):
         ''' updates modified intensity after scale, normalization and offset changes '''
 
-        for i, sasm in enumerate(self._sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
+        mean_i, total_i, I_of_q, qrange_I = self._updateProfiles('unsub',
+            self._sasm_list, self._q_range)
 
-            if self._q_range is not None:
-                sasm.setQrange((self._q_range[0], self._q_range[1]+1))
+        self.mean_i = mean_i
+        self.total_i = total_i
 
-            self.mean_i[i] = sasm.getMeanI()
-            self.total_i[i] = sasm.getTotalI()
+        if I_of_q is not None:
+            self.I_of_q = I_of_q
+        if qrange_I is not None:
+            self.qrange_I = qrange_I
 
-            if self.qref > 0:
-                self.I_of_q[i] = sasm.getIofQ(self.qref)
+        if self.subtracted_sasm_list:
+            mean_i, total_i, I_of_q, qrange_I = self._updateProfiles('sub',
+                self.subtracted_sasm_list, self._sub_q_range)
 
-            if self.qrange[0] != 0 and self.qrange[1] != 0:
-                self.qrange_I[i] = sasm.getIofQRange(self.qrange[0], self.qrange[1])
+            self.mean_i_sub = mean_i
+            self.total_i_sub = total_i
 
-        for i, sasm in enumerate(self.subtracted_sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
+            if I_of_q is not None:
+                self.I_of_q_sub = I_of_q
+            if qrange_I is not None:
+                self.qrange_I_sub = qrange_I
+
+        if self.baseline_subtracted_sasm_list:
+            mean_i, total_i, I_of_q, qrange_I = self._updateProfiles('baseline',
+                self.baseline_subtracted_sasm_list, self._bc_sub_q_range)
+
+            self.mean_i_bcsub = mean_i
+            self.total_i_bcsub = total_i
+
+            if I_of_q is not None:
+                self.I_of_q_bcsub = I_of_q
+            if qrange_I is not None:
+                self.qrange_I_bcsub = qrange_I
+
+        self._updateProfiles('baseline_corr', self.baseline_corr,
+            self._sub_q_range, False)
+
+        if self.average_buffer_sasm is not None:
+            self.average_buffer_sasm.scale(self._scale_factor)
+            self.average_buffer_sasm.offset(self._offset_value)
 
             if self._sub_q_range is not None:
-                sasm.setQrange((self._sub_q_range[0], self._sub_q_range[1]+1))
+                self.average_buffer_sasm.setQrange((self._sub_q_range[0], self._sub_q_range[1]+1))
 
-            self.mean_i_sub[i] = sasm.getMeanI()
-            self.total_i_sub[i] = sasm.getTotalI()
+    def _getProfileBlock(self, int_type, sasm_list):
+        """
+        Gets the bioxtasraw.SECM.ProfileBlock holding the given profiles,
+        making a new one if the profiles have changed. If int_type is None
+        the block is not cached. Returns None if the profiles can't be
+        stored in a block.
+        """
+        block = self._profile_blocks.get(int_type)
 
-            if self.qref > 0:
-                self.I_of_q_sub[i] = sasm.getIofQ(self.qref)
+        if isinstance(sasm_list, LazyProfileList):
+            block = None
 
-            if self.qrange[0] != 0 and self.qrange[1] != 0:
-                self.qrange_I_sub[i] = sasm.getIofQRange(self.qrange[0], self.qrange[1])
+        elif block is None or not block.matches(sasm_list):
+            if ProfileBlock.canBlock(sasm_list):
+                block = ProfileBlock(sasm_list)
+            else:
+                block = None
 
-        for i, sasm in enumerate(self.baseline_subtracted_sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
+            if int_type is not None:
+                self._profile_blocks[int_type] = block
 
-            if self._bc_sub_q_range is not None:
-                sasm.setQrange((self._bc_sub_q_range[0], self._bc_sub_q_range[1]+1))
+        return block
 
-            self.mean_i_bcsub[i] = sasm.getMeanI()
-            self.total_i_bcsub[i] = sasm.getTotalI()
+    def _updateProfiles(self, int_type, sasm_list, q_range, calc_values=True):
+        """
+        Applies the series scale, offset, and q range to a list of profiles
+        and returns the mean intensity, total intensity, intensity at qref,
+        and intensity in the qrange of each profile. The last two are None
+        if qref or qrange aren't set.
+        """
+        if q_range is not None:
+            qrange = (q_range[0], q_range[1]+1)
+        else:
+            qrange = None
 
-            if self.qref > 0:
-                self.I_of_q_bcsub[i] = sasm.getIofQ(self.qref)
+        if isinstance(sasm_list, LazyProfileList):
+            mean_i, total_i = sasm_list.update(self._scale_factor,
+                self._offset_value, qrange)
 
-            if self.qrange[0] != 0 and self.qrange[1] != 0:
-                self.qrange_I_bcsub[i] = sasm.getIofQRange(self.qrange[0], self.qrange[1])
+            I_of_q = None
+            qrange_I = None
 
-        for i, sasm in enumerate(self.baseline_corr):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
+            if calc_values and self.qref > 0:
+                I_of_q = sasm_list.getIofQ(self.qref)
 
-            if self._sub_q_range is not None:
-                sasm.setQrange((self._sub_q_range[0], self._sub_q_range[1]+1))
+            if calc_values and tuple(self.qrange) != (0, 0):
+                qrange_I = sasm_list.getIofQRange(self.qrange[0], self.qrange[1])
 
-        if self.average_buffer_sasm is not None:
-            self.average_buffer_sasm.scale(self._scale_factor)
-            self.average_buffer_sasm.offset(self._offset_value)
+            return mean_i, total_i, I_of_q, qrange_I
 
-            if self._sub_q_range is not None:
-                self.average_buffer_sasm.setQrange((self._sub_q_range[0], self._sub_q_range[1]+1))
+        block = self._getProfileBlock(int_type, sasm_list)
+
+        if block is not None and qrange is None:
+            qranges = set(tuple(sasm.getQrange()) for sasm in sasm_list)
+
+            if len(qranges) == 1:
+                qrange = qranges.pop()
+            else:
+                block = None
+
+        I_of_q = None
+        qrange_I = None
+
+        if block is not None:
+            mean_i, total_i = block.update(self._scale_factor,
+                self._offset_value, qrange)
+
+            if calc_values and self.qref > 0:
+                I_of_q = block.getIofQ(self.qref)
+
+            if calc_values and tuple(self.qrange) != (0, 0):
+                qrange_I = block.getIofQRange(self.qrange[0], self.qrange[1])
+
+        else:
+            for sasm in sasm_list:
+                sasm.scale(self._scale_factor)
+                sasm.offset(self._offset_value)
+
+                if qrange is not None:
+                    sasm.setQrange(qrange)
+
+            mean_i = np.array([sasm.getMeanI() for sasm in sasm_list])
+            total_i = np.array([sasm.getTotalI() for sasm in sasm_list])
+
+            if calc_values and self.qref > 0:
+                I_of_q = np.array([sasm.getIofQ(self.qref) for sasm in sasm_list])
+
+            if calc_values and tuple(self.qrange) != (0, 0):
+                qrange_I = np.array([sasm.getIofQRange(self.qrange[0],
+                    self.qrange[1]) for sasm in sasm_list])
+
+        return mean_i, total_i, I_of_q, qrange_I
+
+    def _calcIofQ(self, int_type, sasm_list, qref):
+        """ Gets the intensity at qref for each profile in the list """
+        block = self._profile_blocks.get(int_type)
+
+        if isinstance(sasm_list, LazyProfileList):
+            I_of_q = sasm_list.getIofQ(qref)
+        elif block is not None and block.isCurrent(sasm_list):
+            I_of_q = block.getIofQ(qref)
+        else:
+            I_of_q = np.array([sasm.getIofQ(qref) for sasm in sasm_list])
+
+        return I_of_q
+
+    def _calcIofQRange(self, int_type, sasm_list, q1, q2):
+        """ Gets the intensity in the q range for each profile in the list """
+        block = self._profile_blocks.get(int_type)
+
+        if isinstance(sasm_list, LazyProfileList):
+            qrange_I = sasm_list.getIofQRange(q1, q2)
+        elif block is not None and block.isCurrent(sasm_list):
+            qrange_I = block.getIofQRange(q1, q2)
+        else:
+            qrange_I = np.array([sasm.getIofQRange(q1, q2) for sasm in sasm_list])
+
+        return qrange_I
 
 
     def append(self, filename_list, sasm_list, frame_list):
@@ -362,19 +1141,15 @@ class SECM(object):
             A list of the frame numbers of each item in the sasm_list. Usually
             just range(len(sasm_list))
         """
-        for i, sasm in enumerate(sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
-
-            if self._q_range is not None:
-                sasm.setQrange((self._q_range[0], self._q_range[1]+1))
+        mean_i, total_i, I_of_q, qrange_I = self._updateProfiles(None,
+            sasm_list, self._q_range)
 
         self._file_list.extend(filename_list)
         self._sasm_list.extend(sasm_list)
         self.frame_list = np.concatenate((self.frame_list, np.array(frame_list, dtype=int)))
 
-        self.mean_i = np.concatenate((self.mean_i, np.array([sasm.getMeanI() for sasm in sasm_list])))
-        self.total_i = np.concatenate((self.total_i, np.array([sasm.getTotalI() for sasm in sasm_list])))
+        self.mean_i = np.concatenate((self.mean_i, mean_i))
+        self.total_i = np.concatenate((self.total_i, total_i))
 
         if len(self._sasm_list) != len(self.frame_list):
             self.frame_list = np.arange(len(self._sasm_list))
@@ -382,12 +1157,10 @@ class SECM(object):
 
         self._calcTime(sasm_list)
 
-        if self.qref>0:
-            I_of_q = np.array([sasm.getIofQ(self.qref) for sasm in sasm_list])
+        if I_of_q is not None:
             self.I_of_q = np.concatenate((self.I_of_q, I_of_q))
 
-        if self.qrange != (0,0):
-            qrange_I = np.array([sasm.getIofQRange(self.qrange[0], self.qrange[1]) for sasm in sasm_list])
+        if qrange_I is not None:
             self.qrange_I = np.concatenate((self.qrange_I, qrange_I))
 
         self.plot_frame_list = np.arange(len(self.frame_list))
@@ -513,40 +1286,47 @@ class SECM(object):
         else:
             return self.time
 
+    def _iterCounters(self, sasm_list, names):
+        # Yields the counters of each profile that has counters. Lazy lists
+        # read the named counters from their counter arrays.
+        if isinstance(sasm_list, LazyProfileList):
+            for counters in sasm_list.iterCounters(names):
+                if counters:
+                    yield counters
+        else:
+            for sasm in sasm_list:
+                if 'counters' in sasm.getAllParameters():
+                    yield sasm.getParameter('counters')
+
     def _calcTime(self, sasm_list):
         time=list(self.time)
 
         if self.hdr_format == 'G1, CHESS' or self.hdr_format == 'G1 WAXS, CHESS':
-            for sasm in sasm_list:
-                if 'counters' in sasm.getAllParameters():
-                    file_hdr = sasm.getParameter('counters')
-
-                    if '#C' not in list(file_hdr.values()):
-                        if 'Time' in file_hdr:
-                            sasm_time = float(file_hdr['Time'])
-                            time.append(sasm_time)
-
-                        elif 'Seconds' in file_hdr:
-                            sasm_time = float(file_hdr['Seconds'])
-                            if len(time) == 0:
-                                time.append(0)
-                            else:
-                                time.append(sasm_time+time[-1])
-
-                        elif 'Exposure_time' in file_hdr:
-                            sasm_time = float(file_hdr['Exposure_time'])
-                            if len(time) == 0:
-                                time.append(0)
-                            else:
-                                time.append(sasm_time+self.time[-1])
+            for file_hdr in self._iterCounters(sasm_list, ['Time', 'Seconds',
+                'Exposure_time']):
+                if '#C' not in list(file_hdr.values()):
+                    if 'Time' in file_hdr:
+                        sasm_time = float(file_hdr['Time'])
+                        time.append(sasm_time)
+
+                    elif 'Seconds' in file_hdr:
+                        sasm_time = float(file_hdr['Seconds'])
+                        if len(time) == 0:
+                            time.append(0)
+                        else:
+                            time.append(sasm_time+time[-1])
+
+                    elif 'Exposure_time' in file_hdr:
+                        sasm_time = float(file_hdr['Exposure_time'])
+                        if len(time) == 0:
+                            time.append(0)
+                        else:
+                            time.append(sasm_time+self.time[-1])
 
         elif self.hdr_format == 'BioCAT, APS':
-            for sasm in sasm_list:
-                if 'counters' in sasm.getAllParameters():
-                    file_hdr = sasm.getParameter('counters')
-
-                    if 'start_time' in file_hdr:
-                        time.append(float(file_hdr['start_time']))
+            for file_hdr in self._iterCounters(sasm_list, ['start_time']):
+                if 'start_time' in file_hdr:
+                    time.append(float(file_hdr['start_time']))
 
         self.time = np.array(time, dtype=float)
 
@@ -987,7 +1767,7 @@ class SECM(object):
         be faster.
         """
         copy_secm = SECM(copy.deepcopy(self._file_list),
-            [sasm.copy_no_metadata() for sasm in self._sasm_list],
+            _copyProfileList(self._sasm_list),
             copy.deepcopy(self.frame_list), copy.deepcopy(self._parameters),
             copy.deepcopy(self.hdr_format))
 
@@ -1011,7 +1791,7 @@ class SECM(object):
         if self.average_buffer_sasm is not None:
             copy_secm.average_buffer_sasm = self.average_buffer_sasm.copy_no_metadata()
 
-        copy_secm.subtracted_sasm_list = [sasm.copy_no_metadata() for sasm in self.subtracted_sasm_list]
+        copy_secm.subtracted_sasm_list = _copyProfileList(self.subtracted_sasm_list)
         copy_secm.use_subtracted_sasm = copy.deepcopy(self.use_subtracted_sasm)
         copy_secm.mean_i_sub = copy.deepcopy(self.mean_i_sub)
         copy_secm.total_i_sub = copy.deepcopy(self.total_i_sub)
@@ -1025,7 +1805,7 @@ class SECM(object):
         copy_secm.baseline_extrap = copy.deepcopy(self.baseline_extrap)
         copy_secm.baseline_fit_results = copy.deepcopy(self.baseline_fit_results)
 
-        copy_secm.baseline_subtracted_sasm_list = [sasm.copy_no_metadata() for sasm in self.baseline_subtracted_sasm_list]
+        copy_secm.baseline_subtracted_sasm_list = _copyProfileList(self.baseline_subtracted_sasm_list)
         copy_secm.use_baseline_subtracted_sasm = copy.deepcopy(self.use_baseline_subtracted_sasm)
         copy_secm.mean_i_bcsub = copy.deepcopy(self.mean_i_bcsub)
         copy_secm.total_i_bcsub = copy.deepcopy(self.total_i_bcsub)
@@ -1099,13 +1879,15 @@ class SECM(object):
             The intensity of each profile at the given q value.
         """
         self.qref=float(qref)
-        self.I_of_q = np.array([sasm.getIofQ(qref) for sasm in self.getAllSASMs()])
+        self.I_of_q = self._calcIofQ('unsub', self._sasm_list, qref)
 
         if self.subtracted_sasm_list:
-            self.I_of_q_sub = np.array([sasm.getIofQ(qref) for sasm in self.subtracted_sasm_list])
+            self.I_of_q_sub = self._calcIofQ('sub', self.subtracted_sasm_list,
+                qref)
 
         if self.baseline_subtracted_sasm_list:
-            self.I_of_q_bcsub = np.array([sasm.getIofQ(qref) for sasm in self.baseline_subtracted_sasm_list])
+            self.I_of_q_bcsub = self._calcIofQ('baseline',
+                self.baseline_subtracted_sasm_list, qref)
 
         return self.I_of_q
 
@@ -1128,13 +1910,16 @@ class SECM(object):
             The total intensity of each profile in the given q range.
         """
         self.qrange = qrange
-        self.qrange_I = np.array([sasm.getIofQRange(qrange[0], qrange[1]) for sasm in self.getAllSASMs()])
+        self.qrange_I = self._calcIofQRange('unsub', self._sasm_list,
+            qrange[0], qrange[1])
 
         if self.subtracted_sasm_list:
-            self.qrange_I_sub = np.array([sasm.getIofQRange(qrange[0], qrange[1]) for sasm in self.subtracted_sasm_list])
+            self.qrange_I_sub = self._calcIofQRange('sub',
+                self.subtracted_sasm_list, qrange[0], qrange[1])
 
         if self.baseline_subtracted_sasm_list:
-            self.qrange_I_bcsub = np.array([sasm.getIofQRange(qrange[0], qrange[1]) for sasm in self.baseline_subtracted_sasm_list])
+            self.qrange_I_bcsub = self._calcIofQRange('baseline',
+                self.baseline_subtracted_sasm_list, qrange[0], qrange[1])
 
         return self.qrange_I
 
@@ -1720,24 +2505,20 @@ class SECM(object):
             A list of bools indicating whether or not the subtracted profiles
             should be used when calculating parameters such as Rg.
         """
-        for i, sasm in enumerate(sub_sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
-
-            if self._sub_q_range is not None:
-                sasm.setQrange((self._sub_q_range[0], self._sub_q_range[1]+1))
-
-        self.subtracted_sasm_list = list(sub_sasm_list)
+        self.subtracted_sasm_list = _profileList(sub_sasm_list)
         self.use_subtracted_sasm = list(use_sub_sasm)
 
-        self.mean_i_sub = np.array([sasm.getMeanI() for sasm in sub_sasm_list])
-        self.total_i_sub = np.array([sasm.getTotalI() for sasm in sub_sasm_list])
+        mean_i, total_i, I_of_q, qrange_I = self._updateProfiles('sub',
+            self.subtracted_sasm_list, self._sub_q_range)
+
+        self.mean_i_sub = mean_i
+        self.total_i_sub = total_i
 
-        if self.qref>0:
-            self.I_of_q_sub = np.array([sasm.getIofQ(self.qref) for sasm in sub_sasm_list])
+        if I_of_q is not None:
+            self.I_of_q_sub = I_of_q
 
-        if self.qrange != (0,0):
-            self.qrange_I_sub = np.array([sasm.getIofQRange(self.qrange[0], self.qrange[1]) for sasm in sub_sasm_list])
+        if qrange_I is not None:
+            self.qrange_I_sub = qrange_I
 
     def appendSubtractedSASMs(self, sub_sasm_list, use_sasm_list, window_size):
         """
@@ -1754,30 +2535,25 @@ class SECM(object):
         window_size: int
             The averaging window size used to calculate the parameters.
         """
-        for i, sasm in enumerate(sub_sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
+        mean_i, total_i, I_of_q, qrange_I = self._updateProfiles(None,
+            sub_sasm_list, self._sub_q_range)
 
-            if self._sub_q_range is not None:
-                sasm.setQrange((self._sub_q_range[0], self._sub_q_range[1]+1))
+        n_keep = max(len(self.subtracted_sasm_list) - window_size, 0)
 
-        self.subtracted_sasm_list = self.subtracted_sasm_list[:-window_size] + sub_sasm_list
-        self.use_subtracted_sasm = self.use_subtracted_sasm[:-window_size] + use_sasm_list
+        self.subtracted_sasm_list = _replaceProfiles(self.subtracted_sasm_list,
+            n_keep, sub_sasm_list)
+        self.use_subtracted_sasm = list(self.use_subtracted_sasm[:n_keep]) + list(use_sasm_list)
 
-        self.mean_i_sub = np.concatenate((self.mean_i_sub[:-window_size],
-            np.array([sasm.getMeanI() for sasm in sub_sasm_list])))
-        self.total_i_sub = np.concatenate((self.total_i_sub[:-window_size],
-            np.array([sasm.getTotalI() for sasm in sub_sasm_list])))
+        self.mean_i_sub = np.concatenate((self.mean_i_sub[:n_keep], mean_i))
+        self.total_i_sub = np.concatenate((self.total_i_sub[:n_keep], total_i))
 
-        if self.qref>0:
-            I_of_q_sub = np.array([sasm.getIofQ(self.qref) for sasm in sub_sasm_list])
-            self.I_of_q_sub = np.concatenate((self.I_of_q_sub[:-window_size],
-                I_of_q_sub))
+        if I_of_q is not None:
+            self.I_of_q_sub = np.concatenate((self.I_of_q_sub[:n_keep],
+                I_of_q))
 
-        if self.qrange != (0,0):
-            qrange_I_sub = np.array([sasm.getIofQRange(self.qrange[0], self.qrange[1]) for sasm in sub_sasm_list])
-            self.qrange_I_sub = np.concatenate((self.qrange_I_sub[:-window_size],
-                qrange_I_sub))
+        if qrange_I is not None:
+            self.qrange_I_sub = np.concatenate((self.qrange_I_sub[:n_keep],
+                qrange_I))
 
     def setBCSubtractedSASMs(self, sub_sasm_list, use_sub_sasm):
         """
@@ -1791,24 +2567,20 @@ class SECM(object):
             A list of bools indicating whether or not the profiles should be
             used when calculating parameters such as Rg.
         """
-        for i, sasm in enumerate(sub_sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
-
-            if self._bc_sub_q_range is not None:
-                sasm.setQrange((self._bc_sub_q_range[0], self._bc_sub_q_range[1]+1))
-
-        self.baseline_subtracted_sasm_list = list(sub_sasm_list)
+        self.baseline_subtracted_sasm_list = _profileList(sub_sasm_list)
         self.use_baseline_subtracted_sasm = list(use_sub_sasm)
 
-        self.mean_i_bcsub = np.array([sasm.getMeanI() for sasm in sub_sasm_list])
-        self.total_i_bcsub = np.array([sasm.getTotalI() for sasm in sub_sasm_list])
+        mean_i, total_i, I_of_q, qrange_I = self._updateProfiles('baseline',
+            self.baseline_subtracted_sasm_list, self._bc_sub_q_range)
+
+        self.mean_i_bcsub = mean_i
+        self.total_i_bcsub = total_i
 
-        if self.qref>0:
-            self.I_of_q_bcsub = np.array([sasm.getIofQ(self.qref) for sasm in sub_sasm_list])
+        if I_of_q is not None:
+            self.I_of_q_bcsub = I_of_q
 
-        if self.qrange != (0,0):
-            self.qrange_I_bcsub = np.array([sasm.getIofQRange(self.qrange[0], self.qrange[1]) for sasm in sub_sasm_list])
+        if qrange_I is not None:
+            self.qrange_I_bcsub = qrange_I
 
     def appendBCSubtractedSASMs(self, sub_sasm_list, use_sasm_list, window_size):
         """
@@ -1826,27 +2598,22 @@ class SECM(object):
         window_size: int
             The averaging window size used to calculate the parameters.
         """
-        for i, sasm in enumerate(sub_sasm_list):
-            sasm.scale(self._scale_factor)
-            sasm.offset(self._offset_value)
+        mean_i, total_i, I_of_q, qrange_I = self._updateProfiles(None,
+            sub_sasm_list, self._bc_sub_q_range)
 
-            if self._bc_sub_q_range is not None:
-                sasm.setQrange((self._bc_sub_q_range[0], self._bc_sub_q_range[1]+1))
+        n_keep = max(len(self.baseline_subtracted_sasm_list) - window_size, 0)
 
-        self.baseline_subtracted_sasm_list = self.baseline_subtracted_sasm_list[:-window_size] + sub_sasm_list
-        self.use_baseline_subtracted_sasm = self.use_baseline_subtracted_sasm[:-window_size] + use_sasm_list
+        self.baseline_subtracted_sasm_list = _replaceProfiles(self.baseline_subtracted_sasm_list,
+            n_keep, sub_sasm_list)
+        self.use_baseline_subtracted_sasm = list(self.use_baseline_subtracted_sasm[:n_keep]) + list(use_sasm_list)
 
-        self.mean_i_bcsub = np.concatenate((self.mean_i_bcsub[:-window_size],
-            np.array([sasm.getMeanI() for sasm in sub_sasm_list])))
-        self.total_i_bcsub = np.concatenate((self.total_i_bcsub[:-window_size],
-            np.array([sasm.getTotalI() for sasm in sub_sasm_list])))
+        self.mean_i_bcsub = np.concatenate((self.mean_i_bcsub[:n_keep], mean_i))
+        self.total_i_bcsub = np.concatenate((self.total_i_bcsub[:n_keep], total_i))
 
-        if self.qref>0:
-            I_of_q_bcsub = np.array([sasm.getIofQ(self.qref) for sasm in sub_sasm_list])
-            self.I_of_q_bcsub = np.concatenate((self.I_of_q_bcsub[:-window_size],
-                I_of_q_bcsub))
+        if I_of_q is not None:
+            self.I_of_q_bcsub = np.concatenate((self.I_of_q_bcsub[:n_keep],
+                I_of_q))
 
-        if self.qrange != (0,0):
-            qrange_I_bcsub = np.array([sasm.getIofQRange(self.qrange[0], self.qrange[1]) for sasm in sub_sasm_list])
-            self.qrange_I_bcsub = np.concatenate((self.qrange_I_bcsub[:-window_size],
-                qrange_I_bcsub))
+        if qrange_I is not None:
+            self.qrange_I_bcsub = np.concatenate((self.qrange_I_bcsub[:n_keep],
+                qrange_I))